@@ -0,0 +1,349 @@
+"""HTTP hot-path benchmark (listing, search, upload, download, zip, WebSocket).
+
+一時ディレクトリの DATA_DIR / DB に合成データ (ユーザー・フォルダ・ファイル) を入れて
+``create_app()`` を起動し、ファイル一覧・検索・アップロード (通常 / 分割)・ダウンロード
+(全体 / Range)・ZIP・WebSocket の一斉配信について、スループットと p50 / p99 を JSON で出力する。
+コミット間で結果を比べられるよう、現在のコミットと seed の条件も含める。
+
+Gemini はスタブのクライアントに、Google Drive のクライアントはネットワークに出ない
+モジュールに差し替え、Discord の Bot は渡さない。ログインはセッション Cookie を
+直接作って済ませるので、計測対象のリクエストは本番と同じミドルウェアを通る。
+
+    python benchmarks/bench_http.py --files 10000 --requests 200 --concurrency 8 > result.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from bench_templates import summarize  # noqa: E402
+
+BENCH_DISCORD_ID = 1001
+CSRF = "bench-csrf"
+WORDS = ("report", "budget", "meeting", "invoice", "holiday", "design", "roadmap", "会議資料")
+
+
+def git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_env(data_dir: Path) -> None:
+    """``web.app`` を import する前に呼ぶ (設定は import 時に読まれる)。"""
+    os.environ["DATA_DIR"] = str(data_dir)
+    os.environ["DB_PATH"] = str(data_dir / "bench.db")
+    os.environ.setdefault("STATIC_DIR", str(ROOT / "web" / "static"))
+    os.environ.setdefault("TEMPLATE_DIR", str(ROOT / "web" / "templates"))
+    os.environ.setdefault(
+        "COOKIE_SECRET", base64.urlsafe_b64encode(os.urandom(32)).decode()
+    )
+    # 計測が流量制限や空き容量の下限に引っかからないようにする
+    for key in ("RATE_LIMIT_DEFAULT", "RATE_LIMIT_LOGIN", "RATE_LIMIT_ZIP"):
+        os.environ[key] = "1000000000/1"
+    for key in ("RATE_LIMIT_UPLOAD_BYTES", "RATE_LIMIT_DOWNLOAD_BYTES"):
+        os.environ[key] = f"{1 << 50}/1"
+    os.environ["MIN_FREE_DISK_BYTES"] = "0"
+    # スタブの Gemini に対してはレート制限で待たない
+    os.environ["GEMINI_RPM"] = "1000000"
+    os.environ["GEMINI_BURST"] = "1000000"
+    os.environ.pop("GEMINI_API_KEY", None)
+
+
+def install_stubs() -> None:
+    """Gemini と Google Drive をネットワークに出ないものに差し替える。"""
+    from bot import auto_tag
+
+    class StubModel:
+        def generate_content(self, payload):
+            return types.SimpleNamespace(text="bench, stub")
+
+    auto_tag.set_client(StubModel())
+
+    drive = types.ModuleType("integrations.google_drive_client")
+
+    def offline(*args, **kwargs):
+        raise RuntimeError("Google Drive is stubbed out in benchmarks")
+
+    for name in (
+        "build_flow", "upload_file_resumable", "download_to_path", "get_file_info",
+        "list_files", "search_files", "download_file",
+    ):
+        setattr(drive, name, offline)
+    sys.modules["integrations.google_drive_client"] = drive
+
+
+def session_cookie(secret: str) -> str:
+    """``EncryptedCookieStorage`` と同じ形式のログイン済みセッション Cookie。"""
+    from cryptography.fernet import Fernet
+
+    data = {"created": int(time.time()), "session": {"user_id": BENCH_DISCORD_ID, "csrf_token": CSRF}}
+    return Fernet(secret.encode()).encrypt(json.dumps(data).encode()).decode()
+
+
+def seed(db_path: Path, data_dir: Path, users: int, folders: int, files: int, zip_files: int) -> dict:
+    """合成データを直接 SQLite に入れる (集計・変更履歴・検索索引はトリガーで作られる)。"""
+    blob = data_dir / "blob.bin"
+    blob.write_bytes(os.urandom(64 << 10))
+    big = data_dir / "download.bin"
+    big.write_bytes(os.urandom(8 << 20))
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO users(discord_id, username, pw_hash, created_at) VALUES (?,?,?,?)",
+            [(BENCH_DISCORD_ID + i, f"user{i}", "x", now) for i in range(users)],
+        )
+        owner = conn.execute("SELECT id FROM users WHERE discord_id=?", (BENCH_DISCORD_ID,)).fetchone()[0]
+        folder_ids = []
+        for i in range(folders):
+            # 半分は 1 つ前のフォルダの子にして階層を作る
+            parent = folder_ids[-1] if folder_ids and i % 2 else None
+            cur = conn.execute(
+                "INSERT INTO user_folders(user_id, name, parent_id) VALUES (?,?,?)",
+                (owner, f"folder{i}", parent),
+            )
+            folder_ids.append(cur.lastrowid)
+        targets = [""] + [str(f) for f in folder_ids]
+
+        def rows():
+            for i in range(files):
+                word = WORDS[i % len(WORDS)]
+                yield (
+                    f"f{i:07d}", owner, targets[i % len(targets)], str(blob),
+                    f"{word}_{i}.pdf", 64 << 10, "0" * 64, now, f"{word}, bench",
+                )
+
+        conn.executemany(
+            "INSERT INTO files(id, user_id, folder, path, original_name, size, sha256, uploaded_at, tags)"
+            " VALUES (?,?,?,?,?,?,?,?,?)",
+            rows(),
+        )
+        conn.execute(
+            "INSERT INTO files(id, user_id, folder, path, original_name, size, sha256, uploaded_at)"
+            " VALUES ('download', ?, '', ?, 'download.bin', ?, ?, ?)",
+            (owner, str(big), 8 << 20, "0" * 64, now),
+        )
+        shared = conn.execute("INSERT INTO shared_folders(name) VALUES ('bench')").lastrowid
+        conn.execute(
+            "INSERT INTO shared_folder_members(folder_id, discord_user_id) VALUES (?,?)",
+            (shared, BENCH_DISCORD_ID),
+        )
+        zip_dir = data_dir / "zip"
+        zip_dir.mkdir(exist_ok=True)
+        for i in range(zip_files):
+            p = zip_dir / f"z{i}"
+            p.write_bytes(os.urandom(256 << 10))
+            conn.execute(
+                "INSERT INTO shared_files(id, folder_id, file_name, path, size, is_shared, uploaded_at)"
+                " VALUES (?,?,?,?,?,0,?)",
+                (f"z{i}", shared, f"z{i}.bin", str(p), 256 << 10, now),
+            )
+    conn.close()
+    return {"folders": targets, "shared_folder": shared}
+
+
+async def measure(fn, n: int, concurrency: int, nbytes: int = 0) -> dict:
+    """``fn(i)`` を ``concurrency`` 並列で ``n`` 回呼び、分布とスループットを返す。"""
+    samples: list[float] = []
+    counter = iter(range(n))
+
+    async def worker():
+        for i in counter:
+            t = time.perf_counter()
+            await fn(i)
+            samples.append(time.perf_counter() - t)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    wall = time.perf_counter() - start
+    result = {**summarize(samples), "rps": round(n / wall, 2)}
+    if nbytes:
+        result["mb_per_s"] = round(nbytes * n / wall / (1 << 20), 2)
+    return result
+
+
+async def run(args, wa, seeded: dict) -> dict:
+    from aiohttp import FormData
+    from aiohttp.test_utils import TestClient, TestServer
+
+    app = wa.create_app()
+    headers = {"Cookie": f"wdsid={session_cookie(wa.COOKIE_SECRET)}", "X-CSRF-Token": CSRF}
+    results: dict = {}
+    async with TestClient(TestServer(app), headers=headers) as client:
+
+        async def get(url: str, expect=(200,), **kw) -> bytes:
+            async with client.get(url, **kw) as r:
+                body = await r.read()
+                if r.status not in expect:
+                    raise RuntimeError(f"GET {url}: {r.status} {body[:200]!r}")
+                return body
+
+        folders = seeded["folders"]
+        pages = max(1, args.files // len(folders) // wa.FILES_PER_PAGE)
+
+        async def listing(i):
+            await get(f"/partial/files?folder={folders[i % len(folders)]}&page={i // len(folders) % pages + 1}")
+
+        results["partial_files"] = await measure(listing, args.requests, args.concurrency)
+        results["partial_files_repeat"] = await measure(
+            lambda i: get(f"/partial/files?folder={folders[0]}"), args.requests, args.concurrency
+        )
+        results["search"] = await measure(
+            lambda i: get(f"/search?q={WORDS[i % len(WORDS)]}"), args.requests, args.concurrency
+        )
+
+        for size in args.upload_sizes:
+            payload = os.urandom(size)
+
+            async def upload(i):
+                form = FormData()
+                form.add_field("file", payload, filename=f"up{i}.bin")
+                async with client.post("/upload", data=form) as r:
+                    if r.status != 200:
+                        raise RuntimeError(f"upload: {r.status} {await r.text()}")
+
+            async def chunked(i):
+                uid = f"bench-{size}-{i}-{time.monotonic_ns()}"
+                chunks = [payload[o:o + args.chunk_size] for o in range(0, size, args.chunk_size)]
+                for idx, chunk in enumerate(chunks):
+                    form = FormData()
+                    form.add_field("file", chunk, filename=f"chunked{i}.bin")
+                    h = {
+                        "X-Upload-Id": uid,
+                        "X-Chunk-Index": str(idx),
+                        "X-Last-Chunk": "1" if idx == len(chunks) - 1 else "0",
+                    }
+                    async with client.post("/upload_chunked", data=form, headers=h) as r:
+                        if r.status != 200:
+                            raise RuntimeError(f"upload_chunked: {r.status} {await r.text()}")
+
+            results[f"upload_{size}"] = await measure(upload, args.uploads, args.concurrency, size)
+            results[f"upload_chunked_{size}"] = await measure(chunked, args.uploads, args.concurrency, size)
+
+        token = wa._sign_token("download", int(time.time()) + 3600)
+        size = 8 << 20
+        results["download"] = await measure(
+            lambda i: get(f"/download/{token}"), args.downloads, args.concurrency, size
+        )
+        results["download_range"] = await measure(
+            lambda i: get(
+                f"/download/{token}",
+                expect=(206,),
+                headers={"Range": f"bytes={(i * 65536) % (size - 65536)}-{(i * 65536) % (size - 65536) + 65535}"},
+            ),
+            args.requests,
+            args.concurrency,
+            65536,
+        )
+        results["zip"] = await measure(
+            lambda i: get(f"/zip/{seeded['shared_folder']}"),
+            args.zips,
+            min(args.concurrency, 2),
+            args.zip_files * (256 << 10),
+        )
+        results["ws_fanout"] = await ws_fanout(client, app, args.ws_clients, args.ws_messages)
+    # on_cleanup は DB を閉じないので、接続スレッドが残って終了できなくならないよう閉じる
+    await app["db"].close()
+    return results
+
+
+async def ws_fanout(client, app, clients: int, messages: int) -> dict:
+    """``clients`` 本の接続へ ``broadcast_ws`` し、全員に届くまでの時間を測る。"""
+    sockets = [await client.ws_connect("/ws") for _ in range(clients)]
+    while len(app["websockets"]) < clients:
+        await asyncio.sleep(0.01)
+    all_received: list[float] = []
+    per_client: list[float] = []
+    for seq in range(messages):
+        start = time.perf_counter()
+
+        async def receive(ws):
+            msg = await ws.receive_json()
+            assert msg["seq"] == seq
+            per_client.append(time.perf_counter() - start)
+
+        waiting = [asyncio.create_task(receive(ws)) for ws in sockets]
+        await app["broadcast_ws"]({"action": "bench", "seq": seq})
+        await asyncio.gather(*waiting)
+        all_received.append(time.perf_counter() - start)
+    for ws in sockets:
+        await ws.close()
+    return {"clients": clients, "all_received": summarize(all_received), "per_client": summarize(per_client)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--folders", type=int, default=50)
+    parser.add_argument("--files", type=int, default=10_000, help="10k〜1M 程度を想定")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--upload-sizes", type=lambda s: [int(x) for x in s.split(",")],
+        default=[64 << 10, 1 << 20, 16 << 20],
+    )
+    parser.add_argument("--uploads", type=int, default=10, help="大きさごとの回数")
+    parser.add_argument("--chunk-size", type=int, default=1 << 20)
+    parser.add_argument("--downloads", type=int, default=20)
+    parser.add_argument("--zip-files", type=int, default=20)
+    parser.add_argument("--zips", type=int, default=5)
+    parser.add_argument("--ws-clients", type=int, default=100)
+    parser.add_argument("--ws-messages", type=int, default=50)
+    args = parser.parse_args()
+
+    data_dir = Path(tempfile.mkdtemp(prefix="wds-bench-"))
+    prepare_env(data_dir)
+    install_stubs()
+
+    import web.app as wa
+    from bot.db import init_db
+
+    t = time.perf_counter()
+    asyncio.run(init_db(wa.DB_PATH))
+    seeded = seed(wa.DB_PATH, data_dir, args.users, args.folders, args.files, args.zip_files)
+    seed_s = time.perf_counter() - t
+
+    try:
+        results = asyncio.run(run(args, wa, seeded))
+    finally:
+        # アップロードで数百 MB になることがあるので残さない
+        shutil.rmtree(data_dir, ignore_errors=True)
+    out = {
+        "benchmark": "http",
+        "commit": git_commit(),
+        "seed": {
+            "users": args.users,
+            "folders": args.folders,
+            "files": args.files,
+            "seconds": round(seed_s, 2),
+        },
+        "concurrency": args.concurrency,
+        "results": results,
+    }
+    json.dump(out, sys.stdout, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
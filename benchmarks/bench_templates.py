@@ -0,0 +1,155 @@
+"""Template cold-start and render latency benchmark.
+
+起動時のテンプレート読み込み (バイトコードキャッシュ無し / 有り) と、
+ファイル一覧の部分テンプレートの描画時間 (p50 / p99) を計測して JSON で出力する。
+比較用に、従来の設定 (auto_reload 有効・バイトコードキャッシュ無し) の環境でも同じ描画を測る。
+
+    python benchmarks/bench_templates.py --renders 1000 --files 90 > result.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+MOBILE_UA = "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) Mobile/15E148"
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        "n": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 4),
+        "p99_ms": round(percentile(samples, 99) * 1000, 4),
+        "max_ms": round(max(samples) * 1000, 4),
+    }
+
+
+def synthetic_files(n: int) -> list[dict]:
+    files = []
+    for i in range(n):
+        kind = ("image/png", "video/mp4", "application/pdf", "text/plain")[i % 4]
+        files.append(
+            {
+                "id": f"f{i:06d}",
+                "original_name": f"file_{i}.{kind.split('/')[1]}",
+                "size": 1024 * (i + 1),
+                "mime": kind,
+                "is_image": kind.startswith("image/"),
+                "is_video": kind.startswith("video/"),
+                "tags": "会議, budget",
+                "is_shared": i % 3 == 0,
+                "share_url": f"https://example.com/f/tok{i}",
+                "download_path": f"/download/tok{i}",
+                "url": f"https://example.com/download/tok{i}",
+                "preview_url": f"/previews/f{i:06d}.jpg",
+                "hls_url": None,
+                "user_id": 1,
+                "expiration": 3600,
+                "expiration_str": "1時間",
+            }
+        )
+    return files
+
+
+def time_renders(env, name: str, ctx: dict, renders: int) -> list[float]:
+    samples = []
+    for _ in range(renders):
+        t = time.perf_counter()
+        env.get_template(name).render(ctx)
+        samples.append(time.perf_counter() - t)
+    return samples
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--renders", type=int, default=500)
+    parser.add_argument("--files", type=int, default=90)
+    args = parser.parse_args()
+
+    data_dir = Path(tempfile.mkdtemp(prefix="wds-bench-"))
+    os.environ["DATA_DIR"] = str(data_dir)
+    os.environ.setdefault("STATIC_DIR", str(ROOT / "web" / "static"))
+    os.environ.setdefault("TEMPLATE_DIR", str(ROOT / "web" / "templates"))
+    os.environ.setdefault(
+        "COOKIE_SECRET", base64.urlsafe_b64encode(os.urandom(32)).decode()
+    )
+    sys.path.insert(0, str(ROOT))
+
+    import aiohttp_jinja2
+    import web.app as wa
+
+    # 1 回目はバイトコードキャッシュが空、2 回目はディスク上のキャッシュを使う
+    t = time.perf_counter()
+    wa.create_app()
+    cold = time.perf_counter() - t
+    t = time.perf_counter()
+    app = wa.create_app()
+    warm = time.perf_counter() - t
+
+    env = aiohttp_jinja2.get_env(app)
+    t = time.perf_counter()
+    legacy = env.overlay(auto_reload=True, bytecode_cache=None, cache_size=400)
+    loaded = sum(1 for n in env.list_templates(extensions=["html"]) if legacy.get_template(n))
+    parse_only = time.perf_counter() - t
+
+    ctx = {
+        "files": synthetic_files(args.files),
+        "csrf_token": "bench",
+        "user_id": 1,
+        "page": 1,
+        "has_next": True,
+        "folder_id": "",
+        "tag_filter": [],
+        "tag_mode": "and",
+    }
+    name = "partials/file_table.html"
+    tuned = time_renders(env, name, ctx, args.renders)
+    baseline = time_renders(legacy, name, ctx, args.renders)
+
+    mobile = wa._is_mobile
+    samples = []
+    for _ in range(args.renders):
+        t = time.perf_counter()
+        mobile(MOBILE_UA)
+        samples.append(time.perf_counter() - t)
+    uncached = []
+    for _ in range(args.renders):
+        t = time.perf_counter()
+        mobile.__wrapped__(MOBILE_UA)
+        uncached.append(time.perf_counter() - t)
+
+    result = {
+        "benchmark": "templates",
+        "templates": loaded,
+        "startup": {
+            "create_app_cold_s": round(cold, 4),
+            "create_app_warm_bytecode_s": round(warm, 4),
+            "parse_all_without_cache_s": round(parse_only, 4),
+        },
+        "render": {
+            "template": name,
+            "files": args.files,
+            "production": summarize(tuned),
+            "auto_reload_no_bytecode": summarize(baseline),
+        },
+        "is_mobile": {"cached": summarize(samples), "uncached": summarize(uncached)},
+    }
+    json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,68 @@
 from __future__ import annotations
 
-"""Automatic tagging with Gemini AI."""
+"""Automatic tagging with a local engine and optional Gemini enrichment."""
 
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence
 import base64
+import codecs
+import hashlib
 import io
+import json
 import mimetypes
+import multiprocessing
 import os
+import re
+import sqlite3
+import subprocess
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zipfile
 
 import google.generativeai as genai
 from google.generativeai import GenerationConfig
 from PyPDF2 import PdfReader
 from PIL import Image, UnidentifiedImageError
-from docx import Document
-from pptx import Presentation
 from openpyxl import load_workbook
 
 # Gemini へ送信するテキストの最大長
 MAX_TAG_SOURCE_LENGTH = 2000
 
+# MIME 不明のファイルがテキストかどうかを判定する際に読む先頭バイト数
+SNIFF_BYTES = 8192
+
+# 画像や PDF をそのまま Gemini に送る場合の上限 (インラインデータの制限)
+INLINE_MAX_BYTES = 20 * 1024 * 1024
+
+# プロンプトやモデルを変更したら上げる。キャッシュのキーに含まれる
+TAGGER_VERSION = "gemini-2.0-flash:1"
+
+# まとめて 1 回のプロンプトで処理する小さなテキスト文書の条件
+BATCH_TEXT_MAX_BYTES = 16 * 1024
+BATCH_MAX_DOCS = 8
+
+# Gemini API 呼び出しのレート (1 分あたり) とバースト許容量
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", 15))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", 5))
+
+TEXT_PROMPT = (
+    "以下のテキストから重要と思われるキーワードを5個抽出し、"
+    "カンマ区切りで出力してください:\n"
+)
+BATCH_PROMPT_HEAD = "以下の複数の文書それぞれについて"
+
+# Gemini がサポートしていない ZIP と、セキュリティ上扱わない実行ファイル
+_SKIP_MIMES = {
+    "application/zip",
+    "application/x-msdos-program",
+    "application/x-msdownload",
+}
+
 # 処理対象とする拡張子一覧
 SUPPORTED_EXTENSIONS = {
     ".txt",
@@ -33,11 +77,191 @@ SUPPORTED_EXTENSIONS = {
     ".png",
     ".jpg",
     ".jpeg",
+    ".webp",
+    ".mp4",
+    ".mov",
+    ".mkv",
+    ".webm",
+    ".mp3",
+    ".m4a",
+    ".wav",
+    ".flac",
+    ".ogg",
 }
 
 
-def generate_tags(file_path: Path, original_name: str | None = None) -> str:
-    """Analyze the file and return comma separated tags using Gemini.
+class TokenBucket:
+    """スレッドセーフなトークンバケット。
+
+    ``rate`` 個/秒でトークンが補充され、最大 ``capacity`` 個まで貯まる。
+    ``acquire`` はトークンが得られるまで呼び出しスレッドを待機させる。
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._stamp) * self.rate
+                )
+                self._stamp = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class TagCache:
+    """SHA-256 とタガーのバージョンをキーにしたタグキャッシュ。
+
+    ``path`` を指定すると SQLite に永続化し、未指定ならメモリ上の LRU のみ。
+    """
+
+    def __init__(self, path: Optional[Path] = None, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._mem: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        if path:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(path), check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tag_cache ("
+                " sha256 TEXT NOT NULL, version TEXT NOT NULL, tags TEXT NOT NULL,"
+                " created_at INTEGER NOT NULL, PRIMARY KEY(sha256, version))"
+            )
+            self._conn.commit()
+
+    def get(self, digest: str, version: Optional[str] = None) -> Optional[str]:
+        key = (digest, version or TAGGER_VERSION)
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                return self._mem[key]
+            if self._conn is None:
+                return None
+            row = self._conn.execute(
+                "SELECT tags FROM tag_cache WHERE sha256=? AND version=?", key
+            ).fetchone()
+            if row is None:
+                return None
+            self._remember(key, row[0])
+            return row[0]
+
+    def put(self, digest: str, tags: str, version: Optional[str] = None) -> None:
+        key = (digest, version or TAGGER_VERSION)
+        with self._lock:
+            self._remember(key, tags)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO tag_cache VALUES (?, ?, ?, ?)",
+                    (*key, tags, int(time.time())),
+                )
+                self._conn.commit()
+
+    def _remember(self, key: tuple[str, str], tags: str) -> None:
+        self._mem[key] = tags
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+
+class FakeTagClient:
+    """Gemini の代わりに使えるローカルクライアント (テスト・ベンチマーク用)。
+
+    ``generate_content`` は ``tags`` を返し、呼び出し内容を ``calls`` に残す。
+    バッチ用プロンプトには JSON で応答する。
+    """
+
+    def __init__(self, tags: str = "tagA, tagB"):
+        self.tags = tags
+        self.calls: list[Any] = []
+
+    def generate_content(self, payload: Any):
+        self.calls.append(payload)
+        text = self.tags
+        if isinstance(payload, str) and payload.startswith(BATCH_PROMPT_HEAD):
+            count = len(re.findall(r"^### \d+$", payload, re.M))
+            text = json.dumps({str(i + 1): self.tags for i in range(count)})
+        return type("FakeResponse", (), {"text": text})()
+
+
+_client_override: Any = None
+_model_state: Optional[tuple[Any, str, Any]] = None
+_model_lock = threading.Lock()
+_cache = TagCache()
+_bucket = TokenBucket(GEMINI_RPM / 60.0, GEMINI_BURST)
+
+
+def set_client(client: Any) -> None:
+    """タグ生成に使うクライアントを差し替える。``None`` で Gemini に戻す。"""
+    global _client_override
+    _client_override = client
+
+
+def configure_cache(path: Optional[Path]) -> None:
+    """タグキャッシュの保存先を設定する。``None`` ならメモリのみ。"""
+    global _cache
+    _cache = TagCache(path)
+
+
+def get_client() -> Any:
+    """設定済みの GenerativeModel を返す。API キーが変わらない限り再利用する。"""
+    global _model_state
+    if _client_override is not None:
+        return _client_override
+    api_key = os.getenv("GEMINI_API_KEY", "")
+    with _model_lock:
+        state = _model_state
+        if state and state[0] is genai and state[1] == api_key:
+            return state[2]
+        # API キー設定＆モデル準備（温度や出力トークン数もここでまとめて指定）
+        genai.configure(api_key=api_key)
+        gen_cfg = GenerationConfig(
+            temperature=0.2,
+            max_output_tokens=256,
+        )
+        model = genai.GenerativeModel(
+            "gemini-2.0-flash",
+            generation_config=gen_cfg,
+        )
+        _model_state = (genai, api_key, model)
+        return model
+
+
+def _generate(model: Any, payload: Any) -> str:
+    """レート制限を守って 1 回 API を呼び出す。"""
+    _bucket.acquire()
+    resp = model.generate_content(payload)
+    return resp.text.strip()
+
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def generate_tags(
+    file_path: Path, original_name: str | None = None, sha256: str | None = None
+) -> str:
+    """Analyze the file and return comma separated tags.
+
+    ファイルの種類ごとに ``ENGINE_ROUTES`` で選ばれたエンジンを順に実行し、
+    結果をまとめる。既定ではローカルエンジンが必ず動き、Gemini は
+    API キーがある場合だけ補完として呼ばれる。
+    同一内容のファイルは SHA-256 をキーにしたキャッシュから返すため、
+    再アップロードではエンジンを呼び出さない。
 
     Parameters
     ----------
@@ -46,176 +270,649 @@ def generate_tags(file_path: Path, original_name: str | None = None) -> str:
     original_name:
         元のファイル名。拡張子を保持していない場合に MIME 判定へ
         利用します。
+    sha256:
+        計算済みのハッシュ値。省略時はファイルから計算します。
     """
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        return ""
-
     ext = Path(original_name or file_path).suffix.lower()
     if ext not in SUPPORTED_EXTENSIONS:
         return ""
 
-    # API キー設定＆モデル準備（温度や出力トークン数もここでまとめて指定）
-    genai.configure(api_key=api_key)
-    gen_cfg = GenerationConfig(
-        temperature=0.2,
-        max_output_tokens=256,
-    )
-    model = genai.GenerativeModel(
-        "gemini-2.0-flash",
-        generation_config=gen_cfg,
-    )
+    engines = _engines_for(file_kind(file_path, original_name))
+    if not engines:
+        return ""
 
     # ファイルサイズが 500MB 以上ならタグ付けをスキップ
     try:
         if file_path.stat().st_size >= 500_000_000:
             return ""
+        digest = sha256 or _file_sha256(file_path)
     except Exception:
         return ""
 
-    # ファイル読み込み
-    mime, _ = mimetypes.guess_type(original_name or str(file_path))
-    try:
-        data = file_path.read_bytes()
-    except Exception:
-        return ""
+    version = _cache_version(engines)
+    cached = _cache.get(digest, version)
+    if cached is not None:
+        return cached
+    tags = _merge_tags(_run_tagger(t, file_path, original_name) for t in engines)
+    if tags:
+        _cache.put(digest, tags, version)
+    return tags
 
-    if not mime:
-        mime = "application/octet-stream"
 
-    # 1) プレーンテキスト処理
-    if mime and mime.startswith("text"):
-        text = data.decode(errors="ignore")
-        prompt = (
-            "以下のテキストから重要と思われるキーワードを5個抽出し、"
-            "カンマ区切りで出力してください:\n" + text[:MAX_TAG_SOURCE_LENGTH]
-        )
-        resp = model.generate_content(prompt)
-        return resp.text.strip()
+def generate_tags_batch(
+    items: Sequence[tuple[Path, Optional[str]]],
+    digests: Optional[Sequence[Optional[str]]] = None,
+) -> list[str]:
+    """複数ファイルのタグをまとめて生成する。
 
-    # 2) PDF はテキスト抽出を試み、失敗時はバイナリ解析
-    if mime == "application/pdf":
-        try:
-            reader = PdfReader(str(file_path))
-            pages = [p.extract_text() or "" for p in reader.pages]
-        except Exception:
-            return ""
-        full_text = "\n".join(pages)
-        if not full_text.strip():
-            b64 = base64.b64encode(data).decode()
-            prompt = (
-                "与えられたPDFの内容を解析し、関連するキーワードを5個"
-                " 日本語で抽出してカンマ区切りで返してください。"
-            )
-            resp = model.generate_content([
-                {"mime_type": "application/pdf", "data": b64},
-                {"text": prompt},
-            ])
-            return resp.text.strip()
-        prompt = (
-            "以下のPDF本文から重要と思われるキーワードを5個抽出し、"
-            "カンマ区切りで出力してください:\n" + full_text[:MAX_TAG_SOURCE_LENGTH]
-        )
-        resp = model.generate_content(prompt)
-        return resp.text.strip()
+    Gemini を使う小さなテキスト文書は ``BATCH_MAX_DOCS`` 件ずつ 1 つの
+    プロンプトにまとめ、それ以外は :func:`generate_tags` で個別に処理する。
+    ``digests`` には計算済みの SHA-256 を ``items`` と同じ順序で渡せる。
+    戻り値は ``items`` と同じ順序のタグ文字列のリスト。
+    """
+    results = [""] * len(items)
 
-    # 2-2) Office 系ファイルはテキストへ変換して解析
-    if mime == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+    batch: list[tuple[int, str, str, str, Any]] = []
+    for i, (path, name) in enumerate(items):
+        engines = _engines_for(file_kind(path, name))
+        if not engines:
+            continue
         try:
-            doc = Document(str(file_path))
-            full_text = "\n".join(p.text for p in doc.paragraphs)
+            size = path.stat().st_size
+            digest = (digests and digests[i]) or _file_sha256(path)
         except Exception:
-            return ""
-        prompt = (
-            "以下の文書から重要と思われるキーワードを5個抽出し、"
-            "カンマ区切りで出力してください:\n" + full_text[:MAX_TAG_SOURCE_LENGTH]
-        )
-        resp = model.generate_content(prompt)
-        return resp.text.strip()
+            continue
+        version = _cache_version(engines)
+        cached = _cache.get(digest, version)
+        if cached is not None:
+            results[i] = cached
+            continue
+        text = None
+        if "gemini" in [t.name for t in engines] and size <= BATCH_TEXT_MAX_BYTES:
+            text = _read_small_text(path, name)
+        if text is None:
+            results[i] = generate_tags(path, name, sha256=digest)
+        elif text.strip():
+            # ローカルエンジンはプロセスプールで並行に走らせておく
+            local = [t.submit(path, name) for t in engines if t.name != "gemini"]
+            batch.append((i, digest, text, version, local))
 
-    if mime == "application/vnd.openxmlformats-officedocument.presentationml.presentation":
+    for start in range(0, len(batch), BATCH_MAX_DOCS):
+        chunk = batch[start : start + BATCH_MAX_DOCS]
         try:
-            pres = Presentation(str(file_path))
-            texts: list[str] = []
-            for slide in pres.slides:
-                for shape in slide.shapes:
-                    if hasattr(shape, "text"):
-                        texts.append(shape.text)
+            remote = _tag_texts([text for _, _, text, _, _ in chunk])
         except Exception:
-            return ""
-        full_text = "\n".join(texts)
-        prompt = (
-            "以下のプレゼンテーションから重要と思われるキーワードを5個抽出し、"
-            "カンマ区切りで出力してください:\n" + full_text[:MAX_TAG_SOURCE_LENGTH]
-        )
-        resp = model.generate_content(prompt)
-        return resp.text.strip()
+            remote = [""] * len(chunk)
+        for (i, digest, _, version, local), tags in zip(chunk, remote):
+            found = [_wait_local(f) for f in local]
+            results[i] = _merge_tags([*found, _split_tags(tags)])
+            if results[i]:
+                _cache.put(digest, results[i], version)
+    return results
 
-    if mime == "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet":
-        try:
-            wb = load_workbook(file_path, data_only=True)
-            texts: list[str] = []
-            for ws in wb.worksheets:
-                for row in ws.iter_rows(values_only=True):
-                    texts.append(" ".join(str(c) for c in row if c is not None))
-        except Exception:
-            return ""
-        full_text = "\n".join(texts)
-        prompt = (
-            "以下の表計算シートから重要と思われるキーワードを5個抽出し、"
-            "カンマ区切りで出力してください:\n" + full_text[:MAX_TAG_SOURCE_LENGTH]
-        )
-        resp = model.generate_content(prompt)
-        return resp.text.strip()
 
-    # 2-3) Gemini がサポートしていない ZIP ファイルはタグ生成をスキップ
-    if mime == "application/zip":
+def _read_small_text(path: Path, name: Optional[str]) -> Optional[str]:
+    """テキストとして扱える小さなファイルなら内容を返す。"""
+    ext = Path(name or path).suffix.lower()
+    if ext not in SUPPORTED_EXTENSIONS:
+        return None
+    mime, _ = mimetypes.guess_type(name or str(path))
+    if not (mime and mime.startswith("text")):
+        return None
+    try:
+        data = _read_head(path, BATCH_TEXT_MAX_BYTES)
+    except Exception:
+        return None
+    if b"\x00" in data:
+        return None
+    return data.decode(errors="ignore")
+
+
+def _tag_texts(texts: list[str]) -> list[str]:
+    """テキストのリストを 1 回の API 呼び出しでタグ付けする。"""
+    model = get_client()
+    if len(texts) == 1:
+        return [_generate(model, TEXT_PROMPT + texts[0][:MAX_TAG_SOURCE_LENGTH])]
+    parts = [
+        BATCH_PROMPT_HEAD + "重要と思われるキーワードを5個抽出し、"
+        '文書番号をキー、カンマ区切りのキーワードを値とする JSON オブジェクト'
+        '(例: {"1": "a, b"}) のみを出力してください。'
+    ]
+    for n, text in enumerate(texts, 1):
+        parts.append(f"### {n}\n{text[:MAX_TAG_SOURCE_LENGTH]}")
+    raw = _generate(model, "\n".join(parts))
+    raw = re.sub(r"^```(?:json)?\s*|\s*```$", "", raw.strip())
+    try:
+        data = json.loads(raw)
+        tags = [str(data.get(str(n), "")).strip() for n in range(1, len(texts) + 1)]
+    except (ValueError, AttributeError):
+        tags = [""] * len(texts)
+    # 応答が欠けていた文書だけ個別に再試行する
+    return [
+        t or _generate(model, TEXT_PROMPT + texts[n][:MAX_TAG_SOURCE_LENGTH])
+        for n, t in enumerate(tags)
+    ]
+
+
+# ── テキスト抽出 ──────────────────────────────
+# いずれの抽出器も ``limit`` 文字が集まった時点で読み込みを打ち切るため、
+# 数百ページの PDF や数万行の表でも先頭部分しか解析しない。
+
+_MIME_DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+_MIME_PPTX = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+_MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_A_NS = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+
+
+def _read_head(path: Path, size: int) -> bytes:
+    """ファイル先頭の ``size`` バイトだけを読み込む。"""
+    with path.open("rb") as f:
+        return f.read(size)
+
+
+def _collect(chunks: Iterable[str], limit: int) -> str:
+    """``chunks`` を改行で連結し、``limit`` 文字に達したら読むのをやめる。"""
+    parts: list[str] = []
+    total = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        parts.append(chunk)
+        total += len(chunk) + 1
+        if total >= limit:
+            break
+    return "\n".join(parts)[:limit]
+
+
+def _pdf_pages(path: Path) -> Iterator[str]:
+    # PdfReader はページを参照されるまで解析しない
+    for page in PdfReader(str(path)).pages:
+        yield page.extract_text() or ""
+
+
+def _xml_runs(zf: zipfile.ZipFile, member: str, text_tag: str, para_tag: str) -> Iterator[str]:
+    """OOXML パーツを逐次パースし、段落ごとのテキストを返す。"""
+    buf: list[str] = []
+    with zf.open(member) as fp:
+        for _, elem in ET.iterparse(fp, events=("end",)):
+            if elem.tag == text_tag:
+                buf.append(elem.text or "")
+            elif elem.tag == para_tag:
+                yield "".join(buf)
+                buf.clear()
+                elem.clear()
+
+
+def _docx_paragraphs(path: Path) -> Iterator[str]:
+    with zipfile.ZipFile(path) as zf:
+        yield from _xml_runs(zf, "word/document.xml", _W_NS + "t", _W_NS + "p")
+
+
+def _pptx_slides(path: Path) -> Iterator[str]:
+    with zipfile.ZipFile(path) as zf:
+        slides = [
+            n for n in zf.namelist() if re.fullmatch(r"ppt/slides/slide\d+\.xml", n)
+        ]
+        slides.sort(key=lambda n: int(re.search(r"(\d+)\.xml$", n).group(1)))
+        for name in slides:
+            yield from _xml_runs(zf, name, _A_NS + "t", _A_NS + "p")
+
+
+def _xlsx_rows(path: Path) -> Iterator[str]:
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            for row in ws.iter_rows(values_only=True):
+                yield " ".join(str(c) for c in row if c is not None)
+    finally:
+        wb.close()
+
+
+def _plain_text(path: Path, limit: int) -> str:
+    # UTF-8 は 1 文字最大 4 バイトなので limit * 4 バイト読めば足りる
+    return _read_head(path, limit * 4).decode(errors="ignore")[:limit]
+
+
+def _sniff_text(path: Path, limit: int) -> Optional[str]:
+    """MIME 不明のファイルを先頭だけ読み、UTF-8 テキストなら返す。"""
+    head = _read_head(path, SNIFF_BYTES)
+    if not head or b"\x00" in head:
+        return None
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+    except UnicodeDecodeError:
+        return None
+    return _plain_text(path, limit)
+
+
+_EXTRACTORS: dict[str, tuple[str, Callable[[Path], Iterable[str]]]] = {
+    "application/pdf": ("PDF本文", _pdf_pages),
+    _MIME_DOCX: ("文書", _docx_paragraphs),
+    _MIME_PPTX: ("プレゼンテーション", _pptx_slides),
+    _MIME_XLSX: ("表計算シート", _xlsx_rows),
+}
+
+
+def extract_text(
+    file_path: Path, original_name: str | None = None, limit: int | None = None
+) -> Optional[str]:
+    """ファイルから先頭 ``limit`` 文字までのテキストを抽出する。
+
+    テキストを取り出せない形式 (画像など) では ``None`` を返す。
+    ``limit`` の既定値は ``MAX_TAG_SOURCE_LENGTH``。
+    """
+    limit = limit or MAX_TAG_SOURCE_LENGTH
+    mime, _ = mimetypes.guess_type(original_name or str(file_path))
+    if mime and mime.startswith("text"):
+        return _plain_text(file_path, limit)
+    entry = _EXTRACTORS.get(mime or "")
+    if entry:
+        return _collect(entry[1](file_path), limit)
+    if mime in _SKIP_MIMES:
+        return None
+    return _sniff_text(file_path, limit)
+
+
+def _inline_part(file_path: Path, mime: str) -> Optional[dict[str, str]]:
+    """Gemini にそのまま送るバイナリを Base64 化する。大きすぎる場合は None。"""
+    if file_path.stat().st_size > INLINE_MAX_BYTES:
+        return None
+    data = file_path.read_bytes()
+    return {"mime_type": mime, "data": base64.b64encode(data).decode()}
+
+
+def _generate_tags_uncached(file_path: Path, original_name: str | None) -> str:
+    """キャッシュを介さずに Gemini でタグを生成する。"""
+    model = get_client()
+
+    mime, _ = mimetypes.guess_type(original_name or str(file_path))
+
+    # ZIP と実行ファイルはスキップ
+    if mime in _SKIP_MIMES:
         return ""
 
-    # 2-4) 実行ファイルはセキュリティ上スキップ
-    if mime in {"application/x-msdos-program", "application/x-msdownload"}:
+    # 1) テキスト・PDF・Office 系は先頭部分だけ抽出して解析
+    try:
+        text = extract_text(file_path, original_name)
+    except Exception:
         return ""
 
-    # 3) MIME 未判定だがテキストとして解釈できる場合
-    if b"\x00" not in data:
-        try:
-            text = data.decode()
-        except UnicodeDecodeError:
-            text = None
-        if text and text.strip():
-            prompt = (
-                "以下のテキストから重要と思われるキーワードを5個抽出し、"
-                "カンマ区切りで出力してください:\n" + text[:MAX_TAG_SOURCE_LENGTH]
-            )
-            resp = model.generate_content(prompt)
-            return resp.text.strip()
+    entry = _EXTRACTORS.get(mime or "")
+    if text and text.strip():
+        if entry is None:
+            return _generate(model, TEXT_PROMPT + text)
+        prompt = (
+            f"以下の{entry[0]}から重要と思われるキーワードを5個抽出し、"
+            "カンマ区切りで出力してください:\n" + text
+        )
+        return _generate(model, prompt)
+    if (mime and mime.startswith("text")) or (entry and mime != "application/pdf"):
+        return ""
 
-    # 4) 画像やその他バイナリ
-    if not mime or mime == "application/octet-stream":
-        # MIME が未判定の場合は画像として扱えるか試みる
-        try:
-            img = Image.open(file_path)
-            with io.BytesIO() as buf:
-                img.save(buf, format="PNG")
-                data = buf.getvalue()
+    # 2) テキストを持たない PDF や画像はバイナリのまま解析
+    try:
+        if not mime or mime == "application/octet-stream":
+            # MIME が未判定の場合は画像として扱えるか試みる
+            try:
+                with Image.open(file_path) as img:
+                    with io.BytesIO() as buf:
+                        img.save(buf, format="PNG")
+                        data = buf.getvalue()
+            except (UnidentifiedImageError, OSError):
+                # Gemini では application/octet-stream を受け付けないため
+                # 未対応ファイルはタグ生成をスキップする
+                return ""
+            if len(data) > INLINE_MAX_BYTES:
+                return ""
             mime = "image/png"
-        except (UnidentifiedImageError, OSError):
-            # Gemini では application/octet-stream を受け付けないため
-            # 未対応ファイルはタグ生成をスキップする
-            return ""
+            part = {"mime_type": mime, "data": base64.b64encode(data).decode()}
+        else:
+            part = _inline_part(file_path, mime)
+    except Exception:
+        return ""
+    if part is None:
+        return ""
 
-    b64 = base64.b64encode(data).decode()
     prompt = (
         f"与えられた {mime} の内容を解析し、関連するキーワードを5個"
         " 日本語で抽出してカンマ区切りで返してください。"
     )
-    resp = model.generate_content([
-        {
-            "mime_type": mime,  # サポートされている MIME タイプのみ送信
-            "data": b64,
-        },
+    return _generate(model, [
+        part,  # サポートされている MIME タイプのみ送信
         {
             "text": prompt,  # Part として扱われるプロンプト
         },
     ])
-    return resp.text.strip()
+
+
+# ── タグ付けエンジン ──────────────────────────
+# ``Tagger`` を継承したクラスを ``register_tagger`` で登録すると、
+# ``AUTO_TAG_ENGINES`` からファイルの種類ごとに選べるようになる。
+
+
+class Tagger(ABC):
+    """タグ付けエンジンの基底クラス。``tag`` を実装しないとインスタンスを作れない。"""
+
+    name = ""
+
+    def available(self) -> bool:
+        return True
+
+    @abstractmethod
+    def tag(self, file_path: Path, original_name: str | None) -> list[str]:
+        """ファイルのタグを返す。"""
+
+    def submit(self, file_path: Path, original_name: str | None) -> Future:
+        """``tag`` を実行し、結果を Future で返す。"""
+        return _completed(self.tag, file_path, original_name)
+
+
+def _completed(fn: Callable[..., list[str]], *args: Any) -> Future:
+    """``fn`` をこのスレッドで実行し、完了済みの Future を返す。"""
+    fut: Future = Future()
+    try:
+        fut.set_result(fn(*args))
+    except Exception as e:
+        fut.set_exception(e)
+    return fut
+
+
+class LocalTagger(Tagger):
+    """ネットワークを使わずにタグを生成するエンジン。プロセスプールで実行する。"""
+
+    name = "local"
+
+    def tag(self, file_path: Path, original_name: str | None) -> list[str]:
+        return _wait_local(self.submit(file_path, original_name))
+
+    def submit(self, file_path: Path, original_name: str | None) -> Future:
+        global _pool
+        pool = _local_pool()
+        if pool is None:
+            return _completed(local_tags, str(file_path), original_name)
+        try:
+            return pool.submit(local_tags, str(file_path), original_name)
+        except BrokenProcessPool:
+            # ワーカーが落ちた場合は作り直し、今回はこのスレッドで実行する
+            with _pool_lock:
+                _pool = None
+            return _completed(local_tags, str(file_path), original_name)
+
+
+class GeminiTagger(Tagger):
+    """Gemini によるタグ生成。API キーがある場合のみ有効。"""
+
+    name = "gemini"
+
+    def available(self) -> bool:
+        return _client_override is not None or bool(os.getenv("GEMINI_API_KEY"))
+
+    def tag(self, file_path: Path, original_name: str | None) -> list[str]:
+        return _split_tags(_generate_tags_uncached(file_path, original_name))
+
+
+# 1 ファイルあたりの最大タグ数
+MAX_TAGS = 10
+
+# ローカルエンジンが解析するテキストの最大長 (API 制限がないので長めに取る)
+LOCAL_TAG_SOURCE_LENGTH = 20_000
+
+# ローカルエンジンのワーカープロセス数。0 なら呼び出し元のスレッドで実行
+LOCAL_TAG_WORKERS = int(os.getenv("AUTO_TAG_WORKERS", min(4, os.cpu_count() or 1)))
+LOCAL_TAG_TIMEOUT = 30
+
+# ファイルの種類ごとに使うエンジン。"種類=エンジン,エンジン;..." で上書きできる
+DEFAULT_ENGINE_ROUTES = (
+    "text=local,gemini;document=local,gemini;image=local,gemini;"
+    "media=local;other=gemini"
+)
+
+
+def _parse_routes(spec: str) -> dict[str, tuple[str, ...]]:
+    routes: dict[str, tuple[str, ...]] = {}
+    for part in spec.split(";"):
+        kind, _, names = part.partition("=")
+        if kind.strip():
+            routes[kind.strip()] = tuple(
+                n.strip() for n in names.split(",") if n.strip()
+            )
+    return routes
+
+
+ENGINE_ROUTES = _parse_routes(DEFAULT_ENGINE_ROUTES)
+ENGINE_ROUTES.update(_parse_routes(os.getenv("AUTO_TAG_ENGINES", "")))
+
+_TAGGERS: dict[str, Tagger] = {}
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def register_tagger(tagger: Tagger) -> None:
+    """タグ付けエンジンを登録する。同名のエンジンは置き換える。"""
+    _TAGGERS[tagger.name] = tagger
+
+
+register_tagger(LocalTagger())
+register_tagger(GeminiTagger())
+
+
+def _local_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    if LOCAL_TAG_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # fork だとイベントループや aiosqlite・scrypt のスレッドを抱えたプロセスを
+            # 複製してしまい、子がロックを握ったまま止まることがある
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else "spawn"
+            )
+            _pool = ProcessPoolExecutor(max_workers=LOCAL_TAG_WORKERS, mp_context=ctx)
+        return _pool
+
+
+def shutdown_pool() -> None:
+    """ローカルエンジンのワーカープロセスを停止する。"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _wait_local(fut: Future) -> list[str]:
+    try:
+        return fut.result(timeout=LOCAL_TAG_TIMEOUT)
+    except Exception:
+        return []
+
+
+def file_kind(file_path: Path, original_name: str | None = None) -> str:
+    """エンジン選択に使うファイルの種類 (text/document/image/media/other)。"""
+    mime, _ = mimetypes.guess_type(original_name or str(file_path))
+    if not mime:
+        return "other"
+    if mime.startswith("text"):
+        return "text"
+    if mime.startswith("image"):
+        return "image"
+    if mime.startswith(("video", "audio")):
+        return "media"
+    if mime == "application/pdf" or mime.startswith(
+        ("application/msword", "application/vnd.ms-", "application/vnd.openxmlformats")
+    ):
+        return "document"
+    return "other"
+
+
+def _engines_for(kind: str) -> list[Tagger]:
+    names = ENGINE_ROUTES.get(kind, ENGINE_ROUTES.get("other", ()))
+    return [
+        _TAGGERS[n] for n in names if n in _TAGGERS and _TAGGERS[n].available()
+    ]
+
+
+def _cache_version(engines: Sequence[Tagger]) -> str:
+    # 使ったエンジンの組み合わせが変わればキャッシュも別扱いにする
+    return TAGGER_VERSION + ":" + "+".join(t.name for t in engines)
+
+
+def _run_tagger(tagger: Tagger, file_path: Path, original_name: str | None) -> list[str]:
+    try:
+        return tagger.tag(file_path, original_name)
+    except Exception:
+        return []
+
+
+def _split_tags(tags: str) -> list[str]:
+    return [t.strip(" #・-*\t") for t in re.split(r"[,、，\n]", tags or "") if t.strip(" #・-*\t")]
+
+
+def _merge_tags(groups: Iterable[list[str]]) -> str:
+    """複数エンジンのタグを重複なく連結し、カンマ区切りの文字列にする。"""
+    seen: set[str] = set()
+    merged: list[str] = []
+    for group in groups:
+        for tag in group:
+            key = tag.lower()
+            if key not in seen:
+                seen.add(key)
+                merged.append(tag)
+    return ", ".join(merged[:MAX_TAGS])
+
+
+# ── ローカルエンジン ──────────────────────────
+
+# RAKE の区切りとして扱う英語のストップワード。日本語はひらがなと記号で区切る
+_STOPWORDS = frozenset(
+    """a about above after again against all also an and any are as at be because
+    been before being below between both but by can could did do does doing down
+    during each few for from further had has have having he her here hers him his
+    how i if in into is it its itself just me more most my no nor not now of off on
+    once only or other our ours out over own same she should so some such than that
+    the their theirs them then there these they this those through to too under
+    until up very was we were what when where which while who whom why will with
+    would you your yours""".split()
+)
+_PHRASE_SPLIT_RE = re.compile(r"[^0-9A-Za-z'\-\s゠-ヿ一-鿿々ー]+")
+_WORD_RE = re.compile(r"[0-9a-z][0-9a-z'\-]*|[゠-ヿ一-鿿々ー]+")
+
+
+def _is_keyword(word: str) -> bool:
+    if word in _STOPWORDS or word.replace("-", "").isdigit():
+        return False
+    return len(word) >= (3 if word.isascii() else 2)
+
+
+def rake_keywords(text: str, top: int = 5) -> list[str]:
+    """RAKE でテキストからキーワードを抽出する。
+
+    ストップワード・記号・ひらがなで区切った語の並びを候補とし、
+    語の次数/出現数の和に候補の出現回数を掛けたスコアの高い順に返す。
+    """
+    phrases: list[tuple[str, ...]] = []
+    for chunk in _PHRASE_SPLIT_RE.split(text.lower()):
+        words: list[str] = []
+        for word in _WORD_RE.findall(chunk):
+            if _is_keyword(word):
+                words.append(word)
+            elif words:
+                phrases.append(tuple(words))
+                words = []
+        if words:
+            phrases.append(tuple(words))
+    phrases = [p for p in phrases if len(p) <= 3]
+
+    freq: Counter[str] = Counter()
+    degree: Counter[str] = Counter()
+    for phrase in phrases:
+        for word in phrase:
+            freq[word] += 1
+            degree[word] += len(phrase)
+    counts = Counter(phrases)
+    scores = {
+        p: n * sum(degree[w] / freq[w] for w in p) for p, n in counts.items()
+    }
+    ranked = sorted(scores, key=lambda p: (-scores[p], -len("".join(p))))
+    return [" ".join(p) if p[0].isascii() else "".join(p) for p in ranked[:top]]
+
+
+def _image_tags(file_path: Path) -> list[str]:
+    tags = ["画像"]
+    with Image.open(file_path) as img:
+        w, h = img.size
+        tags.append("横長" if w > h else "縦長" if h > w else "正方形")
+        if max(w, h) >= 3000:
+            tags.append("高解像度")
+        exif = img.getexif()
+        camera = str(exif.get(272) or exif.get(271) or "").strip("\x00 ")
+        if camera:
+            tags.append(camera)
+        taken = exif.get_ifd(0x8769).get(36867) or exif.get(306)
+        if taken and str(taken)[:4].isdigit():
+            tags.append(f"{str(taken)[:4]}年")
+        if exif.get_ifd(0x8825):
+            tags.append("位置情報あり")
+    return tags
+
+
+def _media_tags(file_path: Path, original_name: str | None) -> list[str]:
+    mime, _ = mimetypes.guess_type(original_name or str(file_path))
+    tags = ["動画" if (mime or "").startswith("video") else "音声"]
+    try:
+        out = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "quiet",
+                "-print_format",
+                "json",
+                "-show_format",
+                "-show_streams",
+                str(file_path),
+            ],
+            capture_output=True,
+            timeout=LOCAL_TAG_TIMEOUT,
+            check=True,
+        ).stdout
+        info = json.loads(out or b"{}")
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return tags
+
+    streams = info.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    if video and video.get("height"):
+        h = int(video["height"])
+        tags.append("4K" if h >= 2160 else "1080p" if h >= 1080 else "720p" if h >= 720 else "SD")
+    for s in streams:
+        if s.get("codec_name"):
+            tags.append(s["codec_name"])
+    fmt = info.get("format", {})
+    try:
+        duration = float(fmt.get("duration", 0))
+    except (TypeError, ValueError):
+        duration = 0
+    if 0 < duration < 60:
+        tags.append("1分未満")
+    elif duration >= 20 * 60:
+        tags.append("長尺")
+    meta = {k.lower(): v for k, v in fmt.get("tags", {}).items()}
+    for key in ("title", "artist", "album", "genre"):
+        if meta.get(key):
+            tags.append(str(meta[key]).strip())
+    return tags
+
+
+def local_tags(path: str, original_name: str | None = None) -> list[str]:
+    """ローカルエンジン本体。プロセスプールから呼ばれるためトップレベルに置く。"""
+    file_path = Path(path)
+    kind = file_kind(file_path, original_name)
+    if kind == "image":
+        return _image_tags(file_path)
+    if kind == "media":
+        return _media_tags(file_path, original_name)
+    text = extract_text(file_path, original_name, LOCAL_TAG_SOURCE_LENGTH)
+    return rake_keywords(text) if text else []
@@ -14,8 +14,10 @@ from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import List, Dict, Optional
 from .help import setup_help
-from .db import init_db
+from .db import init_db, HIGHLIGHT_END, HIGHLIGHT_START
+from .quota import QuotaExceeded, open_budget, write_chunks
 
+import aiohttp
 import discord
 from discord import app_commands
 from discord import Embed, Member, User
@@ -33,6 +35,7 @@ FILE_HMAC_SECRET = base64.urlsafe_b64decode(
     os.getenv("FILE_HMAC_SECRET", "").encode() or os.urandom(32)
 )
 URL_EXPIRES_SEC = int(os.getenv("UPLOAD_EXPIRES_SEC", 86400))  # 24h
+SEARCH_TEXT_LIMIT = int(os.getenv("SEARCH_TEXT_LIMIT", 20_000))  # 検索索引に入れる本文の最大文字数
 DATA_DIR = Path(os.getenv("DATA_DIR", Path(__file__).resolve().parents[1] / "data"))
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 PUBLIC_DOMAIN = os.getenv("PUBLIC_DOMAIN", "localhost:9040")
@@ -49,6 +52,24 @@ DM_UPLOAD_LIMIT = int(os.getenv("DISCORD_DM_UPLOAD_LIMIT", 8 << 20))
 # 連続送信抑制インターバル (秒)
 SEND_INTERVAL_SEC = int(os.getenv("SEND_INTERVAL_SEC", 60))
 
+def _quota_message(e: QuotaExceeded) -> str:
+    if e.reason == "disk":
+        return "サーバーの空き容量が不足しているため、現在アップロードできません。"
+    return f"保存容量の上限 ({e.limit / (1 << 20):.0f} MiB) を超えるためアップロードできません。"
+
+# 添付を取りに行くときの 1 回の読み込みサイズとタイムアウト
+ATTACHMENT_READ_SIZE = 256 << 10
+ATTACHMENT_TIMEOUT = aiohttp.ClientTimeout(total=600)
+
+async def _save_attachment(file: discord.Attachment, path: Path, budget) -> tuple[int, str]:
+    """添付をメモリに溜めずに ``path`` へ書き、(サイズ, sha256) を返す。"""
+    async with aiohttp.ClientSession(timeout=ATTACHMENT_TIMEOUT) as session:
+        async with session.get(file.url) as resp:
+            resp.raise_for_status()
+            return await write_chunks(
+                resp.content.iter_chunked(ATTACHMENT_READ_SIZE), path, budget
+            )
+
 # ダウンロードリンク署名
 
 def _sign(fid: str, exp: int) -> str:
@@ -259,17 +280,33 @@ def setup_commands(bot: discord.Client):
             await i.response.send_message("ユーザー登録が見つかりません。", ephemeral=True)
             return
         await i.response.defer(thinking=True, ephemeral=True)
-        data = await file.read()
-        fid = str(uuid.uuid4())
-        path = DATA_DIR / fid
-        path.write_bytes(data)
-        from .auto_tag import generate_tags
-        tags = await asyncio.to_thread(generate_tags, path, file.filename)
-        await db.add_file(fid, pk, "", file.filename, str(path), len(data), hashlib.sha256(data).hexdigest(), tags)
+        # 添付の大きさは事前に分かるので、ダウンロード前に容量を確かめる
+        try:
+            budget = await open_budget(db, DATA_DIR, user_id=pk, expected=file.size)
+        except QuotaExceeded as e:
+            await i.followup.send(f"❌ {_quota_message(e)}", ephemeral=True)
+            return
+        with budget:
+            fid = str(uuid.uuid4())
+            path = DATA_DIR / fid
+            try:
+                size, digest = await _save_attachment(file, path, budget)
+            except QuotaExceeded as e:
+                await i.followup.send(f"❌ {_quota_message(e)}", ephemeral=True)
+                return
+            from .auto_tag import extract_text, generate_tags
+            tags = await asyncio.to_thread(generate_tags, path, file.filename, digest)
+            await db.add_file(fid, pk, "", file.filename, str(path), size, digest, tags)
+        try:
+            body = await asyncio.to_thread(extract_text, path, file.filename, SEARCH_TEXT_LIMIT)
+        except Exception:
+            body = None
+        if body:
+            await db.set_search_text("file", fid, body)
         now = int(datetime.now(timezone.utc).timestamp())
         url = f"https://{os.getenv('PUBLIC_DOMAIN','localhost:9040')}/download/{_sign(fid, now+URL_EXPIRES_SEC)}"
         emb = discord.Embed(title="✅ アップロード完了", description=f"[DL]({url})", colour=0x2ecc71)
-        emb.add_field(name="サイズ", value=f"{len(data)/1024/1024:.1f} MiB", inline=True)
+        emb.add_field(name="サイズ", value=f"{size/1024/1024:.1f} MiB", inline=True)
         await i.followup.send(embed=emb, ephemeral=True)
         if owner_id and (owner := bot.get_user(owner_id)):
             try:
@@ -298,11 +335,9 @@ def setup_commands(bot: discord.Client):
         if pk is None:
             await i.followup.send("ユーザー登録が見つかりません。", ephemeral=True)
             return
-        rows = await db.fetchall("SELECT path FROM files WHERE user_id=?", pk)
-        for r in rows:
-            Path(r["path"]).unlink(missing_ok=True)
-        await db.delete_all_files(pk)
-        await i.followup.send(f"🗑️ {len(rows)} 件のファイルを削除しました。", ephemeral=True)
+        # 実体は Web 側の回収タスクが順に削除する
+        count = await db.delete_all_files(pk)
+        await i.followup.send(f"🗑️ {count} 件のファイルを削除しました。", ephemeral=True)
 
     @tree.command(name="set_tags", description="ファイルにタグを設定します。")
     async def _set_tags(i: discord.Interaction, file_id: str, tags: str):
@@ -632,14 +667,23 @@ def setup_commands(bot: discord.Client):
             await interaction.followup.send(f"❌ 上限 {limit>>20} MiB を超えています。", ephemeral=True)
             return
 
-        # 4) ファイル保存＆DB 登録
-        data = await file.read()
-        fid = str(uuid.uuid4())
-        path = DATA_DIR / fid
-        path.write_bytes(data)
-        from .auto_tag import generate_tags
-        tags = await asyncio.to_thread(generate_tags, path, file.filename)
-        await db.add_shared_file(fid, folder_id, file.filename, str(path), tags)
+        # 4) ファイル保存＆DB 登録 (共有フォルダの容量とディスクの空きを先に確かめる)
+        try:
+            budget = await open_budget(db, DATA_DIR, shared_folder_id=folder_id, expected=file.size)
+        except QuotaExceeded as e:
+            await interaction.followup.send(f"❌ {_quota_message(e)}", ephemeral=True)
+            return
+        with budget:
+            fid = str(uuid.uuid4())
+            path = DATA_DIR / fid
+            try:
+                await _save_attachment(file, path, budget)
+            except QuotaExceeded as e:
+                await interaction.followup.send(f"❌ {_quota_message(e)}", ephemeral=True)
+                return
+            from .auto_tag import generate_tags
+            tags = await asyncio.to_thread(generate_tags, path, file.filename)
+            await db.add_shared_file(fid, folder_id, file.filename, str(path), tags)
 
         # 5) Webhook で通知
         await interaction.client.notify_shared_upload(folder_id, interaction.user, file.filename)
@@ -802,7 +846,7 @@ def setup_commands(bot: discord.Client):
         view = DeleteSharedFolderView(i.client, i.user, folders)
         await i.followup.send("共有フォルダの削除メニューです。", view=view, ephemeral=True)
 
-    @tree.command(name="search_files", description="タグで自分のファイルを検索します")
+    @tree.command(name="search_files", description="ファイル名・タグ・本文で自分と共有フォルダのファイルを検索します")
     @app_commands.describe(tag="検索ワード")
     async def search_files_cmd(i: discord.Interaction, tag: str):
         db = i.client.db
@@ -810,15 +854,19 @@ def setup_commands(bot: discord.Client):
         if pk is None:
             await i.response.send_message("ユーザー登録が見つかりません。", ephemeral=True)
             return
-        rows = await db.search_files(pk, tag)
+        rows = await db.search(pk, i.user.id, tag, limit=10)
         if not rows:
             await i.response.send_message("該当ファイルがありません。", ephemeral=True)
             return
         now = int(datetime.now(timezone.utc).timestamp())
         emb = discord.Embed(title=f"検索結果: {tag}")
-        for r in rows[:10]:
+        for r in rows:
             url = f"https://{os.getenv('PUBLIC_DOMAIN','localhost:9040')}/download/{_sign(r['id'], now+URL_EXPIRES_SEC)}"
-            emb.add_field(name=r['original_name'], value=f"[DL]({url}) tags:{r['tags']}", inline=False)
+            snippet = (r["snippet"] or "").replace(HIGHLIGHT_START, "**").replace(HIGHLIGHT_END, "**")
+            value = f"[DL]({url}) tags:{r['tags']}"
+            if snippet:
+                value += f"\n{snippet}"
+            emb.add_field(name=r['original_name'], value=value[:1024], inline=False)
         await i.response.send_message(embed=emb, ephemeral=True)
 
     # --------------- /setup_qr -------------
@@ -3,21 +3,36 @@
 from __future__ import annotations
 
 # ── 標準ライブラリ ─────────────────────────
-import asyncio, os, secrets, hashlib, sqlite3
+import asyncio, os, secrets, hashlib, sqlite3, time
 import datetime as dt
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, List, Optional
+from typing import Any, Callable, List, Optional
 
 # ── サードパーティ ────────────────────────
 import aiosqlite
 import scrypt  # pip install scrypt
 
+from bot.query_log import QueryLog
+
 # ── パス & 定数 ───────────────────────────
 DB_PATH = Path(__file__).parents[1] / "data" / "web_discord_server.db"
 
 SCRYPT_N, SCRYPT_r, SCRYPT_p = 2**15, 8, 1  # 32768:8:1
 SCRYPT_BUFLEN = 64  # 512-bit
 
+# scrypt 専用スレッド数と、実行待ちを含めた同時受付数の上限
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE", "16"))
+
+# ユーザー名ごとのログイン失敗制限
+LOGIN_FREE_ATTEMPTS = int(os.getenv("LOGIN_FREE_ATTEMPTS", "5"))
+LOGIN_FAIL_WINDOW = float(os.getenv("LOGIN_FAIL_WINDOW", "900"))
+LOGIN_MAX_DELAY = float(os.getenv("LOGIN_MAX_DELAY", "900"))
+
+EMPTY_USAGE = {"file_count": 0, "total_size": 0, "last_modified": 0}
+
 # ── スキーマ ──────────────────────────────
 SCHEMA = """
 PRAGMA foreign_keys = ON;
@@ -31,7 +46,8 @@ CREATE TABLE IF NOT EXISTS users (
     totp_secret  TEXT,
     totp_enabled INTEGER NOT NULL DEFAULT 0,
     totp_verified INTEGER NOT NULL DEFAULT 0,
-    enc_key      TEXT
+    enc_key      TEXT,
+    quota_bytes  INTEGER
 );
 CREATE TABLE IF NOT EXISTS files (
     id              TEXT PRIMARY KEY,
@@ -64,6 +80,7 @@ CREATE TABLE IF NOT EXISTS shared_folders (
     channel_id INTEGER,
     webhook_url TEXT,
     parent_id INTEGER,
+    quota_bytes INTEGER,
     FOREIGN KEY(parent_id) REFERENCES shared_folders(id) ON DELETE CASCADE
 );
 CREATE TABLE IF NOT EXISTS shared_folder_members (
@@ -94,8 +111,346 @@ CREATE TABLE IF NOT EXISTS send_logs (
     sent_at           INTEGER NOT NULL,
     PRIMARY KEY(sender_discord_id, target_discord_id, file_id)
 );
+CREATE TABLE IF NOT EXISTS gdrive_sync (
+    file_id     TEXT PRIMARY KEY,
+    user_id     INTEGER NOT NULL,
+    path        TEXT NOT NULL,
+    file_name   TEXT NOT NULL,
+    session_uri TEXT,
+    status      TEXT NOT NULL DEFAULT 'pending',
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    last_error  TEXT,
+    updated_at  INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+-- 全文検索の元データ。files / shared_files からトリガーで同期する
+-- kind='file' の owner は files.user_id、kind='shared' は shared_files.folder_id
+CREATE TABLE IF NOT EXISTS search_docs (
+    id      INTEGER PRIMARY KEY,
+    kind    TEXT    NOT NULL,
+    file_id TEXT    NOT NULL,
+    owner   INTEGER NOT NULL,
+    name    TEXT    NOT NULL,
+    tags    TEXT    NOT NULL DEFAULT '',
+    body    TEXT    NOT NULL DEFAULT '',
+    UNIQUE(kind, file_id)
+);
+CREATE INDEX IF NOT EXISTS idx_search_docs_owner ON search_docs(kind, owner);
+CREATE TRIGGER IF NOT EXISTS files_search_ai AFTER INSERT ON files BEGIN
+    INSERT OR REPLACE INTO search_docs (kind, file_id, owner, name, tags)
+    VALUES ('file', new.id, new.user_id, new.original_name, new.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS files_search_au
+AFTER UPDATE OF original_name, tags, user_id ON files BEGIN
+    UPDATE search_docs
+       SET owner = new.user_id, name = new.original_name, tags = new.tags
+     WHERE kind = 'file' AND file_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS files_search_ad AFTER DELETE ON files BEGIN
+    DELETE FROM search_docs WHERE kind = 'file' AND file_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS shared_files_search_ai AFTER INSERT ON shared_files BEGIN
+    INSERT OR REPLACE INTO search_docs (kind, file_id, owner, name, tags)
+    VALUES ('shared', new.id, new.folder_id, new.file_name, new.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS shared_files_search_au
+AFTER UPDATE OF file_name, tags, folder_id ON shared_files BEGIN
+    UPDATE search_docs
+       SET owner = new.folder_id, name = new.file_name, tags = new.tags
+     WHERE kind = 'shared' AND file_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS shared_files_search_ad AFTER DELETE ON shared_files BEGIN
+    DELETE FROM search_docs WHERE kind = 'shared' AND file_id = old.id;
+END;
+-- 正規化したタグ。files.tags / shared_files.tags は表示用にそのまま残し、
+-- 書き込みは Database._set_file_tags で両方を更新する
+CREATE TABLE IF NOT EXISTS tags (
+    id   INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE COLLATE NOCASE
+);
+CREATE TABLE IF NOT EXISTS file_tags (
+    kind    TEXT    NOT NULL,
+    file_id TEXT    NOT NULL,
+    tag_id  INTEGER NOT NULL,
+    owner   INTEGER NOT NULL,
+    PRIMARY KEY(kind, file_id, tag_id),
+    FOREIGN KEY(tag_id) REFERENCES tags(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_file_tags_owner ON file_tags(kind, owner, tag_id);
+CREATE TRIGGER IF NOT EXISTS files_tags_ad AFTER DELETE ON files BEGIN
+    DELETE FROM file_tags WHERE kind = 'file' AND file_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS files_tags_au AFTER UPDATE OF user_id ON files BEGIN
+    UPDATE file_tags SET owner = new.user_id WHERE kind = 'file' AND file_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS shared_files_tags_ad AFTER DELETE ON shared_files BEGIN
+    DELETE FROM file_tags WHERE kind = 'shared' AND file_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS shared_files_tags_au AFTER UPDATE OF folder_id ON shared_files BEGIN
+    UPDATE file_tags SET owner = new.folder_id WHERE kind = 'shared' AND file_id = old.id;
+END;
+-- (ユーザー, フォルダ) ごとの更新カウンタ。files やフォルダが変わるたびに単調増加し、
+-- 一覧の描画キャッシュや ETag の鍵になる。Bot など別経路の更新もトリガーで拾う
+CREATE TABLE IF NOT EXISTS folder_versions (
+    user_id INTEGER NOT NULL,
+    folder  TEXT    NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(user_id, folder)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS files_version_ai AFTER INSERT ON files BEGIN
+    INSERT INTO folder_versions (user_id, folder, version) VALUES (new.user_id, new.folder, 1)
+    ON CONFLICT(user_id, folder) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS files_version_ad AFTER DELETE ON files BEGIN
+    INSERT INTO folder_versions (user_id, folder, version) VALUES (old.user_id, old.folder, 1)
+    ON CONFLICT(user_id, folder) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS files_version_au AFTER UPDATE ON files BEGIN
+    INSERT INTO folder_versions (user_id, folder, version) VALUES (new.user_id, new.folder, 1)
+    ON CONFLICT(user_id, folder) DO UPDATE SET version = version + 1;
+    INSERT INTO folder_versions (user_id, folder, version)
+    SELECT old.user_id, old.folder, 1
+    WHERE old.user_id != new.user_id OR old.folder != new.folder
+    ON CONFLICT(user_id, folder) DO UPDATE SET version = version + 1;
+END;
+-- フォルダの作成・名前変更・移動・削除では、親フォルダの一覧 (子フォルダ) と
+-- そのフォルダ自身の一覧 (パンくず) の版を上げる。ルートの子は parent_id が NULL
+CREATE TRIGGER IF NOT EXISTS user_folders_version_ai AFTER INSERT ON user_folders BEGIN
+    INSERT INTO folder_versions (user_id, folder, version)
+    VALUES (new.user_id, COALESCE(CAST(new.parent_id AS TEXT), ''), 1)
+    ON CONFLICT(user_id, folder) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS user_folders_version_ad AFTER DELETE ON user_folders BEGIN
+    INSERT INTO folder_versions (user_id, folder, version)
+    VALUES (old.user_id, COALESCE(CAST(old.parent_id AS TEXT), ''), 1)
+    ON CONFLICT(user_id, folder) DO UPDATE SET version = version + 1;
+    INSERT INTO folder_versions (user_id, folder, version)
+    VALUES (old.user_id, CAST(old.id AS TEXT), 1)
+    ON CONFLICT(user_id, folder) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS user_folders_version_au AFTER UPDATE ON user_folders BEGIN
+    INSERT INTO folder_versions (user_id, folder, version)
+    VALUES (new.user_id, COALESCE(CAST(new.parent_id AS TEXT), ''), 1)
+    ON CONFLICT(user_id, folder) DO UPDATE SET version = version + 1;
+    INSERT INTO folder_versions (user_id, folder, version)
+    VALUES (new.user_id, CAST(new.id AS TEXT), 1)
+    ON CONFLICT(user_id, folder) DO UPDATE SET version = version + 1;
+    INSERT INTO folder_versions (user_id, folder, version)
+    SELECT old.user_id, COALESCE(CAST(old.parent_id AS TEXT), ''), 1
+    WHERE old.user_id != new.user_id OR old.parent_id IS NOT new.parent_id
+    ON CONFLICT(user_id, folder) DO UPDATE SET version = version + 1;
+END;
+-- ファイル数・合計サイズ・最終更新時刻 (epoch 秒) の集計。行の追加・削除・更新の
+-- たびにトリガーで差分だけ反映する。scope='user' は owner=users.id・folder=''、
+-- 'folder' は owner=users.id・folder=files.folder、'shared' は owner=shared_folders.id
+CREATE TABLE IF NOT EXISTS usage_stats (
+    scope         TEXT    NOT NULL,
+    owner         INTEGER NOT NULL,
+    folder        TEXT    NOT NULL DEFAULT '',
+    file_count    INTEGER NOT NULL DEFAULT 0,
+    total_size    INTEGER NOT NULL DEFAULT 0,
+    last_modified INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(scope, owner, folder)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS files_usage_ai AFTER INSERT ON files BEGIN
+    INSERT INTO usage_stats VALUES
+        ('user', new.user_id, '', 1, new.size, strftime('%s','now')),
+        ('folder', new.user_id, new.folder, 1, new.size, strftime('%s','now'))
+    ON CONFLICT(scope, owner, folder) DO UPDATE SET
+        file_count = file_count + 1,
+        total_size = total_size + excluded.total_size,
+        last_modified = excluded.last_modified;
+END;
+CREATE TRIGGER IF NOT EXISTS files_usage_ad AFTER DELETE ON files BEGIN
+    UPDATE usage_stats SET
+        file_count = file_count - 1,
+        total_size = total_size - old.size,
+        last_modified = strftime('%s','now')
+    WHERE owner = old.user_id
+      AND ((scope = 'user' AND folder = '') OR (scope = 'folder' AND folder = old.folder));
+END;
+CREATE TRIGGER IF NOT EXISTS files_usage_au AFTER UPDATE OF user_id, folder, size ON files
+WHEN old.user_id != new.user_id OR old.folder != new.folder OR old.size != new.size BEGIN
+    UPDATE usage_stats SET
+        file_count = file_count - 1,
+        total_size = total_size - old.size,
+        last_modified = strftime('%s','now')
+    WHERE owner = old.user_id
+      AND ((scope = 'user' AND folder = '') OR (scope = 'folder' AND folder = old.folder));
+    INSERT INTO usage_stats VALUES
+        ('user', new.user_id, '', 1, new.size, strftime('%s','now')),
+        ('folder', new.user_id, new.folder, 1, new.size, strftime('%s','now'))
+    ON CONFLICT(scope, owner, folder) DO UPDATE SET
+        file_count = file_count + 1,
+        total_size = total_size + excluded.total_size,
+        last_modified = excluded.last_modified;
+END;
+CREATE TRIGGER IF NOT EXISTS shared_files_usage_ai AFTER INSERT ON shared_files BEGIN
+    INSERT INTO usage_stats VALUES
+        ('shared', new.folder_id, '', 1, new.size, strftime('%s','now'))
+    ON CONFLICT(scope, owner, folder) DO UPDATE SET
+        file_count = file_count + 1,
+        total_size = total_size + excluded.total_size,
+        last_modified = excluded.last_modified;
+END;
+CREATE TRIGGER IF NOT EXISTS shared_files_usage_ad AFTER DELETE ON shared_files BEGIN
+    UPDATE usage_stats SET
+        file_count = file_count - 1,
+        total_size = total_size - old.size,
+        last_modified = strftime('%s','now')
+    WHERE scope = 'shared' AND owner = old.folder_id AND folder = '';
+END;
+CREATE TRIGGER IF NOT EXISTS shared_files_usage_au AFTER UPDATE OF folder_id, size ON shared_files
+WHEN old.folder_id != new.folder_id OR old.size != new.size BEGIN
+    UPDATE usage_stats SET
+        file_count = file_count - 1,
+        total_size = total_size - old.size,
+        last_modified = strftime('%s','now')
+    WHERE scope = 'shared' AND owner = old.folder_id AND folder = '';
+    INSERT INTO usage_stats VALUES
+        ('shared', new.folder_id, '', 1, new.size, strftime('%s','now'))
+    ON CONFLICT(scope, owner, folder) DO UPDATE SET
+        file_count = file_count + 1,
+        total_size = total_size + excluded.total_size,
+        last_modified = excluded.last_modified;
+END;
+-- 一覧のキーセットページング (uploaded_at, id の降順) 用
+CREATE INDEX IF NOT EXISTS idx_files_listing ON files(user_id, folder, uploaded_at, id);
+-- ユーザーごとの変更履歴。seq は単調増加し、クライアントは ?since=<seq> で
+-- それ以降の差分だけを取得する (オフライン用のカタログ同期)
+CREATE TABLE IF NOT EXISTS changes (
+    seq     INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    kind    TEXT    NOT NULL,
+    item_id TEXT    NOT NULL,
+    op      TEXT    NOT NULL,
+    at      INTEGER NOT NULL DEFAULT (strftime('%s','now'))
+);
+CREATE INDEX IF NOT EXISTS idx_changes_user ON changes(user_id, seq);
+CREATE TRIGGER IF NOT EXISTS files_changes_ai AFTER INSERT ON files BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op) VALUES (new.user_id, 'file', new.id, 'upsert');
+END;
+CREATE TRIGGER IF NOT EXISTS files_changes_ad AFTER DELETE ON files BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op) VALUES (old.user_id, 'file', old.id, 'delete');
+END;
+CREATE TRIGGER IF NOT EXISTS files_changes_au AFTER UPDATE ON files BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op)
+    SELECT old.user_id, 'file', old.id, 'delete' WHERE old.user_id != new.user_id;
+    INSERT INTO changes (user_id, kind, item_id, op) VALUES (new.user_id, 'file', new.id, 'upsert');
+END;
+CREATE TRIGGER IF NOT EXISTS user_folders_changes_ai AFTER INSERT ON user_folders BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op) VALUES (new.user_id, 'folder', new.id, 'upsert');
+END;
+CREATE TRIGGER IF NOT EXISTS user_folders_changes_ad AFTER DELETE ON user_folders BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op) VALUES (old.user_id, 'folder', old.id, 'delete');
+END;
+CREATE TRIGGER IF NOT EXISTS user_folders_changes_au AFTER UPDATE ON user_folders BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op) VALUES (new.user_id, 'folder', new.id, 'upsert');
+END;
+-- 共有フォルダの変更はメンバー全員の履歴に書く (discord_id → users.id)
+CREATE TRIGGER IF NOT EXISTS shared_files_changes_ai AFTER INSERT ON shared_files BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op)
+    SELECT u.id, 'shared_file', new.id, 'upsert' FROM shared_folder_members m
+    JOIN users u ON u.discord_id = m.discord_user_id WHERE m.folder_id = new.folder_id;
+END;
+CREATE TRIGGER IF NOT EXISTS shared_files_changes_ad AFTER DELETE ON shared_files BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op)
+    SELECT u.id, 'shared_file', old.id, 'delete' FROM shared_folder_members m
+    JOIN users u ON u.discord_id = m.discord_user_id WHERE m.folder_id = old.folder_id;
+END;
+CREATE TRIGGER IF NOT EXISTS shared_files_changes_au AFTER UPDATE ON shared_files BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op)
+    SELECT u.id, 'shared_file', old.id, 'delete' FROM shared_folder_members m
+    JOIN users u ON u.discord_id = m.discord_user_id
+    WHERE m.folder_id = old.folder_id AND old.folder_id != new.folder_id;
+    INSERT INTO changes (user_id, kind, item_id, op)
+    SELECT u.id, 'shared_file', new.id, 'upsert' FROM shared_folder_members m
+    JOIN users u ON u.discord_id = m.discord_user_id WHERE m.folder_id = new.folder_id;
+END;
+CREATE TRIGGER IF NOT EXISTS shared_folders_changes_au AFTER UPDATE ON shared_folders BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op)
+    SELECT u.id, 'shared_folder', new.id, 'upsert' FROM shared_folder_members m
+    JOIN users u ON u.discord_id = m.discord_user_id WHERE m.folder_id = new.id;
+END;
+-- 参加するとフォルダと中のファイルが、抜けるとフォルダの削除が届く。
+-- フォルダの削除を受け取ったクライアントはそのフォルダのファイルも捨てる
+CREATE TRIGGER IF NOT EXISTS shared_members_changes_ai AFTER INSERT ON shared_folder_members BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op)
+    SELECT u.id, 'shared_folder', new.folder_id, 'upsert' FROM users u
+    WHERE u.discord_id = new.discord_user_id;
+    INSERT INTO changes (user_id, kind, item_id, op)
+    SELECT u.id, 'shared_file', f.id, 'upsert' FROM users u
+    JOIN shared_files f ON f.folder_id = new.folder_id
+    WHERE u.discord_id = new.discord_user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS shared_members_changes_ad AFTER DELETE ON shared_folder_members BEGIN
+    INSERT INTO changes (user_id, kind, item_id, op)
+    SELECT u.id, 'shared_folder', old.folder_id, 'delete' FROM users u
+    WHERE u.discord_id = old.discord_user_id;
+END;
+-- 圧縮で削除済み項目の記録 (墓標) を捨てた位置。これより古い since からは差分で追えない
+CREATE TABLE IF NOT EXISTS changes_floor (
+    user_id INTEGER PRIMARY KEY,
+    seq     INTEGER NOT NULL
+);
+-- 行を消した後で実体を消すファイルの待ち行列。Web 側の回収タスクが少しずつ消す
+CREATE TABLE IF NOT EXISTS pending_unlinks (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    path      TEXT NOT NULL,
+    queued_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
+);
 """
 
+# usage_stats を files / shared_files から作り直す。last_modified は最新のアップロード日時
+# (uploaded_at が epoch 秒でない行は 0)
+REBUILD_USAGE = """
+DELETE FROM usage_stats;
+INSERT INTO usage_stats
+SELECT 'user', user_id, '', COUNT(*), SUM(size), MAX(CAST(uploaded_at AS INTEGER))
+FROM files GROUP BY user_id;
+INSERT INTO usage_stats
+SELECT 'folder', user_id, folder, COUNT(*), SUM(size), MAX(CAST(uploaded_at AS INTEGER))
+FROM files GROUP BY user_id, folder;
+INSERT INTO usage_stats
+SELECT 'shared', folder_id, '', COUNT(*), SUM(size), MAX(CAST(uploaded_at AS INTEGER))
+FROM shared_files GROUP BY folder_id;
+"""
+
+# FTS5 (trigram) 索引。使えない SQLite では作成に失敗し、LIKE 検索で代替する
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+    name, tags, body,
+    content = 'search_docs', content_rowid = 'id',
+    tokenize = 'trigram'
+);
+CREATE TRIGGER IF NOT EXISTS search_docs_fts_ai AFTER INSERT ON search_docs BEGIN
+    INSERT INTO search_fts (rowid, name, tags, body)
+    VALUES (new.id, new.name, new.tags, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS search_docs_fts_ad AFTER DELETE ON search_docs BEGIN
+    INSERT INTO search_fts (search_fts, rowid, name, tags, body)
+    VALUES ('delete', old.id, old.name, old.tags, old.body);
+END;
+CREATE TRIGGER IF NOT EXISTS search_docs_fts_au
+AFTER UPDATE OF name, tags, body ON search_docs BEGIN
+    INSERT INTO search_fts (search_fts, rowid, name, tags, body)
+    VALUES ('delete', old.id, old.name, old.tags, old.body);
+    INSERT INTO search_fts (rowid, name, tags, body)
+    VALUES (new.id, new.name, new.tags, new.body);
+END;
+"""
+
+# タグのオートコンプリート用トライ木を作り直すまでの秒数 (トリガー経由の削除を拾うため)
+TAG_TRIE_TTL = 300
+# フォルダ階層のキャッシュを作り直すまでの秒数 (別プロセスからの変更を拾うため)
+FOLDER_TREE_TTL = 300
+
+# 検索結果の強調表示に使う区切り文字 (表示側で <mark> などに置き換える)
+HIGHLIGHT_START, HIGHLIGHT_END = "\x02", "\x03"
+
+# trigram トークナイザが索引を使える最短の語長
+FTS_MIN_TERM = 3
+
 
 # ── scrypt util ────────────────────────────
 def scrypt_hash(password: str) -> str:
@@ -122,6 +477,126 @@ def verify_password(password: str, hashed: str) -> bool:
         return False
 
 
+def needs_rehash(hashed: str) -> bool:
+    """保存済みハッシュのパラメータが現在の設定と異なれば True。"""
+    try:
+        params, _salt, dk_hex = hashed.split("$")
+        n, r, p = map(int, params.split(":"))
+    except ValueError:
+        return True
+    return (n, r, p) != (SCRYPT_N, SCRYPT_r, SCRYPT_p) or len(dk_hex) != SCRYPT_BUFLEN * 2
+
+
+class PasswordHashBusy(Exception):
+    """scrypt の受付上限に達しているときに送出する。"""
+
+
+class LoginThrottled(Exception):
+    """失敗が続いたユーザー名のログインを一時的に拒否するときに送出する。"""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    """scrypt を専用スレッドプールで実行する。
+
+    scrypt は ctypes 経由で呼ばれ計算中は GIL を手放すため、スレッドで十分並列に動く。
+    ログイン検証は実行中と待機中の合計が ``max_pending`` を超えると即座に
+    ``PasswordHashBusy`` で断り、ログインが殺到してもイベントループや
+    メモリ (1 回あたり約 32MB) を使い潰さない。
+    """
+
+    def __init__(self, workers: int = HASH_WORKERS, max_pending: int = HASH_QUEUE_LIMIT):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.pending = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def _run(self, fn, *args, bounded: bool = True):
+        if bounded and self.pending >= self.max_pending:
+            raise PasswordHashBusy()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="scrypt"
+            )
+        # pending の増減はイベントループ上でのみ行うのでロック不要
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, fn, *args
+            )
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str, *, bounded: bool = False) -> str:
+        # ユーザー登録など信頼できる呼び出し元は上限を無視して順番を待つ
+        return await self._run(scrypt_hash, password, bounded=bounded)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(verify_password, password, hashed)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class LoginThrottle:
+    """ユーザー名ごとの連続失敗数に応じて次の試行までの待ち時間を決める。
+
+    ``free_attempts`` 回までは制限なし。それを超えると 1, 2, 4 … 秒と倍々に延び、
+    ``max_delay`` で頭打ちになる。最後の失敗から ``window`` 秒経てば記録を忘れる。
+    """
+
+    def __init__(
+        self,
+        free_attempts: int = LOGIN_FREE_ATTEMPTS,
+        window: float = LOGIN_FAIL_WINDOW,
+        max_delay: float = LOGIN_MAX_DELAY,
+        max_entries: int = 10000,
+    ) -> None:
+        self.free_attempts = free_attempts
+        self.window = window
+        self.max_delay = max_delay
+        self.max_entries = max_entries
+        # username -> (連続失敗数, 最後の失敗時刻)
+        self._failures: OrderedDict[str, tuple[int, float]] = OrderedDict()
+
+    def retry_after(self, username: str, now: Optional[float] = None) -> float:
+        """次の試行を受け付けるまでの秒数 (0 なら即時可)。"""
+        now = time.monotonic() if now is None else now
+        key = username.lower()
+        entry = self._failures.get(key)
+        if entry is None:
+            return 0.0
+        count, last = entry
+        if now - last > self.window:
+            del self._failures[key]
+            return 0.0
+        if count < self.free_attempts:
+            return 0.0
+        delay = min(self.max_delay, 2.0 ** (count - self.free_attempts))
+        return max(0.0, last + delay - now)
+
+    def failure(self, username: str, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        key = username.lower()
+        count, last = self._failures.pop(key, (0, now))
+        if now - last > self.window:
+            count = 0
+        self._failures[key] = (count + 1, now)
+        while len(self._failures) > self.max_entries:
+            self._failures.popitem(last=False)
+
+    def success(self, username: str) -> None:
+        self._failures.pop(username.lower(), None)
+
+
+password_hasher = PasswordHasher()
+
+
 # ── DB 初期化 ──────────────────────────────
 async def init_db(db_path: Path = DB_PATH) -> None:
     db_path.parent.mkdir(parents=True, exist_ok=True)
@@ -197,7 +672,172 @@ async def init_db(db_path: Path = DB_PATH) -> None:
             )
         if "enc_key" not in ucols:
             await db.execute("ALTER TABLE users ADD COLUMN enc_key TEXT")
+        if "quota_bytes" not in ucols:
+            await db.execute("ALTER TABLE users ADD COLUMN quota_bytes INTEGER")
+        cur = await db.execute("PRAGMA table_info(shared_folders)")
+        if "quota_bytes" not in {row[1] for row in await cur.fetchall()}:
+            await db.execute("ALTER TABLE shared_folders ADD COLUMN quota_bytes INTEGER")
+
+        # 既存の tags 列を正規化テーブルへ移行する (初回のみ)
+        cur = await db.execute("SELECT 1 FROM file_tags LIMIT 1")
+        if await cur.fetchone() is None:
+            for kind, sql in (
+                ("file", "SELECT id, user_id, tags FROM files WHERE tags != ''"),
+                ("shared", "SELECT id, folder_id, tags FROM shared_files WHERE tags != ''"),
+            ):
+                cur = await db.execute(sql)
+                rows = [(fid, owner, parse_tags(tags)) for fid, owner, tags in await cur.fetchall()]
+                await db.executemany(
+                    "INSERT OR IGNORE INTO tags (name) VALUES (?)",
+                    {(name,) for _, _, names in rows for name in names},
+                )
+                await db.executemany(
+                    "INSERT OR IGNORE INTO file_tags (kind, file_id, tag_id, owner) "
+                    "SELECT ?, ?, id, ? FROM tags WHERE name = ?",
+                    [(kind, fid, owner, name) for fid, owner, names in rows for name in names],
+                )
+
+        # 既存のファイルを検索用テーブルへ取り込む (初回のみ)
+        cur = await db.execute("SELECT 1 FROM search_docs LIMIT 1")
+        if await cur.fetchone() is None:
+            await db.execute(
+                "INSERT OR IGNORE INTO search_docs (kind, file_id, owner, name, tags) "
+                "SELECT 'file', id, user_id, original_name, tags FROM files"
+            )
+            await db.execute(
+                "INSERT OR IGNORE INTO search_docs (kind, file_id, owner, name, tags) "
+                "SELECT 'shared', id, folder_id, file_name, tags FROM shared_files"
+            )
+        # 既存のファイルから集計を作る (初回のみ)
+        cur = await db.execute("SELECT 1 FROM usage_stats LIMIT 1")
+        if await cur.fetchone() is None:
+            await db.executescript(REBUILD_USAGE)
+        cur = await db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'search_fts'"
+        )
+        had_fts = await cur.fetchone() is not None
+        try:
+            await db.executescript(SEARCH_SCHEMA)
+        except sqlite3.OperationalError:
+            pass  # FTS5 / trigram 非対応
+        else:
+            if not had_fts:
+                await db.execute("INSERT INTO search_fts (search_fts) VALUES ('rebuild')")
         await db.commit()
+
+
+def parse_tags(text: str) -> list[str]:
+    """カンマ区切りのタグ文字列を、大文字小文字を区別せず重複を除いたリストにする。"""
+    seen: set[str] = set()
+    names: list[str] = []
+    for part in text.replace("、", ",").split(","):
+        name = part.strip()
+        if name and name.lower() not in seen:
+            seen.add(name.lower())
+            names.append(name)
+    return names
+
+
+class TagTrie:
+    """タグ名の前方一致検索用トライ木。各タグのファイル数を保持する。"""
+
+    def __init__(self) -> None:
+        self.root: dict = {}
+        self.loaded_at = time.monotonic()
+
+    def add(self, name: str, delta: int = 1) -> None:
+        node = self.root
+        for ch in name.lower():
+            node = node.setdefault(ch, {})
+        entry = node.get("")
+        count = (entry[1] if entry else 0) + delta
+        if count > 0:
+            node[""] = (name, count)
+        else:
+            node.pop("", None)
+
+    def suggest(self, prefix: str, limit: int = 10) -> list[tuple[str, int]]:
+        """``prefix`` で始まるタグを件数の多い順に返す。"""
+        node = self.root
+        for ch in prefix.lower():
+            node = node.get(ch)
+            if node is None:
+                return []
+        found: list[tuple[str, int]] = []
+        stack = [node]
+        while stack:
+            cur = stack.pop()
+            for key, child in cur.items():
+                if key == "":
+                    found.append(child)
+                else:
+                    stack.append(child)
+        found.sort(key=lambda e: (-e[1], e[0].lower()))
+        return found[:limit]
+
+
+class FolderTree:
+    """ユーザーのフォルダ階層。パンくずや子フォルダを DB に問い合わせずに引く。"""
+
+    def __init__(self, rows) -> None:
+        self.loaded_at = time.monotonic()
+        self.nodes: dict[int, tuple[str, Optional[int]]] = {}
+        self._children: dict[Optional[int], list[int]] = {}
+        for r in rows:
+            self.nodes[r["id"]] = (r["name"], r["parent_id"])
+        for fid, (_name, parent) in self.nodes.items():
+            self._children.setdefault(parent, []).append(fid)
+        for ids in self._children.values():
+            ids.sort(key=lambda i: self.nodes[i][0])
+
+    def __contains__(self, folder_id: object) -> bool:
+        return folder_id in self.nodes
+
+    def ancestors(self, folder_id: Optional[int]) -> list[dict]:
+        """ルートから ``folder_id`` 自身までを順に返す (パンくず用)。"""
+        chain: list[dict] = []
+        cur = folder_id
+        # 壊れた親参照で循環していても止まるようノード数で打ち切る
+        while cur in self.nodes and len(chain) <= len(self.nodes):
+            name, parent = self.nodes[cur]
+            chain.append({"id": cur, "name": name})
+            cur = parent
+        chain.reverse()
+        return chain
+
+    def children(self, parent_id: Optional[int]) -> list[dict]:
+        return [
+            {"id": i, "name": self.nodes[i][0]} for i in self._children.get(parent_id, [])
+        ]
+
+    def subtree(self, folder_id: int) -> list[int]:
+        """``folder_id`` とその子孫の id。"""
+        if folder_id not in self.nodes:
+            return []
+        found, stack = [], [folder_id]
+        while stack:
+            cur = stack.pop()
+            found.append(cur)
+            stack.extend(self._children.get(cur, []))
+        return found
+
+
+def _like_snippet(body: str, word: str, width: int = 40) -> str:
+    """LIKE 検索用に本文中の一致箇所の前後を切り出す。"""
+    pos = body.lower().find(word.lower())
+    if pos < 0:
+        return ""
+    start = max(0, pos - width)
+    end = pos + len(word)
+    return (
+        ("…" if start else "")
+        + body[start:pos]
+        + HIGHLIGHT_START
+        + body[pos:end]
+        + HIGHLIGHT_END
+        + body[end : end + width]
+        + ("…" if end + width < len(body) else "")
+    )
 
 
 # ───────────────────────────────────────────
@@ -207,30 +847,104 @@ class Database:
     def __init__(self, db_path: Path = DB_PATH):
         self.db_path = db_path
         self.conn: aiosqlite.Connection | None = None
+        self._fts: Optional[bool] = None  # search_fts の有無 (初回検索時に確認)
+        self._tag_tries: dict[tuple[str, int], TagTrie] = {}
+        self._folder_trees: dict[int, FolderTree] = {}
+        self.login_throttle = LoginThrottle()
+        # 文を実行するたびに (sql, params, 秒) で呼ばれる。/metrics などが登録する
+        self.query_hooks: list[Callable[[str, Any, float], None]] = []
+        # 文ごとの集計と遅い文の記録 (DB と同じ場所の slow_queries.jsonl にも残す)
+        self.query_log = QueryLog(
+            self.explain, log_path=Path(db_path).parent / "slow_queries.jsonl"
+        )
+        self.query_hooks.append(self.query_log.record)
+
+    async def _connect(self) -> aiosqlite.Connection:
+        """接続を開き、``conn.execute`` を所要時間を測るものに差し替える。
+
+        直接 ``self.conn.execute`` を呼ぶメソッドも多いので、接続側で測れば
+        すべての文が対象になる。時間は最初の行が返るまで (SQLite では並べ替えや
+        集計はこの間に済む)。
+        """
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = aiosqlite.Row
+        raw = conn.execute
+        hooks = self.query_hooks
+
+        async def execute(sql: str, parameters: Any = None):
+            start = time.perf_counter()
+            try:
+                return await raw(sql, parameters)
+            finally:
+                if hooks:
+                    elapsed = time.perf_counter() - start
+                    for hook in hooks:
+                        hook(sql, parameters, elapsed)
+
+        conn.execute = execute  # type: ignore[method-assign]
+        return conn
 
     async def connect(self):
-        self.conn = await aiosqlite.connect(self.db_path)
+        self.conn = await self._connect()
 
     async def close(self):
         if self.conn:
+            await self.query_log.flush()
             await self.conn.close()
             self.conn = None
 
+    async def explain(self, sql: str, params: Any = ()) -> list[str]:
+        """``EXPLAIN QUERY PLAN`` の結果を、入れ子を字下げで表した行にして返す。"""
+        cur = await self.conn.execute("EXPLAIN QUERY PLAN " + sql, params or ())
+        rows = await cur.fetchall()
+        await cur.close()
+        depth = {0: -1}
+        lines = []
+        for node, parent, _, detail in rows:
+            depth[node] = depth.get(parent, -1) + 1
+            lines.append("  " * depth[node] + detail)
+        return lines
+
     async def verify_user(self, username: str, password: str) -> bool:
         """
         users テーブルから pw_hash を取り出し、
         平文 password を scrypt で検証して一致すれば True を返す。
+
+        失敗が続いているユーザー名は scrypt を走らせる前に ``LoginThrottled`` で断り、
+        ハッシュ用スレッドが埋まっていれば ``PasswordHashBusy`` を送出する。
         """
-        # 1. ハッシュを取得
+        # 1. 高コストなハッシュ計算の前に失敗回数を確認
+        wait = self.login_throttle.retry_after(username)
+        if wait > 0:
+            raise LoginThrottled(wait)
+
+        # 2. ハッシュを取得
         row = await self.fetchone(
             "SELECT pw_hash FROM users WHERE username = ?", username
         )
         if not row:
+            self.login_throttle.failure(username)
+            return False
+
+        # 3. 専用スレッドで scrypt を検証
+        if not await password_hasher.verify(password, row["pw_hash"]):
+            self.login_throttle.failure(username)
             return False
+        self.login_throttle.success(username)
 
-        # 2. verify_password ヘルパーでチェック
-        #    verify_password(password: str, hashed: str) -> bool
-        return verify_password(password, row["pw_hash"])
+        # 4. パラメータ変更後の初回ログインで新しい設定のハッシュへ置き換える
+        if needs_rehash(row["pw_hash"]):
+            try:
+                new_hash = await password_hasher.hash(password, bounded=True)
+            except PasswordHashBusy:
+                return True  # 混雑時は次回のログインに回す
+            await self.execute(
+                "UPDATE users SET pw_hash=? WHERE username=? AND pw_hash=?",
+                new_hash,
+                username,
+                row["pw_hash"],
+            )
+        return True
 
     async def get_user_pk(self, discord_id: int) -> Optional[int]:
         """Discord ユーザID から users.id（PK）を返す"""
@@ -260,8 +974,7 @@ class Database:
         """Bot 常駐用：非コンテキストで接続を確立する"""
         if self.conn:  # すでに開いていれば何もしない
             return
-        self.conn = await aiosqlite.connect(self.db_path)
-        self.conn.row_factory = aiosqlite.Row
+        self.conn = await self._connect()
 
     async def create_user_folder(
         self, user_id: int, name: str, parent_id: Optional[int] = None
@@ -271,6 +984,7 @@ class Database:
             (user_id, name, parent_id),
         )
         await self.conn.commit()
+        self._folder_trees.pop(user_id, None)
         return cur.lastrowid
 
     async def create_shared_folder(
@@ -368,6 +1082,7 @@ class Database:
             "VALUES (?, ?, ?, ?, ?, 1, NULL, strftime('%s','now'), 0, ?)",
             (file_id, folder_id, filename, path, os.path.getsize(path), tags),
         )
+        await self._set_file_tags("shared", file_id, tags)
         await self.conn.commit()
 
     async def get_shared_file(self, file_id: str) -> Optional[aiosqlite.Row]:
@@ -388,11 +1103,11 @@ class Database:
 
     # --- context manager ---
     async def __aenter__(self):  # type: ignore[override]
-        self.conn = await aiosqlite.connect(self.db_path)
-        self.conn.row_factory = aiosqlite.Row
+        self.conn = await self._connect()
         return self
 
     async def __aexit__(self, *_):  # type: ignore[override]
+        await self.query_log.flush()
         await self.conn.close()
 
     async def commit(self):
@@ -421,11 +1136,12 @@ class Database:
 
     # ユーザ
     async def add_user(self, discord_id: int, username: str, password: str):
+        pw_hash = await password_hasher.hash(password)
         await self.execute(
             "INSERT OR REPLACE INTO users(discord_id, username, pw_hash, created_at) VALUES (?,?,?,?)",
             discord_id,
             username,
-            scrypt_hash(password),
+            pw_hash,
             dt.datetime.utcnow().isoformat(),
         )
 
@@ -457,31 +1173,113 @@ class Database:
             parent_id,
         )
 
-    async def delete_user_folder(self, folder_id: int) -> None:
+    async def folder_tree(self, user_id: int) -> FolderTree:
+        """ユーザーのフォルダ階層を 1 クエリで読み、キャッシュして返す。"""
+        tree = self._folder_trees.get(user_id)
+        if tree is None or time.monotonic() - tree.loaded_at > FOLDER_TREE_TTL:
+            tree = FolderTree(
+                await self.fetchall(
+                    "SELECT id, name, parent_id FROM user_folders WHERE user_id=?",
+                    user_id,
+                )
+            )
+            self._folder_trees[user_id] = tree
+        return tree
+
+    async def folder_ancestors(self, folder_id: int) -> list[dict]:
+        """ルートから ``folder_id`` 自身までのフォルダを 1 クエリで返す。"""
+        rows = await self.fetchall(
+            "WITH RECURSIVE chain(id, name, parent_id, depth) AS ("
+            "  SELECT id, name, parent_id, 0 FROM user_folders WHERE id = ?"
+            "  UNION ALL"
+            "  SELECT f.id, f.name, f.parent_id, c.depth + 1"
+            "  FROM user_folders f JOIN chain c ON f.id = c.parent_id"
+            "  WHERE c.depth < 1000"
+            ") SELECT id, name FROM chain ORDER BY depth DESC",
+            folder_id,
+        )
+        return [{"id": r["id"], "name": r["name"]} for r in rows]
+
+    # 子孫フォルダを辿る CTE。先頭の SELECT で起点を決める
+    _SUBTREE_CTE = (
+        "WITH RECURSIVE subtree(id) AS ({start}"
+        "  UNION SELECT f.id FROM user_folders f JOIN subtree s ON f.parent_id = s.id"
+        ") "
+    )
+
+    async def folder_subtree(self, folder_id: int) -> list[int]:
+        """``folder_id`` とその子孫フォルダの id を 1 クエリで返す。"""
         rows = await self.fetchall(
-            "SELECT id FROM user_folders WHERE parent_id=?",
+            self._SUBTREE_CTE.format(start="SELECT id FROM user_folders WHERE id = ?")
+            + "SELECT id FROM subtree",
             folder_id,
         )
-        for r in rows:
-            await self.delete_user_folder(r["id"])
-        frows = await self.fetchall(
-            "SELECT path FROM files WHERE folder=?",
-            str(folder_id),
+        return [r["id"] for r in rows]
+
+    async def _delete_subtree(self, start: str, *params: Any) -> int:
+        """``start`` を起点とする子孫フォルダと中のファイルをまとめて削除する。
+
+        行の削除と実体の削除待ちへの登録は 1 トランザクションで行い、ファイルの
+        実体はここでは消さない (``pending_unlinks`` を参照)。登録した件数を返す。
+        """
+        cte = self._SUBTREE_CTE.format(start=start)
+        owners = await self.fetchall(
+            cte + "SELECT DISTINCT user_id FROM user_folders WHERE id IN (SELECT id FROM subtree)",
+            *params,
         )
-        for fr in frows:
-            try:
-                Path(fr["path"]).unlink(missing_ok=True)
-            except Exception:
-                pass
-        await self.execute("DELETE FROM files WHERE folder=?", str(folder_id))
-        await self.execute("DELETE FROM user_folders WHERE id=?", folder_id)
+        in_subtree = "folder IN (SELECT CAST(id AS TEXT) FROM subtree)"
+        await self.conn.execute(
+            cte + f"INSERT INTO pending_unlinks (path) SELECT path FROM files WHERE {in_subtree}",
+            params,
+        )
+        # WITH で始まる文では cursor.rowcount が -1 になるため changes() で数える
+        queued = (await self.fetchone("SELECT changes() AS n"))["n"]
+        await self.conn.execute(cte + f"DELETE FROM files WHERE {in_subtree}", params)
+        await self.conn.execute(
+            cte + "DELETE FROM user_folders WHERE id IN (SELECT id FROM subtree)", params
+        )
+        await self.conn.commit()
+        for r in owners:
+            self._folder_trees.pop(r["user_id"], None)
+            self._tag_tries.pop(("file", r["user_id"]), None)
+        return queued
+
+    async def delete_user_folder(self, folder_id: int) -> int:
+        return await self._delete_subtree("SELECT id FROM user_folders WHERE id = ?", folder_id)
 
     async def delete_all_subfolders(
         self, user_id: int, parent_id: Optional[int] = None
+    ) -> int:
+        if parent_id is None:
+            return await self._delete_subtree(
+                "SELECT id FROM user_folders WHERE user_id = ? AND parent_id IS NULL",
+                user_id,
+            )
+        else:
+            return await self._delete_subtree(
+                "SELECT id FROM user_folders WHERE user_id = ? AND parent_id = ?",
+                user_id,
+                parent_id,
+            )
+
+    async def move_user_folder(
+        self, folder_id: int, new_parent_id: Optional[int]
     ) -> None:
-        rows = await self.list_user_folders(user_id, parent_id)
-        for r in rows:
-            await self.delete_user_folder(r["id"])
+        """フォルダを ``new_parent_id`` の下 (``None`` ならルート) へ移す。
+
+        自分自身や子孫の下へは移せない (``ValueError``)。
+        """
+        if new_parent_id is not None and new_parent_id in await self.folder_subtree(
+            folder_id
+        ):
+            raise ValueError("cannot move a folder into its own subtree")
+        await self.conn.execute(
+            "UPDATE user_folders SET parent_id=? WHERE id=?", (new_parent_id, folder_id)
+        )
+        await self.conn.commit()
+        row = await self.fetchone("SELECT user_id FROM user_folders WHERE id=?", folder_id)
+        if row is not None:
+            self._folder_trees.pop(row["user_id"], None)
 
     # ファイル
     async def add_file(
@@ -513,55 +1311,553 @@ class Database:
                 gdrive_id,
             ),
         )
+        await self._set_file_tags("file", file_id, tags)
         await self.conn.commit()
 
-    async def list_files(self, user_id: int, folder: str = ""):
-        return await self.fetchall(
-            "SELECT id, original_name, size, uploaded_at, tags "
-            "FROM   files "
-            "WHERE  user_id=? AND folder=? "
-            "ORDER  BY uploaded_at DESC",
-            user_id,
-            folder,
-        )
-
     async def get_file(self, file_id: str):
         return await self.fetchone("SELECT * FROM files WHERE id=?", file_id)
 
     async def delete_file(self, file_id: str):
+        row = await self.fetchone("SELECT user_id FROM files WHERE id=?", file_id)
         await self.execute("DELETE FROM files WHERE id=?", file_id)
+        if row:
+            self._tag_tries.pop(("file", row["user_id"]), None)
 
-    async def delete_all_files(self, user_id: int):
-        rows = await self.fetchall("SELECT path FROM files WHERE user_id=?", user_id)
-        for r in rows:
-            try:
-                Path(r["path"]).unlink(missing_ok=True)
-            except Exception:
-                pass
-        await self.execute("DELETE FROM files WHERE user_id=?", user_id)
+    async def delete_all_files(self, user_id: int) -> int:
+        """ユーザーの全ファイルを削除し、実体を削除待ちに登録した件数を返す。"""
+        cur = await self.conn.execute(
+            "INSERT INTO pending_unlinks (path) SELECT path FROM files WHERE user_id=?",
+            (user_id,),
+        )
+        queued = cur.rowcount
+        await self.conn.execute("DELETE FROM files WHERE user_id=?", (user_id,))
+        await self.conn.commit()
+        self._tag_tries.pop(("file", user_id), None)
+        return queued
+
+    async def pending_unlinks(self, limit: int) -> list[aiosqlite.Row]:
+        """削除待ちの実体を古い順に ``limit`` 件返す。"""
+        return await self.fetchall(
+            "SELECT id, path FROM pending_unlinks ORDER BY id LIMIT ?", limit
+        )
+
+    async def finish_unlinks(self, ids: list[int]) -> None:
+        if not ids:
+            return
+        marks = ",".join("?" * len(ids))
+        await self.execute(f"DELETE FROM pending_unlinks WHERE id IN ({marks})", *ids)
+
+    async def count_pending_unlinks(self) -> int:
+        row = await self.fetchone("SELECT COUNT(*) AS n FROM pending_unlinks")
+        return row["n"] if row else 0
 
     async def update_tags(self, file_id: str, tags: str):
-        await self.execute("UPDATE files SET tags=? WHERE id=?", tags, file_id)
+        await self.conn.execute("UPDATE files SET tags=? WHERE id=?", (tags, file_id))
+        await self._set_file_tags("file", file_id, tags)
+        await self.conn.commit()
 
     async def update_shared_tags(self, file_id: str, tags: str):
-        await self.execute("UPDATE shared_files SET tags=? WHERE id=?", tags, file_id)
+        await self.conn.execute(
+            "UPDATE shared_files SET tags=? WHERE id=?", (tags, file_id)
+        )
+        await self._set_file_tags("shared", file_id, tags)
+        await self.conn.commit()
 
-    async def search_files(self, user_id: int, term: str, folder: str = ""):
-        like = f"%{term}%"
-        return await self.fetchall(
-            "SELECT * FROM files WHERE user_id=? AND folder=? AND tags LIKE ?",
+    async def _set_file_tags(self, kind: str, file_id: str, tags: str) -> None:
+        """file_tags をタグ文字列に合わせて置き換える。コミットは呼び出し側で行う。"""
+        table, owner_col = ("files", "user_id") if kind == "file" else ("shared_files", "folder_id")
+        row = await self.fetchone(f"SELECT {owner_col} FROM {table} WHERE id=?", file_id)
+        if row is None:
+            return
+        owner = row[0]
+        old = {
+            r[0]
+            for r in await self.fetchall(
+                "SELECT t.name FROM file_tags ft JOIN tags t ON t.id = ft.tag_id "
+                "WHERE ft.kind=? AND ft.file_id=?",
+                kind,
+                file_id,
+            )
+        }
+        names = parse_tags(tags)
+        await self.conn.execute(
+            "DELETE FROM file_tags WHERE kind=? AND file_id=?", (kind, file_id)
+        )
+        if names:
+            await self.conn.executemany(
+                "INSERT OR IGNORE INTO tags (name) VALUES (?)", [(n,) for n in names]
+            )
+            await self.conn.executemany(
+                "INSERT OR IGNORE INTO file_tags (kind, file_id, tag_id, owner) "
+                "SELECT ?, ?, id, ? FROM tags WHERE name = ?",
+                [(kind, file_id, owner, n) for n in names],
+            )
+
+        # 読み込み済みのトライ木には差分だけ反映する
+        trie = self._tag_tries.get((kind, owner))
+        if trie is not None:
+            new = {n.lower(): n for n in names}
+            old_lower = {n.lower(): n for n in old}
+            for key, name in new.items():
+                if key not in old_lower:
+                    trie.add(name, 1)
+            for key, name in old_lower.items():
+                if key not in new:
+                    trie.add(name, -1)
+
+    async def folder_version(self, user_id: int, folder: str = "") -> int:
+        """(ユーザー, フォルダ) の更新カウンタ。中身が変わるたびに増える。"""
+        row = await self.fetchone(
+            "SELECT version FROM folder_versions WHERE user_id=? AND folder=?",
             user_id,
             folder,
-            like,
         )
+        return row["version"] if row else 0
 
-    async def search_shared_files(self, folder_id: int, term: str):
-        like = f"%{term}%"
+    async def touch_file(self, file_id: str) -> None:
+        """プレビューや HLS など行の外で変わったものがあるとき、ファイルのフォルダの版を上げる。"""
+        await self.conn.execute(
+            """
+            UPDATE folder_versions SET version = version + 1
+            WHERE (user_id, folder) = (SELECT user_id, folder FROM files WHERE id = ?)
+            """,
+            (file_id,),
+        )
+        await self.conn.commit()
+
+    async def user_usage(self, user_id: int) -> dict:
+        """ユーザーの全ファイルの件数・合計バイト数・最終更新時刻。"""
+        row = await self.fetchone(
+            "SELECT file_count, total_size, last_modified FROM usage_stats "
+            "WHERE scope='user' AND owner=? AND folder=''",
+            user_id,
+        )
+        return dict(row) if row else dict(EMPTY_USAGE)
+
+    async def folder_usage(self, user_id: int) -> dict[str, dict]:
+        """フォルダ (``files.folder`` の値) ごとの集計。ファイルの無いフォルダは含まない。"""
+        rows = await self.fetchall(
+            "SELECT folder, file_count, total_size, last_modified FROM usage_stats "
+            "WHERE scope='folder' AND owner=? AND file_count > 0",
+            user_id,
+        )
+        return {
+            r["folder"]: {k: r[k] for k in ("file_count", "total_size", "last_modified")}
+            for r in rows
+        }
+
+    async def member_shared_usage(self, discord_id: int) -> list[aiosqlite.Row]:
+        """参加している共有フォルダを集計付きで名前順に返す。"""
         return await self.fetchall(
-            "SELECT * FROM shared_files WHERE folder_id=? AND tags LIKE ?",
-            folder_id,
-            like,
+            "SELECT sf.id, sf.name, "
+            "       COALESCE(u.file_count, 0) AS file_count, "
+            "       COALESCE(u.total_size, 0) AS total_size, "
+            "       COALESCE(u.last_modified, 0) AS last_modified "
+            "FROM shared_folders sf "
+            "JOIN shared_folder_members m ON m.folder_id = sf.id "
+            "LEFT JOIN usage_stats u "
+            "  ON u.scope = 'shared' AND u.owner = sf.id AND u.folder = '' "
+            "WHERE m.discord_user_id = ? ORDER BY sf.name",
+            discord_id,
+        )
+
+    async def storage_quota(self, scope: str, owner: int) -> tuple[Optional[int], int]:
+        """(個別に設定された上限, 使用中のバイト数) を返す。
+
+        ``scope`` は ``"user"`` (owner は users.id) か ``"shared"`` (shared_folders.id)。
+        上限が未設定なら ``None`` (既定値を使う)。
+        """
+        table = {"user": "users", "shared": "shared_folders"}[scope]
+        row = await self.fetchone(
+            f"SELECT t.quota_bytes, COALESCE(s.total_size, 0) AS used FROM {table} t "
+            "LEFT JOIN usage_stats s ON s.scope = ? AND s.owner = t.id AND s.folder = '' "
+            "WHERE t.id = ?",
+            scope,
+            owner,
+        )
+        if row is None:
+            return None, 0
+        return row["quota_bytes"], row["used"]
+
+    async def set_storage_quota(
+        self, scope: str, owner: int, quota_bytes: Optional[int]
+    ) -> None:
+        """個別の上限を設定する。``None`` で既定値に戻し、0 は無制限。"""
+        table = {"user": "users", "shared": "shared_folders"}[scope]
+        await self.execute(f"UPDATE {table} SET quota_bytes=? WHERE id=?", quota_bytes, owner)
+
+    async def rebuild_usage(self) -> None:
+        """集計をファイル表から作り直す (トリガー導入前の値の補正用)。"""
+        await self.conn.executescript(REBUILD_USAGE)
+        await self.conn.commit()
+
+    async def list_files(
+        self,
+        user_id: int,
+        folder: str = "",
+        limit: Optional[int] = None,
+        offset: int = 0,
+        tags: Optional[list[str]] = None,
+        match_all: bool = True,
+    ):
+        """フォルダ内のファイルを新しい順に返す (``limit`` を省くと全件)。
+
+        ``tags`` を指定すると、``match_all`` が真ならすべてのタグを持つ
+        ファイル (AND)、偽ならいずれかを持つファイル (OR) に絞り込む。
+        """
+        sql = "SELECT * FROM files WHERE user_id = ? AND folder = ? "
+        params: list[Any] = [user_id, folder]
+        names = parse_tags(",".join(tags or []))
+        if names:
+            marks = ",".join("?" * len(names))
+            sql += (
+                "AND id IN (SELECT ft.file_id FROM file_tags ft "
+                "JOIN tags t ON t.id = ft.tag_id "
+                f"WHERE ft.kind = 'file' AND ft.owner = ? AND t.name IN ({marks}) "
+                "GROUP BY ft.file_id"
+            )
+            params += [user_id, *names]
+            if match_all:
+                sql += " HAVING COUNT(*) = ?"
+                params.append(len(names))
+            sql += ") "
+        sql += "ORDER BY uploaded_at DESC"
+        if limit is None:
+            return await self.fetchall(sql, *params)
+        return await self.fetchall(sql + " LIMIT ? OFFSET ?", *params, limit, offset)
+
+    async def list_files_page(
+        self,
+        user_id: int,
+        folder: str,
+        limit: int,
+        after: Optional[tuple[str, str]] = None,
+        name: Optional[str] = None,
+    ):
+        """フォルダ内のファイルを ``(uploaded_at, id)`` の降順で ``limit`` 件返す。
+
+        ``after`` に前ページ最後の ``(uploaded_at, id)`` を渡すとその続きから返す。
+        OFFSET を使わないので深いページでもインデックスを読み飛ばさない。
+        ``name`` を指定するとフォルダを問わずファイル名の部分一致で絞り込む。
+        """
+        sql = (
+            "SELECT id, folder, original_name, size, uploaded_at, tags, is_shared, "
+            "token, expires_at FROM files WHERE user_id = ? "
+        )
+        params: list[Any] = [user_id]
+        if name:
+            escaped = name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            sql += "AND original_name LIKE ? ESCAPE '\\' "
+            params.append(f"%{escaped}%")
+        else:
+            sql += "AND folder = ? "
+            params.append(folder)
+        if after is not None:
+            sql += "AND (uploaded_at < ? OR (uploaded_at = ? AND id < ?)) "
+            params += [after[0], after[0], after[1]]
+        sql += "ORDER BY uploaded_at DESC, id DESC LIMIT ?"
+        return await self.fetchall(sql, *params, limit)
+
+    async def latest_change(self, user_id: Optional[int] = None) -> int:
+        """ユーザーの変更履歴の最新 seq (履歴が無ければ 0)。
+
+        ``user_id`` を省くと全ユーザーを通した最新 seq を返す。
+        """
+        if user_id is None:
+            row = await self.fetchone("SELECT MAX(seq) AS seq FROM changes")
+        else:
+            row = await self.fetchone(
+                "SELECT MAX(seq) AS seq FROM changes WHERE user_id=?", user_id
+            )
+        return row["seq"] or 0
+
+    async def changes_floor(self, user_id: int) -> int:
+        """圧縮で差分を追えなくなった位置。``since`` がこれより前なら全件を取り直す。"""
+        row = await self.fetchone(
+            "SELECT seq FROM changes_floor WHERE user_id=?", user_id
+        )
+        return row["seq"] if row else 0
+
+    async def changes_since(
+        self, user_id: int, since: int, limit: int = 1000
+    ) -> tuple[dict[tuple[str, str], str], int, bool]:
+        """``since`` より後の変更を ``{(kind, item_id): op}`` にまとめて返す。
+
+        同じ項目への複数の変更は最後の操作だけが残る。戻り値は
+        ``(変更, 次回の since, まだ続きがあるか)``。
+        """
+        rows = await self.fetchall(
+            "SELECT seq, kind, item_id, op FROM changes "
+            "WHERE user_id=? AND seq>? ORDER BY seq LIMIT ?",
+            user_id,
+            since,
+            limit,
+        )
+        latest: dict[tuple[str, str], str] = {}
+        for r in rows:
+            latest.pop((r["kind"], r["item_id"]), None)
+            latest[(r["kind"], r["item_id"])] = r["op"]
+        last = rows[-1]["seq"] if rows else since
+        return latest, last, len(rows) == limit
+
+    async def compact_changes(
+        self, retention_sec: int, now: Optional[int] = None
+    ) -> int:
+        """変更履歴を圧縮し、削除した行数を返す。
+
+        1. 同じ項目の古い変更は最新の 1 行に置き換わっているので消す。どの
+           ``since`` から読んでも結果は変わらない。
+        2. ``retention_sec`` より古い削除の記録 (墓標) を消し、その位置を
+           ``changes_floor`` に残す。それより前から追うクライアントは全件を取り直す。
+        """
+        now = int(time.time()) if now is None else now
+        cutoff = now - retention_sec
+        cur = await self.conn.execute(
+            "DELETE FROM changes WHERE seq NOT IN ("
+            "SELECT MAX(seq) FROM changes GROUP BY user_id, kind, item_id)"
+        )
+        removed = cur.rowcount
+        await self.conn.execute(
+            "INSERT INTO changes_floor (user_id, seq) "
+            "SELECT user_id, MAX(seq) FROM changes WHERE op='delete' AND at < ? "
+            "GROUP BY user_id "
+            "ON CONFLICT(user_id) DO UPDATE SET seq = MAX(seq, excluded.seq)",
+            (cutoff,),
+        )
+        cur = await self.conn.execute(
+            "DELETE FROM changes WHERE op='delete' AND at < ?", (cutoff,)
+        )
+        removed += cur.rowcount
+        await self.conn.commit()
+        return removed
+
+    async def _fetch_by_ids(self, sql: str, owner: int, ids: Optional[list]):
+        if ids is None:
+            return await self.fetchall(sql, owner)
+        rows = []
+        # SQLite の変数上限を超えないよう分割して引く
+        for i in range(0, len(ids), 500):
+            chunk = ids[i : i + 500]
+            rows += await self.fetchall(
+                sql + f" AND id IN ({','.join('?' * len(chunk))})", owner, *chunk
+            )
+        return rows
+
+    async def get_user_files(self, user_id: int, ids: Optional[list[str]] = None):
+        """ユーザーのファイル (``ids`` 指定時はその中で存在するもの) を返す。"""
+        return await self._fetch_by_ids(
+            "SELECT id, folder, original_name, size, uploaded_at, tags, is_shared, "
+            "token, expires_at FROM files WHERE user_id=?",
+            user_id,
+            ids,
+        )
+
+    async def get_user_folders(self, user_id: int, ids: Optional[list[int]] = None):
+        """ユーザーのフォルダ (``ids`` 指定時はその中で存在するもの) を返す。"""
+        return await self._fetch_by_ids(
+            "SELECT id, name, parent_id FROM user_folders WHERE user_id=?",
+            user_id,
+            ids,
+        )
+
+    async def get_member_shared_folders(
+        self, user_id: int, ids: Optional[list[int]] = None
+    ):
+        """ユーザーが参加している共有フォルダ (``ids`` 指定時はその中のもの)。"""
+        return await self._fetch_by_ids(
+            "SELECT id, name FROM shared_folders WHERE id IN ("
+            "SELECT m.folder_id FROM shared_folder_members m "
+            "JOIN users u ON u.discord_id = m.discord_user_id WHERE u.id = ?)",
+            user_id,
+            ids,
+        )
+
+    async def get_member_shared_files(
+        self, user_id: int, ids: Optional[list[str]] = None
+    ):
+        """ユーザーが参加している共有フォルダ内のファイル (``ids`` 指定時はその中のもの)。"""
+        return await self._fetch_by_ids(
+            "SELECT id, folder_id, file_name, size, uploaded_at, tags, is_shared, "
+            "token, expires_at FROM shared_files WHERE folder_id IN ("
+            "SELECT m.folder_id FROM shared_folder_members m "
+            "JOIN users u ON u.discord_id = m.discord_user_id WHERE u.id = ?)",
+            user_id,
+            ids,
+        )
+
+    async def tag_facets(
+        self, user_id: int, folder: Optional[str] = None, limit: int = 100
+    ) -> list[dict]:
+        """ユーザーのタグごとのファイル数を多い順に返す。``folder`` で絞り込める。"""
+        sql = (
+            "SELECT t.name, COUNT(*) AS count FROM file_tags ft "
+            "JOIN tags t ON t.id = ft.tag_id "
+        )
+        params: list[Any] = []
+        if folder is not None:
+            sql += "JOIN files f ON f.id = ft.file_id AND f.folder = ? "
+            params.append(folder)
+        sql += (
+            "WHERE ft.kind = 'file' AND ft.owner = ? "
+            "GROUP BY ft.tag_id ORDER BY count DESC, t.name LIMIT ?"
+        )
+        rows = await self.fetchall(sql, *params, user_id, limit)
+        return [{"name": r["name"], "count": r["count"]} for r in rows]
+
+    async def suggest_tags(
+        self, user_id: int, prefix: str, limit: int = 10
+    ) -> list[dict]:
+        """ユーザーのタグから ``prefix`` で始まるものを件数順に返す。"""
+        key = ("file", user_id)
+        trie = self._tag_tries.get(key)
+        if trie is None or time.monotonic() - trie.loaded_at > TAG_TRIE_TTL:
+            trie = TagTrie()
+            for r in await self.fetchall(
+                "SELECT t.name, COUNT(*) FROM file_tags ft JOIN tags t ON t.id = ft.tag_id "
+                "WHERE ft.kind = 'file' AND ft.owner = ? GROUP BY ft.tag_id",
+                user_id,
+            ):
+                trie.add(r[0], r[1])
+            self._tag_tries[key] = trie
+        return [{"name": n, "count": c} for n, c in trie.suggest(prefix.strip(), limit)]
+
+    async def search_files(self, user_id: int, term: str, folder: str = ""):
+        """自分のファイルのうち ``folder`` 直下にあるものを検索する。"""
+        hits = await self._search_docs(
+            term, "d.kind = 'file' AND d.owner = ? AND f.folder = ?", [user_id, folder], 1000
+        )
+        ids = [h["id"] for h in hits]
+        if not ids:
+            return []
+        marks = ",".join("?" * len(ids))
+        rows = await self.fetchall(
+            f"SELECT * FROM files WHERE folder=? AND id IN ({marks})", folder, *ids
         )
+        order = {fid: n for n, fid in enumerate(ids)}
+        return sorted(rows, key=lambda r: order[r["id"]])
+
+    async def search_shared_files(self, folder_id: int, term: str):
+        """共有フォルダ内のファイルを検索する。"""
+        hits = await self._search_docs(
+            term, "d.kind = 'shared' AND d.owner = ?", [folder_id], 1000
+        )
+        ids = [h["id"] for h in hits]
+        if not ids:
+            return []
+        marks = ",".join("?" * len(ids))
+        rows = await self.fetchall(
+            f"SELECT * FROM shared_files WHERE id IN ({marks})", *ids
+        )
+        order = {fid: n for n, fid in enumerate(ids)}
+        return sorted(rows, key=lambda r: order[r["id"]])
+
+    async def search(
+        self,
+        user_id: int,
+        discord_id: Optional[int],
+        term: str,
+        *,
+        shared: bool = True,
+        limit: int = 50,
+    ) -> list[dict]:
+        """ファイル名・タグ・本文を横断して検索する。
+
+        自分の全フォルダと、``discord_id`` がメンバーの共有フォルダが対象。
+        FTS5 が使える場合は BM25 (名前 > タグ > 本文) の順に並べる。
+        戻り値の ``snippet`` は一致箇所を ``HIGHLIGHT_START`` /
+        ``HIGHLIGHT_END`` で囲んだ抜粋。
+        """
+        scope = "(d.kind = 'file' AND d.owner = ?)"
+        params: list[Any] = [user_id]
+        if shared and discord_id is not None:
+            scope = (
+                f"({scope} OR (d.kind = 'shared' AND d.owner IN ("
+                "SELECT folder_id FROM shared_folder_members WHERE discord_user_id = ?)))"
+            )
+            params.append(discord_id)
+        return await self._search_docs(term, scope, params, limit)
+
+    async def set_search_text(self, kind: str, file_id: str, text: str) -> None:
+        """抽出した本文を検索索引に登録する。``kind`` は 'file' か 'shared'。"""
+        await self.execute(
+            "UPDATE search_docs SET body=? WHERE kind=? AND file_id=?",
+            text,
+            kind,
+            file_id,
+        )
+
+    async def _has_fts(self) -> bool:
+        if self._fts is None:
+            row = await self.fetchone(
+                "SELECT 1 FROM sqlite_master WHERE name = 'search_fts'"
+            )
+            self._fts = row is not None
+        return self._fts
+
+    async def _search_docs(
+        self, term: str, scope: str, params: list[Any], limit: int
+    ) -> list[dict]:
+        words = term.split()
+        if not words:
+            return []
+        select = (
+            "SELECT d.kind, d.file_id AS id, d.owner, d.name AS original_name, d.tags, "
+            "COALESCE(uf.name, sf.name, '/') AS location, {snippet} AS snippet "
+        )
+        # files.folder は user_folders.id の文字列 (ルートは '')。表示にはフォルダ名を使う
+        joins = (
+            "LEFT JOIN files f ON d.kind = 'file' AND f.id = d.file_id "
+            "LEFT JOIN user_folders uf ON uf.id = f.folder "
+            "LEFT JOIN shared_folders sf ON d.kind = 'shared' AND sf.id = d.owner "
+        )
+        if await self._has_fts() and all(len(w) >= FTS_MIN_TERM for w in words):
+            match = " ".join('"' + w.replace('"', '""') + '"' for w in words)
+            snippet = (
+                f"snippet(search_fts, -1, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '…', 24)"
+            )
+            rows = await self.fetchall(
+                select.format(snippet=snippet)
+                + "FROM search_fts JOIN search_docs d ON d.id = search_fts.rowid "
+                + joins
+                + f"WHERE search_fts MATCH ? AND {scope} "
+                "ORDER BY bm25(search_fts, 10.0, 5.0, 1.0) LIMIT ?",
+                match,
+                *params,
+                limit,
+            )
+            return [dict(r) for r in rows]
+
+        # 短い語や FTS5 が無い環境では LIKE で代替する
+        conds, like_params = [], []
+        for w in words:
+            like = "%" + w.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            conds.append(
+                "(d.name LIKE ? ESCAPE '\\' OR d.tags LIKE ? ESCAPE '\\' "
+                "OR d.body LIKE ? ESCAPE '\\')"
+            )
+            like_params += [like, like, like]
+        rows = await self.fetchall(
+            select.format(snippet="''")
+            + ", d.body FROM search_docs d "
+            + joins
+            + f"WHERE {scope} AND "
+            + " AND ".join(conds)
+            + " ORDER BY (d.name LIKE ? ESCAPE '\\') DESC, d.id DESC LIMIT ?",
+            *params,
+            *like_params,
+            like_params[0],
+            limit,
+        )
+        result = []
+        for r in rows:
+            d = dict(r)
+            body = d.pop("body")
+            d["snippet"] = next(
+                filter(None, (_like_snippet(t, words[0]) for t in (d["original_name"], d["tags"], body))),
+                "",
+            )
+            result.append(d)
+        return result
 
     async def delete_all_shared_files(self, folder_id: int):
         rows = await self.fetchall(
@@ -575,6 +1871,65 @@ class Database:
                 pass
         await self.execute("DELETE FROM shared_files WHERE folder_id=?", folder_id)
 
+    # Google Drive ミラーリングキュー
+    async def enqueue_gdrive_sync(
+        self, file_id: str, user_id: int, path: str, file_name: str
+    ) -> None:
+        await self.execute(
+            "INSERT OR REPLACE INTO gdrive_sync "
+            "(file_id, user_id, path, file_name, session_uri, status, attempts, updated_at) "
+            "VALUES (?, ?, ?, ?, NULL, 'pending', 0, strftime('%s','now'))",
+            file_id,
+            user_id,
+            path,
+            file_name,
+        )
+
+    async def get_gdrive_sync(self, file_id: str) -> Optional[aiosqlite.Row]:
+        return await self.fetchone("SELECT * FROM gdrive_sync WHERE file_id=?", file_id)
+
+    async def list_pending_gdrive_sync(self):
+        return await self.fetchall(
+            "SELECT * FROM gdrive_sync WHERE status='pending' ORDER BY updated_at"
+        )
+
+    async def set_gdrive_session(self, file_id: str, session_uri: Optional[str]) -> None:
+        """レジューム用のアップロードセッション URI を保存"""
+        await self.execute(
+            "UPDATE gdrive_sync SET session_uri=?, updated_at=strftime('%s','now') "
+            "WHERE file_id=?",
+            session_uri,
+            file_id,
+        )
+
+    async def fail_gdrive_sync(
+        self, file_id: str, error: str, max_attempts: int
+    ) -> int:
+        """失敗回数を加算し、上限に達したら status を failed にする"""
+        await self.execute(
+            "UPDATE gdrive_sync SET attempts=attempts+1, last_error=?, "
+            "status=CASE WHEN attempts+1 >= ? THEN 'failed' ELSE 'pending' END, "
+            "updated_at=strftime('%s','now') WHERE file_id=?",
+            error[:500],
+            max_attempts,
+            file_id,
+        )
+        row = await self.fetchone(
+            "SELECT attempts FROM gdrive_sync WHERE file_id=?", file_id
+        )
+        return row["attempts"] if row else max_attempts
+
+    async def finish_gdrive_sync(self, file_id: str, gdrive_id: str) -> None:
+        """ミラー完了: files.gdrive_id を設定しキューから外す"""
+        await self.conn.execute(
+            "UPDATE files SET gdrive_id=? WHERE id=?", (gdrive_id, file_id)
+        )
+        await self.conn.execute("DELETE FROM gdrive_sync WHERE file_id=?", (file_id,))
+        await self.conn.commit()
+
+    async def delete_gdrive_sync(self, file_id: str) -> None:
+        await self.execute("DELETE FROM gdrive_sync WHERE file_id=?", file_id)
+
     async def get_last_send(
         self, sender: int, target: int, file_id: str
     ) -> Optional[int]:
@@ -603,7 +1958,7 @@ class Database:
 # CLI
 # ───────────────────────────────────────────
 def _cli():
-    import argparse, textwrap, sys
+    import argparse, json, textwrap, sys
 
     parser = argparse.ArgumentParser(
         description="DB maintenance helper",
@@ -613,13 +1968,17 @@ def _cli():
             commands:
               init-db                 初期化
               add-user USERNAME [-p PW] [--discord-id ID]
+              slow-queries [--limit N]  記録された遅い文を文ごとに集計
+              explain SQL             EXPLAIN QUERY PLAN を表示
             """
         ),
     )
     parser.add_argument("cmd")
-    parser.add_argument("username", nargs="?")
+    parser.add_argument("username", nargs="?", metavar="USERNAME|SQL")
     parser.add_argument("-p", "--password")
     parser.add_argument("--discord-id", type=int)
+    parser.add_argument("--db", type=Path, default=DB_PATH)
+    parser.add_argument("--limit", type=int, default=20)
     args = parser.parse_args()
 
     async def run():
@@ -632,6 +1991,26 @@ def _cli():
                 await db.add_user(args.discord_id or 0, args.username, pw)
             print("✔ user added:", args.username)
             print("  password:", pw)
+        elif args.cmd == "slow-queries":
+            from bot.query_log import summarize_log
+
+            path = args.db.parent / "slow_queries.jsonl"
+            if not path.exists():
+                print("no slow queries recorded:", path)
+                return
+            for g in summarize_log(path)[: args.limit]:
+                print(
+                    f"{g['count']:>6}x  total {g['total_ms']:.1f}ms  "
+                    f"p50 {g['p50_ms']:.1f}  p95 {g['p95_ms']:.1f}  max {g['max_ms']:.1f}"
+                )
+                print("   ", g["statement"])
+                print("    params:", json.dumps(g["params"]))
+                for line in g["plan"] or ["(plan not captured)"]:
+                    print("    |", line)
+        elif args.cmd == "explain" and args.username:
+            async with Database(args.db) as db:
+                for line in await db.explain(args.username):
+                    print(line)
         else:
             parser.print_help()
             sys.exit(1)
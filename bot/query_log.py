@@ -0,0 +1,263 @@
+"""Per-statement timing and the slow-query log for ``Database``.
+
+``Database`` の接続はすべての文の所要時間をフックに渡す。``QueryLog`` はそれを
+正規化した SQL ごとに件数・合計・直近の分布 (p50/p95/p99) として集計し、
+``SLOW_QUERY_MS`` を超えた文はパラメータの型と長さ (値そのものは残さない) と
+``EXPLAIN QUERY PLAN`` の結果を付けて記録する。
+
+遅い文は ``slow_queries.jsonl`` (DB と同じディレクトリ) にも 1 行ずつ追記するので、
+Web と Bot のどちらで起きたものも ``python -m bot.db slow-queries`` で確認できる。
+書き込みはまとめて別スレッドで行い、``SLOW_QUERY_LOG_BYTES`` を超えたら
+``slow_queries.jsonl.1`` へ退避して新しいファイルに切り替える。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import re
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Iterator, Optional
+
+log = logging.getLogger(__name__)
+
+# これより時間のかかった文を記録する (ミリ秒)。0 以下で記録しない
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))
+# メモリに残す遅い文の件数と、文ごとに分布を取る直近の件数
+SLOW_QUERY_KEEP = int(os.getenv("SLOW_QUERY_KEEP", 200))
+QUERY_SAMPLE_SIZE = 512
+# slow_queries.jsonl がこの大きさを超えたら 1 世代だけ残して切り替える。0 以下で切り替えない
+SLOW_QUERY_LOG_BYTES = int(os.getenv("SLOW_QUERY_LOG_BYTES", 5 << 20))
+
+# 実行せずに計画だけ見られる文
+_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+_PLACEHOLDERS = re.compile(r"\?(\s*,\s*\?)+")
+_SPACES = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(sql: str, limit: int = 120) -> str:
+    """SQL 文をラベル用に正規化する (空白を詰め、``IN (?,?,…)`` の長さを揃える)。"""
+    text = _SPACES.sub(" ", sql).strip()
+    text = _PLACEHOLDERS.sub("?,…", text)
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+
+def param_shape(params: Any) -> Any:
+    """パラメータの値を型 (文字列・バイト列は長さ付き) に置き換える。"""
+
+    def shape(v: Any) -> str:
+        if v is None:
+            return "null"
+        if isinstance(v, (str, bytes)):
+            return f"{type(v).__name__}({len(v)})"
+        return type(v).__name__
+
+    if params is None:
+        return []
+    if isinstance(params, dict):
+        return {k: shape(v) for k, v in params.items()}
+    return [shape(v) for v in params]
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+class _Stat:
+    __slots__ = ("count", "total", "max", "slow", "recent")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.recent: deque = deque(maxlen=QUERY_SAMPLE_SIZE)
+
+
+class QueryLog:
+    """文ごとの集計と遅い文の記録。
+
+    ``explain`` には ``(sql, params) -> 計画の行`` のコルーチン関数を渡す。フックは
+    イベントループ上で同期的に呼ばれるので、計画の取得はタスクにして後で行い、
+    同じ文については最初の 1 回だけ調べる。ファイルへの追記も同じ理由で、
+    溜めた行を ``asyncio.to_thread`` でまとめて書く。
+    """
+
+    def __init__(
+        self,
+        explain: Optional[Callable[[str, Any], Awaitable[list[str]]]] = None,
+        threshold_ms: float = SLOW_QUERY_MS,
+        log_path: Optional[Path] = None,
+        keep: int = SLOW_QUERY_KEEP,
+        max_bytes: int = SLOW_QUERY_LOG_BYTES,
+    ) -> None:
+        self.explain = explain
+        self.threshold = threshold_ms / 1000
+        self.log_path = log_path
+        self.stats: dict[str, _Stat] = {}
+        self.slow: deque = deque(maxlen=max(1, keep))
+        self.plans: dict[str, list[str]] = {}
+        self.max_bytes = max_bytes
+        self._tasks: set[asyncio.Task] = set()
+        self._lines: list[str] = []
+        self._writer: Optional[asyncio.Task] = None
+
+    def record(self, sql: str, params: Any, elapsed: float) -> None:
+        """``Database.query_hooks`` に登録するフック。"""
+        label = statement_label(sql)
+        if label.startswith("EXPLAIN"):
+            return
+        st = self.stats.get(label)
+        if st is None:
+            st = self.stats[label] = _Stat()
+        st.count += 1
+        st.total += elapsed
+        st.recent.append(elapsed)
+        if elapsed > st.max:
+            st.max = elapsed
+        if self.threshold <= 0 or elapsed < self.threshold:
+            return
+        st.slow += 1
+        entry = {
+            "time": time.time(),
+            "statement": label,
+            "ms": round(elapsed * 1000, 3),
+            "params": param_shape(params),
+            "plan": self.plans.get(label),
+        }
+        self.slow.append(entry)
+        if entry["plan"] is None and self.explain is not None and label.split(" ", 1)[0].upper() in _EXPLAINABLE:
+            try:
+                task = asyncio.get_running_loop().create_task(self._explain(entry, sql, params))
+            except RuntimeError:
+                self._write(entry)
+                return
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            self._write(entry)
+
+    async def _explain(self, entry: dict, sql: str, params: Any) -> None:
+        label = entry["statement"]
+        try:
+            if label not in self.plans:
+                self.plans[label] = await self.explain(sql, params)
+            entry["plan"] = self.plans[label]
+        except Exception as e:
+            log.debug("EXPLAIN QUERY PLAN failed: %s", e)
+        self._write(entry)
+
+    def _write(self, entry: dict) -> None:
+        if self.log_path is None:
+            return
+        self._lines.append(json.dumps(entry, ensure_ascii=False) + "\n")
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # イベントループの外 (CLI など) ではその場で書く
+            lines, self._lines = self._lines, []
+            self._append(lines)
+            return
+        if self._writer is None or self._writer.done():
+            self._writer = loop.create_task(self._drain())
+
+    async def _drain(self) -> None:
+        while self._lines:
+            lines, self._lines = self._lines, []
+            await asyncio.to_thread(self._append, lines)
+
+    def _append(self, lines: list[str]) -> None:
+        path = self.log_path
+        try:
+            if self.max_bytes > 0 and path.exists() and path.stat().st_size >= self.max_bytes:
+                path.replace(path.with_name(path.name + ".1"))
+            with path.open("a", encoding="utf-8") as f:
+                f.write("".join(lines))
+        except OSError as e:
+            log.debug("slow query log write failed: %s", e)
+
+    def snapshot(self, limit: int = 50) -> dict:
+        """合計時間の長い順に ``limit`` 件の集計と、直近の遅い文を返す。"""
+        rows = []
+        for label, st in self.stats.items():
+            recent = sorted(st.recent)
+            rows.append(
+                {
+                    "statement": label,
+                    "count": st.count,
+                    "slow": st.slow,
+                    "total_ms": round(st.total * 1000, 3),
+                    "mean_ms": round(st.total * 1000 / st.count, 3),
+                    "p50_ms": round(percentile(recent, 0.50) * 1000, 3),
+                    "p95_ms": round(percentile(recent, 0.95) * 1000, 3),
+                    "p99_ms": round(percentile(recent, 0.99) * 1000, 3),
+                    "max_ms": round(st.max * 1000, 3),
+                    "plan": self.plans.get(label),
+                }
+            )
+        rows.sort(key=lambda r: r["total_ms"], reverse=True)
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "statements": rows[:limit],
+            "slow": list(reversed(self.slow))[:limit],
+        }
+
+    async def flush(self) -> None:
+        """計画の取得中のタスクとファイルへの書き込みを待つ (接続を閉じる前に呼ぶ)。"""
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        if self._writer is not None:
+            await self._writer
+
+
+def _read_entries(path: Path) -> Iterator[dict]:
+    # 切り替えで退避した 1 世代前のファイルも含める
+    for p in (path.with_name(path.name + ".1"), path):
+        if not p.exists():
+            continue
+        with p.open(encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def summarize_log(path: Path) -> list[dict]:
+    """``slow_queries.jsonl`` を文ごとにまとめる (合計時間の長い順)。"""
+    groups: dict[str, dict] = {}
+    for e in _read_entries(path):
+        g = groups.setdefault(
+            e["statement"], {"statement": e["statement"], "ms": [], "params": None, "plan": None, "last": 0}
+        )
+        g["ms"].append(e["ms"])
+        if e.get("plan"):
+            g["plan"] = e["plan"]
+        if e["time"] >= g["last"]:
+            g["last"] = e["time"]
+            g["params"] = e.get("params")
+    out = []
+    for g in groups.values():
+        ms = sorted(g.pop("ms"))
+        out.append(
+            {
+                **g,
+                "count": len(ms),
+                "total_ms": round(sum(ms), 3),
+                "p50_ms": percentile(ms, 0.50),
+                "p95_ms": percentile(ms, 0.95),
+                "max_ms": ms[-1],
+            }
+        )
+    out.sort(key=lambda r: r["total_ms"], reverse=True)
+    return out
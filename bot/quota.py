@@ -0,0 +1,154 @@
+"""Storage quotas and the low-disk watermark for uploads.
+
+ユーザーごと・共有フォルダごとの保存容量と、データディレクトリの空き容量の下限を
+アップロード中に確かめる。使用量は ``usage_stats`` の集計を 1 行読むだけで分かり、
+受信済みのバイト数を ``UploadBudget.consume`` に渡していけば上限を超えた時点で
+``QuotaExceeded`` になるので、全体を受け取る前に打ち切れる。
+
+上限は環境変数の既定値を使い、``users.quota_bytes`` / ``shared_folders.quota_bytes``
+が設定されていればそちらを優先する (0 は無制限)。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import AsyncIterable, Optional
+
+# 既定の上限 (バイト)。0 は無制限
+USER_QUOTA_BYTES = int(os.getenv("USER_QUOTA_BYTES", 0))
+SHARED_FOLDER_QUOTA_BYTES = int(os.getenv("SHARED_FOLDER_QUOTA_BYTES", 0))
+# データディレクトリの空きがこれを下回るアップロードは受け付けない
+MIN_FREE_DISK_BYTES = int(os.getenv("MIN_FREE_DISK_BYTES", 1 << 30))
+
+# 受信中のアップロード。集計にはまだ入っていない分を同じ上限の枠で合算する
+_OPEN: dict[tuple[str, int], set["UploadBudget"]] = {}
+
+
+class QuotaExceeded(Exception):
+    """上限を超えた。``reason`` は ``"user"`` / ``"shared"`` / ``"disk"``。"""
+
+    def __init__(self, reason: str, limit: int) -> None:
+        if reason == "disk":
+            msg = "not enough free disk space"
+        else:
+            msg = f"{reason} storage quota of {limit} bytes exceeded"
+        super().__init__(msg)
+        self.reason = reason
+        self.limit = limit
+
+
+class UploadBudget:
+    """1 回のアップロードで書き込めるバイト数。
+
+    ``limits`` は (枠, 開始時点の残り, 上限) の並び。枠ごとの残りは受信中の他の
+    アップロードと分け合う。空き容量は書き込んだ分だけ実際に減るので自分の分だけ数える。
+    """
+
+    def __init__(
+        self,
+        limits: list[tuple[tuple[str, int], int, int]],
+        disk_left: Optional[int] = None,
+    ) -> None:
+        self.limits = limits
+        self.disk_left = disk_left
+        self.used = 0
+        for key, _, _ in limits:
+            _OPEN.setdefault(key, set()).add(self)
+
+    def check(self, size: int) -> None:
+        """あと ``size`` バイト書けるか確かめる (書いた量には数えない)。"""
+        if self.disk_left is not None and self.used + size > self.disk_left:
+            raise QuotaExceeded("disk", MIN_FREE_DISK_BYTES)
+        for key, left, limit in self.limits:
+            # 別スレッドから呼ばれても集合のコピーは GIL の下で一度に作られる
+            inflight = sum(b.used for b in list(_OPEN.get(key, ())) if b is not self)
+            if inflight + self.used + size > left:
+                raise QuotaExceeded(key[0], limit)
+
+    def consume(self, size: int) -> None:
+        """``size`` バイト受信したことを記録し、上限を超えたら ``QuotaExceeded``。"""
+        self.check(size)
+        self.used += size
+
+    def close(self) -> None:
+        """受信を終えた (DB 登録後なら使用量は集計に入っている)。何度呼んでもよい。"""
+        for key, _, _ in self.limits:
+            group = _OPEN.get(key)
+            if group is not None:
+                group.discard(self)
+                if not group:
+                    del _OPEN[key]
+        self.limits = []
+
+    def __enter__(self) -> "UploadBudget":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def free_disk_bytes(path: Path) -> int:
+    return shutil.disk_usage(path).free
+
+
+async def open_budget(
+    db,
+    data_dir: Path,
+    *,
+    user_id: Optional[int] = None,
+    shared_folder_id: Optional[int] = None,
+    expected: int = 0,
+) -> UploadBudget:
+    """アップロードを始める前に呼び、書き込める量を表す ``UploadBudget`` を返す。
+
+    空き容量が下限を割っている場合や、``expected`` (Content-Length や添付のサイズなど
+    事前に分かる大きさ) が残りを超える場合はここで ``QuotaExceeded`` になる。
+    """
+    limits = []
+    for scope, owner, default in (
+        ("user", user_id, USER_QUOTA_BYTES),
+        ("shared", shared_folder_id, SHARED_FOLDER_QUOTA_BYTES),
+    ):
+        if owner is None:
+            continue
+        override, used = await db.storage_quota(scope, int(owner))
+        limit = default if override is None else override
+        if limit > 0:
+            limits.append(((scope, int(owner)), limit - used, limit))
+    disk_left = None
+    if MIN_FREE_DISK_BYTES > 0:
+        disk_left = free_disk_bytes(data_dir) - MIN_FREE_DISK_BYTES
+    budget = UploadBudget(limits, disk_left)
+    try:
+        if disk_left is not None and disk_left <= 0:
+            raise QuotaExceeded("disk", MIN_FREE_DISK_BYTES)
+        budget.check(max(0, expected))
+    except QuotaExceeded:
+        budget.close()
+        raise
+    return budget
+
+
+async def write_chunks(
+    chunks: AsyncIterable[bytes], path: Path, budget: UploadBudget
+) -> tuple[int, str]:
+    """受信したチャンクを ``budget`` に数えながら ``path`` へ書き、(サイズ, sha256) を返す。
+
+    上限を超えたり受信が途中で失敗したりした場合は書きかけを消して送出し直す。
+    """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with path.open("wb") as f:
+            async for chunk in chunks:
+                budget.consume(len(chunk))
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return size, digest.hexdigest()
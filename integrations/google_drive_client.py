@@ -2,11 +2,12 @@ import os
 import io
 import json
 from pathlib import Path
-from typing import List, Tuple, Dict, Optional
+from typing import Callable, List, Tuple, Dict, Optional
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 from google.auth.transport.requests import Request
 
@@ -21,6 +22,8 @@ _SCOPES = [
     "https://www.googleapis.com/auth/drive.readonly",
 ]
 _CRED_PATH = os.getenv("GDRIVE_CREDENTIALS")
+# レジューム可能アップロードのチャンクサイズ (256 KiB の倍数である必要がある)
+RESUMABLE_CHUNK_SIZE = int(os.getenv("GDRIVE_CHUNK_SIZE", 8 << 20))
 
 
 def build_flow(redirect_uri: str, *, state: Optional[str] = None) -> Flow:
@@ -57,6 +60,72 @@ def upload_file(local_path: Path, filename: str, token_json: str) -> Tuple[str,
     return file.get("id"), token_json
 
 
+def upload_file_resumable(
+    local_path: Path,
+    filename: str,
+    token_json: str,
+    session_uri: Optional[str] = None,
+    on_session: Optional[Callable[[str], None]] = None,
+    chunk_size: int = RESUMABLE_CHUNK_SIZE,
+) -> Tuple[str, str]:
+    """Upload a file in chunks using a resumable session.
+
+    ``session_uri`` に前回のセッション URI を渡すと、送信済みバイト数を
+    サーバーへ問い合わせてから途中のチャンクより再開します。新しい
+    セッションが開始されたときは ``on_session`` に URI が渡されるため、
+    呼び出し側で永続化しておけばプロセス再起動後も再開できます。
+    """
+    service, token_json = _service_from_token(token_json)
+    media = MediaFileUpload(str(local_path), chunksize=chunk_size, resumable=True)
+
+    request = service.files().create(
+        body={"name": filename}, media_body=media, fields="id"
+    )
+    notified = None
+    response = None
+    if session_uri:
+        done, offset = _query_upload(request.http, session_uri, Path(local_path).stat().st_size)
+        if done is not None:
+            return done.get("id"), token_json
+        if offset is not None:
+            # 受信済みの位置から同じセッションで送信を続ける
+            request.resumable_uri = session_uri
+            request.resumable_progress = offset
+            notified = session_uri
+        # offset が None ならセッションの有効期限切れなので最初からやり直す
+
+    while response is None:
+        _, response = request.next_chunk(num_retries=3)
+        uri = request.resumable_uri
+        if uri and uri != notified:
+            notified = uri
+            if on_session:
+                on_session(uri)
+    return response.get("id"), token_json
+
+
+def _query_upload(http, session_uri: str, size: int) -> Tuple[Optional[dict], Optional[int]]:
+    """レジューム可能セッションの進捗を空の PUT (``Content-Range: bytes */size``) で問い合わせる。
+
+    完了済みなら ``(ファイルのメタデータ, None)``、途中なら ``(None, 受信済みバイト数)``、
+    セッションが失効していれば ``(None, None)`` を返す。
+    """
+    resp, content = http.request(
+        session_uri,
+        "PUT",
+        headers={"Content-Range": f"bytes */{size}", "Content-Length": "0"},
+    )
+    if resp.status in (200, 201):
+        return json.loads(content or b"{}"), None
+    if resp.status == 308:
+        # "range: bytes=0-<最後に受信したバイト>"。無ければまだ何も受信していない
+        received = resp.get("range")
+        return None, int(received.rsplit("-", 1)[1]) + 1 if received else 0
+    if resp.status in (404, 410):
+        return None, None
+    raise HttpError(resp, content, uri=session_uri)
+
+
 def download_file(
     file_id: str,
     token_json: str,
@@ -79,6 +148,42 @@ def download_file(
     return fh.getvalue(), token_json
 
 
+def download_to_path(
+    file_id: str,
+    token_json: str,
+    dest: Path,
+    on_chunk: Optional[Callable[[int], None]] = None,
+    acknowledge_abuse: bool = False,
+) -> Tuple[int, str]:
+    """Stream a Drive file to ``dest`` and return ``(size, token_json)``.
+
+    ``on_chunk`` はチャンクを受け取るたびにそのバイト数で呼ばれ、例外を送出すると
+    ダウンロードを中断する (書きかけの ``dest`` は呼び出し側で消す)。
+    """
+    service, token_json = _service_from_token(token_json)
+    request = service.files().get_media(
+        fileId=file_id, acknowledgeAbuse=acknowledge_abuse
+    )
+    with dest.open("wb") as fh:
+        downloader = MediaIoBaseDownload(fh, request, chunksize=RESUMABLE_CHUNK_SIZE)
+        done = False
+        written = 0
+        while not done:
+            _, done = downloader.next_chunk()
+            pos = fh.tell()
+            if on_chunk:
+                on_chunk(pos - written)
+            written = pos
+    return written, token_json
+
+
+def get_file_info(file_id: str, token_json: str) -> Tuple[Dict[str, object], str]:
+    """Return ``({"name", "size"}, token_json)``. Google ドキュメント形式は size が 0。"""
+    service, token_json = _service_from_token(token_json)
+    meta = service.files().get(fileId=file_id, fields="name,size").execute()
+    return {"name": meta.get("name", file_id), "size": int(meta.get("size") or 0)}, token_json
+
+
 def get_file_name(file_id: str, token_json: str) -> Tuple[str, str]:
     service, token_json = _service_from_token(token_json)
     meta = service.files().get(fileId=file_id, fields="name").execute()
@@ -2,7 +2,9 @@ import os
 import json
 import shutil
 import time
-from typing import Dict, Tuple, Optional
+import asyncio
+from collections import deque
+from typing import Any, Dict, List, Tuple, Optional
 
 
 def get_system_metrics() -> Dict[str, float]:
@@ -80,6 +82,39 @@ def get_network_speed(interval: float = 1.0) -> Dict[str, float]:
     }
 
 
+def get_network_counters() -> Dict[str, float]:
+    """Return cumulative bytes received/sent on non-loopback interfaces (no sleep)."""
+    rx, tx = _read_net_bytes()
+    return {"bytes_recv_total": float(rx), "bytes_sent_total": float(tx)}
+
+
+def get_server_process_counters(pid: Optional[int] = None) -> Dict[str, float]:
+    """Return cumulative CPU seconds, RSS and open fds for this process (no sleep).
+
+    Rates are left to the consumer (e.g. Prometheus ``rate()``) instead of sleeping
+    between two readings like :func:`get_server_process_metrics`.
+    """
+    if pid is None:
+        pid = os.getpid()
+    try:
+        ticks = os.sysconf("SC_CLK_TCK")
+    except (AttributeError, ValueError, OSError):
+        ticks = 100
+    try:
+        cpu_seconds = _read_process_times(pid) / ticks
+        rss = _read_process_rss(pid)
+        fd_count = len(os.listdir(f"/proc/{pid}/fd"))
+    except FileNotFoundError:
+        cpu_seconds = 0.0
+        rss = 0
+        fd_count = 0
+    return {
+        "process_cpu_seconds_total": float(cpu_seconds),
+        "process_memory_rss_bytes": float(rss),
+        "open_fd_count": int(fd_count),
+    }
+
+
 def _read_process_times(pid: int) -> int:
     """Return user+system jiffies for the given process."""
     with open(f"/proc/{pid}/stat") as f:
@@ -131,6 +166,234 @@ def get_server_process_metrics(interval: float = 0.1, pid: Optional[int] = None)
     }
 
 
+# Child process names (``/proc/<pid>/comm``) grouped under a label
+CHILD_GROUPS = {
+    "ffmpeg": "ffmpeg",
+    "soffice.bin": "libreoffice",
+    "soffice": "libreoffice",
+    "oosplash": "libreoffice",
+}
+
+
+def _read_meminfo() -> Tuple[int, int]:
+    """Return (MemTotal, MemAvailable) in KiB, or zeros when unavailable."""
+    total = available = 0
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, val = line.split(":", 1)
+                if key == "MemTotal":
+                    total = int(val.split()[0])
+                elif key == "MemAvailable":
+                    available = int(val.split()[0])
+    except FileNotFoundError:
+        pass
+    return total, available
+
+
+def _read_stat(pid: str) -> Optional[Tuple[str, int, int, int]]:
+    """Return (comm, ppid, user+system jiffies, rss pages) or None if the process is gone."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            data = f.read()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+    # comm may contain spaces and parentheses; it ends at the last ')'
+    lpar, rpar = data.find("("), data.rfind(")")
+    fields = data[rpar + 2:].split()
+    return data[lpar + 1:rpar], int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[21])
+
+
+def _read_children(root: int) -> Dict[str, Dict[str, int]]:
+    """Aggregate count/jiffies/RSS of descendants of ``root`` by :data:`CHILD_GROUPS`."""
+    procs = {}
+    try:
+        pids = [p for p in os.listdir("/proc") if p.isdigit()]
+    except FileNotFoundError:
+        return {}
+    for pid in pids:
+        st = _read_stat(pid)
+        if st is not None:
+            procs[int(pid)] = st
+    children: Dict[int, List[int]] = {}
+    for pid, (_, ppid, _, _) in procs.items():
+        children.setdefault(ppid, []).append(pid)
+    page = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+    groups = {name: {"count": 0, "cpu_jiffies": 0, "rss_bytes": 0} for name in set(CHILD_GROUPS.values())}
+    stack = list(children.get(root, ()))
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, ()))
+        comm, _, jiffies, rss = procs[pid]
+        name = CHILD_GROUPS.get(comm)
+        if name is not None:
+            g = groups[name]
+            g["count"] += 1
+            g["cpu_jiffies"] += jiffies
+            g["rss_bytes"] += rss * page
+    return groups
+
+
+def read_sample(pid: Optional[int] = None) -> Dict[str, Any]:
+    """Read one snapshot of cumulative counters and levels from ``/proc`` (no sleep)."""
+    if pid is None:
+        pid = os.getpid()
+    load1 = load5 = load15 = 0.0
+    if hasattr(os, "getloadavg"):
+        try:
+            load1, load5, load15 = os.getloadavg()
+        except OSError:
+            pass
+    mem_total, mem_available = _read_meminfo()
+    disk = shutil.disk_usage("/")
+    rx, tx = _read_net_bytes()
+    try:
+        total_jiffies = _read_total_jiffies()
+    except FileNotFoundError:
+        total_jiffies = 0
+    try:
+        cpu_jiffies = _read_process_times(pid)
+        rss = _read_process_rss(pid)
+        fd_count = len(os.listdir(f"/proc/{pid}/fd"))
+    except FileNotFoundError:
+        cpu_jiffies = rss = fd_count = 0
+    return {
+        "time": time.time(),
+        "monotonic": time.monotonic(),
+        "loadavg_1min": float(load1),
+        "loadavg_5min": float(load5),
+        "loadavg_15min": float(load15),
+        "memory_usage_percent": (
+            100.0 * (mem_total - mem_available) / mem_total if mem_total else 0.0
+        ),
+        "disk_usage_percent": 100.0 * disk.used / disk.total,
+        "bytes_recv_total": rx,
+        "bytes_sent_total": tx,
+        "total_jiffies": total_jiffies,
+        "process": {"cpu_jiffies": cpu_jiffies, "rss_bytes": rss, "open_fds": fd_count},
+        "children": _read_children(pid),
+    }
+
+
+def _cpu_percent(old: int, new: int, total_old: int, total_new: int) -> float:
+    # Share of all CPUs, same definition as get_server_process_metrics()
+    if total_new <= total_old:
+        return 0.0
+    return max(0.0, 100.0 * (new - old) / (total_new - total_old))
+
+
+def compute_rates(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """Derive per-second and CPU-percent rates between two samples.
+
+    Child CPU only covers processes alive in both samples' groups, so a child
+    that exits between samples can make its delta negative; it is clamped to 0.
+    """
+    elapsed = max(new["monotonic"] - old["monotonic"], 1e-6)
+    t0, t1 = old["total_jiffies"], new["total_jiffies"]
+    children = {}
+    for name, g in new["children"].items():
+        prev = old["children"].get(name, {"cpu_jiffies": 0})
+        children[name] = {
+            "count": g["count"],
+            "rss_bytes": g["rss_bytes"],
+            "cpu_percent": _cpu_percent(prev["cpu_jiffies"], g["cpu_jiffies"], t0, t1),
+        }
+    return {
+        "seconds": elapsed,
+        "bytes_recv_per_sec": max(new["bytes_recv_total"] - old["bytes_recv_total"], 0) / elapsed,
+        "bytes_sent_per_sec": max(new["bytes_sent_total"] - old["bytes_sent_total"], 0) / elapsed,
+        "process_cpu_percent": _cpu_percent(
+            old["process"]["cpu_jiffies"], new["process"]["cpu_jiffies"], t0, t1
+        ),
+        "children": children,
+    }
+
+
+class SystemSampler:
+    """Sample ``/proc`` every ``interval`` seconds into a ring buffer.
+
+    Reading happens in a worker thread from :meth:`run`; the accessors only look
+    at samples already in memory, so callers on the event loop never block or
+    sleep. ``history`` is the number of samples kept (default: one hour at 5s).
+    """
+
+    def __init__(self, interval: float = 5.0, history: int = 720, pid: Optional[int] = None) -> None:
+        self.interval = max(interval, 0.1)
+        self.pid = pid if pid is not None else os.getpid()
+        self.samples: deque = deque(maxlen=max(history, 2))
+
+    def sample_now(self) -> Dict[str, Any]:
+        """Take one sample synchronously (used by :meth:`run` in a thread)."""
+        s = read_sample(self.pid)
+        self.samples.append(s)
+        return s
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sample_now)
+            except Exception:
+                # a vanished /proc entry or similar should not stop sampling
+                pass
+            await asyncio.sleep(self.interval)
+
+    def _sample_before(self, seconds: float) -> Optional[Dict[str, Any]]:
+        """Newest sample at least ``seconds`` older than the latest (or the oldest one)."""
+        if len(self.samples) < 2:
+            return None
+        cutoff = self.samples[-1]["monotonic"] - seconds
+        for s in reversed(self.samples):
+            if s["monotonic"] <= cutoff:
+                return s
+        return self.samples[0]
+
+    async def latest(self) -> Optional[Dict[str, Any]]:
+        return self.samples[-1] if self.samples else None
+
+    async def rates(self, window: float = 0.0) -> Optional[Dict[str, Any]]:
+        """Rates over ``window`` seconds (0 means between the last two samples)."""
+        if len(self.samples) < 2:
+            return None
+        old = self.samples[-2] if window <= 0 else self._sample_before(window)
+        return compute_rates(old, self.samples[-1])
+
+    async def summary(self) -> Dict[str, Any]:
+        """Latest levels plus instantaneous, 1-minute and 5-minute rates."""
+        return {
+            "latest": await self.latest(),
+            "rates": {
+                "instant": await self.rates(),
+                "1m": await self.rates(60),
+                "5m": await self.rates(300),
+            },
+        }
+
+    async def history(self, seconds: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Per-sample levels and rates (relative to the previous sample) for charts."""
+        samples = list(self.samples)
+        if seconds is not None and samples:
+            cutoff = samples[-1]["monotonic"] - seconds
+            start = next((i for i, s in enumerate(samples) if s["monotonic"] >= cutoff), len(samples))
+            samples = samples[max(start - 1, 0):]
+        points = []
+        for prev, cur in zip(samples, samples[1:]):
+            rates = compute_rates(prev, cur)
+            points.append(
+                {
+                    "time": cur["time"],
+                    "loadavg_1min": cur["loadavg_1min"],
+                    "memory_usage_percent": cur["memory_usage_percent"],
+                    "disk_usage_percent": cur["disk_usage_percent"],
+                    "process_memory_rss_bytes": cur["process"]["rss_bytes"],
+                    "bytes_recv_per_sec": rates["bytes_recv_per_sec"],
+                    "bytes_sent_per_sec": rates["bytes_sent_per_sec"],
+                    "process_cpu_percent": rates["process_cpu_percent"],
+                    "children": rates["children"],
+                }
+            )
+        return points
+
+
 if __name__ == "__main__":
     metrics = get_system_metrics()
     speed = get_network_speed(1.0)
@@ -67,6 +67,14 @@ if Image is None:
 
 import bot.auto_tag as auto_tag
 
+
+@pytest.fixture(autouse=True)
+def gemini_only(monkeypatch):
+    # このファイルは Gemini 経路のテスト。ローカルエンジンは test_local_tagger.py
+    monkeypatch.setattr(
+        auto_tag, "ENGINE_ROUTES", {k: ("gemini",) for k in auto_tag.ENGINE_ROUTES}
+    )
+
 class DummyResp:
     def __init__(self, text):
         self.text = text
@@ -125,7 +133,7 @@ def test_skip_corrupted_file(monkeypatch, tmp_path):
     def raise_error(*a, **k):
         raise OSError("broken")
 
-    monkeypatch.setattr(Path, "read_bytes", raise_error)
+    monkeypatch.setattr(Path, "open", raise_error)
     tags = auto_tag.generate_tags(f)
     assert tags == ""
 
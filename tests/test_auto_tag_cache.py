@@ -0,0 +1,108 @@
+from pathlib import Path
+import sys
+import time
+import types
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import bot.auto_tag as auto_tag
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    client = auto_tag.FakeTagClient("tagX, tagY")
+    monkeypatch.setattr(auto_tag, "_client_override", client)
+    monkeypatch.setattr(auto_tag, "_cache", auto_tag.TagCache())
+    monkeypatch.setattr(auto_tag, "_bucket", auto_tag.TokenBucket(1000.0, 1000))
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    monkeypatch.setattr(
+        auto_tag, "ENGINE_ROUTES", {k: ("gemini",) for k in auto_tag.ENGINE_ROUTES}
+    )
+    return client
+
+
+def test_identical_content_uses_cache(fake, tmp_path):
+    a = tmp_path / "a.txt"
+    b = tmp_path / "b.txt"
+    a.write_text("same body")
+    b.write_text("same body")
+    assert auto_tag.generate_tags(a) == "tagX, tagY"
+    assert auto_tag.generate_tags(b) == "tagX, tagY"
+    assert len(fake.calls) == 1
+
+
+def test_cache_keyed_by_version(fake, tmp_path, monkeypatch):
+    f = tmp_path / "a.txt"
+    f.write_text("body")
+    auto_tag.generate_tags(f)
+    monkeypatch.setattr(auto_tag, "TAGGER_VERSION", "next")
+    auto_tag.generate_tags(f)
+    assert len(fake.calls) == 2
+
+
+def test_persistent_cache(tmp_path):
+    db = tmp_path / "cache" / "tags.db"
+    auto_tag.TagCache(db).put("abc", "t1")
+    assert auto_tag.TagCache(db).get("abc") == "t1"
+    assert auto_tag.TagCache(db).get("abc", version="other") is None
+
+
+def test_small_texts_are_batched(fake, tmp_path):
+    items = []
+    for n in range(3):
+        p = tmp_path / f"{n}.txt"
+        p.write_text(f"document {n}")
+        items.append((p, p.name))
+    tags = auto_tag.generate_tags_batch(items)
+    assert tags == ["tagX, tagY"] * 3
+    assert len(fake.calls) == 1
+    assert fake.calls[0].startswith(auto_tag.BATCH_PROMPT_HEAD)
+    # 2 回目はキャッシュから返る
+    assert auto_tag.generate_tags_batch(items) == tags
+    assert len(fake.calls) == 1
+
+
+def test_batch_falls_back_on_bad_json(fake, tmp_path, monkeypatch):
+    class _Broken(auto_tag.FakeTagClient):
+        def generate_content(self, payload):
+            self.calls.append(payload)
+            text = "not json" if payload.startswith(auto_tag.BATCH_PROMPT_HEAD) else self.tags
+            return types.SimpleNamespace(text=text)
+
+    client = _Broken("solo")
+    monkeypatch.setattr(auto_tag, "_client_override", client)
+    items = []
+    for n in range(2):
+        p = tmp_path / f"{n}.txt"
+        p.write_text(f"doc {n}")
+        items.append((p, None))
+    assert auto_tag.generate_tags_batch(items) == ["solo", "solo"]
+    assert len(client.calls) == 3
+
+
+def test_model_is_reused(monkeypatch):
+    created = []
+    dummy_genai = types.SimpleNamespace(
+        configure=lambda **kw: None,
+        GenerativeModel=lambda *a, **kw: created.append(1) or object(),
+    )
+    monkeypatch.setattr(auto_tag, "genai", dummy_genai)
+    monkeypatch.setattr(auto_tag, "_client_override", None)
+    monkeypatch.setattr(auto_tag, "_model_state", None)
+    monkeypatch.setenv("GEMINI_API_KEY", "k1")
+    first = auto_tag.get_client()
+    assert auto_tag.get_client() is first
+    monkeypatch.setenv("GEMINI_API_KEY", "k2")
+    assert auto_tag.get_client() is not first
+    assert len(created) == 2
+
+
+def test_token_bucket_limits_bursts():
+    bucket = auto_tag.TokenBucket(rate=50.0, capacity=2)
+    start = time.monotonic()
+    for _ in range(4):
+        bucket.acquire()
+    # 2 回はバースト、残り 2 回は 1/50 秒ずつ待つ
+    assert time.monotonic() - start >= 0.03
@@ -0,0 +1,35 @@
+from pathlib import Path
+import json
+import subprocess
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+BENCH = ROOT / 'benchmarks' / 'bench_http.py'
+
+
+def test_http_benchmark_runs_and_reports_json():
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    pytest.importorskip("cryptography")
+    out = subprocess.run(
+        [
+            sys.executable, str(BENCH),
+            "--files", "200", "--folders", "3", "--requests", "4", "--concurrency", "2",
+            "--upload-sizes", "1024,3000", "--uploads", "1", "--chunk-size", "1024",
+            "--downloads", "1", "--zip-files", "2", "--zips", "1",
+            "--ws-clients", "3", "--ws-messages", "2",
+        ],
+        capture_output=True, text=True, timeout=120, check=True,
+    )
+    result = json.loads(out.stdout)
+    assert result["benchmark"] == "http"
+    assert result["seed"]["files"] == 200
+    for key in (
+        "partial_files", "search", "upload_1024", "upload_chunked_3000",
+        "download", "download_range", "zip",
+    ):
+        assert result["results"][key]["p99_ms"] >= 0
+        assert result["results"][key]["rps"] > 0
+    assert result["results"]["ws_fanout"]["per_client"]["n"] == 6
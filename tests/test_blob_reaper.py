@@ -0,0 +1,103 @@
+from pathlib import Path
+import asyncio
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+from web.reaper import BlobReaper, unlink_paths
+
+
+def test_unlink_paths_ignores_missing(tmp_path):
+    a = tmp_path / "a"
+    a.write_text("x")
+    assert unlink_paths([str(a), str(tmp_path / "missing")]) == 1
+    assert not a.exists()
+
+
+def test_deletion_returns_before_blobs_are_removed(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        events = []
+
+        async def notify(msg):
+            events.append(msg)
+
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            folder = await db.create_user_folder(uid, "big")
+            blobs = []
+            for i in range(7):
+                blob = tmp_path / f"b{i}"
+                blob.write_text("x")
+                blobs.append(blob)
+                where = str(folder) if i < 5 else ""
+                await db.add_file(f"f{i}", uid, where, f"{i}.txt", str(blob), 1, "h", "")
+
+            # 行は 1 トランザクションで消え、実体は残っている
+            assert await db.delete_user_folder(folder) == 5
+            assert await db.delete_all_files(uid) == 2
+            assert await db.fetchall("SELECT id FROM files") == []
+            assert all(b.exists() for b in blobs)
+
+            reaper = BlobReaper(db, notify, batch_size=3, workers=2)
+            assert await reaper.drain() == 7
+            reaper.shutdown()
+            assert not any(b.exists() for b in blobs)
+            assert await db.count_pending_unlinks() == 0
+            assert [e["remaining"] for e in events] == [4, 1, 0]
+            assert events[-1] == {"action": "delete_progress", "done": 7, "remaining": 0}
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_reaper_wakes_on_demand():
+    class FakeDB:
+        def __init__(self):
+            self.rows = []
+
+        async def pending_unlinks(self, limit):
+            return self.rows[:limit]
+
+        async def finish_unlinks(self, ids):
+            self.rows = [r for r in self.rows if r["id"] not in ids]
+
+        async def count_pending_unlinks(self):
+            return len(self.rows)
+
+    async def run():
+        db = FakeDB()
+        reaper = BlobReaper(db, interval=60)
+        task = asyncio.create_task(reaper.run())
+        await asyncio.sleep(0.01)
+        db.rows = [{"id": 1, "path": "/nonexistent/blob"}]
+        reaper.wake()
+        for _ in range(100):
+            if not db.rows:
+                break
+            await asyncio.sleep(0.01)
+        assert db.rows == []
+        task.cancel()
+        reaper.shutdown()
+
+    asyncio.run(run())
+
+
+def test_handlers_hand_off_to_reaper():
+    text = APP.read_text(encoding='utf-8')
+    assert text.count('["blob_reaper"].wake()') == 3
+    start = text.index('async def delete_all(req')
+    assert '.unlink(' not in text[start:text.index('async def update_tags', start)]
+    assert 'asyncio.create_task(app["blob_reaper"].run())' in text
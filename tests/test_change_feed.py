@@ -0,0 +1,137 @@
+from pathlib import Path
+import asyncio
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+from web.changes import ChangeFeed, format_sse, parse_wait
+
+
+def test_format_sse():
+    assert format_sse({"a": 1}, 7) == b'id: 7\nevent: changes\ndata: {"a": 1}\n\n'
+    assert format_sse([], event="ping").startswith(b"event: ping\n")
+
+
+def test_feed_wakes_waiters_when_seq_grows():
+    seq = {"v": 0}
+
+    async def latest():
+        return seq["v"]
+
+    async def run():
+        feed = ChangeFeed(latest, interval=0.01)
+        assert await feed.wait(0.05) is False  # 変化が無ければ時間切れ
+        waiter = asyncio.create_task(feed.wait(2))
+        await asyncio.sleep(0.03)
+        seq["v"] = 5
+        assert await waiter is True
+        assert feed.seq == 5 and feed.waiters == 0
+        await feed.close()
+
+    asyncio.run(run())
+
+
+def test_shared_changes_fan_out_to_members(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            await db.add_user(2, "bob", "pw")
+            alice = await db.get_user_pk(1)
+            bob = await db.get_user_pk(2)
+            fid = await db.create_shared_folder("team", 100)
+            await db.add_shared_folder_member(fid, 1)
+            src = tmp_path / "s.txt"
+            src.write_text("x")
+            await db.add_shared_file("s1", fid, "s.txt", str(src))
+            before = await db.latest_change(bob)
+
+            # 後から参加したメンバーにはフォルダと既存ファイルが届く
+            await db.add_shared_folder_member(fid, 2)
+            changed, _, _ = await db.changes_since(bob, before)
+            assert changed == {
+                ("shared_folder", str(fid)): "upsert",
+                ("shared_file", "s1"): "upsert",
+            }
+            rows = await db.get_member_shared_files(bob, ["s1"])
+            assert [r["id"] for r in rows] == ["s1"]
+
+            mark = await db.latest_change()
+            await db.update_shared_tags("s1", "x")
+            for uid in (alice, bob):
+                changed, _, _ = await db.changes_since(uid, mark)
+                assert changed == {("shared_file", "s1"): "upsert"}
+
+            await db.delete_shared_folder_member(fid, 2)
+            changed, _, _ = await db.changes_since(bob, mark)
+            assert changed[("shared_folder", str(fid))] == "delete"
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_compaction_keeps_latest_and_raises_floor(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            await db.add_file("a", uid, "", "a.txt", "/a", 1, "h", "")
+            await db.add_file("b", uid, "", "b.txt", "/b", 1, "h", "")
+            for tags in ("x", "y", "z"):
+                await db.update_tags("a", tags)
+            await db.delete_file("b")
+            expected = (await db.changes_since(uid, 0))[0]
+
+            # 古い重複だけを消すので、どこから読んでも結果は同じ
+            assert await db.compact_changes(86400) > 0
+            assert (await db.changes_since(uid, 0))[0] == expected
+            assert await db.changes_floor(uid) == 0
+
+            # 保持期間を過ぎた削除の記録は消え、floor が上がる
+            seq = await db.latest_change(uid)
+            await db.compact_changes(0, now=10**10)
+            assert await db.changes_floor(uid) == seq
+            changed, _, _ = await db.changes_since(uid, 0)
+            assert changed == {("file", "a"): "upsert"}
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_parse_wait_rejects_non_finite_and_negative():
+    assert parse_wait(None, 25) == 0
+    assert parse_wait("", 25) == 0
+    assert parse_wait("1.5", 25) == 1.5
+    assert parse_wait("1e9", 25) == 25
+    for bad in ("nan", "inf", "-inf", "-1", "soon"):
+        with pytest.raises(ValueError):
+            parse_wait(bad, 25)
+
+
+def test_change_endpoints_registered():
+    text = APP.read_text(encoding='utf-8')
+    assert 'parse_wait(request.query.get("wait"), CHANGES_MAX_WAIT)' in text
+    assert '{"error": "invalid wait"}, status=400' in text
+    assert 'app.router.add_get("/api/changes/stream", changes_stream)' in text
+    assert 'request.headers.get("Last-Event-ID")' in text
+    assert 'await feed.wait(remaining)' in text
+    assert 'asyncio.create_task(_compact_changes(app))' in text
@@ -0,0 +1,89 @@
+from pathlib import Path
+import asyncio
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+JS = ROOT / 'web' / 'static' / 'js' / 'main.js'
+sys.path.insert(0, str(ROOT))
+
+from web import listing
+
+
+def test_parse_fields_always_includes_id():
+    assert listing.parse_fields(None) == listing.FILE_FIELDS
+    assert listing.parse_fields("size,name") == ("id", "name", "size")
+    with pytest.raises(ValueError):
+        listing.parse_fields("name,password")
+
+
+def test_cursor_round_trip():
+    cur = listing.encode_cursor("1700000000", "abc-1")
+    assert "=" not in cur
+    assert listing.decode_cursor(cur) == ("1700000000", "abc-1")
+    assert listing.decode_cursor("") is None
+    with pytest.raises(ValueError):
+        listing.decode_cursor("not-a-cursor")
+    assert listing.parse_limit("100000") == listing.MAX_LIMIT
+    assert listing.parse_limit("0") == 1
+
+
+def test_list_files_page_keyset(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            for i in range(5):
+                await db.add_file(f"f{i}", uid, "", f"{i}.txt", "/p", 1, "h", "")
+            # 同じ uploaded_at の行も id で順序が決まる
+            await db.execute("UPDATE files SET uploaded_at='100' WHERE id IN ('f1','f2','f3')")
+            seen = []
+            after = None
+            while True:
+                rows = await db.list_files_page(uid, "", 2, after)
+                if not rows:
+                    break
+                seen += [r["id"] for r in rows]
+                after = (rows[-1]["uploaded_at"], rows[-1]["id"])
+            assert sorted(seen) == [f"f{i}" for i in range(5)]
+            assert len(seen) == len(set(seen))
+            assert seen[-3:] == ["f3", "f2", "f1"]
+            plan = await db.fetchall(
+                "EXPLAIN QUERY PLAN SELECT id FROM files WHERE user_id=? AND folder=? "
+                "ORDER BY uploaded_at DESC, id DESC LIMIT 2",
+                uid,
+                "",
+            )
+            assert any("idx_files_listing" in r[-1] for r in plan)
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_json_api_route_and_etag():
+    text = APP.read_text(encoding='utf-8')
+    assert 'app.router.add_get("/api/files", file_list_json)' in text
+    start = text.index('async def file_list_json')
+    snippet = text[start:start + 3500]
+    assert 'listing.parse_fields(request.query.get("fields"))' in snippet
+    assert 'db.list_files_page(user_id, folder, limit + 1, after, name=name)' in snippet
+    assert 'web.Response(status=304' in snippet
+    assert '"next_cursor": next_cursor' in snippet
+
+
+def test_mobile_renders_json_with_indexeddb():
+    js = JS.read_text(encoding='utf-8')
+    assert 'indexedDB.open(LISTING_DB' in js
+    assert '"If-None-Match": cached.etag' in js
+    assert '/api/files?' in js
+    assert 'reloadListingJson(container, folderBlock, folderId)' in js
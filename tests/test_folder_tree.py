@@ -0,0 +1,98 @@
+from pathlib import Path
+import asyncio
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+
+def test_folder_tree_walks_without_db():
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import FolderTree
+
+    rows = [
+        {"id": 1, "name": "a", "parent_id": None},
+        {"id": 2, "name": "b", "parent_id": 1},
+        {"id": 3, "name": "c", "parent_id": 2},
+        {"id": 4, "name": "0", "parent_id": 1},
+    ]
+    tree = FolderTree(rows)
+    assert tree.ancestors(3) == [
+        {"id": 1, "name": "a"},
+        {"id": 2, "name": "b"},
+        {"id": 3, "name": "c"},
+    ]
+    assert tree.ancestors(None) == []
+    assert [c["name"] for c in tree.children(1)] == ["0", "b"]
+    assert sorted(tree.subtree(2)) == [2, 3]
+    # 親参照が循環していても止まる
+    loop = FolderTree([{"id": 1, "name": "x", "parent_id": 2}, {"id": 2, "name": "y", "parent_id": 1}])
+    assert len(loop.ancestors(1)) <= 3
+
+
+def test_recursive_folder_operations(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            root = await db.create_user_folder(uid, "root")
+            mid = await db.create_user_folder(uid, "mid", root)
+            leaf = await db.create_user_folder(uid, "leaf", mid)
+            other = await db.create_user_folder(uid, "other")
+
+            assert [f["name"] for f in await db.folder_ancestors(leaf)] == ["root", "mid", "leaf"]
+            assert sorted(await db.folder_subtree(root)) == sorted([root, mid, leaf])
+
+            tree = await db.folder_tree(uid)
+            assert tree is await db.folder_tree(uid)  # キャッシュされる
+            assert [f["id"] for f in tree.ancestors(leaf)] == [root, mid, leaf]
+
+            with pytest.raises(ValueError):
+                await db.move_user_folder(root, leaf)
+            await db.move_user_folder(mid, other)
+            moved = await db.folder_tree(uid)
+            assert moved is not tree  # 変更で作り直される
+            assert [f["id"] for f in moved.ancestors(leaf)] == [other, mid, leaf]
+
+            blobs = []
+            for i, folder in enumerate((mid, leaf, root)):
+                blob = tmp_path / f"f{i}"
+                blob.write_text("x")
+                blobs.append(blob)
+                await db.add_file(f"f{i}", uid, str(folder), f"{i}.txt", str(blob), 1, "h", "")
+
+            assert await db.delete_user_folder(other) == 2
+            assert await db.folder_subtree(other) == []
+            assert await db.get_file("f0") is None and await db.get_file("f1") is None
+            # 実体は削除待ちに積まれ、後で回収される
+            pending = {r["path"] for r in await db.pending_unlinks(10)}
+            assert pending == {str(blobs[0]), str(blobs[1])}
+            assert await db.get_file("f2") is not None
+            assert [f["id"] for f in (await db.folder_tree(uid)).children(None)] == [root]
+
+            await db.delete_all_subfolders(uid, None)
+            assert (await db.folder_tree(uid)).nodes == {}
+            assert await db.get_file("f2") is None
+            assert await db.count_pending_unlinks() == 3
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_index_uses_cached_tree_for_breadcrumbs():
+    text = APP.read_text(encoding='utf-8')
+    assert 'breadcrumbs = tree.ancestors(parent_id)' in text
+    assert 'get_user_folder(cur)' not in text
+    assert 'app.router.add_post("/move_folder/{folder_id}", move_folder)' in text
@@ -0,0 +1,235 @@
+from pathlib import Path
+import importlib
+import re
+import sys
+import types
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+
+class _HttpError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.resp = types.SimpleNamespace(status=status)
+
+
+class _Media:
+    def __init__(self, path, chunksize=-1, resumable=False):
+        self.path = path
+        self.chunksize = chunksize
+        self.resumable = resumable
+
+
+class _Resp(dict):
+    def __init__(self, status, headers=None):
+        super().__init__(headers or {})
+        self.status = status
+
+
+class _Http:
+    """空の PUT による進捗の問い合わせに ``status`` で答える"""
+
+    def __init__(self, log, status, headers=None, content=b""):
+        self.log = log
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+    def request(self, uri, method, headers=None):
+        self.log.append(("query", uri, method, headers["Content-Range"]))
+        return _Resp(self.status, self.headers), self.content
+
+
+class _Request:
+    """next_chunk を 3 回呼ぶと完了する擬似アップロード"""
+
+    def __init__(self, log, http=None):
+        self.resumable_uri = None
+        self.resumable_progress = 0
+        self.http = http
+        self.log = log
+        self.calls = 0
+
+    def next_chunk(self, num_retries=0):
+        if self.resumable_uri is None:
+            self.resumable_uri = "https://upload/session-new"
+        elif self.calls == 0:
+            self.log.append(("resume", self.resumable_uri, self.resumable_progress))
+        self.calls += 1
+        if self.calls < 3:
+            return None, None
+        return None, {"id": "drive-id"}
+
+
+@pytest.fixture
+def gdc(monkeypatch):
+    fakes = {
+        "google.oauth2": types.ModuleType("google.oauth2"),
+        "google.oauth2.credentials": types.ModuleType("google.oauth2.credentials"),
+        "google_auth_oauthlib": types.ModuleType("google_auth_oauthlib"),
+        "google_auth_oauthlib.flow": types.ModuleType("google_auth_oauthlib.flow"),
+        "googleapiclient": types.ModuleType("googleapiclient"),
+        "googleapiclient.discovery": types.ModuleType("googleapiclient.discovery"),
+        "googleapiclient.errors": types.ModuleType("googleapiclient.errors"),
+        "googleapiclient.http": types.ModuleType("googleapiclient.http"),
+        "google.auth": types.ModuleType("google.auth"),
+        "google.auth.transport": types.ModuleType("google.auth.transport"),
+        "google.auth.transport.requests": types.ModuleType("google.auth.transport.requests"),
+    }
+    fakes["google.oauth2.credentials"].Credentials = object
+    fakes["google_auth_oauthlib.flow"].Flow = object
+    fakes["googleapiclient.discovery"].build = lambda *a, **k: None
+    fakes["googleapiclient.errors"].HttpError = _HttpError
+    fakes["googleapiclient.http"].MediaFileUpload = _Media
+    fakes["googleapiclient.http"].MediaIoBaseDownload = object
+    fakes["google.auth.transport.requests"].Request = object
+    for name, mod in fakes.items():
+        monkeypatch.setitem(sys.modules, name, mod)
+    monkeypatch.delitem(sys.modules, "integrations.google_drive_client", raising=False)
+    mod = importlib.import_module("integrations.google_drive_client")
+    yield mod
+    sys.modules.pop("integrations.google_drive_client", None)
+
+
+def _fake_service(requests):
+    class _Files:
+        def create(self, **kw):
+            assert kw["media_body"].resumable
+            return requests.pop(0)
+
+    return types.SimpleNamespace(files=lambda: _Files())
+
+
+def test_resumable_upload_reports_session(gdc, monkeypatch, tmp_path):
+    f = tmp_path / "a.bin"
+    f.write_bytes(b"x" * 10)
+    log = []
+    monkeypatch.setattr(
+        gdc, "_service_from_token", lambda t: (_fake_service([_Request(log)]), t)
+    )
+    seen = []
+    fid, token = gdc.upload_file_resumable(f, "a.bin", "tok", on_session=seen.append)
+    assert fid == "drive-id"
+    assert token == "tok"
+    assert seen == ["https://upload/session-new"]
+
+
+def test_resumable_upload_resumes_saved_session(gdc, monkeypatch, tmp_path):
+    f = tmp_path / "a.bin"
+    f.write_bytes(b"x" * 10)
+    log = []
+    http = _Http(log, 308, {"range": "bytes=0-3"})
+    monkeypatch.setattr(
+        gdc, "_service_from_token", lambda t: (_fake_service([_Request(log, http)]), t)
+    )
+    seen = []
+    fid, _ = gdc.upload_file_resumable(
+        f, "a.bin", "tok", session_uri="https://upload/old", on_session=seen.append
+    )
+    assert fid == "drive-id"
+    assert log == [
+        ("query", "https://upload/old", "PUT", "bytes */10"),
+        ("resume", "https://upload/old", 4),
+    ]
+    assert seen == []
+
+
+def test_saved_session_without_range_resumes_from_start(gdc, monkeypatch, tmp_path):
+    f = tmp_path / "a.bin"
+    f.write_bytes(b"x")
+    log = []
+    monkeypatch.setattr(
+        gdc, "_service_from_token", lambda t: (_fake_service([_Request(log, _Http(log, 308))]), t)
+    )
+    gdc.upload_file_resumable(f, "a.bin", "tok", session_uri="https://upload/old")
+    assert log[-1] == ("resume", "https://upload/old", 0)
+
+
+def test_completed_session_returns_without_sending(gdc, monkeypatch, tmp_path):
+    f = tmp_path / "a.bin"
+    f.write_bytes(b"x")
+    log = []
+    http = _Http(log, 200, content=b'{"id": "done-id"}')
+    monkeypatch.setattr(
+        gdc, "_service_from_token", lambda t: (_fake_service([_Request(log, http)]), t)
+    )
+    fid, _ = gdc.upload_file_resumable(f, "a.bin", "tok", session_uri="https://upload/old")
+    assert fid == "done-id"
+    assert [e[0] for e in log] == ["query"]
+
+
+def test_expired_session_restarts(gdc, monkeypatch, tmp_path):
+    f = tmp_path / "a.bin"
+    f.write_bytes(b"x")
+    log = []
+    reqs = [_Request(log, _Http(log, 404))]
+    monkeypatch.setattr(gdc, "_service_from_token", lambda t: (_fake_service(reqs), t))
+    seen = []
+    fid, _ = gdc.upload_file_resumable(
+        f, "a.bin", "tok", session_uri="https://upload/old", on_session=seen.append
+    )
+    assert fid == "drive-id"
+    assert seen == ["https://upload/session-new"]
+
+
+def test_resume_does_not_touch_client_internals():
+    text = (ROOT / "integrations" / "google_drive_client.py").read_text(encoding="utf-8")
+    assert "_in_error_state" not in text
+
+
+def test_upload_handlers_queue_drive_mirror():
+    text = APP.read_text(encoding='utf-8')
+    assert 'upload_file as gd_up' not in text
+    # 受信後の保存処理は upload / upload_chunked から呼ばれる補助関数にある
+    for name in ('async def _store_uploads', 'async def _finish_chunked'):
+        start = text.index(name)
+        snippet = text[start:start + 5000]
+        assert '_queue_gdrive_mirror(' in snippet
+
+
+def test_gdrive_worker_started_and_limits_per_user():
+    text = APP.read_text(encoding='utf-8')
+    assert 'asyncio.create_task(_gdrive_sync_worker(app))' in text
+    assert re.search(r'gdrive_user_sems.*Semaphore\(GDRIVE_USER_CONCURRENCY\)', text, re.S)
+    # ユーザーの枠を全体の枠より先に取り、使い終わった枠は捨てる
+    body = text[text.index('async def _mirror_to_gdrive'):text.index('async def _mirror_one')]
+    assert 'async with entry[0], app["gdrive_sem"]:' in body
+    assert 'del user_sems[user_id]' in body
+    assert 'list_pending_gdrive_sync' in text
+
+
+def test_sync_queue_db_roundtrip(tmp_path):
+    import asyncio
+
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        db_path = tmp_path / "t.db"
+        await init_db(db_path)
+        db = Database(db_path)
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            await db.add_file("f1", uid, "", "a.txt", "/tmp/a", 1, "h")
+            await db.enqueue_gdrive_sync("f1", uid, "/tmp/a", "a.txt")
+            await db.set_gdrive_session("f1", "https://upload/s1")
+            rec = await db.get_gdrive_sync("f1")
+            assert rec["session_uri"] == "https://upload/s1"
+            assert await db.fail_gdrive_sync("f1", "boom", 2) == 1
+            assert len(await db.list_pending_gdrive_sync()) == 1
+            assert await db.fail_gdrive_sync("f1", "boom", 2) == 2
+            assert await db.list_pending_gdrive_sync() == []
+            await db.finish_gdrive_sync("f1", "drive-id")
+            assert (await db.get_file("f1"))["gdrive_id"] == "drive-id"
+            assert await db.get_gdrive_sync("f1") is None
+        finally:
+            await db.close()
+
+    asyncio.run(run())
@@ -0,0 +1,177 @@
+from pathlib import Path
+import json
+import subprocess
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import bot.auto_tag as auto_tag
+
+
+@pytest.fixture(autouse=True)
+def inline(monkeypatch):
+    monkeypatch.setattr(auto_tag, "LOCAL_TAG_WORKERS", 0)
+    monkeypatch.setattr(auto_tag, "_cache", auto_tag.TagCache())
+    monkeypatch.setattr(auto_tag, "_bucket", auto_tag.TokenBucket(1000.0, 1000))
+    monkeypatch.setattr(auto_tag, "_client_override", None)
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+
+
+def test_rake_english_phrases():
+    text = (
+        "Compatibility of systems of linear constraints over the set of natural "
+        "numbers. Criteria of compatibility of a system of linear Diophantine "
+        "equations, strict inequations, and nonstrict inequations are considered."
+    )
+    tags = auto_tag.rake_keywords(text)
+    assert tags[0] == "linear diophantine equations"
+    assert "natural numbers" in tags
+
+
+def test_rake_japanese_splits_on_hiragana():
+    text = "東京タワーは東京都港区にある電波塔です。東京タワーの高さは333メートルです。"
+    tags = auto_tag.rake_keywords(text)
+    assert tags[0] == "東京タワー"
+    assert "電波塔" in tags
+    assert "333" not in tags
+
+
+def test_tags_without_gemini_key(tmp_path):
+    f = tmp_path / "memo.txt"
+    f.write_text("Quarterly budget review. Budget review meeting notes.")
+    assert "budget review" in auto_tag.generate_tags(f)
+
+
+def test_gemini_enriches_local_tags(monkeypatch, tmp_path):
+    client = auto_tag.FakeTagClient("会議, budget review")
+    monkeypatch.setattr(auto_tag, "_client_override", client)
+    f = tmp_path / "memo.txt"
+    f.write_text("Budget review meeting.")
+    tags = auto_tag.generate_tags(f).split(", ")
+    # ローカルのタグが先頭、Gemini の結果は重複を除いて後ろに付く
+    assert tags[0] == "budget review meeting"
+    assert tags.count("budget review") == 1
+    assert "会議" in tags
+    assert len(client.calls) == 1
+
+
+def test_routes_select_engines(monkeypatch, tmp_path):
+    client = auto_tag.FakeTagClient("remote")
+    monkeypatch.setattr(auto_tag, "_client_override", client)
+    monkeypatch.setattr(
+        auto_tag, "ENGINE_ROUTES", auto_tag._parse_routes("text=local;other=gemini")
+    )
+    f = tmp_path / "memo.txt"
+    f.write_text("Budget review meeting.")
+    assert auto_tag.generate_tags(f) == "budget review meeting"
+    assert client.calls == []
+
+
+def test_batch_merges_local_and_gemini(monkeypatch, tmp_path):
+    client = auto_tag.FakeTagClient("remote")
+    monkeypatch.setattr(auto_tag, "_client_override", client)
+    items = []
+    for word in ("alpha project", "beta release"):
+        p = tmp_path / f"{word[:4]}.txt"
+        p.write_text(f"{word} notes")
+        items.append((p, p.name))
+    tags = auto_tag.generate_tags_batch(items)
+    assert tags == ["alpha project notes, remote", "beta release notes, remote"]
+    assert len(client.calls) == 1
+
+
+def test_image_exif_tags(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    img = Image.new("RGB", (40, 20))
+    exif = img.getexif()
+    exif[272] = "PixelCam 7"
+    exif[306] = "2023:05:01 10:00:00"
+    f = tmp_path / "photo.jpg"
+    img.save(f, exif=exif)
+    tags = auto_tag.local_tags(str(f), "photo.jpg")
+    assert tags[:2] == ["画像", "横長"]
+    assert "PixelCam 7" in tags
+    assert "2023年" in tags
+
+
+def test_media_container_tags(monkeypatch, tmp_path):
+    probe = {
+        "streams": [
+            {"codec_type": "video", "codec_name": "h264", "height": 1080},
+            {"codec_type": "audio", "codec_name": "aac"},
+        ],
+        "format": {"duration": "42.0", "tags": {"TITLE": "Demo"}},
+    }
+
+    def fake_run(cmd, **kw):
+        assert cmd[0] == "ffprobe"
+        return types.SimpleNamespace(stdout=json.dumps(probe).encode())
+
+    monkeypatch.setattr(subprocess, "run", fake_run)
+    f = tmp_path / "clip.mp4"
+    f.write_bytes(b"\x00")
+    assert auto_tag.local_tags(str(f)) == [
+        "動画", "1080p", "h264", "aac", "1分未満", "Demo"
+    ]
+
+
+def test_media_without_ffprobe(monkeypatch, tmp_path):
+    def missing(*a, **kw):
+        raise FileNotFoundError("ffprobe")
+
+    monkeypatch.setattr(subprocess, "run", missing)
+    f = tmp_path / "song.mp3"
+    f.write_bytes(b"\x00")
+    assert auto_tag.generate_tags(f) == "音声"
+
+
+def test_process_pool(monkeypatch, tmp_path):
+    monkeypatch.setattr(auto_tag, "LOCAL_TAG_WORKERS", 1)
+    f = tmp_path / "memo.txt"
+    f.write_text("Release checklist for release checklist owners.")
+    try:
+        assert auto_tag.LocalTagger().tag(f, None)[0].startswith("release checklist")
+        assert auto_tag._pool is not None
+    finally:
+        auto_tag.shutdown_pool()
+    assert auto_tag._pool is None
+
+
+def test_process_pool_does_not_fork(monkeypatch):
+    # イベントループやスレッドを抱えたプロセスを fork しない
+    seen = {}
+
+    def fake_pool(max_workers, mp_context):
+        seen["method"] = mp_context.get_start_method()
+        return object()
+
+    monkeypatch.setattr(auto_tag, "LOCAL_TAG_WORKERS", 1)
+    monkeypatch.setattr(auto_tag, "_pool", None)
+    monkeypatch.setattr(auto_tag, "ProcessPoolExecutor", fake_pool)
+    assert auto_tag._local_pool() is not None
+    assert seen["method"] in ("forkserver", "spawn")
+
+
+def test_incomplete_tagger_fails_at_construction():
+    class NoTag(auto_tag.Tagger):
+        name = "broken"
+
+    with pytest.raises(TypeError):
+        NoTag()
+
+
+def test_register_custom_tagger(monkeypatch, tmp_path):
+    class Upper(auto_tag.Tagger):
+        name = "upper"
+
+        def tag(self, file_path, original_name):
+            return [file_path.read_text().upper()]
+
+    monkeypatch.setitem(auto_tag._TAGGERS, "upper", Upper())
+    monkeypatch.setattr(auto_tag, "ENGINE_ROUTES", {"text": ("upper",)})
+    f = tmp_path / "a.txt"
+    f.write_text("hi")
+    assert auto_tag.generate_tags(f) == "HI"
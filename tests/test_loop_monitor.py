@@ -0,0 +1,88 @@
+from pathlib import Path
+import asyncio
+import sys
+import time
+import traceback
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+from web.loop_monitor import LoopMonitor, call_site
+from web.metrics import Registry
+
+
+def _block(seconds):
+    time.sleep(seconds)
+
+
+def test_blocking_call_is_attributed_to_call_site():
+    reg = Registry()
+    monitor = LoopMonitor(interval=0.01, threshold=0.05, registry=reg)
+
+    async def main():
+        task = asyncio.create_task(monitor.run())
+        await asyncio.sleep(0.05)
+        _block(0.3)
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+    snap = monitor.snapshot()
+    assert snap["stalls"] == 1
+    (off,) = snap["offenders"]
+    assert off["site"].startswith("tests/test_loop_monitor.py:")
+    assert off["site"].endswith("(_block)")
+    assert off["count"] == 1 and off["max_ms"] >= 250
+    assert any("time.sleep" in line for line in off["stack"])
+    assert snap["lag"]["max_ms"] >= 250
+    text = reg.render()
+    count = next(l for l in text.splitlines() if l.startswith("wds_event_loop_lag_seconds_count"))
+    assert int(count.split()[1]) == snap["lag"]["samples"] > 1  # 起きるたびに観測する
+    assert 'wds_event_loop_blocked_total{site="tests/test_loop_monitor.py:' in text
+    assert monitor._watchdog is None  # 止めたら見張りスレッドも終わる
+
+
+def test_short_lag_is_measured_without_stack():
+    monitor = LoopMonitor(interval=0.01, threshold=0.5)
+
+    async def main():
+        task = asyncio.create_task(monitor.run())
+        await asyncio.sleep(0.05)
+        _block(0.03)
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+    snap = monitor.snapshot()
+    assert snap["stalls"] == 0 and snap["offenders"] == []
+    assert snap["lag"]["samples"] > 0
+    assert snap["lag"]["max_ms"] >= 20
+
+
+def test_call_site_prefers_repo_frames():
+    stack = traceback.StackSummary.from_list(
+        [
+            (str(ROOT / "web" / "app.py"), 10, "handler", None),
+            ("/usr/lib/python3/subprocess.py", 99, "run", None),
+        ]
+    )
+    assert call_site(stack) == "web/app.py:10 (handler)"
+    outside = traceback.StackSummary.from_list([("/usr/lib/x.py", 5, "f", None)])
+    assert call_site(outside) == "/usr/lib/x.py:5 (f)"
+
+
+def test_app_wires_loop_monitor():
+    text = APP.read_text()
+    assert 'asyncio.create_task(loop_monitor.run())' in text
+    assert 'app.router.add_get("/api/admin/loop", admin_loop)' in text
+    assert "await asyncio.to_thread(_generate_preview, path, fid, mime)" in text
+    assert "await asyncio.to_thread(_remove_stale_chunks)" in text
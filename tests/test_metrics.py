@@ -0,0 +1,81 @@
+from pathlib import Path
+import asyncio
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+from bot.query_log import statement_label
+from web.metrics import Registry
+
+
+def test_registry_renders_text_format():
+    reg = Registry()
+    c = reg.counter("reqs_total", "Requests.", ("route",))
+    c.inc(labels=("/a",))
+    c.inc(2, ("/a",))
+    reg.gauge("depth", "Depth.", func=lambda: 3)
+    reg.gauge("unused", "Never set.")
+    text = reg.render()
+    assert '# TYPE reqs_total counter\nreqs_total{route="/a"} 3\n' in text
+    assert "depth 3\n" in text
+    assert "unused" not in text  # 値の無い系列は出さない
+
+
+def test_histogram_buckets_are_cumulative():
+    reg = Registry()
+    h = reg.histogram("lat", "Latency.", ("m",), buckets=(0.1, 1.0))
+    for v in (0.05, 0.1, 0.5, 3.0):
+        h.observe(v, ("GET",))
+    lines = reg.render().splitlines()
+    assert 'lat_bucket{m="GET",le="0.1"} 2' in lines
+    assert 'lat_bucket{m="GET",le="1"} 3' in lines
+    assert 'lat_bucket{m="GET",le="+Inf"} 4' in lines
+    assert 'lat_count{m="GET"} 4' in lines
+
+
+def test_statement_label_normalizes():
+    sql = "SELECT *\n   FROM files WHERE id IN (?, ?,?)"
+    assert statement_label(sql) == "SELECT * FROM files WHERE id IN (?,…)"
+    assert len(statement_label("SELECT " + "x, " * 100)) == 120
+
+
+def test_query_hooks_time_statements(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    seen = []
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        db.query_hooks.append(lambda sql, params, elapsed: seen.append((sql, params, elapsed)))
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            await db.get_user_pk(1)
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+    assert any("FROM users" in sql for sql, _, _ in seen)
+    assert all(elapsed >= 0 for _, _, elapsed in seen)
+
+
+def test_metrics_route_and_middleware_registered():
+    text = APP.read_text(encoding='utf-8')
+    assert 'app.router.add_get("/metrics", metrics_endpoint)' in text
+    assert 'app.middlewares.append(http_metrics.middleware())' in text
+    assert 'if not METRICS_TOKEN:' in text
+    assert 'db.query_hooks.append(' in text
+
+
+def test_admin_system_endpoint_registered():
+    text = APP.read_text(encoding='utf-8')
+    assert 'app.router.add_get("/api/admin/system", admin_system)' in text
+    assert 'request.get("user_id") != OWNER_ID' in text
+    assert 'asyncio.create_task(app["system_sampler"].run())' in text
@@ -0,0 +1,100 @@
+from pathlib import Path
+import asyncio
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+SW = ROOT / 'web' / 'static' / 'service-worker.js'
+JS = ROOT / 'web' / 'static' / 'js' / 'main.js'
+sys.path.insert(0, str(ROOT))
+
+
+def test_changes_logged_by_triggers(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            await db.add_file("a", uid, "", "a.txt", "/a", 1, "h", "")
+            await db.add_file("b", uid, "", "b.txt", "/b", 1, "h", "")
+            since = await db.latest_change(uid)
+            assert since > 0
+
+            await db.update_tags("a", "x")
+            await db.delete_file("b")
+            await db.create_user_folder(uid, "docs")
+            changed, seq, more = await db.changes_since(uid, since)
+            assert changed[("file", "a")] == "upsert"
+            assert changed[("file", "b")] == "delete"
+            assert [k for k in changed if k[0] == "folder"]
+            assert seq == await db.latest_change(uid) and not more
+
+            # 上限で区切ると続きがあることを返す
+            _, first, more = await db.changes_since(uid, since, limit=1)
+            assert more and since < first < seq
+            assert await db.changes_since(uid, seq) == ({}, seq, False)
+
+            rows = await db.get_user_files(uid, ["a", "b"])
+            assert [r["id"] for r in rows] == ["a"]
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_name_search_spans_folders(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            await db.add_file("a", uid, "", "Report.pdf", "/a", 1, "h", "")
+            await db.add_file("b", uid, "3", "report_2.pdf", "/b", 1, "h", "")
+            await db.add_file("c", uid, "", "100%.txt", "/c", 1, "h", "")
+            rows = await db.list_files_page(uid, "", 10, name="report")
+            assert {r["id"] for r in rows} == {"a", "b"}
+            # LIKE のワイルドカードは文字として扱う
+            rows = await db.list_files_page(uid, "", 10, name="0%")
+            assert [r["id"] for r in rows] == ["c"]
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_changes_route_registered():
+    text = APP.read_text(encoding='utf-8')
+    assert 'app.router.add_get("/api/changes", changes_api)' in text
+    assert 'db.changes_since(user_id, since, CHANGES_PAGE_SIZE)' in text
+    assert '"reset": reset' in text
+
+
+def test_service_worker_keeps_catalog():
+    sw = SW.read_text(encoding='utf-8')
+    assert "indexedDB.open(CATALOG_DB" in sw
+    assert "/api/changes?since=${since}" in sw
+    assert "url.pathname === '/api/files'" in sw
+    assert "event.respondWith(catalogFallback(request, url))" in sw
+    assert "action === 'syncCatalog'" in sw
+    # ログアウト時はカタログも消す
+    assert "clearCatalog()" in sw
+
+
+def test_main_js_requests_catalog_sync():
+    js = JS.read_text(encoding='utf-8')
+    assert 'postMessage({ action: "syncCatalog" })' in js
+    assert '/api/files?q=' in js
@@ -0,0 +1,131 @@
+from pathlib import Path
+import asyncio
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+from web.render_cache import RenderCache, etag_matches, make_etag
+
+
+def test_render_cache_lru_and_etag():
+    cache = RenderCache(max_entries=2)
+    cache.put("a", "e1", "<a>")
+    cache.put("b", "e1", "<b>")
+    assert cache.get("a", "e1") == "<a>"
+    assert cache.get("a", "e2") is None  # 版が変われば使わない
+    cache.put("c", "e1", "<c>")
+    assert cache.get("b", "e1") is None  # 最も古いものから追い出す
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_etag_weak_comparison():
+    etag = make_etag(3, ("u", ""), "tok")
+    assert etag.startswith('W/"3-')
+    assert etag != make_etag(4, ("u", ""), "tok")
+    assert etag != make_etag(3, ("u", ""), "other")
+    assert etag_matches(etag, etag)
+    assert etag_matches(f'"x", {etag[2:]}', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches(None, etag)
+    assert not etag_matches('"x"', etag)
+
+
+def test_folder_version_bumped_by_triggers(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            assert await db.folder_version(uid, "") == 0
+            await db.add_file("a", uid, "", "a.txt", "/a", 1, "h", "")
+            v1 = await db.folder_version(uid, "")
+            assert v1 > 0
+            await db.update_tags("a", "x")
+            v2 = await db.folder_version(uid, "")
+            assert v2 > v1
+            # 別フォルダへ移すと両方の版が上がる
+            await db.execute("UPDATE files SET folder='7' WHERE id='a'")
+            assert await db.folder_version(uid, "") > v2
+            moved = await db.folder_version(uid, "7")
+            assert moved > 0
+            await db.delete_file("a")
+            assert await db.folder_version(uid, "7") > moved
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_folder_version_bumped_by_folder_changes(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            parent = await db.create_user_folder(uid, "p")
+            child = await db.create_user_folder(uid, "c", parent)
+            p, c = str(parent), str(child)
+
+            async def snap():
+                return {f: await db.folder_version(uid, f) for f in ("", p, c)}
+
+            v0 = await snap()
+            assert v0[""] > 0 and v0[p] > 0  # 親の一覧に子フォルダができた
+            # 名前変更は親の一覧とそのフォルダ自身のパンくずが変わる
+            await db.execute("UPDATE user_folders SET name='c2' WHERE id=?", child)
+            await db.commit()
+            v1 = await snap()
+            assert v1[p] > v0[p] and v1[c] > v0[c] and v1[""] == v0[""]
+            # ルートへ移すと移動元・移動先の両方
+            await db.move_user_folder(child, None)
+            v2 = await snap()
+            assert v2[""] > v1[""] and v2[p] > v1[p] and v2[c] > v1[c]
+            await db.delete_user_folder(child)
+            assert (await snap())[""] > v2[""]
+
+            # HLS やプレビューのように行の外で変わったもの
+            await db.add_file("a", uid, p, "a.mp4", "/a", 1, "h", "")
+            before = await db.folder_version(uid, p)
+            await db.touch_file("a")
+            assert await db.folder_version(uid, p) == before + 1
+            await db.touch_file("missing")
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_background_processing_bumps_version():
+    text = APP.read_text(encoding='utf-8')
+    start = text.index('async def _generate_hls')
+    assert 'await db.touch_file(fid)' in text[start:text.index('async def _run_hls_variants')]
+    start = text.index('async def _task_worker')
+    assert 'await app["db"].touch_file(job["fid"])' in text[start:start + 1500]
+
+
+def test_file_list_api_uses_render_cache():
+    text = APP.read_text(encoding='utf-8')
+    start = text.index('async def file_list_api')
+    snippet = text[start:start + 4000]
+    assert 'await db.folder_version(user_id, folder)' in snippet
+    assert 'etag_matches(request.headers.get("If-None-Match"), etag)' in snippet
+    assert 'web.Response(status=304' in snippet
+    assert 'cache.get(key, etag)' in snippet
+    assert 'cache.put(key, etag, html)' in snippet
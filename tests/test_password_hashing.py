@@ -0,0 +1,103 @@
+from pathlib import Path
+import asyncio
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+pytest.importorskip("aiosqlite")
+pytest.importorskip("scrypt")
+
+import bot.db as db_mod
+from bot.db import Database, LoginThrottle, LoginThrottled, init_db
+
+
+def test_throttle_backs_off_exponentially():
+    t = LoginThrottle(free_attempts=2, window=100, max_delay=3)
+    for _ in range(2):
+        t.failure("Alice", now=0)
+    assert t.retry_after("alice", now=0) == 1
+    t.failure("alice", now=0)
+    assert t.retry_after("alice", now=0) == 2
+    t.failure("alice", now=0)
+    t.failure("alice", now=0)
+    assert t.retry_after("alice", now=0) == 3  # max_delay で頭打ち
+    assert t.retry_after("alice", now=101) == 0
+    t.failure("bob", now=0)
+    t.success("bob")
+    assert t.retry_after("bob", now=0) == 0
+
+
+def test_hasher_rejects_when_saturated():
+    async def run():
+        hasher = db_mod.PasswordHasher(workers=1, max_pending=1)
+        hashed = db_mod.scrypt_hash("pw")
+        first = asyncio.ensure_future(hasher.verify("pw", hashed))
+        await asyncio.sleep(0)
+        with pytest.raises(db_mod.PasswordHashBusy):
+            await hasher.verify("pw", hashed)
+        assert await first is True
+        hasher.shutdown()
+
+    asyncio.run(run())
+
+
+def test_verify_user_throttles_before_hashing(monkeypatch, tmp_path):
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        db.login_throttle = LoginThrottle(free_attempts=1, window=60, max_delay=60)
+        try:
+            await db.add_user(1, "alice", "pw")
+            assert await db.verify_user("alice", "pw") is True
+            assert await db.verify_user("alice", "nope") is False
+
+            calls = []
+            real = db_mod.verify_password
+            monkeypatch.setattr(
+                db_mod, "verify_password", lambda *a: calls.append(a) or real(*a)
+            )
+            with pytest.raises(LoginThrottled):
+                await db.verify_user("ALICE", "pw")
+            assert calls == []
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_rehash_on_parameter_change(monkeypatch, tmp_path):
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            monkeypatch.setattr(db_mod, "SCRYPT_N", 2**10)
+            await db.add_user(1, "alice", "pw")
+            old = (await db.fetchone("SELECT pw_hash FROM users"))["pw_hash"]
+            assert old.startswith("1024:")
+
+            monkeypatch.setattr(db_mod, "SCRYPT_N", 2**11)
+            assert db_mod.needs_rehash(old)
+            assert await db.verify_user("alice", "pw") is True
+            new = (await db.fetchone("SELECT pw_hash FROM users"))["pw_hash"]
+            assert new.startswith("2048:")
+            assert not db_mod.needs_rehash(new)
+            assert await db.verify_user("alice", "pw") is True
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_login_post_reports_throttle():
+    text = APP.read_text(encoding='utf-8')
+    start = text.index('async def login_post')
+    snippet = text[start:start + 1500]
+    assert 'except LoginThrottled' in snippet
+    assert 'except PasswordHashBusy' in snippet
+    assert 'password_hasher.shutdown()' in text
@@ -0,0 +1,98 @@
+from pathlib import Path
+import asyncio
+import json
+import sys
+import threading
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+from bot.query_log import QueryLog, param_shape, summarize_log
+
+
+def test_param_shape_hides_values():
+    assert param_shape((1, "secret", None, b"xy")) == ["int", "str(6)", "null", "bytes(2)"]
+    assert param_shape({"a": 1.5}) == {"a": "float"}
+    assert param_shape(None) == []
+
+
+def test_aggregates_and_slow_entries(tmp_path):
+    qlog = QueryLog(threshold_ms=10, log_path=tmp_path / "slow.jsonl")
+    for ms in range(1, 101):
+        qlog.record("SELECT * FROM files WHERE id IN (?, ?)", (1, 2), ms / 1000)
+    qlog.record("EXPLAIN QUERY PLAN SELECT 1", (), 1.0)  # 自分の EXPLAIN は数えない
+    snap = qlog.snapshot()
+    [row] = snap["statements"]
+    assert row["statement"] == "SELECT * FROM files WHERE id IN (?,…)"
+    assert row["count"] == 100 and row["slow"] == 91
+    assert row["p50_ms"] == pytest.approx(50, abs=1)
+    assert row["p99_ms"] == pytest.approx(99, abs=1)
+    assert row["max_ms"] == 100
+    assert snap["slow"][0]["ms"] == 100 and snap["slow"][0]["params"] == ["int", "int"]
+    # イベントループが無いときは計画なしですぐ書き出す
+    [summary] = summarize_log(tmp_path / "slow.jsonl")
+    assert summary["count"] == 91 and summary["max_ms"] == 100
+
+
+def test_log_file_is_written_off_loop_and_rotated(tmp_path, monkeypatch):
+    path = tmp_path / "slow.jsonl"
+    qlog = QueryLog(threshold_ms=1, log_path=path, max_bytes=1000)
+    writers = []
+    append = qlog._append
+    monkeypatch.setattr(
+        qlog, "_append", lambda lines: (writers.append(threading.get_ident()), append(lines))
+    )
+
+    async def run():
+        for i in range(10):
+            qlog.record(f"PRAGMA t{i}", (), 0.01)
+        assert not path.exists()  # フックの中では書かない
+        await qlog.flush()
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+    assert writers and loop_thread not in writers
+    assert len(writers) < 10  # 溜めた行はまとめて書く
+    assert len(summarize_log(path)) == 10
+
+    for i in range(10):
+        qlog.record(f"PRAGMA u{i}", (), 0.01)
+    # 上限を超えたら 1 世代だけ退避して新しいファイルへ
+    assert (tmp_path / "slow.jsonl.1").exists()
+    assert path.stat().st_size < 1000
+    assert "PRAGMA u9" in {g["statement"] for g in summarize_log(path)}
+
+
+def test_slow_statements_get_query_plan(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        db.query_log.threshold = 0.0000001  # すべての文を遅いとみなす
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            await db.get_user_pk(1)
+        finally:
+            await db.close()  # 計画の取得を待ってから閉じる
+        return db
+
+    db = asyncio.run(run())
+    entries = [json.loads(l) for l in (tmp_path / "slow_queries.jsonl").read_text().splitlines()]
+    lookup = [e for e in entries if "FROM users WHERE discord_id" in e["statement"]]
+    assert lookup and lookup[0]["params"] == ["int"]
+    assert any("users" in line for line in lookup[0]["plan"])
+    assert all(e["plan"] is None for e in entries if e["statement"].startswith("PRAGMA"))
+    assert db.query_log.snapshot()["statements"]
+
+
+def test_admin_queries_endpoint_registered():
+    text = APP.read_text(encoding='utf-8')
+    assert 'app.router.add_get("/api/admin/queries", admin_queries)' in text
+    assert 'request.app["db"].query_log.snapshot(limit)' in text
@@ -0,0 +1,124 @@
+from pathlib import Path
+import asyncio
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+from bot import quota
+from bot.quota import QuotaExceeded, UploadBudget, write_chunks
+
+
+def test_budget_shares_limit_with_inflight_uploads():
+    key = ("user", 99)
+    a = UploadBudget([(key, 100, 100)])
+    b = UploadBudget([(key, 100, 100)])
+    a.consume(60)
+    with pytest.raises(QuotaExceeded) as e:
+        b.consume(50)
+    assert e.value.reason == "user" and b.used == 0
+    a.close()
+    b.consume(50)  # 終わったアップロードの分は枠を空ける
+    b.close()
+    assert key not in quota._OPEN
+
+
+def test_disk_watermark_counts_own_bytes():
+    with UploadBudget([], disk_left=10) as budget:
+        budget.consume(10)
+        with pytest.raises(QuotaExceeded) as e:
+            budget.consume(1)
+    assert e.value.reason == "disk"
+
+
+def test_open_budget_uses_overrides_and_usage(tmp_path, monkeypatch):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    monkeypatch.setattr(quota, "USER_QUOTA_BYTES", 100)
+    monkeypatch.setattr(quota, "MIN_FREE_DISK_BYTES", 1000)
+    monkeypatch.setattr(quota, "free_disk_bytes", lambda path: 10_000)
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            await db.add_file("a", uid, "", "a.txt", "/a", 70, "h", "")
+            with pytest.raises(QuotaExceeded):
+                await quota.open_budget(db, tmp_path, user_id=uid, expected=31)
+            with await quota.open_budget(db, tmp_path, user_id=uid, expected=30) as budget:
+                with pytest.raises(QuotaExceeded):
+                    budget.consume(31)
+
+            # 個別の上限が既定値より優先され、0 は無制限
+            await db.set_storage_quota("user", uid, 0)
+            with await quota.open_budget(db, tmp_path, user_id=uid, expected=5000):
+                pass
+
+            # 空きが下限を割っていれば大きさに関係なく断る
+            monkeypatch.setattr(quota, "free_disk_bytes", lambda path: 900)
+            with pytest.raises(QuotaExceeded) as e:
+                await quota.open_budget(db, tmp_path, user_id=uid)
+            assert e.value.reason == "disk"
+            assert quota._OPEN == {}
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_receive_part_checks_before_writing():
+    text = APP.read_text(encoding='utf-8')
+    start = text.index('async def _receive_part')
+    snippet = text[start:text.index('def _sha256_file', start)]
+    assert snippet.index('budget.consume(len(chunk))') < snippet.index('f.write(chunk)')
+    assert 'path.unlink(missing_ok=True)' in snippet
+
+
+def test_upload_paths_stream_with_budget():
+    text = APP.read_text(encoding='utf-8')
+    for name in ('async def upload(req)', 'async def shared_upload', 'async def upload_chunked'):
+        start = text.index(name)
+        snippet = text[start:start + 2500]
+        assert 'open_budget(' in snippet
+        assert 'await req.post()' not in snippet
+    assert 'download_to_path, file_id, new_token, path, budget.consume, True' in text
+    bot = (ROOT / 'bot' / 'commands.py').read_text(encoding='utf-8')
+    assert bot.count('await open_budget(') == 2
+    assert 'await file.read()' not in bot
+    assert bot.count('await _save_attachment(file, path, budget)') == 2
+    assert bot.count('size, digest = await _save_attachment(file, path, budget)') == 1
+
+
+def _chunks(*parts):
+    async def gen():
+        for part in parts:
+            yield part
+    return gen()
+
+
+def test_write_chunks_hashes_and_counts(tmp_path):
+    import hashlib
+
+    path = tmp_path / "f"
+    with UploadBudget([(("user", 7), 10, 10)]) as budget:
+        size, digest = asyncio.run(write_chunks(_chunks(b"abc", b"de"), path, budget))
+        assert budget.used == 5
+    assert size == 5 and path.read_bytes() == b"abcde"
+    assert digest == hashlib.sha256(b"abcde").hexdigest()
+
+
+def test_write_chunks_stops_at_quota(tmp_path):
+    path = tmp_path / "f"
+    with UploadBudget([(("user", 7), 4, 4)]) as budget:
+        with pytest.raises(QuotaExceeded):
+            asyncio.run(write_chunks(_chunks(b"abc", b"de"), path, budget))
+        assert budget.used == 3
+    assert not path.exists()  # 書きかけは消す
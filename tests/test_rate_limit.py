@@ -1,8 +1,161 @@
 from pathlib import Path
+import asyncio
+import sys
+import warnings
 
-APP_PATH = Path(__file__).resolve().parents[1] / 'web' / 'app.py'
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP_PATH = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+from web.rate_limit import (
+    MemoryStore,
+    RateLimiter,
+    SqliteStore,
+    client_key,
+    parse_networks,
+    parse_policy,
+)
 
 
 def test_rate_limit_setting():
     text = APP_PATH.read_text(encoding='utf-8')
-    assert 'AsyncLimiter(1000, 60)' in text
+    assert 'os.getenv("RATE_LIMIT_DEFAULT", "1000/60")' in text
+    assert 'app.middlewares.append(rl_mw)' in text
+    assert 'app.on_response_prepare.append(rate_limiter.on_response_prepare)' in text
+
+
+class _Transport:
+    def __init__(self, peer):
+        self.peer = peer
+
+    def get_extra_info(self, name, default=None):
+        return (self.peer, 0) if name == "peername" else default
+
+    def is_closing(self):
+        return False
+
+
+def _req(path, peer="203.0.113.5", headers=None, method="GET"):
+    return make_mocked_request(
+        method, path, headers=headers or {}, transport=_Transport(peer)
+    )
+
+
+def _limiter(store=None, **kw):
+    return RateLimiter(
+        [
+            parse_policy("default", "3/60"),
+            parse_policy("login", "1/60"),
+            parse_policy("upload", "100/60", "bytes"),
+            parse_policy("download", "100/60", "bytes"),
+        ],
+        [
+            ("/health", None),
+            ("/login", "login"),
+            ("/upload", "upload"),
+            ("/download", "download"),
+        ],
+        store=store,
+        **kw,
+    )
+
+
+def test_route_classes_and_exemptions():
+    async def run():
+        rl = _limiter()
+        assert await rl.check(_req("/login")) == 0
+        assert await rl.check(_req("/login")) > 0
+        # 別の区分は別のバケット
+        assert await rl.check(_req("/")) == 0
+        for _ in range(10):
+            assert await rl.check(_req("/health")) == 0
+        assert rl.classify("/upload_chunked").name == "default"
+
+    asyncio.run(run())
+
+
+def test_upload_counts_bytes():
+    async def run():
+        rl = _limiter()
+        big = {"Content-Length": "80"}
+        assert await rl.check(_req("/upload", headers=big, method="POST")) == 0
+        wait = await rl.check(_req("/upload", headers=big, method="POST"))
+        assert wait == pytest.approx(36, abs=1)
+
+    asyncio.run(run())
+
+
+def test_download_charged_on_response():
+    async def run():
+        rl = _limiter()
+        req = _req("/download/x")
+        assert await rl.check(req) == 0
+        resp = web.Response(body=b"x" * 150)
+        await rl.on_response_prepare(req, resp)
+        # 借り越し中は次のダウンロードを断る
+        assert await rl.check(_req("/download/y")) > 0
+
+    asyncio.run(run())
+
+
+def test_chunked_upload_charged_after_receive():
+    async def handler(request):
+        return web.Response(text=str(len(await request.read())))
+
+    async def body():
+        for _ in range(3):
+            yield b"x" * 50
+
+    async def run():
+        rl = _limiter()
+        app = web.Application(middlewares=[rl.middleware()])
+        app.router.add_post("/upload", handler)
+        async with TestClient(TestServer(app)) as client:
+            # Content-Length が無くても受信した 150 バイトを借り越しで差し引く
+            resp = await client.post("/upload", data=body())
+            assert await resp.text() == "150"
+            resp = await client.post("/upload", data=b"x")
+            assert resp.status == 429
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", web.NotAppKeyWarning)
+        asyncio.run(run())
+
+
+def test_memory_store_is_bounded():
+    async def run():
+        store = MemoryStore(max_entries=10)
+        policy = parse_policy("default", "5/60")
+        for n in range(100):
+            await store.take(f"ip{n}", policy, 1, now=0)
+        assert len(store) == 10
+        # 満杯に戻ったバケットは時間経過で消える
+        await store.take("late", policy, 1, now=1000)
+        assert len(store) == 1
+
+    asyncio.run(run())
+
+
+def test_trusted_proxy_forwarded_for():
+    trusted = parse_networks("10.0.0.0/8")
+    hdr = {"X-Forwarded-For": "198.51.100.7, 203.0.113.9, 10.0.0.3"}
+    assert client_key(_req("/", "10.0.0.2", hdr), trusted) == "203.0.113.9"
+    # プロキシ以外から届いたヘッダーは無視する
+    assert client_key(_req("/", "192.0.2.1", hdr), trusted) == "192.0.2.1"
+    assert client_key(_req("/", "10.0.0.2", hdr)) == "10.0.0.2"
+
+
+def test_sqlite_store_shared_between_limiters(tmp_path):
+    async def run():
+        a = _limiter(SqliteStore(tmp_path / "rl.db"))
+        b = _limiter(SqliteStore(tmp_path / "rl.db"))
+        assert await a.check(_req("/login")) == 0
+        assert await b.check(_req("/login")) > 0
+        a.store.close()
+        b.store.close()
+
+    asyncio.run(run())
@@ -1,9 +1,91 @@
 from pathlib import Path
+import asyncio
+import gzip
+import sys
 
-APP_PATH = Path(__file__).resolve().parents[1] / 'web' / 'app.py'
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+ROOT = Path(__file__).resolve().parents[1]
+APP_PATH = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+from web.compression import Compressor
 
 
 def test_compress_middleware_added():
     text = APP_PATH.read_text(encoding='utf-8')
     assert 'compress_middleware' in text
     assert 'app.middlewares.append(compress_middleware)' in text
+    assert 'aiohttp_compress' not in text
+
+
+def _client(tmp_path, compressor):
+    big = tmp_path / "video.bin"
+    big.write_bytes(b"\x00" * 50_000)
+
+    async def partial(request):
+        return web.Response(
+            text="<tr>row</tr>" * 500,
+            content_type="text/html",
+            headers={"ETag": '"v1"'},
+        )
+
+    async def small(request):
+        return web.json_response({"ok": True})
+
+    async def png(request):
+        return web.Response(body=b"\x89PNG" * 1000, content_type="image/png")
+
+    async def download(request):
+        return web.FileResponse(big)
+
+    app = web.Application(middlewares=[compressor.middleware()])
+    app.router.add_get("/partial/files", partial)
+    app.router.add_get("/small", small)
+    app.router.add_get("/img", png)
+    app.router.add_get("/download/x", download)
+    return TestClient(TestServer(app))
+
+
+def test_only_large_text_is_compressed(tmp_path):
+    async def run():
+        comp = Compressor(("/download/",), min_size=1024)
+        async with _client(tmp_path, comp) as client:
+            hdr = {"Accept-Encoding": "gzip"}
+            resp = await client.get("/partial/files", headers=hdr, auto_decompress=False)
+            assert resp.headers["Content-Encoding"] == "gzip"
+            assert resp.headers["ETag"] == 'W/"v1"'
+            body = gzip.decompress(await resp.read())
+            assert body.startswith(b"<tr>row</tr>")
+
+            for path in ("/small", "/img", "/download/x"):
+                resp = await client.get(path, headers=hdr, auto_decompress=False)
+                assert "Content-Encoding" not in resp.headers, path
+
+    asyncio.run(run())
+
+
+def test_compressed_output_cached_by_etag(tmp_path):
+    async def run():
+        comp = Compressor()
+        async with _client(tmp_path, comp) as client:
+            hdr = {"Accept-Encoding": "gzip"}
+            for _ in range(3):
+                await client.get("/partial/files", headers=hdr)
+            assert comp.hits == 2
+            # gzip を受け付けないクライアントにはそのまま返す
+            resp = await client.get(
+                "/partial/files", headers={"Accept-Encoding": "gzip;q=0"}
+            )
+            assert "Content-Encoding" not in resp.headers
+
+    asyncio.run(run())
+
+
+def test_downloads_never_compressed():
+    text = APP_PATH.read_text(encoding='utf-8')
+    start = text.index('NO_COMPRESS_PREFIXES = (')
+    block = text[start:text.index(')', start)]
+    for prefix in ('"/download/"', '"/shared/download/"', '"/f/"', '"/previews/"', '"/hls/"'):
+        assert prefix in block
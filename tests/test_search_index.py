@@ -0,0 +1,164 @@
+from pathlib import Path
+import asyncio
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+COMMANDS = ROOT / 'bot' / 'commands.py'
+sys.path.insert(0, str(ROOT))
+
+pytest.importorskip("aiosqlite")
+pytest.importorskip("scrypt")
+
+from bot.db import Database, init_db, HIGHLIGHT_START, HIGHLIGHT_END
+
+
+def _run(tmp_path, body):
+    async def run():
+        db_path = tmp_path / "t.db"
+        await init_db(db_path)
+        db = Database(db_path)
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            await db.add_user(2, "bob", "pw")
+            uid = await db.get_user_pk(1)
+            await body(db, uid)
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+async def _seed(db, uid):
+    await db.add_file("f1", uid, "", "会議議事録.docx", "/x", 1, "h", "予算, 会議")
+    await db.add_file("f2", uid, "7", "notes.txt", "/y", 1, "h", "finance")
+    await db.set_search_text("file", "f2", "Quarterly budget review and forecast")
+    other = await db.get_user_pk(2)
+    await db.add_file("f3", other, "", "forecast-bob.txt", "/z", 1, "h", "")
+    await db.execute("INSERT INTO shared_folders (name) VALUES ('team')")
+    await db.execute("INSERT INTO shared_folder_members VALUES (1, 1)")
+    await db.execute(
+        "INSERT INTO shared_files (id, folder_id, file_name, path, size, is_shared, uploaded_at, tags) "
+        "VALUES ('s1', 1, 'forecast.pdf', '/s', 1, 0, '0', 'plan')"
+    )
+
+
+def test_searches_names_tags_body_and_shared(tmp_path):
+    async def body(db, uid):
+        await _seed(db, uid)
+        hits = await db.search(uid, 1, "forecast")
+        assert {h["id"] for h in hits} == {"f2", "s1"}
+        # 名前に一致したものが本文だけの一致より上位
+        assert hits[0]["id"] == "s1"
+        assert hits[0]["location"] == "team"
+        assert f"{HIGHLIGHT_START}forecast{HIGHLIGHT_END}" in hits[1]["snippet"]
+        assert [h["id"] for h in await db.search(uid, 1, "会議議事")] == ["f1"]
+        assert await db.search(uid, None, "plan") == []
+
+    _run(tmp_path, body)
+
+
+def test_short_terms_fall_back_to_like(tmp_path):
+    async def body(db, uid):
+        await _seed(db, uid)
+        hits = await db.search(uid, 1, "予算")
+        assert [h["id"] for h in hits] == ["f1"]
+        assert HIGHLIGHT_START in hits[0]["snippet"]
+        assert await db.search(uid, 1, "%") == []
+
+    _run(tmp_path, body)
+
+
+def test_triggers_keep_index_in_sync(tmp_path):
+    async def body(db, uid):
+        await _seed(db, uid)
+        await db.update_tags("f1", "contract")
+        assert [h["id"] for h in await db.search(uid, 1, "contract")] == ["f1"]
+        assert await db.search(uid, 1, "予算") == []
+        await db.execute("UPDATE files SET original_name='renamed.txt' WHERE id='f2'")
+        assert [h["id"] for h in await db.search(uid, 1, "renamed")] == ["f2"]
+        await db.delete_file("f2")
+        assert [h["id"] for h in await db.search(uid, 1, "forecast")] == ["s1"]
+
+    _run(tmp_path, body)
+
+
+def test_folder_scoped_wrappers(tmp_path):
+    async def body(db, uid):
+        await _seed(db, uid)
+        rows = await db.search_files(uid, "budget", "7")
+        assert [r["id"] for r in rows] == ["f2"]
+        assert await db.search_files(uid, "budget") == []
+        rows = await db.search_shared_files(1, "plan")
+        assert [r["id"] for r in rows] == ["s1"]
+
+    _run(tmp_path, body)
+
+
+def test_location_is_folder_name(tmp_path):
+    async def body(db, uid):
+        folder = await db.create_user_folder(uid, "経理")
+        await db.add_file("a", uid, str(folder), "report.txt", "/a", 1, "h", "")
+        await db.add_file("b", uid, "", "report-root.txt", "/b", 1, "h", "")
+        hits = {h["id"]: h["location"] for h in await db.search(uid, None, "report")}
+        assert hits == {"a": "経理", "b": "/"}
+
+    _run(tmp_path, body)
+
+
+def test_folder_search_is_not_cut_off_by_other_folders(tmp_path):
+    # 他のフォルダに一致が 1000 件以上あっても、指定フォルダの一致を取りこぼさない
+    async def body(db, uid):
+        await db.conn.executemany(
+            "INSERT INTO files (id, user_id, folder, original_name, path, size, sha256, uploaded_at) "
+            "VALUES (?, ?, '', ?, '/p', 1, 'h', '0')",
+            [(f"r{i}", uid, f"report-{i}.txt") for i in range(1100)],
+        )
+        await db.add_file("x", uid, "9", "report-old.txt", "/x", 1, "h", "")
+        rows = await db.search_files(uid, "report", "9")
+        assert [r["id"] for r in rows] == ["x"]
+
+    _run(tmp_path, body)
+
+
+def test_existing_rows_are_backfilled(tmp_path):
+    import sqlite3
+
+    async def body(db, uid):
+        await _seed(db, uid)
+
+    _run(tmp_path, body)
+    # 索引導入前のデータベースを再現する
+    conn = sqlite3.connect(tmp_path / "t.db")
+    triggers = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE '%search%'"
+    ).fetchall()
+    for (name,) in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.executescript("DROP TABLE search_fts; DROP TABLE search_docs;")
+    conn.close()
+
+    async def check():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            uid = await db.get_user_pk(1)
+            assert [h["id"] for h in await db.search(uid, 1, "notes")] == ["f2"]
+        finally:
+            await db.close()
+
+    asyncio.run(check())
+
+
+def test_endpoints_use_index():
+    text = APP.read_text(encoding='utf-8')
+    start = text.index('async def search_files_api')
+    assert 'db.search(user_id, discord_id' in text[start:start + 1500]
+    assert '_index_text(' in text
+    cmds = COMMANDS.read_text(encoding='utf-8')
+    start = cmds.index('async def search_files_cmd')
+    assert 'db.search(pk, i.user.id' in cmds[start:start + 800]
@@ -0,0 +1,81 @@
+from pathlib import Path
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# web.app は import 時に設定を読むので、別プロセスで環境を整えてから動かす
+DRIVER = r'''
+import asyncio, json, sys
+from pathlib import Path
+sys.path[:0] = [sys.argv[1], sys.argv[1] + "/benchmarks"]
+import bench_http
+bench_http.prepare_env(Path(sys.argv[2]))
+bench_http.install_stubs()
+import web.app as wa
+from aiohttp import MultipartWriter
+from aiohttp.test_utils import TestClient, TestServer
+from bot.db import init_db
+
+
+def form(order, folder_id):
+    with MultipartWriter("form-data") as mp:
+        for name in order:
+            if name == "file":
+                part = mp.append(b"hello shared")
+                part.set_content_disposition("form-data", name="file", filename="a.txt")
+            else:
+                part = mp.append(str(folder_id))
+                part.set_content_disposition("form-data", name="folder_id")
+    return mp
+
+
+async def main():
+    await init_db(wa.DB_PATH)
+    app = wa.create_app()
+    headers = {
+        "Cookie": "wdsid=" + bench_http.session_cookie(wa.COOKIE_SECRET),
+        "X-CSRF-Token": bench_http.CSRF,
+    }
+    out = {}
+    async with TestClient(TestServer(app)) as client:
+        db = app["db"]
+        folder = await db.create_shared_folder("s", 1)
+        await db.add_shared_folder_member(folder, bench_http.BENCH_DISCORD_ID)
+        for key, order in (("folder_first", ("folder_id", "file")),
+                           ("file_first", ("file", "folder_id")),
+                           ("file_only", ("file",))):
+            resp = await client.post("/shared/upload", data=form(order, folder),
+                                     headers=headers, allow_redirects=False)
+            out[key] = resp.status
+        rows = await db.fetchall("SELECT path FROM shared_files WHERE folder_id = ?", folder)
+        out["bodies"] = [Path(r["path"]).read_bytes().decode() for r in rows]
+        out["spooled"] = [p.name for p in wa.CHUNK_DIR.iterdir()]
+        await db.close()
+    print(json.dumps(out))
+
+
+if __name__ == "__main__":  # タグ付けのワーカープロセスでは動かさない
+    asyncio.run(main())
+'''
+
+
+def test_shared_upload_accepts_file_before_folder_id(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    pytest.importorskip("cryptography")
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    proc = subprocess.run(
+        [sys.executable, "-c", DRIVER, str(ROOT), str(tmp_path)],
+        capture_output=True, text=True, timeout=60, env=env, check=True,
+    )
+    out = json.loads(proc.stdout.splitlines()[-1])
+    assert out["folder_first"] == 302
+    assert out["file_first"] == 302
+    assert out["file_only"] == 400
+    assert out["bodies"] == ["hello shared", "hello shared"]
+    assert out["spooled"] == []  # 一時ファイルは残さない
@@ -0,0 +1,77 @@
+from pathlib import Path
+import gzip
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+TEMPLATES = ROOT / 'web' / 'templates'
+sys.path.insert(0, str(ROOT))
+
+from web.assets import build_assets
+
+
+def _static(tmp_path):
+    static = tmp_path / "static"
+    (static / "js").mkdir(parents=True)
+    (static / "js" / "main.js").write_text("console.log('hello');\n" * 50)
+    (static / "favicon.png").write_bytes(b"\x89PNG" + b"\x00" * 64)
+    (static / "service-worker.js").write_text(
+        "const CACHE_VERSION = 'v4';\n"
+        "const OFFLINE_URLS = ['/static/js/main.js', '/static/missing.css'];\n"
+    )
+    return static
+
+
+def test_hashed_copies_and_precompressed(tmp_path):
+    static = _static(tmp_path)
+    out = tmp_path / "out"
+    m = build_assets(static, out)
+    name = m.files["js/main.js"]
+    assert name.startswith("js/main.") and name.endswith(".js")
+    assert m.url("js/main.js") == f"/assets/{name}"
+    data = (static / "js" / "main.js").read_bytes()
+    assert gzip.decompress((out / (name + ".gz")).read_bytes()) == data
+    # 画像は圧縮しない
+    assert not (out / (m.files["favicon.png"] + ".gz")).exists()
+    assert m.url("other.css").startswith("/static/other.css?v=")
+
+
+def test_hash_changes_with_content(tmp_path):
+    static = _static(tmp_path)
+    first = build_assets(static, tmp_path / "out")
+    assert build_assets(static, tmp_path / "out").files == first.files
+    (static / "js" / "main.js").write_text("changed")
+    second = build_assets(static, tmp_path / "out")
+    assert second.files["js/main.js"] != first.files["js/main.js"]
+    assert second.version != first.version
+    # 古いファイルは猶予期間が過ぎるまで残す
+    assert (tmp_path / "out" / first.files["js/main.js"]).exists()
+    build_assets(static, tmp_path / "out", now=10**12)
+    assert not (tmp_path / "out" / first.files["js/main.js"]).exists()
+
+
+def test_service_worker_references_hashed_names(tmp_path):
+    static = _static(tmp_path)
+    m = build_assets(static, tmp_path / "out")
+    sw = (tmp_path / "out" / "service-worker.js").read_text()
+    assert f"'/assets/{m.files['js/main.js']}'" in sw
+    assert "'/static/missing.css'" in sw
+    assert f"const CACHE_VERSION = 'v4-{m.version}';" in sw
+
+
+def test_app_serves_assets_immutable():
+    text = APP.read_text(encoding='utf-8')
+    assert 'env.globals["asset_url"] = assets.url' in text
+    assert 'app.router.add_static(ASSET_PREFIX, str(ASSET_DIR), name="assets")' in text
+    assert 'response.headers["Cache-Control"] = IMMUTABLE_CACHE' in text
+    assert '"static_version": int(time.time())' not in text
+    base = (TEMPLATES / 'base.html').read_text(encoding='utf-8')
+    assert "{{ asset_url('js/main.js') }}" in base
+
+
+def test_compression_skipped_for_media_and_downloads():
+    text = APP.read_text(encoding='utf-8')
+    start = text.index('NO_COMPRESS_PREFIXES = (')
+    block = text[start:text.index(')', start)]
+    for prefix in ('"/hls/"', '"/download/"', '"/f/"', 'ASSET_PREFIX'):
+        assert prefix in block
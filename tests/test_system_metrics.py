@@ -44,3 +44,50 @@ def test_get_server_process_metrics():
     assert isinstance(metrics["open_fd_count"], int)
     assert metrics["open_fd_count"] >= 0
 
+
+
+def test_counters_do_not_sleep():
+    net = system_metrics.get_network_counters()
+    assert {"bytes_recv_total", "bytes_sent_total"} <= net.keys()
+    proc = system_metrics.get_server_process_counters()
+    assert proc["process_cpu_seconds_total"] >= 0.0
+    assert proc["process_memory_rss_bytes"] >= 0.0
+    assert proc["open_fd_count"] >= 0
+
+
+def test_sampler_rates_and_history():
+    import asyncio
+
+    sampler = system_metrics.SystemSampler(interval=1, history=5)
+
+    async def run():
+        assert await sampler.rates() is None  # サンプルが 2 つ揃うまでは無い
+        for _ in range(7):
+            sampler.sample_now()
+        assert len(sampler.samples) == 5  # リングバッファ
+        summary = await sampler.summary()
+        assert summary["latest"] is sampler.samples[-1]
+        for key in ("instant", "1m", "5m"):
+            rates = summary["rates"][key]
+            assert rates["process_cpu_percent"] >= 0.0
+            assert rates["bytes_recv_per_sec"] >= 0.0
+        history = await sampler.history()
+        assert len(history) == 4
+        assert {"ffmpeg", "libreoffice"} <= history[-1]["children"].keys()
+        assert len(await sampler.history(0)) == 1
+
+    asyncio.run(run())
+
+
+def test_children_are_grouped_by_name(monkeypatch):
+    import subprocess
+
+    monkeypatch.setitem(system_metrics.CHILD_GROUPS, "sleep", "sleep")
+    proc = subprocess.Popen(["sleep", "5"])
+    try:
+        children = system_metrics.read_sample()["children"]
+        assert children["sleep"]["count"] == 1
+        assert children["sleep"]["rss_bytes"] > 0
+    finally:
+        proc.kill()
+        proc.wait()
@@ -0,0 +1,128 @@
+from pathlib import Path
+import asyncio
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+pytest.importorskip("aiosqlite")
+pytest.importorskip("scrypt")
+
+from bot.db import Database, TagTrie, init_db, parse_tags
+
+
+def test_parse_tags_dedupes_case_insensitively():
+    assert parse_tags(" 会議、予算 , Budget,budget,, ") == ["会議", "予算", "Budget"]
+
+
+def test_trie_suggest_orders_by_count():
+    trie = TagTrie()
+    trie.add("Python", 3)
+    trie.add("pytest", 5)
+    trie.add("rust")
+    assert trie.suggest("py") == [("pytest", 5), ("Python", 3)]
+    trie.add("pytest", -5)
+    assert trie.suggest("PY") == [("Python", 3)]
+    assert trie.suggest("go") == []
+
+
+def _run(tmp_path, body):
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            await body(db, uid)
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_facets_filtering_and_suggest(tmp_path):
+    async def body(db, uid):
+        await db.add_file("a", uid, "", "a.txt", "/a", 1, "h", "会議, 予算")
+        await db.add_file("b", uid, "", "b.txt", "/b", 1, "h", "会議")
+        await db.add_file("c", uid, "x", "c.txt", "/c", 1, "h", "予算, 契約")
+
+        assert await db.tag_facets(uid) == [
+            {"name": "予算", "count": 2},
+            {"name": "会議", "count": 2},
+            {"name": "契約", "count": 1},
+        ]
+        assert await db.tag_facets(uid, folder="x") == [
+            {"name": "予算", "count": 1},
+            {"name": "契約", "count": 1},
+        ]
+
+        both = await db.list_files(uid, "", 10, tags=["会議", "予算"])
+        assert [r["id"] for r in both] == ["a"]
+        either = await db.list_files(uid, "", 10, tags=["会議", "予算"], match_all=False)
+        assert sorted(r["id"] for r in either) == ["a", "b"]
+
+        assert await db.suggest_tags(uid, "会") == [{"name": "会議", "count": 2}]
+        # 読み込み済みのトライ木は差分更新される
+        await db.update_tags("b", "会計")
+        assert await db.suggest_tags(uid, "会") == [
+            {"name": "会計", "count": 1},
+            {"name": "会議", "count": 1},
+        ]
+        await db.delete_file("a")
+        assert await db.suggest_tags(uid, "会") == [{"name": "会計", "count": 1}]
+        assert await db.tag_facets(uid, folder="") == [{"name": "会計", "count": 1}]
+
+    _run(tmp_path, body)
+
+
+def test_list_files_without_paging(tmp_path):
+    # Bot の /myfiles は list_files(pk) でルートの全件を読む
+    async def body(db, uid):
+        await db.add_file("a", uid, "", "a.txt", "/a", 1, "h", "会議")
+        await db.add_file("b", uid, "", "b.txt", "/b", 1, "h", "")
+        await db.add_file("c", uid, "x", "c.txt", "/c", 1, "h", "")
+        rows = await db.list_files(uid)
+        assert sorted(r["id"] for r in rows) == ["a", "b"]
+        assert {"original_name", "size", "uploaded_at", "tags"} <= set(rows[0].keys())
+        assert len(await db.list_files(uid, "", 1)) == 1
+
+    _run(tmp_path, body)
+
+
+def test_existing_tag_column_is_migrated(tmp_path):
+    async def seed(db, uid):
+        await db.add_file("a", uid, "", "a.txt", "/a", 1, "h", "old, tags")
+
+    _run(tmp_path, seed)
+    conn = sqlite3.connect(tmp_path / "t.db")
+    conn.executescript("DELETE FROM file_tags; DELETE FROM tags;")
+    conn.close()
+
+    async def check():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            uid = await db.get_user_pk(1)
+            assert await db.tag_facets(uid) == [
+                {"name": "old", "count": 1},
+                {"name": "tags", "count": 1},
+            ]
+        finally:
+            await db.close()
+
+    asyncio.run(check())
+
+
+def test_file_list_api_accepts_tag_filter():
+    text = APP.read_text(encoding='utf-8')
+    start = text.index('async def file_list_api')
+    snippet = text[start:start + 2500]
+    assert 'request.query.get("tags"' in snippet
+    assert 'match_all=match_all' in snippet
+    assert 'app.router.add_get("/api/tags/suggest", tag_suggest_api)' in text
@@ -0,0 +1,34 @@
+from pathlib import Path
+import re
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+BENCH = ROOT / 'benchmarks' / 'bench_templates.py'
+
+
+def test_jinja_production_settings():
+    text = APP.read_text(encoding='utf-8')
+    assert 'auto_reload=TEMPLATE_AUTO_RELOAD' in text
+    assert 'bytecode_cache=jinja2.FileSystemBytecodeCache(str(JINJA_CACHE_DIR))' in text
+    assert 'TEMPLATE_AUTO_RELOAD = os.getenv("TEMPLATE_AUTO_RELOAD", "0")' in text
+
+
+def test_templates_precompiled_after_globals():
+    text = APP.read_text(encoding='utf-8')
+    start = text.index('def create_app')
+    body = text[start:]
+    # フィルタやグローバルを登録し終えてからコンパイルする
+    assert body.index('precompile_templates(env)') > body.index('env.globals["asset_url"]')
+    assert body.index('precompile_templates(env)') > body.index('env.filters["human_size"]')
+
+
+def test_mobile_check_memoized():
+    text = APP.read_text(encoding='utf-8')
+    assert re.search(r"@functools\.lru_cache\(maxsize=\d+\)\s*def _is_mobile", text)
+    assert 'MOBILE_UA_RE = re.compile(' in text
+
+
+def test_benchmark_reports_startup_and_p99():
+    text = BENCH.read_text(encoding='utf-8')
+    assert '"create_app_cold_s"' in text
+    assert '"p99_ms"' in text
@@ -0,0 +1,106 @@
+from pathlib import Path
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import bot.auto_tag as auto_tag
+
+
+def test_pdf_stops_after_limit(monkeypatch, tmp_path):
+    opened = []
+
+    class _Page:
+        def __init__(self, n):
+            self.n = n
+
+        def extract_text(self):
+            opened.append(self.n)
+            return "x" * 100
+
+    class _Reader:
+        def __init__(self, *a, **k):
+            self.pages = (_Page(n) for n in range(300))
+
+    monkeypatch.setattr(auto_tag, "PdfReader", _Reader)
+    f = tmp_path / "big.pdf"
+    f.write_bytes(b"%PDF-1.4")
+    text = auto_tag.extract_text(f, limit=250)
+    assert len(text) == 250
+    assert opened == [0, 1, 2]
+
+
+def test_docx_paragraphs_streamed(tmp_path):
+    docx = pytest.importorskip("docx")
+    doc = docx.Document()
+    for n in range(2000):
+        doc.add_paragraph(f"paragraph {n}")
+    f = tmp_path / "a.docx"
+    doc.save(f)
+    text = auto_tag.extract_text(f, limit=40)
+    assert text.startswith("paragraph 0\nparagraph 1\n")
+    assert len(text) <= 40
+
+
+def test_pptx_slides_in_order(tmp_path):
+    pptx = pytest.importorskip("pptx")
+    from pptx.util import Inches
+
+    pres = pptx.Presentation()
+    for n in range(12):
+        slide = pres.slides.add_slide(pres.slide_layouts[6])
+        box = slide.shapes.add_textbox(Inches(1), Inches(1), Inches(2), Inches(1))
+        box.text_frame.text = f"slide {n}"
+    f = tmp_path / "a.pptx"
+    pres.save(f)
+    text = auto_tag.extract_text(f, limit=1000)
+    assert text.split("\n")[:3] == ["slide 0", "slide 1", "slide 2"]
+    assert "slide 11" in text
+
+
+def test_xlsx_read_only_rows(monkeypatch, tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    for n in range(500):
+        ws.append([f"row{n}", n])
+    f = tmp_path / "a.xlsx"
+    wb.save(f)
+
+    seen = {}
+    real = auto_tag.load_workbook
+
+    def spy(*a, **k):
+        seen.update(k)
+        return real(*a, **k)
+
+    monkeypatch.setattr(auto_tag, "load_workbook", spy)
+    text = auto_tag.extract_text(f, limit=30)
+    assert seen.get("read_only") is True
+    assert text.startswith("row0 0\nrow1 1")
+    assert len(text) <= 30
+
+
+def test_text_reads_only_head(monkeypatch, tmp_path):
+    f = tmp_path / "big.txt"
+    f.write_text("a" * 1_000_000)
+    sizes = []
+    real = auto_tag._read_head
+
+    def spy(path, size):
+        sizes.append(size)
+        return real(path, size)
+
+    monkeypatch.setattr(auto_tag, "_read_head", spy)
+    assert auto_tag.extract_text(f, limit=100) == "a" * 100
+    assert sizes == [400]
+
+
+def test_unknown_binary_is_not_text(tmp_path):
+    f = tmp_path / "blob"
+    f.write_bytes(b"\x89PNG\r\n\x1a\n\x00\x00" + b"\xff" * 100)
+    assert auto_tag.extract_text(f) is None
+    g = tmp_path / "note"
+    g.write_text("日本語のメモ" * 10)
+    assert auto_tag.extract_text(g, limit=6) == "日本語のメモ"
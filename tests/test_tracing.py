@@ -0,0 +1,142 @@
+from pathlib import Path
+import asyncio
+import json
+import sys
+import time
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+from web.tracing import JsonFileExporter, Tracer, _current, current_span, otlp_payload
+
+
+def test_unsampled_trace_records_nothing():
+    tracer = Tracer(sample_rate=0)
+    with tracer.start_trace("GET /") as root:
+        assert root is None
+        with tracer.span("child") as span:
+            assert span is None
+        tracer.record("db", 0.01)
+    assert tracer.slowest() == []
+
+
+def test_nested_spans_keep_parent_ids():
+    tracer = Tracer(sample_rate=1)
+    with tracer.start_trace("GET /a", {"http.route": "/a"}, kind="server") as root:
+        with tracer.span("outer") as outer:
+            with tracer.span("inner", {"k": 1}) as inner:
+                assert current_span() is inner
+            tracer.record("db", 0.002, {"db.statement": "SELECT 1"})
+        assert current_span() is root
+    assert current_span() is None
+
+    (trace,) = tracer.slowest()
+    assert trace["name"] == "GET /a"
+    assert trace["attributes"] == {"http.route": "/a"}
+    spans = {s["name"]: s for s in trace["spans"]}
+    assert spans["outer"]["parent_id"] == root.span_id
+    assert spans["inner"]["parent_id"] == outer.span_id
+    assert spans["inner"]["attributes"] == {"k": 1}
+    assert spans["db"]["parent_id"] == outer.span_id
+    assert 1.5 <= spans["db"]["duration_ms"] <= 2.5
+
+
+def test_error_is_recorded_on_span():
+    tracer = Tracer(sample_rate=1)
+    try:
+        with tracer.start_trace("task"):
+            with tracer.span("step"):
+                raise ValueError("boom")
+    except ValueError:
+        pass
+    (trace,) = tracer.slowest()
+    assert trace["spans"][0]["error"] == "ValueError"
+
+
+def test_span_context_follows_to_thread():
+    tracer = Tracer(sample_rate=1)
+
+    def work():
+        with tracer.span("in-thread"):
+            time.sleep(0.001)
+
+    async def main():
+        with tracer.start_trace("task") as root:
+            with tracer.span("offload") as offload:
+                await asyncio.to_thread(work)
+        return root, offload
+
+    root, offload = asyncio.run(main())
+    (trace,) = tracer.slowest()
+    spans = {s["name"]: s for s in trace["spans"]}
+    assert spans["in-thread"]["parent_id"] == offload.span_id
+
+
+def test_spans_after_trace_end_are_dropped():
+    tracer = Tracer(sample_rate=1)
+    with tracer.start_trace("GET /") as root:
+        pass
+    token = _current.set(root)  # 終了後も残ったタスクから呼ばれた場合
+    with tracer.span("late") as span:
+        assert span is None
+    tracer.record("db", 0.001)
+    _current.reset(token)
+    assert tracer.slowest()[0]["spans"] == []
+
+
+def test_span_limit_counts_dropped():
+    tracer = Tracer(sample_rate=1, max_spans=3)
+    with tracer.start_trace("GET /"):
+        for _ in range(5):
+            tracer.record("db", 0)
+    (trace,) = tracer.slowest()
+    assert len(trace["spans"]) == 2
+    assert trace["dropped_spans"] == 3
+
+
+def test_slowest_orders_by_duration_and_keeps_recent():
+    tracer = Tracer(sample_rate=1, keep=2)
+    for name, delay in (("a", 0.003), ("b", 0.001), ("c", 0.002)):
+        with tracer.start_trace(name):
+            time.sleep(delay)
+    assert [t["name"] for t in tracer.slowest()] == ["c", "b"]
+
+
+def test_otlp_payload_shape():
+    tracer = Tracer(sample_rate=1)
+    with tracer.start_trace("GET /x", {"http.status_code": 200, "ok": True}, kind="server") as root:
+        with tracer.span("db", {"ms": 1.5}):
+            pass
+    payload = otlp_payload(list(tracer.recent))
+    spans = payload["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    by_name = {s["name"]: s for s in spans}
+    server = by_name["GET /x"]
+    assert server["kind"] == 2 and "parentSpanId" not in server
+    assert len(server["traceId"]) == 32 and len(server["spanId"]) == 16
+    assert {"key": "http.status_code", "value": {"intValue": "200"}} in server["attributes"]
+    assert {"key": "ok", "value": {"boolValue": True}} in server["attributes"]
+    assert by_name["db"]["parentSpanId"] == root.span_id
+    assert int(server["endTimeUnixNano"]) >= int(server["startTimeUnixNano"])
+    json.dumps(payload)
+
+
+def test_json_file_exporter_appends_lines(tmp_path):
+    out = tmp_path / "traces.jsonl"
+    tracer = Tracer(sample_rate=1, exporter=JsonFileExporter(out))
+    for name in ("a", "b"):
+        with tracer.start_trace(name):
+            tracer.record("db", 0)
+    asyncio.run(tracer.flush())
+    lines = out.read_text().splitlines()
+    assert [json.loads(l)["name"] for l in lines] == ["a", "b"]
+    assert tracer.pending == []
+
+
+def test_app_wires_tracing():
+    text = APP.read_text()
+    assert "app.middlewares.append(tracer.middleware())" in text
+    assert 'tracer.record(\n            "db", elapsed' in text
+    assert 'app.router.add_get("/api/admin/traces", admin_traces)' in text
+    assert "trace_configs=[http_trace_config]" in text
+    assert 'tracer.start_trace("task preview_and_tags"' in text
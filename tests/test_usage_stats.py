@@ -0,0 +1,125 @@
+from pathlib import Path
+import asyncio
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+APP = ROOT / 'web' / 'app.py'
+sys.path.insert(0, str(ROOT))
+
+
+def test_usage_follows_every_write(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            await db.add_user(1, "alice", "pw")
+            uid = await db.get_user_pk(1)
+            folder = await db.create_user_folder(uid, "docs")
+            await db.add_file("a", uid, "", "a.txt", "/a", 10, "h", "")
+            await db.add_file("b", uid, str(folder), "b.txt", "/b", 20, "h", "")
+            await db.add_file("c", uid, str(folder), "c.txt", "/c", 30, "h", "")
+
+            usage = await db.user_usage(uid)
+            assert (usage["file_count"], usage["total_size"]) == (3, 60)
+            assert usage["last_modified"] > 0
+            per_folder = await db.folder_usage(uid)
+            assert per_folder[""]["total_size"] == 10
+            assert per_folder[str(folder)]["file_count"] == 2
+
+            # 移動・削除で差分だけ反映される
+            await db.execute("UPDATE files SET folder='' WHERE id='b'")
+            await db.delete_file("c")
+            per_folder = await db.folder_usage(uid)
+            assert per_folder[""] == {**per_folder[""], "file_count": 2, "total_size": 30}
+            assert str(folder) not in per_folder
+            assert (await db.user_usage(uid))["total_size"] == 30
+
+            # 作り直しても同じ値になる
+            before = await db.user_usage(uid)
+            await db.rebuild_usage()
+            after = await db.user_usage(uid)
+            assert (after["file_count"], after["total_size"]) == (
+                before["file_count"],
+                before["total_size"],
+            )
+
+            await db.delete_all_files(uid)
+            assert (await db.user_usage(uid))["total_size"] == 0
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_shared_usage_without_group_by(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            fid = await db.create_shared_folder("team", 100)
+            empty = await db.create_shared_folder("empty", 101)
+            await db.add_shared_folder_member(fid, 1)
+            await db.add_shared_folder_member(empty, 1)
+            src = tmp_path / "s.txt"
+            src.write_bytes(b"12345")
+            await db.add_shared_file("s1", fid, "s.txt", str(src))
+            await db.add_shared_file("s2", fid, "s.txt", str(src))
+            rows = {r["name"]: dict(r) for r in await db.member_shared_usage(1)}
+            assert rows["team"]["file_count"] == 2 and rows["team"]["total_size"] == 10
+            assert rows["empty"]["file_count"] == 0
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_existing_files_are_backfilled(tmp_path):
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("scrypt")
+    import sqlite3
+    from bot.db import Database, init_db
+
+    async def run():
+        await init_db(tmp_path / "t.db")
+        # トリガー導入前の DB を再現する
+        con = sqlite3.connect(tmp_path / "t.db")
+        con.execute(
+            "INSERT INTO files (id, user_id, folder, path, original_name, size, sha256, uploaded_at) "
+            "VALUES ('x', 7, '', '/x', 'x', 42, 'h', '1700000000')"
+        )
+        con.execute("DELETE FROM usage_stats")
+        con.commit()
+        con.close()
+        await init_db(tmp_path / "t.db")
+        db = Database(tmp_path / "t.db")
+        await db.open()
+        try:
+            assert await db.user_usage(7) == {
+                "file_count": 1,
+                "total_size": 42,
+                "last_modified": 1700000000,
+            }
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_listings_read_aggregates():
+    text = APP.read_text(encoding='utf-8')
+    assert 'COUNT(f.id)' not in text
+    assert text.count('db.member_shared_usage(') == 3
+    assert 'app.router.add_get("/api/usage", usage_api)' in text
+    assert '**usage.get(str(f["id"]), EMPTY_USAGE)' in text
@@ -4,9 +4,11 @@ from __future__ import annotations
 import time
 import asyncio
 import base64
+import functools
 import hashlib
 import hmac
 import logging
+import math
 import mimetypes
 import os
 import re
@@ -22,18 +24,16 @@ import discord
 
 from aiohttp import web
 import aiohttp
-from aiohttp_compress import compress_middleware
 from aiohttp_session import new_session, setup as session_setup
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 import aiohttp_session
 import aiohttp_jinja2
 import jinja2
+from markupsafe import Markup, escape
 from aiohttp.web_exceptions import HTTPForbidden, HTTPPermanentRedirect
 from aiohttp_session import get_session
 from jinja2 import pass_context
 from aiohttp_jinja2 import static_root_key
-from aiolimiter import AsyncLimiter
-from collections import defaultdict
 import io, qrcode, pyotp
 from PIL import Image
 import subprocess
@@ -41,6 +41,21 @@ from pdf2image import convert_from_path
 import shutil
 
 from bot.db import init_db  # スキーマ初期化用
+from bot.db import EMPTY_USAGE, HIGHLIGHT_END, HIGHLIGHT_START
+from bot.db import LoginThrottled, PasswordHashBusy, password_hasher
+from bot.quota import USER_QUOTA_BYTES, QuotaExceeded, UploadBudget, open_budget
+from bot.query_log import statement_label
+from web.rate_limit import RateLimiter, SqliteStore, parse_networks, parse_policy
+from web.assets import ASSET_PREFIX, IMMUTABLE_CACHE, build_assets
+from web.compression import Compressor
+from web.render_cache import RenderCache, etag_matches, make_etag
+from web import listing
+from web.changes import ChangeFeed, format_sse, parse_wait
+from web.reaper import BlobReaper
+from web.metrics import HttpMetrics, Registry
+from web.tracing import JsonFileExporter, OtlpExporter, Tracer
+from web.loop_monitor import LoopMonitor
+import system_metrics
 
 Database = import_module("bot.db").Database  # type: ignore
 
@@ -53,8 +68,21 @@ DB_PATH = Path(os.getenv("DB_PATH", ROOT / "data" / "web_discord_server.db"))
 CHUNK_DIR = DATA_DIR / "chunks"
 PREVIEW_DIR = DATA_DIR / "previews"
 HLS_DIR = DATA_DIR / "hls"
-
-for d in (DATA_DIR, STATIC_DIR, TEMPLATE_DIR, CHUNK_DIR, PREVIEW_DIR, HLS_DIR):
+CACHE_DIR = DATA_DIR / "cache"
+ASSET_DIR = CACHE_DIR / "assets"  # ハッシュ名を付けた静的ファイルの出力先
+JINJA_CACHE_DIR = CACHE_DIR / "jinja"  # コンパイル済みテンプレートのバイトコード
+
+for d in (
+    DATA_DIR,
+    STATIC_DIR,
+    TEMPLATE_DIR,
+    CHUNK_DIR,
+    PREVIEW_DIR,
+    HLS_DIR,
+    CACHE_DIR,
+    ASSET_DIR,
+    JINJA_CACHE_DIR,
+):
     d.mkdir(parents=True, exist_ok=True)
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
@@ -79,9 +107,87 @@ DISCORD_CLIENT_SECRET = os.getenv("DISCORD_CLIENT_SECRET")
 
 # HTTPS 強制リダイレクトの有無
 FORCE_HTTPS = os.getenv("FORCE_HTTPS", "0").lower() in {"1", "true", "yes"}
+# 開発時だけ 1 にする。無効ならテンプレートの更新確認 (stat) を描画ごとに行わない
+TEMPLATE_AUTO_RELOAD = os.getenv("TEMPLATE_AUTO_RELOAD", "0").lower() in {"1", "true", "yes"}
 DM_UPLOAD_LIMIT = int(os.getenv("DISCORD_DM_UPLOAD_LIMIT", 8 << 20))
 FILES_PER_PAGE = int(os.getenv("FILES_PER_PAGE", 90))
 HTTP_TIMEOUT = aiohttp.ClientTimeout(total=60)
+# Google Drive ミラーリングの同時実行数 (全体 / ユーザー単位) と再試行上限
+GDRIVE_SYNC_CONCURRENCY = int(os.getenv("GDRIVE_SYNC_CONCURRENCY", 4))
+GDRIVE_USER_CONCURRENCY = int(os.getenv("GDRIVE_USER_CONCURRENCY", 1))
+GDRIVE_SYNC_MAX_ATTEMPTS = int(os.getenv("GDRIVE_SYNC_MAX_ATTEMPTS", 5))
+
+# ファイル一覧の部分 HTML をキャッシュする件数と最長保持秒数。
+# 残り期限の表示や署名付き URL が古くなり過ぎないよう、更新がなくても定期的に描き直す
+PARTIAL_CACHE_SIZE = int(os.getenv("PARTIAL_CACHE_SIZE", 512))
+PARTIAL_CACHE_TTL = int(os.getenv("PARTIAL_CACHE_TTL", 60))
+# /api/files の署名付き URL は有効期限の半分までは同じ ETag で使い回せる
+LISTING_URL_TTL = max(60, URL_EXPIRES_SEC // 2)
+# /api/changes が 1 回に読む変更履歴の行数
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", 1000))
+# ロングポーリング / SSE で変更を待つ最長秒数と、新着を確認する間隔
+CHANGES_MAX_WAIT = float(os.getenv("CHANGES_MAX_WAIT", 25))
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", 1.0))
+# 削除の記録を残す日数と、変更履歴を圧縮する間隔 (秒)
+CHANGES_RETENTION_DAYS = int(os.getenv("CHANGES_RETENTION_DAYS", 30))
+CHANGES_COMPACT_INTERVAL = int(os.getenv("CHANGES_COMPACT_INTERVAL", 3600))
+# 全文検索の索引に登録する本文の最大文字数と、検索結果の最大件数
+SEARCH_TEXT_LIMIT = int(os.getenv("SEARCH_TEXT_LIMIT", 20_000))
+SEARCH_RESULT_LIMIT = 50
+# アップロードを受信しながら書き出す単位
+UPLOAD_READ_SIZE = 256 << 10
+# 削除済みファイルの実体を消す 1 バッチの件数、スレッド数、待ち行列を見に行く間隔 (秒)
+REAPER_BATCH_SIZE = int(os.getenv("REAPER_BATCH_SIZE", 500))
+REAPER_WORKERS = int(os.getenv("REAPER_WORKERS", 4))
+REAPER_INTERVAL = float(os.getenv("REAPER_INTERVAL", 60))
+# /metrics を読むための Bearer トークン。未設定なら /metrics は 404
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()
+# システム計測のサンプリング間隔 (秒) と保持するサンプル数 (既定で 1 時間分)
+SYSTEM_SAMPLE_INTERVAL = float(os.getenv("SYSTEM_SAMPLE_INTERVAL", 5))
+SYSTEM_SAMPLE_HISTORY = int(os.getenv("SYSTEM_SAMPLE_HISTORY", 720))
+# トレースを取るリクエストの割合 (0〜1)、書き出し先 ("file" / "otlp" / 空なら書き出さない)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.05))
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "").strip().lower()
+TRACE_FILE = Path(os.getenv("TRACE_FILE", DATA_DIR / "traces.jsonl"))
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+# 管理画面で「遅いリクエスト」を選ぶ対象として残す直近のトレース数
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", 200))
+# イベントループの遅延を測る間隔と、呼び出し元のスタックを取る停止時間 (ミリ秒、0 で取らない)
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", 0.1))
+LOOP_BLOCK_THRESHOLD_MS = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", 100))
+# 管理者向け API を使える Discord ユーザー (Bot の製作者)
+OWNER_ID = int(os.getenv("BOT_OWNER_ID", "0")) or None
+
+# ─────────────── Metrics ───────────────
+metrics_registry = Registry()
+http_metrics = HttpMetrics(metrics_registry)
+db_query_seconds = metrics_registry.histogram(
+    "wds_db_query_duration_seconds",
+    "Time spent in SQLite statements (normalized SQL).",
+    ("statement",),
+)
+upload_bytes = metrics_registry.counter(
+    "wds_upload_bytes_total", "File bytes received and stored.", ("source",)
+)
+hls_jobs = metrics_registry.gauge(
+    "wds_hls_jobs_running", "HLS transcodes currently running."
+)
+hls_jobs.set(0)
+# Bot と共有するイベントループを止めている同期処理を呼び出し元ごとに数える
+loop_monitor = LoopMonitor(
+    LOOP_MONITOR_INTERVAL, LOOP_BLOCK_THRESHOLD_MS / 1000, metrics_registry
+)
+
+# ─────────────── Tracing ───────────────
+if TRACE_EXPORT == "file":
+    _trace_exporter = JsonFileExporter(TRACE_FILE)
+elif TRACE_EXPORT == "otlp":
+    _trace_exporter = OtlpExporter(TRACE_OTLP_ENDPOINT)
+else:
+    _trace_exporter = None
+tracer = Tracer(TRACE_SAMPLE_RATE, _trace_exporter, keep=TRACE_KEEP)
+# 外部 HTTP (Webhook・OAuth) の ClientSession に渡す
+http_trace_config = tracer.client_trace_config()
 
 # ─────────────── Helpers ───────────────
 MOBILE_TEMPLATES = {
@@ -95,13 +201,33 @@ MOBILE_TEMPLATES = {
 }
 
 
+MOBILE_UA_RE = re.compile(
+    r"iPhone|Android.*Mobile|Windows Phone|iPod|BlackBerry|Opera Mini|IEMobile", re.I
+)
+
+
+@functools.lru_cache(maxsize=1024)
 def _is_mobile(user_agent: str) -> bool:
+    # 同じ User-Agent が繰り返し届くので判定結果を覚えておく
     if not user_agent:
         return False
-    pattern = (
-        r"iPhone|Android.*Mobile|Windows Phone|iPod|BlackBerry|Opera Mini|IEMobile"
-    )
-    return re.search(pattern, user_agent, re.I) is not None
+    return MOBILE_UA_RE.search(user_agent) is not None
+
+
+def precompile_templates(env: jinja2.Environment) -> int:
+    """全テンプレートをコンパイルして環境のキャッシュに載せ、読み込めた数を返す。
+
+    バイトコードキャッシュが有効ならその内容も書き出されるため、次回起動時は構文解析を省ける。
+    壊れたテンプレートがあっても起動は止めず、使われたときに従来どおりエラーにする。
+    """
+    count = 0
+    for name in env.list_templates(extensions=["html"]):
+        try:
+            env.get_template(name)
+            count += 1
+        except jinja2.TemplateError as e:
+            log.warning("template %s failed to compile: %s", name, e)
+    return count
 
 
 def _render(req: web.Request, tpl: str, ctx: Dict[str, object]):
@@ -184,6 +310,15 @@ def _make_download_url(path: str, external: bool = False) -> str:
     return path
 
 
+def _highlight(snippet: str) -> Markup:
+    """検索スニペットを HTML エスケープし、一致箇所を <mark> で囲む。"""
+    return Markup(
+        str(escape(snippet or ""))
+        .replace(HIGHLIGHT_START, "<mark>")
+        .replace(HIGHLIGHT_END, "</mark>")
+    )
+
+
 async def issue_csrf(request: web.Request) -> str:
     """Return a CSRF token stored in the session, creating one if needed."""
     session = await aiohttp_session.get_session(request)
@@ -198,7 +333,9 @@ async def _send_shared_webhook(db: Database, folder_id: int, message: str) -> No
     url = rec["webhook_url"] if rec else None
     if not url:
         return
-    async with aiohttp.ClientSession(timeout=HTTP_TIMEOUT) as session:
+    async with aiohttp.ClientSession(
+        timeout=HTTP_TIMEOUT, trace_configs=[http_trace_config]
+    ) as session:
         await session.post(url, json={"content": message})
 
 
@@ -212,71 +349,80 @@ async def notify_shared_upload(
 
 
 # ─────────────── Background Processing ───────────────
-def _generate_preview_and_tags(path: Path, fid: str, file_name: str) -> str:
-    """Create preview image and return tags."""
-    mime, _ = mimetypes.guess_type(file_name)
+def _run_quiet(args: list[str]) -> None:
+    """外部コマンド (ffmpeg / libreoffice) を出力を捨てて実行する。"""
+    with tracer.span("subprocess", {"process.command": args[0]}):
+        subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _generate_preview(path: Path, fid: str, mime: Optional[str]) -> None:
+    """画像・動画・PDF・Office 文書のサムネイルを作る (失敗してもログに残すだけ)。"""
     preview_path = PREVIEW_DIR / f"{fid}.jpg"
-    try:
-        if mime and mime.startswith("image"):
-            img = Image.open(path)
-            img.thumbnail((320, 320))
-            img.convert("RGB").save(preview_path, "JPEG")
-        elif mime and mime.startswith("video"):
-            subprocess.run(
-                [
-                    "ffmpeg",
-                    "-y",
-                    "-i",
-                    str(path),
-                    "-ss",
-                    "00:00:01",
-                    "-vframes",
-                    "1",
-                    str(preview_path),
-                ],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
-        elif mime == "application/pdf":
-            pages = convert_from_path(str(path), first_page=1, last_page=1)
-            if pages:
-                img = pages[0]
+    with tracer.span("preview", {"file.mime": mime or ""}):
+        try:
+            if mime and mime.startswith("image"):
+                img = Image.open(path)
                 img.thumbnail((320, 320))
-                img.save(preview_path, "JPEG")
-        elif mime and mime.startswith("application/vnd"):
-            tmp_pdf = path.with_suffix(".pdf")
-            subprocess.run(
-                [
-                    "libreoffice",
-                    "--headless",
-                    "--convert-to",
-                    "pdf",
-                    str(path),
-                    "--outdir",
-                    str(path.parent),
-                ],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
-            if tmp_pdf.exists():
-                pages = convert_from_path(str(tmp_pdf), first_page=1, last_page=1)
+                img.convert("RGB").save(preview_path, "JPEG")
+            elif mime and mime.startswith("video"):
+                _run_quiet(
+                    [
+                        "ffmpeg",
+                        "-y",
+                        "-i",
+                        str(path),
+                        "-ss",
+                        "00:00:01",
+                        "-vframes",
+                        "1",
+                        str(preview_path),
+                    ]
+                )
+            elif mime == "application/pdf":
+                pages = convert_from_path(str(path), first_page=1, last_page=1)
                 if pages:
                     img = pages[0]
                     img.thumbnail((320, 320))
                     img.save(preview_path, "JPEG")
-                tmp_pdf.unlink(missing_ok=True)
-        else:
-            preview_path = None
-    except Exception as e:
-        log.warning("preview generation failed: %s", e)
-        if preview_path and preview_path.exists():
-            preview_path.unlink(missing_ok=True)
+            elif mime and mime.startswith("application/vnd"):
+                tmp_pdf = path.with_suffix(".pdf")
+                _run_quiet(
+                    [
+                        "libreoffice",
+                        "--headless",
+                        "--convert-to",
+                        "pdf",
+                        str(path),
+                        "--outdir",
+                        str(path.parent),
+                    ]
+                )
+                if tmp_pdf.exists():
+                    pages = convert_from_path(str(tmp_pdf), first_page=1, last_page=1)
+                    if pages:
+                        img = pages[0]
+                        img.thumbnail((320, 320))
+                        img.save(preview_path, "JPEG")
+                    tmp_pdf.unlink(missing_ok=True)
+            else:
+                preview_path = None
+        except Exception as e:
+            log.warning("preview generation failed: %s", e)
+            if preview_path and preview_path.exists():
+                preview_path.unlink(missing_ok=True)
+
+
+def _generate_preview_and_tags(path: Path, fid: str, file_name: str) -> str:
+    """Create preview image and return tags."""
+    mime, _ = mimetypes.guess_type(file_name)
+    _generate_preview(path, fid, mime)
     from bot.auto_tag import generate_tags
 
-    return generate_tags(path, file_name)
+    with tracer.span("auto_tag"):
+        return generate_tags(path, file_name)
 
 
-async def _generate_hls(path: Path, fid: str) -> None:
+async def _generate_hls(path: Path, fid: str, db: Database) -> None:
     """Create HLS streams for the given video."""
     variants = [
         ("360p", 640, 360, 800_000),
@@ -284,6 +430,26 @@ async def _generate_hls(path: Path, fid: str) -> None:
     ]
     out_dir = HLS_DIR / fid
     out_dir.mkdir(parents=True, exist_ok=True)
+    hls_jobs.inc()
+    try:
+        # 応答後に動くのでリクエストとは別のトレースにする
+        with tracer.start_trace("task hls", {"file.id": fid}), tracer.span(
+            "subprocess", {"process.command": "ffmpeg", "hls.variants": len(variants)}
+        ):
+            await _run_hls_variants(path, out_dir, variants)
+    finally:
+        hls_jobs.dec()
+    master = out_dir / "master.m3u8"
+    with master.open("w") as f:
+        f.write("#EXTM3U\n#EXT-X-VERSION:3\n")
+        for name, w, h, br in variants:
+            f.write(f"#EXT-X-STREAM-INF:BANDWIDTH={br},RESOLUTION={w}x{h}\n")
+            f.write(f"{name}.m3u8\n")
+    # 一覧の hls_url が変わるので、描画キャッシュと ETag を作り直させる
+    await db.touch_file(fid)
+
+
+async def _run_hls_variants(path: Path, out_dir: Path, variants: list) -> None:
     procs = []
     for name, w, h, br in variants:
         out = out_dir / f"{name}.m3u8"
@@ -311,12 +477,6 @@ async def _generate_hls(path: Path, fid: str) -> None:
             )
         )
     await asyncio.gather(*(p.wait() for p in procs))
-    master = out_dir / "master.m3u8"
-    with master.open("w") as f:
-        f.write("#EXTM3U\n#EXT-X-VERSION:3\n")
-        for name, w, h, br in variants:
-            f.write(f"#EXT-X-STREAM-INF:BANDWIDTH={br},RESOLUTION={w}x{h}\n")
-            f.write(f"{name}.m3u8\n")
 
 
 async def _task_worker(app: web.Application):
@@ -325,28 +485,203 @@ async def _task_worker(app: web.Application):
     while True:
         job = await queue.get()
         try:
-            tags = await asyncio.to_thread(
-                _generate_preview_and_tags, job["path"], job["fid"], job["file_name"]
-            )
-            if job.get("shared"):
-                await app["db"].update_shared_tags(job["fid"], tags)
-            else:
-                await app["db"].update_tags(job["fid"], tags)
+            with tracer.start_trace("task preview_and_tags", {"file.id": job["fid"]}):
+                tags = await asyncio.to_thread(
+                    _generate_preview_and_tags, job["path"], job["fid"], job["file_name"]
+                )
+                if job.get("shared"):
+                    await app["db"].update_shared_tags(job["fid"], tags)
+                else:
+                    await app["db"].update_tags(job["fid"], tags)
         except Exception as e:
             log.exception("Background task failed: %s", e)
+            # タグ付けに失敗してもプレビューはできているかもしれない
+            if not job.get("shared"):
+                await app["db"].touch_file(job["fid"])
         finally:
             queue.task_done()
             await app["broadcast_ws"]({"action": "reload"})
 
 
+async def _receive_part(part, path: Path, budget: UploadBudget) -> tuple[int, str]:
+    """multipart の 1 パートを ``path`` へ書き出し、(サイズ, sha256) を返す。
+
+    受信した分ずつ ``budget`` に数え、上限を超えたら書きかけを消して
+    ``QuotaExceeded`` を送出する。
+    """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with tracer.span("file.receive") as span, path.open("wb") as f:
+            while chunk := await part.read_chunk(UPLOAD_READ_SIZE):
+                budget.consume(len(chunk))
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+            if span is not None:
+                span.set("file.size", size)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    upload_bytes.inc(size, ("web",))
+    return size, digest.hexdigest()
+
+
+def _sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with tracer.span("file.hash"), path.open("rb") as f:
+        while chunk := f.read(UPLOAD_READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _quota_response(e: QuotaExceeded) -> web.Response:
+    # 空き容量不足は 507、利用者ごとの上限は 413
+    status = 507 if e.reason == "disk" else 413
+    return web.json_response(
+        {"success": False, "error": "quota exceeded", "reason": e.reason, "limit": e.limit},
+        status=status,
+    )
+
+
+async def _index_text(
+    app: web.Application, kind: str, fid: str, path: Path, file_name: str
+) -> None:
+    """ファイルの本文を抽出して全文検索の索引へ登録する。"""
+    from bot.auto_tag import extract_text
+
+    try:
+        text = await asyncio.to_thread(extract_text, path, file_name, SEARCH_TEXT_LIMIT)
+    except Exception as e:
+        log.debug("text extraction failed for %s: %s", file_name, e)
+        return
+    if text:
+        await app["db"].set_search_text(kind, fid, text)
+
+
+async def _queue_gdrive_mirror(
+    app: web.Application, fid: str, user_id: int, path: Path, file_name: str
+) -> None:
+    """Drive 連携済みユーザーのファイルをバックグラウンド同期キューへ登録する。"""
+    if not GDRIVE_CREDENTIALS:
+        return
+    db = app["db"]
+    if not await db.get_gdrive_token(user_id):
+        return
+    await db.enqueue_gdrive_sync(fid, user_id, str(path), file_name)
+    app["gdrive_queue"].put_nowait({"fid": fid, "user_id": user_id})
+
+
+async def _mirror_to_gdrive(app: web.Application, job: dict) -> None:
+    """1 ファイルをレジューム可能アップロードで Drive へミラーする。"""
+    fid, user_id = job["fid"], job["user_id"]
+    # ユーザーごとの枠 -> [Semaphore, 待っている・実行中のジョブ数]
+    user_sems = app["gdrive_user_sems"]
+    entry = user_sems.get(user_id)
+    if entry is None:
+        entry = user_sems[user_id] = [asyncio.Semaphore(GDRIVE_USER_CONCURRENCY), 0]
+    entry[1] += 1
+    try:
+        # 先にユーザーの枠を取る。全体の枠から取ると、大量に溜めた 1 人のジョブが
+        # 全体の枠を埋めたまま自分の枠を待ち、他のユーザーの同期が進まなくなる
+        async with entry[0], app["gdrive_sem"]:
+            with tracer.start_trace("task gdrive_mirror", {"file.id": fid}):
+                await _mirror_one(app, job, fid, user_id)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and user_sems.get(user_id) is entry:
+            del user_sems[user_id]
+
+
+async def _mirror_one(app: web.Application, job: dict, fid: str, user_id: int) -> None:
+    db = app["db"]
+    rec = await db.get_gdrive_sync(fid)
+    if not rec or rec["status"] != "pending":
+        return
+    path = Path(rec["path"])
+    token_json = await db.get_gdrive_token(user_id)
+    if not token_json or not path.exists() or not await db.get_file(fid):
+        # 連携解除済み・削除済みのファイルは同期しない
+        await db.delete_gdrive_sync(fid)
+        return
+
+    from integrations.google_drive_client import upload_file_resumable
+
+    loop = asyncio.get_running_loop()
+
+    def _on_session(uri: str) -> None:
+        # 別スレッドから呼ばれるためイベントループへ委譲して保存する
+        asyncio.run_coroutine_threadsafe(db.set_gdrive_session(fid, uri), loop)
+
+    try:
+        with tracer.span("gdrive.upload", {"file.size": path.stat().st_size}):
+            gdrive_id, new_token = await asyncio.to_thread(
+                upload_file_resumable,
+                path,
+                rec["file_name"],
+                token_json,
+                rec["session_uri"],
+                _on_session,
+            )
+    except Exception as e:
+        attempts = await db.fail_gdrive_sync(fid, str(e), GDRIVE_SYNC_MAX_ATTEMPTS)
+        log.warning(
+            "Google Drive upload failed (%s, attempt %d): %s", fid, attempts, e
+        )
+        if attempts < GDRIVE_SYNC_MAX_ATTEMPTS:
+            loop.call_later(
+                min(30 * 2**attempts, 3600),
+                app["gdrive_queue"].put_nowait,
+                job,
+            )
+        return
+    if new_token != token_json:
+        await db.set_gdrive_token(user_id, new_token)
+    await db.finish_gdrive_sync(fid, gdrive_id)
+
+
+async def _gdrive_sync_worker(app: web.Application) -> None:
+    """Drive 同期キューを監視し、ジョブごとにタスクを起動する。
+
+    同時実行数は全体とユーザー単位のセマフォで制限する。起動時には
+    DB に残った未完了ジョブを再投入し、保存済みのセッションから再開する。
+    """
+    queue: asyncio.Queue = app["gdrive_queue"]
+    running: set = app["gdrive_tasks"]
+    for rec in await app["db"].list_pending_gdrive_sync():
+        queue.put_nowait({"fid": rec["file_id"], "user_id": rec["user_id"]})
+    while True:
+        job = await queue.get()
+        task = asyncio.create_task(_mirror_to_gdrive(app, job))
+        running.add(task)
+        task.add_done_callback(running.discard)
+        queue.task_done()
+
+
+def _remove_stale_chunks() -> None:
+    now = time.time()
+    for d in CHUNK_DIR.iterdir():
+        if d.is_dir() and now - d.stat().st_mtime > 3600:
+            shutil.rmtree(d, ignore_errors=True)
+
+
+def _remove_orphan_paths(valid_paths: set[str]) -> None:
+    for p in DATA_DIR.iterdir():
+        if p in {CHUNK_DIR, PREVIEW_DIR, HLS_DIR, CACHE_DIR} or p == DB_PATH:
+            continue
+        if p.is_file() and str(p) not in valid_paths:
+            try:
+                p.unlink()
+            except Exception:
+                pass
+
+
 async def _cleanup_chunks() -> None:
     """定期的に未完了のチャンクを削除する。"""
     while True:
         try:
-            now = time.time()
-            for d in CHUNK_DIR.iterdir():
-                if d.is_dir() and now - d.stat().st_mtime > 3600:
-                    shutil.rmtree(d, ignore_errors=True)
+            # ディレクトリの走査と削除はループを止めないよう別スレッドで行う
+            await asyncio.to_thread(_remove_stale_chunks)
         except Exception as e:
             log.warning("chunk cleanup failed: %s", e)
         await asyncio.sleep(3600)
@@ -377,21 +712,25 @@ async def _cleanup_orphan_files(app: web.Application) -> None:
             else:
                 valid_paths = set()
 
-            for p in DATA_DIR.iterdir():
-                if p in {CHUNK_DIR, PREVIEW_DIR, HLS_DIR} or p == DB_PATH:
-                    continue
-                if not valid_paths:
-                    break
-                if p.is_file() and str(p) not in valid_paths:
-                    try:
-                        p.unlink()
-                    except Exception:
-                        pass
+            if valid_paths:
+                await asyncio.to_thread(_remove_orphan_paths, valid_paths)
         except Exception as e:
             log.warning("orphan cleanup failed: %s", e)
         await asyncio.sleep(3600)
 
 
+async def _compact_changes(app: web.Application) -> None:
+    """変更履歴を定期的に圧縮する"""
+    while True:
+        await asyncio.sleep(CHANGES_COMPACT_INTERVAL)
+        try:
+            removed = await app["db"].compact_changes(CHANGES_RETENTION_DAYS * 86400)
+            if removed:
+                log.info("compacted %d change log rows", removed)
+        except Exception as e:
+            log.warning("change log compaction failed: %s", e)
+
+
 async def _cleanup_setup_tokens(app: web.Application) -> None:
     """期限切れの自動設定トークンを削除"""
     while True:
@@ -451,15 +790,49 @@ async def csp_mw(request: web.Request, handler):
     return resp
 
 
-limiters = defaultdict(lambda: AsyncLimiter(1000, 60))  # 60 秒あたり 1000 リクエスト / IP
-
-
-@web.middleware
-async def rl_mw(req, handler):
-    ip = req.remote
-    limiter = limiters[ip]
-    async with limiter:
-        return await handler(req)
+# X-Forwarded-For を信用するリバースプロキシ (カンマ区切りの IP / CIDR)
+TRUSTED_PROXIES = parse_networks(os.getenv("TRUSTED_PROXIES", ""))
+# 設定するとレート制限のカウンタを SQLite で全ワーカープロセスと共有する
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB")
+# "量/秒数" 形式。bytes の区分は転送バイト数を数える
+RATE_POLICIES = [
+    parse_policy("default", os.getenv("RATE_LIMIT_DEFAULT", "1000/60")),
+    parse_policy("login", os.getenv("RATE_LIMIT_LOGIN", "20/60")),
+    parse_policy("zip", os.getenv("RATE_LIMIT_ZIP", "6/60")),
+    parse_policy(
+        "upload", os.getenv("RATE_LIMIT_UPLOAD_BYTES", f"{10 << 30}/60"), "bytes"
+    ),
+    parse_policy(
+        "download", os.getenv("RATE_LIMIT_DOWNLOAD_BYTES", f"{10 << 30}/60"), "bytes"
+    ),
+]
+# パスの前方一致で区分を決める。None は制限なし
+RATE_ROUTES = [
+    ("/health", None),
+    ("/metrics", None),
+    ("/static", None),
+    ("/previews", None),
+    ("/service-worker.js", None),
+    ("/manifest.json", None),
+    ("/login", "login"),
+    ("/totp", "login"),
+    ("/upload", "upload"),
+    ("/upload_chunked", "upload"),
+    ("/shared/upload", "upload"),
+    ("/zip", "zip"),
+    ("/download", "download"),
+    ("/shared/download", "download"),
+    ("/f", "download"),
+    ("/hls", "download"),
+]
+
+rate_limiter = RateLimiter(
+    RATE_POLICIES,
+    RATE_ROUTES,
+    store=SqliteStore(Path(RATE_LIMIT_DB)) if RATE_LIMIT_DB else None,
+    trusted_proxies=TRUSTED_PROXIES,
+)
+rl_mw = rate_limiter.middleware()
 
 
 # HTTP -> HTTPS redirect
@@ -473,6 +846,32 @@ async def https_redirect_mw(request: web.Request, handler):
     return await handler(request)
 
 
+# 事前圧縮済みの静的ファイルやバイナリの配信は素通しして sendfile を使わせる
+# (FileResponse はそもそも圧縮対象外だが、経路としても明示しておく)
+NO_COMPRESS_PREFIXES = (
+    ASSET_PREFIX,
+    "/hls/",
+    "/previews/",
+    "/download/",
+    "/shared/download/",
+    "/f/",
+    "/zip/",
+)
+
+# これより小さい本文は圧縮しても得にならない
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+
+compressor = Compressor(NO_COMPRESS_PREFIXES, min_size=COMPRESS_MIN_SIZE)
+compress_middleware = compressor.middleware()
+
+
+async def _asset_cache_headers(request: web.Request, response: web.StreamResponse):
+    # ハッシュ名のファイルは内容が変わらないので再検証も不要
+    if request.path.startswith(ASSET_PREFIX) and response.status == 200:
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE
+        response.headers["Vary"] = "Accept-Encoding"
+
+
 # ─────────────── APP Factory ───────────────
 def create_app(bot: Optional[discord.Client] = None) -> web.Application:
     """Create and configure the aiohttp application."""
@@ -493,15 +892,25 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
     session_setup(app, storage)
 
     # middlewares
+    app.middlewares.append(http_metrics.middleware())  # 他のミドルウェアの時間も含める
+    app.on_response_prepare.append(http_metrics.on_response_prepare)
+    app.middlewares.append(tracer.middleware())
     app.middlewares.append(https_redirect_mw)
     app.middlewares.append(csrf_protect_mw)
     app.middlewares.append(auth_mw)
     app.middlewares.append(rl_mw)  # DoS / ブルートフォース緩和
+    app.on_response_prepare.append(rate_limiter.on_response_prepare)
+    app.on_response_prepare.append(_asset_cache_headers)
     app.middlewares.append(csp_mw)
     app.middlewares.append(compress_middleware)
 
     # jinja2 setup
-    aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(str(TEMPLATE_DIR)))
+    aiohttp_jinja2.setup(
+        app,
+        loader=jinja2.FileSystemLoader(str(TEMPLATE_DIR)),
+        auto_reload=TEMPLATE_AUTO_RELOAD,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(str(JINJA_CACHE_DIR)),
+    )
     env = aiohttp_jinja2.get_env(app)
     if bot:
         app["bot"] = bot
@@ -640,6 +1049,15 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
     env.globals["vapid_public_key"] = VAPID_PUBLIC_KEY
     app[static_root_key] = "/static/"
 
+    # 静的ファイルをハッシュ名で書き出し、テンプレートからは asset_url() で参照する
+    assets = build_assets(STATIC_DIR, ASSET_DIR)
+    app["assets"] = assets
+    env.globals["asset_url"] = assets.url
+    env.globals["static_version"] = assets.version
+
+    # フィルタと関数を登録し終えたので全テンプレートを読み込んでおく
+    precompile_templates(env)
+
     # ─────────────── otpauth リダイレクト ───────────────
     async def otp_redirect(req: web.Request):
         import base64, urllib.parse
@@ -657,7 +1075,11 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
     app.router.add_get("/otp/{token}", otp_redirect)
 
     # ─────────────── File table API (PATCHED) ───────────────
-    @aiohttp_jinja2.template("partials/file_table.html")
+    app["partial_cache"] = RenderCache(PARTIAL_CACHE_SIZE)
+    app["change_feed"] = ChangeFeed(
+        lambda: app["db"].latest_change(), CHANGES_POLL_INTERVAL
+    )
+
     async def file_list_api(request: web.Request):
         # 認証チェック
         discord_id = request.get("user_id")
@@ -688,13 +1110,34 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         if page < 1:
             page = 1
         offset = (page - 1) * FILES_PER_PAGE
-        rows = await db.fetchall(
-            "SELECT *, expiration_sec, expires_at FROM files WHERE user_id = ? AND folder = ? "
-            "ORDER BY uploaded_at DESC LIMIT ? OFFSET ?",
+        # ?tags=a,b でタグ絞り込み。tag_mode=or ならいずれか、既定はすべて一致
+        tag_filter = [t for t in request.query.get("tags", "").split(",") if t.strip()]
+        match_all = request.query.get("tag_mode", "and").lower() != "or"
+
+        # 上の期限切れ処理も含め、フォルダに変更がなければ前回の描画結果を返す
+        token = await issue_csrf(request)
+        key = (discord_id, folder, page, tuple(tag_filter), match_all)
+        etag = make_etag(
+            await db.folder_version(user_id, folder),
+            key,
+            token,
+            int(time.time() // PARTIAL_CACHE_TTL),
+        )
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return web.Response(status=304, headers=headers)
+        cache = request.app["partial_cache"]
+        html = cache.get(key, etag)
+        if html is not None:
+            return web.Response(text=html, content_type="text/html", headers=headers)
+
+        rows = await db.list_files(
             user_id,
             folder,
             FILES_PER_PAGE + 1,
             offset,
+            tags=tag_filter,
+            match_all=match_all,
         )
         has_next = len(rows) > FILES_PER_PAGE
         if has_next:
@@ -726,17 +1169,378 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
 
             file_objs.append(f)
 
-        # CSRF トークン発行
-        token = await issue_csrf(request)
+        html = aiohttp_jinja2.render_string(
+            "partials/file_table.html",
+            request,
+            {
+                "files": file_objs,
+                "csrf_token": token,
+                "user_id": discord_id,
+                "page": page,
+                "has_next": has_next,
+                "folder_id": folder,
+                "tag_filter": tag_filter,
+                "tag_mode": "and" if match_all else "or",
+            },
+        )
+        cache.put(key, etag, html)
+        return web.Response(text=html, content_type="text/html", headers=headers)
+
+    def _listing_entry(row: Row, request: web.Request, fields, now: int) -> dict:
+        """DB Row → /api/files の 1 行。要求された項目だけを計算する。"""
+        name = row["original_name"]
+        mime, _ = mimetypes.guess_type(name)
+        entry = {
+            "id": row["id"],
+            "folder": row["folder"],
+            "name": name,
+            "size": row["size"],
+            "uploaded_at": row["uploaded_at"],
+            "mime": mime or "application/octet-stream",
+            "icon": icon_by_ext(name),
+            "tags": row["tags"],
+            "is_shared": bool(row["is_shared"]),
+            "expires_at": int(row["expires_at"] or 0),
+        }
+        token = row["token"]
+        entry["share_url"] = (
+            f"{request.scheme}://{request.host}/f/{token}" if token else ""
+        )
+        if listing.SIGNED_FIELDS.intersection(fields):
+            signed = _sign_token(row["id"], now + URL_EXPIRES_SEC)
+            entry["download_path"] = f"/download/{signed}"
+            entry["url"] = _make_download_url(entry["download_path"], external=True)
+        if "preview_url" in fields:
+            preview_file = PREVIEW_DIR / f"{row['id']}.jpg"
+            if preview_file.exists():
+                entry["preview_url"] = f"/previews/{preview_file.name}"
+            else:
+                entry["preview_url"] = entry["download_path"] + "?preview=1"
+        if "hls_url" in fields:
+            master = HLS_DIR / row["id"] / "master.m3u8"
+            entry["hls_url"] = f"/hls/{row['id']}/master.m3u8" if master.exists() else ""
+        return listing.project(entry, fields)
+
+    async def file_list_json(request: web.Request):
+        """フォルダ内のファイル一覧を JSON で返す (カーソルページング・項目選択・ETag)。
+
+        ``?folder=&cursor=&limit=&fields=id,name,size`` を受け付ける。
+        1 ページ目にはサブフォルダ一覧も含める。``q=`` を付けるとフォルダを問わず
+        ファイル名の部分一致で検索する。
+        """
+        discord_id = request.get("user_id")
+        if not discord_id:
+            return web.json_response({"error": "unauthorized"}, status=403)
+        db = request.app["db"]
+        user_id = await db.get_user_pk(discord_id)
+        if not user_id:
+            return web.json_response({"error": "invalid user"}, status=403)
+        try:
+            fields = listing.parse_fields(request.query.get("fields"))
+            limit = listing.parse_limit(request.query.get("limit"), FILES_PER_PAGE)
+            after = listing.decode_cursor(request.query.get("cursor"))
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+        folder = request.query.get("folder", "")
+        name = request.query.get("q", "").strip()
+
+        now_ts = int(time.time())
+        await db.execute(
+            "UPDATE files SET is_shared=0, token=NULL "
+            "WHERE is_shared=1 AND expires_at!=0 AND expires_at < ?",
+            now_ts,
+        )
+
+        subfolders = None
+        if after is None and not name:
+            parent_id = int(folder) if folder.isdigit() else None
+            usage = await db.folder_usage(user_id)
+            subfolders = [
+                {**f, **usage.get(str(f["id"]), EMPTY_USAGE)}
+                for f in (await db.folder_tree(user_id)).children(parent_id)
+            ]
+        # 検索はフォルダをまたぐので、ユーザー全体の変更履歴の seq を版にする
+        if name:
+            version = await db.latest_change(user_id)
+        else:
+            version = await db.folder_version(user_id, folder)
+        etag = make_etag(
+            version,
+            "json",
+            discord_id,
+            folder,
+            name,
+            request.query.get("cursor", ""),
+            limit,
+            fields,
+            subfolders,
+            # 署名付き URL を返す場合だけ、期限切れ前に新しい URL を配り直す
+            now_ts // LISTING_URL_TTL if listing.SIGNED_FIELDS.intersection(fields) else 0,
+        )
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return web.Response(status=304, headers=headers)
+
+        rows = await db.list_files_page(user_id, folder, limit + 1, after, name=name)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = listing.encode_cursor(last["uploaded_at"], last["id"])
+        payload = {
+            "folder": folder,
+            "version": version,
+            "files": [_listing_entry(r, request, fields, now_ts) for r in rows],
+            "next_cursor": next_cursor,
+        }
+        if subfolders is not None:
+            payload["folders"] = subfolders
+        return web.json_response(payload, headers=headers)
+
+    async def usage_api(request: web.Request):
+        """ユーザー全体・フォルダごと・参加中の共有フォルダごとの使用量を返す。"""
+        discord_id = request.get("user_id")
+        if not discord_id:
+            return web.json_response({"error": "unauthorized"}, status=403)
+        db = request.app["db"]
+        user_id = await db.get_user_pk(discord_id)
+        if not user_id:
+            return web.json_response({"error": "invalid user"}, status=403)
+        tree = await db.folder_tree(user_id)
+        usage = await db.folder_usage(user_id)
+        folders = [
+            {
+                "id": fid,
+                "name": tree.nodes[fid][0],
+                "parent_id": tree.nodes[fid][1],
+                **usage.get(str(fid), EMPTY_USAGE),
+            }
+            for fid in sorted(tree.nodes)
+        ]
+        override, _ = await db.storage_quota("user", user_id)
+        return web.json_response(
+            {
+                "user": await db.user_usage(user_id),
+                # 0 は無制限
+                "quota": USER_QUOTA_BYTES if override is None else override,
+                "root": usage.get("", EMPTY_USAGE),
+                "folders": folders,
+                "shared": [dict(r) for r in await db.member_shared_usage(discord_id)],
+            },
+            headers={"Cache-Control": "private, no-cache"},
+        )
+
+    def _shared_entry(row: Row, request: web.Request) -> dict:
+        """共有フォルダ内ファイルの Row → /api/changes の 1 行。"""
+        name = row["file_name"]
+        mime, _ = mimetypes.guess_type(name)
+        token = row["token"]
         return {
-            "files": file_objs,
-            "csrf_token": token,
-            "user_id": discord_id,
-            "page": page,
-            "has_next": has_next,
-            "folder_id": folder,
+            "id": row["id"],
+            "folder_id": row["folder_id"],
+            "name": name,
+            "size": row["size"],
+            "uploaded_at": row["uploaded_at"],
+            "mime": mime or "application/octet-stream",
+            "icon": icon_by_ext(name),
+            "tags": row["tags"],
+            "is_shared": bool(row["is_shared"]),
+            "share_url": (
+                f"{request.scheme}://{request.host}/shared/download/{token}"
+                if token
+                else ""
+            ),
+            "expires_at": int(row["expires_at"] or 0),
         }
 
+    async def _changes_payload(
+        request: web.Request, user_id: int, since: Optional[int]
+    ) -> dict:
+        """``since`` より後の変更 (``None`` なら全件のスナップショット) を組み立てる。"""
+        db = request.app["db"]
+        now_ts = int(time.time())
+        # seq は全ユーザー共通の連番なので、スナップショットの位置も全体の最新にする
+        latest = await db.latest_change()
+        reset = (
+            since is None
+            or since > latest
+            or since < await db.changes_floor(user_id)
+        )
+        kinds = ("file", "folder", "shared_file", "shared_folder")
+        upserts: dict = {k: [] for k in kinds}
+        deletes: dict = {k: [] for k in kinds}
+        if reset:
+            # 先に seq を読んでおけば、この間の変更は次回の差分で重ねて適用される
+            seq, more = latest, False
+            upserts = dict.fromkeys(kinds)
+        else:
+            changed, seq, more = await db.changes_since(user_id, since, CHANGES_PAGE_SIZE)
+            for (kind, item_id), op in changed.items():
+                (upserts if op == "upsert" else deletes).setdefault(kind, []).append(item_id)
+
+        async def fetch(getter, ids, cast=str):
+            # None は全件、空リストは取得不要
+            if ids is None:
+                return await getter(user_id)
+            return await getter(user_id, [cast(i) for i in ids]) if ids else []
+
+        files = await fetch(db.get_user_files, upserts["file"])
+        folders = await fetch(db.get_user_folders, upserts["folder"], int)
+        shared_files = await fetch(db.get_member_shared_files, upserts["shared_file"])
+        shared_folders = await fetch(
+            db.get_member_shared_folders, upserts["shared_folder"], int
+        )
+        return {
+            "user": user_id,
+            "since": since,
+            "seq": seq,
+            "more": more,
+            "reset": reset,
+            "files": [
+                _listing_entry(r, request, listing.CATALOG_FIELDS, now_ts) for r in files
+            ],
+            "deleted_files": deletes["file"],
+            "folders": [
+                {"id": r["id"], "name": r["name"], "parent_id": r["parent_id"]}
+                for r in folders
+            ],
+            "deleted_folders": [int(i) for i in deletes["folder"]],
+            # 共有フォルダの削除 (脱退) を受け取ったら、その中のファイルも捨てること
+            "shared_folders": [{"id": r["id"], "name": r["name"]} for r in shared_folders],
+            "deleted_shared_folders": [int(i) for i in deletes["shared_folder"]],
+            "shared_files": [_shared_entry(r, request) for r in shared_files],
+            "deleted_shared_files": deletes["shared_file"],
+        }
+
+    def _has_changes(payload: dict) -> bool:
+        return payload["reset"] or payload["seq"] != payload["since"]
+
+    def _parse_since(value: Optional[str]) -> Optional[int]:
+        # 未指定はスナップショットの要求。0 は「履歴の最初から」
+        if value is None or value == "":
+            return None
+        return max(0, int(value))
+
+    async def _changes_user(request: web.Request):
+        discord_id = request.get("user_id")
+        if not discord_id:
+            return None, web.json_response({"error": "unauthorized"}, status=403)
+        db = request.app["db"]
+        user_id = await db.get_user_pk(discord_id)
+        if not user_id:
+            return None, web.json_response({"error": "invalid user"}, status=403)
+        # 期限切れの共有を解除しておけば、その変更も履歴に載る
+        now_ts = int(time.time())
+        for table in ("files", "shared_files"):
+            await db.execute(
+                f"UPDATE {table} SET is_shared=0, token=NULL "
+                "WHERE is_shared=1 AND expires_at!=0 AND expires_at < ?",
+                now_ts,
+            )
+        return user_id, None
+
+    async def changes_api(request: web.Request):
+        """``?since=<seq>`` より後のファイル・フォルダ・共有フォルダの変更を返す。
+
+        ``since`` が無い、履歴より新しい、または圧縮で追えなくなった場合は
+        全件のスナップショットを返し ``reset`` を真にする。``more`` が真なら ``seq`` を
+        次の ``since`` にして続きを取る。``wait=<秒>`` を付けると、変更が無い間は
+        最長 ``CHANGES_MAX_WAIT`` 秒まで応答を保留する (ロングポーリング)。
+        """
+        user_id, error = await _changes_user(request)
+        if error is not None:
+            return error
+        try:
+            since = _parse_since(request.query.get("since"))
+        except ValueError:
+            return web.json_response({"error": "invalid since"}, status=400)
+        try:
+            wait = parse_wait(request.query.get("wait"), CHANGES_MAX_WAIT)
+        except ValueError:
+            return web.json_response({"error": "invalid wait"}, status=400)
+
+        feed = request.app["change_feed"]
+        deadline = time.monotonic() + wait
+        payload = await _changes_payload(request, user_id, since)
+        while not _has_changes(payload):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not await feed.wait(remaining):
+                break
+            payload = await _changes_payload(request, user_id, since)
+        return web.json_response(payload, headers={"Cache-Control": "no-store"})
+
+    async def changes_stream(request: web.Request):
+        """変更を Server-Sent Events で送り続ける。
+
+        各イベントの ``id`` は seq で、再接続時はブラウザが送る ``Last-Event-ID``
+        (または ``?since=``) の続きから再開する。
+        """
+        user_id, error = await _changes_user(request)
+        if error is not None:
+            return error
+        try:
+            since = _parse_since(
+                request.headers.get("Last-Event-ID") or request.query.get("since")
+            )
+        except ValueError:
+            return web.json_response({"error": "invalid since"}, status=400)
+
+        resp = web.StreamResponse(
+            headers={
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-store",
+                "X-Accel-Buffering": "no",
+            }
+        )
+        await resp.prepare(request)
+        feed = request.app["change_feed"]
+        try:
+            await resp.write(b"retry: 3000\n\n")
+            while True:
+                payload = await _changes_payload(request, user_id, since)
+                if _has_changes(payload):
+                    await resp.write(format_sse(payload, payload["seq"]))
+                    since = payload["seq"]
+                    if payload["more"]:
+                        continue
+                if not await feed.wait(CHANGES_MAX_WAIT):
+                    # プロキシに切断されないよう定期的にコメント行を送る
+                    await resp.write(b": keepalive\n\n")
+        except ConnectionResetError:
+            pass
+        return resp
+
+    async def tag_facets_api(request: web.Request):
+        """ユーザーのタグとファイル数 (ファセット) を返す。"""
+        discord_id = request.get("user_id")
+        if not discord_id:
+            return web.json_response({"error": "unauthorized"}, status=403)
+        db = request.app["db"]
+        user_id = await db.get_user_pk(discord_id)
+        if not user_id:
+            return web.json_response({"error": "invalid user"}, status=403)
+        folder = request.query.get("folder")
+        facets = await db.tag_facets(user_id, folder)
+        return web.json_response({"tags": facets})
+
+    async def tag_suggest_api(request: web.Request):
+        """タグの前方一致候補を返す (オートコンプリート用)。"""
+        discord_id = request.get("user_id")
+        if not discord_id:
+            return web.json_response({"error": "unauthorized"}, status=403)
+        db = request.app["db"]
+        user_id = await db.get_user_pk(discord_id)
+        if not user_id:
+            return web.json_response({"error": "invalid user"}, status=403)
+        prefix = request.query.get("q", "")
+        try:
+            limit = max(1, min(int(request.query.get("limit", 10)), 50))
+        except ValueError:
+            limit = 10
+        return web.json_response({"tags": await db.suggest_tags(user_id, prefix, limit)})
+
     @aiohttp_jinja2.template("partials/search_results.html")
     async def search_files_api(request: web.Request):
         discord_id = request.get("user_id")
@@ -747,9 +1551,23 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         if not user_id:
             raise web.HTTPFound("/login")
         term = request.query.get("q", "").strip()
-        folder = request.query.get("folder", "")
-        rows = await db.search_files(user_id, term, folder) if term else []
-        file_objs = [await _file_to_dict(r, request) for r in rows]
+        # 自分の全フォルダと参加中の共有フォルダを横断して検索する
+        rows = (
+            await db.search(user_id, discord_id, term, limit=SEARCH_RESULT_LIMIT)
+            if term
+            else []
+        )
+        now_ts = int(time.time())
+        file_objs = []
+        for r in rows:
+            signed = _sign_token(r["id"], now_ts + URL_EXPIRES_SEC)
+            file_objs.append(
+                {
+                    **r,
+                    "snippet": _highlight(r["snippet"]),
+                    "download_url": _make_download_url(f"/download/{signed}"),
+                }
+            )
         token = await issue_csrf(request)
         return {
             "files": file_objs,
@@ -766,17 +1584,7 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         if not user_id:
             raise web.HTTPFound("/login")
 
-        rows = await db.fetchall(
-            """
-            SELECT sf.id, sf.name, COUNT(f.id) as file_count
-            FROM shared_folders sf
-            JOIN shared_folder_members m ON sf.id = m.folder_id
-            LEFT JOIN shared_files f ON f.folder_id = sf.id
-            WHERE m.discord_user_id = ?
-            GROUP BY sf.id
-        """,
-            user_id,
-        )
+        rows = await db.member_shared_usage(user_id)
 
         return _render(request, "shared/index.html", {"folders": rows})
 
@@ -906,19 +1714,7 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
             file_objs.append(f)
 
         # ── 4. 他の共有フォルダ一覧 (ファイル数付き) ──
-        shared_folders = await db.fetchall(
-            """
-            SELECT sf.id,
-                   sf.name,
-                   COUNT(f.id) AS file_count
-            FROM shared_folders sf
-            JOIN shared_folder_members m ON sf.id = m.folder_id
-            LEFT JOIN shared_files f ON f.folder_id = sf.id
-            WHERE m.discord_user_id = ?
-            GROUP BY sf.id
-        """,
-            discord_id,
-        )
+        shared_folders = await db.member_shared_usage(discord_id)
         session = await get_session(request)
         current_user_id = session.get("user_id")
         base_url = f"{request.scheme}://{request.host}"
@@ -946,7 +1742,6 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
                 "shared_folders": shared_folders,
                 "all_folders": all_folders,
                 "csrf_token": await issue_csrf(request),
-                "static_version": int(time.time()),
             },
         )
 
@@ -956,15 +1751,38 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
     app["qr_tokens"] = {}
     app["setup_tokens"] = {}
     app["task_queue"] = asyncio.Queue()
+    app["gdrive_queue"] = asyncio.Queue()
+    app["gdrive_sem"] = asyncio.Semaphore(GDRIVE_SYNC_CONCURRENCY)
+    app["gdrive_user_sems"] = {}
+    app["gdrive_tasks"] = set()
     app["broadcast_ws"] = None  # placeholder, assigned later
+    db.query_hooks.append(
+        lambda sql, _params, elapsed: db_query_seconds.observe(
+            elapsed, (statement_label(sql),)
+        )
+    )
+    db.query_hooks.append(
+        lambda sql, _params, elapsed: tracer.record(
+            "db", elapsed, {"db.statement": statement_label(sql)}
+        )
+    )
 
     async def on_startup(app: web.Application):
         await init_db(DB_PATH)
+        from bot.auto_tag import configure_cache
+
+        configure_cache(CACHE_DIR / "tag_cache.db")
         await db.open()
         app["worker"] = asyncio.create_task(_task_worker(app))
         app["chunk_cleanup"] = asyncio.create_task(_cleanup_chunks())
         app["orphan_cleanup"] = asyncio.create_task(_cleanup_orphan_files(app))
         app["setup_cleanup"] = asyncio.create_task(_cleanup_setup_tokens(app))
+        app["gdrive_worker"] = asyncio.create_task(_gdrive_sync_worker(app))
+        app["changes_compactor"] = asyncio.create_task(_compact_changes(app))
+        app["reaper_task"] = asyncio.create_task(app["blob_reaper"].run())
+        app["sampler_task"] = asyncio.create_task(app["system_sampler"].run())
+        app["trace_task"] = asyncio.create_task(tracer.run())
+        app["loop_monitor_task"] = asyncio.create_task(loop_monitor.run())
 
     async def on_cleanup(app: web.Application):
         worker = app.get("worker")
@@ -995,6 +1813,57 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
                 await s_cleaner
             except asyncio.CancelledError:
                 pass
+        g_worker = app.get("gdrive_worker")
+        if g_worker:
+            g_worker.cancel()
+            try:
+                await g_worker
+            except asyncio.CancelledError:
+                pass
+        compactor = app.get("changes_compactor")
+        if compactor:
+            compactor.cancel()
+            try:
+                await compactor
+            except asyncio.CancelledError:
+                pass
+        reaper = app.get("reaper_task")
+        if reaper:
+            reaper.cancel()
+            try:
+                await reaper
+            except asyncio.CancelledError:
+                pass
+        app["blob_reaper"].shutdown()
+        sampler = app.get("sampler_task")
+        if sampler:
+            sampler.cancel()
+            try:
+                await sampler
+            except asyncio.CancelledError:
+                pass
+        trace_task = app.get("trace_task")
+        if trace_task:
+            trace_task.cancel()
+            try:
+                await trace_task
+            except asyncio.CancelledError:
+                pass
+        monitor_task = app.get("loop_monitor_task")
+        if monitor_task:
+            monitor_task.cancel()
+            try:
+                await monitor_task
+            except asyncio.CancelledError:
+                pass
+        await app["change_feed"].close()
+        # 実行中の同期は中断し、次回起動時に保存済みセッションから再開する
+        for task in list(app["gdrive_tasks"]):
+            task.cancel()
+        from bot.auto_tag import shutdown_pool
+
+        shutdown_pool()
+        password_hasher.shutdown()
 
     app.on_startup.append(on_startup)
     app.on_cleanup.append(on_cleanup)
@@ -1002,16 +1871,22 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
     # static files
     if STATIC_DIR.exists():
         app.router.add_static("/static/", str(STATIC_DIR), name="static")
+    app.router.add_static(ASSET_PREFIX, str(ASSET_DIR), name="assets")
     if PREVIEW_DIR.exists():
         app.router.add_static("/previews/", str(PREVIEW_DIR), name="previews")
     if HLS_DIR.exists():
         app.router.add_static("/hls/", str(HLS_DIR), name="hls")
 
+    def _built(name: str) -> Path:
+        # 参照をハッシュ名へ書き換えた版があればそちらを返す
+        path = ASSET_DIR / name
+        return path if path.exists() else STATIC_DIR / name
+
     async def service_worker(request):
-        return web.FileResponse(STATIC_DIR / "service-worker.js")
+        return web.FileResponse(_built("service-worker.js"))
 
     async def web_manifest(request):
-        return web.FileResponse(STATIC_DIR / "manifest.json")
+        return web.FileResponse(_built("manifest.json"))
 
     async def offline_page(request):
         return _render(request, "offline.html", {"request": request})
@@ -1042,11 +1917,125 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
                 await ws.send_json(message)
 
     app["broadcast_ws"] = broadcast_ws
+    app["blob_reaper"] = BlobReaper(
+        db, broadcast_ws, REAPER_BATCH_SIZE, REAPER_WORKERS, REAPER_INTERVAL
+    )
+    app["system_sampler"] = system_metrics.SystemSampler(
+        SYSTEM_SAMPLE_INTERVAL, SYSTEM_SAMPLE_HISTORY
+    )
 
     # handlers
     async def health(req):
         return web.json_response({"status": "ok"})
 
+    # アプリごとの値 (描画時に読む)。ここでは len() などだけでイベントループを止めない
+    app_metrics = Registry()
+    app_metrics.gauge(
+        "wds_task_queue_depth", "Preview/tagging tasks waiting.",
+        func=lambda: app["task_queue"].qsize(),
+    )
+    app_metrics.gauge(
+        "wds_gdrive_queue_depth", "Google Drive sync jobs waiting.",
+        func=lambda: app["gdrive_queue"].qsize(),
+    )
+    app_metrics.gauge(
+        "wds_gdrive_jobs_running", "Google Drive sync jobs in progress.",
+        func=lambda: len(app["gdrive_tasks"]),
+    )
+    app_metrics.gauge(
+        "wds_websocket_clients", "Connected WebSocket clients.",
+        func=lambda: len(app["websockets"]),
+    )
+    pending_unlinks = app_metrics.gauge(
+        "wds_pending_unlinks", "Deleted blobs waiting for the reaper."
+    )
+    system_gauges = {
+        key: app_metrics.gauge(f"wds_system_{key}", f"Host {key.replace('_', ' ')}.")
+        for key in (
+            "loadavg_1min", "loadavg_5min", "loadavg_15min",
+            "memory_usage_percent", "disk_usage_percent",
+            "process_memory_rss_bytes", "open_fd_count",
+        )
+    }
+    system_counters = {
+        key: app_metrics.external_counter(name, help)
+        for key, name, help in (
+            ("process_cpu_seconds_total", "wds_process_cpu_seconds_total", "CPU time used by this process."),
+            ("bytes_recv_total", "wds_network_receive_bytes_total", "Bytes received on non-loopback interfaces."),
+            ("bytes_sent_total", "wds_network_transmit_bytes_total", "Bytes sent on non-loopback interfaces."),
+        )
+    }
+
+    def _read_system() -> dict:
+        # /proc と statvfs を読むだけ (sleep して差分を取る関数は使わない)
+        values = system_metrics.get_system_metrics()
+        values.update(system_metrics.get_server_process_counters())
+        values.update(system_metrics.get_network_counters())
+        return values
+
+    async def metrics_endpoint(request: web.Request):
+        """Prometheus のテキスト形式で計測値を返す (``METRICS_TOKEN`` の Bearer 認証)。"""
+        if not METRICS_TOKEN:
+            raise web.HTTPNotFound()
+        auth = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            return web.Response(status=401, headers={"WWW-Authenticate": "Bearer"})
+        for key, value in (await asyncio.to_thread(_read_system)).items():
+            metric = system_gauges.get(key) or system_counters.get(key)
+            if metric is not None:
+                metric.set(value)
+        pending_unlinks.set(await db.count_pending_unlinks())
+        return web.Response(
+            body=(metrics_registry.render() + app_metrics.render()).encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def admin_system(request: web.Request):
+        """管理者向け: 最新のシステム計測値・1 分/5 分の平均レートと推移 (``seconds`` 秒分)。"""
+        if OWNER_ID is None or request.get("user_id") != OWNER_ID:
+            return web.json_response({"error": "unauthorized"}, status=403)
+        sampler = request.app["system_sampler"]
+        try:
+            seconds = float(request.query["seconds"]) if "seconds" in request.query else None
+        except ValueError:
+            return web.json_response({"error": "invalid seconds"}, status=400)
+        payload = await sampler.summary()
+        payload["interval"] = sampler.interval
+        payload["history"] = await sampler.history(seconds)
+        return web.json_response(payload)
+
+    async def admin_queries(request: web.Request):
+        """管理者向け: SQL 文ごとの件数・パーセンタイルと直近の遅い文 (実行計画付き)。"""
+        if OWNER_ID is None or request.get("user_id") != OWNER_ID:
+            return web.json_response({"error": "unauthorized"}, status=403)
+        try:
+            limit = max(1, min(int(request.query.get("limit", 50)), 500))
+        except ValueError:
+            return web.json_response({"error": "invalid limit"}, status=400)
+        return web.json_response(request.app["db"].query_log.snapshot(limit))
+
+    async def admin_traces(request: web.Request):
+        """管理者向け: サンプリングした直近のリクエストのうち遅いもの (スパン付き)。"""
+        if OWNER_ID is None or request.get("user_id") != OWNER_ID:
+            return web.json_response({"error": "unauthorized"}, status=403)
+        try:
+            limit = max(1, min(int(request.query.get("limit", 20)), 200))
+        except ValueError:
+            return web.json_response({"error": "invalid limit"}, status=400)
+        return web.json_response(
+            {"sample_rate": tracer.sample_rate, "traces": tracer.slowest(limit)}
+        )
+
+    async def admin_loop(request: web.Request):
+        """管理者向け: イベントループの遅延と、ループを止めた呼び出し元 (スタック付き)。"""
+        if OWNER_ID is None or request.get("user_id") != OWNER_ID:
+            return web.json_response({"error": "unauthorized"}, status=403)
+        try:
+            limit = max(1, min(int(request.query.get("limit", 20)), 200))
+        except ValueError:
+            return web.json_response({"error": "invalid limit"}, status=400)
+        return web.json_response(loop_monitor.snapshot(limit))
+
     async def csrf_token(req: web.Request):
         token = await issue_csrf(req)
         return web.json_response({"csrf_token": token})
@@ -1083,7 +2072,35 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         password = data.get("password", "")
         db = app["db"]
 
-        if not await db.verify_user(username, password):
+        try:
+            ok = await db.verify_user(username, password)
+        except LoginThrottled as e:
+            resp = _render(
+                req,
+                "login.html",
+                {
+                    "error": f"Too many attempts. Retry in {math.ceil(e.retry_after)}s",
+                    "csrf_token": await issue_csrf(req),
+                    "request": req,
+                },
+            )
+            resp.set_status(429)
+            resp.headers["Retry-After"] = str(math.ceil(e.retry_after))
+            return resp
+        except PasswordHashBusy:
+            resp = _render(
+                req,
+                "login.html",
+                {
+                    "error": "Server busy. Please retry",
+                    "csrf_token": await issue_csrf(req),
+                    "request": req,
+                },
+            )
+            resp.set_status(503)
+            resp.headers["Retry-After"] = "1"
+            return resp
+        if not ok:
             return _render(
                 req,
                 "login.html",
@@ -1175,7 +2192,9 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
             "redirect_uri": redirect_uri,
         }
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
-        async with aiohttp.ClientSession(timeout=HTTP_TIMEOUT) as session:
+        async with aiohttp.ClientSession(
+            timeout=HTTP_TIMEOUT, trace_configs=[http_trace_config]
+        ) as session:
             async with session.post("https://discord.com/api/oauth2/token", data=data, headers=headers) as resp:
                 if resp.status != 200:
                     log.error("OAuth token error: %s", await resp.text())
@@ -1388,7 +2407,7 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         return _render(
             req,
             "gdrive_import.html",
-            {"csrf_token": token, "static_version": int(time.time()), "request": req},
+            {"csrf_token": token, "request": req},
         )
 
 
@@ -1434,15 +2453,10 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         if has_next:
             rows = rows[:-1]
         parent_id = int(folder) if folder else None
-        subfolders = await app["db"].list_user_folders(user_id, parent_id)
-        breadcrumbs = []
-        cur = parent_id
-        while cur:
-            rec = await app["db"].get_user_folder(cur)
-            if not rec:
-                break
-            breadcrumbs.insert(0, {"id": cur, "name": rec["name"]})
-            cur = rec["parent_id"]
+        # パンくずと子フォルダはキャッシュ済みのフォルダ階層から引く
+        tree = await app["db"].folder_tree(user_id)
+        subfolders = tree.children(parent_id)
+        breadcrumbs = tree.ancestors(parent_id)
         now_ts = int(datetime.now(timezone.utc).timestamp())
         files = []
 
@@ -1491,7 +2505,6 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
                     if GDRIVE_CREDENTIALS
                     else False
                 ),
-                "static_version": int(time.time()),
                 "request": req,
             },
         )
@@ -1538,7 +2551,7 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         if has_next:
             rows = rows[:-1]
         parent_id = int(folder) if folder else None
-        subfolders = await app["db"].list_user_folders(user_id, parent_id)
+        subfolders = (await app["db"].folder_tree(user_id)).children(parent_id)
         now_ts = int(datetime.now(timezone.utc).timestamp())
         files = []
         for r in rows:
@@ -1584,7 +2597,6 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
                     if GDRIVE_CREDENTIALS
                     else False
                 ),
-                "static_version": int(time.time()),
                 "request": req,
             },
         )
@@ -1597,118 +2609,80 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         if not user_id:
             raise web.HTTPForbidden()
 
-        data = await req.post()
-        # 複数の "file" フィールドをすべて取得
-        filefields = data.getall("file")
-        if not filefields:
+        try:
+            budget = await open_budget(
+                app["db"], DATA_DIR, user_id=user_id, expected=req.content_length or 0
+            )
+        except QuotaExceeded as e:
+            return _quota_response(e)
+        with budget:
+            return await _store_uploads(req, user_id, budget)
+
+    async def _store_uploads(req: web.Request, user_id: int, budget: UploadBudget):
+        # 本文を一時ファイルに溜めずに受信しながら保存し、上限を超えたら打ち切る
+        reader = await req.multipart()
+        data: Dict[str, str] = {}
+        saved: List[Dict[str, object]] = []
+        try:
+            while (part := await reader.next()) is not None:
+                if part.name != "file" or part.filename is None:
+                    data[part.name] = await part.text()
+                    continue
+                if not part.filename:
+                    continue  # ファイル未選択の空パート
+                fid = str(uuid.uuid4())
+                path = DATA_DIR / fid
+                size, sha256sum = await _receive_part(part, path, budget)
+                saved.append(
+                    {
+                        "fid": fid,
+                        "path": path,
+                        "name": part.filename,
+                        "size": size,
+                        "sha256": sha256sum,
+                    }
+                )
+        except QuotaExceeded as e:
+            for item in saved:
+                item["path"].unlink(missing_ok=True)
+            return _quota_response(e)
+        if not saved:
             return web.json_response({"success": False, "error": "no file"}, status=400)
 
-        # 受け取った各ファイルごとに保存＆DB 登録
-        for filefield in filefields:
-            fid = str(uuid.uuid4())
-            path = DATA_DIR / fid
-            size = 0
-            with path.open("wb") as f:
-                while True:
-                    chunk = filefield.file.read(8192)
-                    if not chunk:
-                        break
-                    size += len(chunk)
-                    f.write(chunk)
-            sha256sum = hashlib.sha256(path.read_bytes()).hexdigest()
-            # プレビュー生成
-            mime, _ = mimetypes.guess_type(filefield.filename)
-            preview_path = PREVIEW_DIR / f"{fid}.jpg"
-            try:
-                if mime and mime.startswith("image"):
-                    img = Image.open(path)
-                    img.thumbnail((320, 320))
-                    img.convert("RGB").save(preview_path, "JPEG")
-                elif mime and mime.startswith("video"):
-                    subprocess.run(
-                        [
-                            "ffmpeg",
-                            "-y",
-                            "-i",
-                            str(path),
-                            "-ss",
-                            "00:00:01",
-                            "-vframes",
-                            "1",
-                            str(preview_path),
-                        ],
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                    )
-                elif mime == "application/pdf":
-                    pages = convert_from_path(str(path), first_page=1, last_page=1)
-                    if pages:
-                        img = pages[0]
-                        img.thumbnail((320, 320))
-                        img.save(preview_path, "JPEG")
-                elif mime and mime.startswith("application/vnd"):
-                    tmp_pdf = path.with_suffix(".pdf")
-                    subprocess.run(
-                        [
-                            "libreoffice",
-                            "--headless",
-                            "--convert-to",
-                            "pdf",
-                            str(path),
-                            "--outdir",
-                            str(path.parent),
-                        ],
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                    )
-                    if tmp_pdf.exists():
-                        pages = convert_from_path(
-                            str(tmp_pdf), first_page=1, last_page=1
-                        )
-                        if pages:
-                            img = pages[0]
-                            img.thumbnail((320, 320))
-                            img.save(preview_path, "JPEG")
-                        tmp_pdf.unlink(missing_ok=True)
-                else:
-                    preview_path = None
-            except Exception as e:
-                log.warning("preview generation failed: %s", e)
-                if preview_path and preview_path.exists():
-                    preview_path.unlink(missing_ok=True)
-            # 自動タグ生成
-            from bot.auto_tag import generate_tags
-
-            tags = await asyncio.to_thread(generate_tags, path, filefield.filename)
-            gdrive_id = None
-            if GDRIVE_CREDENTIALS:
-                try:
-                    from integrations.google_drive_client import upload_file as gd_up
-
-                    token_json = await app["db"].get_gdrive_token(user_id)
-                    if token_json:
-                        gdrive_id, new_token = await asyncio.to_thread(
-                            gd_up, path, filefield.filename, token_json
-                        )
-                        if new_token != token_json:
-                            await app["db"].set_gdrive_token(user_id, new_token)
-                except Exception as e:
-                    log.warning("Google Drive upload failed: %s", e)
-            # DB 登録（タグを即時保存）
-            folder = data.get("folder") or data.get("folder_id", "")
+        # 受け取った各ファイルごとにプレビュー生成
+        for item in saved:
+            fid = item["fid"]
+            path = item["path"]
+            mime, _ = mimetypes.guess_type(item["name"])
+            item["mime"] = mime
+            await asyncio.to_thread(_generate_preview, path, fid, mime)
+
+        # 自動タグ生成（小さなテキスト文書はまとめて 1 回の API 呼び出しにする）
+        from bot.auto_tag import generate_tags_batch
+
+        tags_list = await asyncio.to_thread(
+            generate_tags_batch,
+            [(item["path"], item["name"]) for item in saved],
+            [item["sha256"] for item in saved],
+        )
+        # DB 登録（タグを即時保存）
+        folder = data.get("folder") or data.get("folder_id", "")
+        for item, tags in zip(saved, tags_list):
             await app["db"].add_file(
-                fid,
+                item["fid"],
                 user_id,
                 folder,
-                filefield.filename,
-                str(path),
-                size,
-                sha256sum,
+                item["name"],
+                str(item["path"]),
+                item["size"],
+                item["sha256"],
                 tags,
-                gdrive_id,
             )
-            if mime and mime.startswith("video"):
-                asyncio.create_task(_generate_hls(path, fid))
+            await _index_text(app, "file", item["fid"], item["path"], item["name"])
+            # Drive へのコピーはバックグラウンドで行い、応答を待たせない
+            await _queue_gdrive_mirror(app, item["fid"], user_id, item["path"], item["name"])
+            if item["mime"] and item["mime"].startswith("video"):
+                asyncio.create_task(_generate_hls(item["path"], item["fid"], app["db"]))
         # すべてのファイルを正常受信できた
         await broadcast_ws({"action": "reload"})
         return web.json_response({"success": True})
@@ -1739,99 +2713,66 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
                 {"success": False, "error": "forbidden"}, status=403
             )
         folder = data.get("folder", "")
+        token_json = await app["db"].get_gdrive_token(user_id)
+        if not token_json:
+            return web.json_response({"success": False, "error": "no token"}, status=400)
+        fid = str(uuid.uuid4())
+        path = DATA_DIR / fid
         try:
-            from integrations.google_drive_client import download_file, get_file_name
+            from integrations.google_drive_client import download_to_path, get_file_info
 
-            token_json = await app["db"].get_gdrive_token(user_id)
-            if not token_json:
-                return web.json_response(
-                    {"success": False, "error": "no token"}, status=400
-                )
-            file_bytes, new_token = await asyncio.to_thread(
-                download_file,
-                file_id,
-                token_json,
-                True,
-            )
-            filename, new_token = await asyncio.to_thread(
-                get_file_name, file_id, new_token
+            info, new_token = await asyncio.to_thread(get_file_info, file_id, token_json)
+            # 大きさが分かれば受信前に、分からなくても受信しながら上限を確かめる
+            budget = await open_budget(
+                app["db"], DATA_DIR, user_id=user_id, expected=info["size"]
             )
-            if new_token != token_json:
-                await app["db"].set_gdrive_token(user_id, new_token)
-            filename = data.get("filename") or filename
+        except QuotaExceeded as e:
+            return _quota_response(e)
         except Exception as e:
             log.warning("Google Drive fetch failed: %s", e)
             return web.json_response(
                 {"success": False, "error": "fetch failed"}, status=500
             )
+        with budget:
+            try:
+                with tracer.span("gdrive.download"):
+                    size, new_token = await asyncio.to_thread(
+                        download_to_path, file_id, new_token, path, budget.consume, True
+                    )
+            except QuotaExceeded as e:
+                path.unlink(missing_ok=True)
+                return _quota_response(e)
+            except Exception as e:
+                path.unlink(missing_ok=True)
+                log.warning("Google Drive fetch failed: %s", e)
+                return web.json_response(
+                    {"success": False, "error": "fetch failed"}, status=500
+                )
+            upload_bytes.inc(size, ("gdrive",))
+            if new_token != token_json:
+                await app["db"].set_gdrive_token(user_id, new_token)
+            filename = data.get("filename") or info["name"]
+            return await _store_gdrive_import(
+                user_id, folder, fid, path, filename, size, file_id
+            )
 
-        fid = str(uuid.uuid4())
-        path = DATA_DIR / fid
-        path.write_bytes(file_bytes)
-        size = path.stat().st_size
-        sha256sum = hashlib.sha256(path.read_bytes()).hexdigest()
+    async def _store_gdrive_import(
+        user_id: int,
+        folder: str,
+        fid: str,
+        path: Path,
+        filename: str,
+        size: int,
+        file_id: str,
+    ):
+        sha256sum = await asyncio.to_thread(_sha256_file, path)
 
         mime, _ = mimetypes.guess_type(filename)
-        preview_path = PREVIEW_DIR / f"{fid}.jpg"
-        try:
-            if mime and mime.startswith("image"):
-                img = Image.open(path)
-                img.thumbnail((320, 320))
-                img.convert("RGB").save(preview_path, "JPEG")
-            elif mime and mime.startswith("video"):
-                subprocess.run(
-                    [
-                        "ffmpeg",
-                        "-y",
-                        "-i",
-                        str(path),
-                        "-ss",
-                        "00:00:01",
-                        "-vframes",
-                        "1",
-                        str(preview_path),
-                    ],
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                )
-            elif mime == "application/pdf":
-                pages = convert_from_path(str(path), first_page=1, last_page=1)
-                if pages:
-                    img = pages[0]
-                    img.thumbnail((320, 320))
-                    img.save(preview_path, "JPEG")
-            elif mime and mime.startswith("application/vnd"):
-                tmp_pdf = path.with_suffix(".pdf")
-                subprocess.run(
-                    [
-                        "libreoffice",
-                        "--headless",
-                        "--convert-to",
-                        "pdf",
-                        str(path),
-                        "--outdir",
-                        str(path.parent),
-                    ],
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                )
-                if tmp_pdf.exists():
-                    pages = convert_from_path(str(tmp_pdf), first_page=1, last_page=1)
-                    if pages:
-                        img = pages[0]
-                        img.thumbnail((320, 320))
-                        img.save(preview_path, "JPEG")
-                    tmp_pdf.unlink(missing_ok=True)
-            else:
-                preview_path = None
-        except Exception as e:
-            log.warning("preview generation failed: %s", e)
-            if preview_path and preview_path.exists():
-                preview_path.unlink(missing_ok=True)
+        await asyncio.to_thread(_generate_preview, path, fid, mime)
 
         from bot.auto_tag import generate_tags
 
-        tags = await asyncio.to_thread(generate_tags, path, filename)
+        tags = await asyncio.to_thread(generate_tags, path, filename, sha256sum)
         await app["db"].add_file(
             fid,
             user_id,
@@ -1843,8 +2784,9 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
             tags,
             file_id,
         )
+        await _index_text(app, "file", fid, path, filename)
         if mime and mime.startswith("video"):
-            asyncio.create_task(_generate_hls(path, fid))
+            asyncio.create_task(_generate_hls(path, fid, app["db"]))
         await broadcast_ws({"action": "reload"})
         return web.json_response({"success": True, "file_id": fid})
 
@@ -2026,69 +2968,81 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         is_last = req.headers.get("X-Last-Chunk") == "1"
         if not upload_id:
             return web.HTTPBadRequest(text="Missing X-Upload-Id")
+        discord_id = req.get("user_id")
+        if not discord_id:
+            raise web.HTTPForbidden()
+        user_id = await req.app["db"].get_user_pk(discord_id)
+        if not user_id:
+            raise web.HTTPForbidden()
         reader = await req.multipart()
         field = await reader.next()
         if not field or field.name != "file":
             return web.HTTPBadRequest(text="Missing file field")
-        chunk = await field.read(decode=False)
         tmp_dir = CHUNK_DIR / upload_id
         tmp_dir.mkdir(parents=True, exist_ok=True)
         part_path = tmp_dir / f"{idx:06}.part"
-        part_path.write_bytes(chunk)
-        if is_last:
-            target_id = str(uuid.uuid4())
-            target_path = DATA_DIR / target_id
-            with target_path.open("wb") as out:
-                for part_file in sorted(tmp_dir.iterdir()):
-                    out.write(part_file.read_bytes())
-            for part_file in tmp_dir.iterdir():
-                part_file.unlink()
-            tmp_dir.rmdir()
-            discord_id = req.get("user_id")
-            if not discord_id:
-                raise web.HTTPForbidden()
-            user_id = await req.app["db"].get_user_pk(discord_id)
-            if not user_id:
-                raise web.HTTPForbidden()
-
-            folder = req.headers.get("X-Upload-Folder") or req.headers.get(
-                "X-Upload-FolderId", ""
-            )
-            from bot.auto_tag import generate_tags
-
-            tags = await asyncio.to_thread(generate_tags, target_path, field.filename)
-            gdrive_id = None
-            if GDRIVE_CREDENTIALS:
-                try:
-                    from integrations.google_drive_client import upload_file as gd_up
-
-                    token_json = await req.app["db"].get_gdrive_token(user_id)
-                    if token_json:
-                        gdrive_id, new_token = await asyncio.to_thread(
-                            gd_up, target_path, field.filename, token_json
-                        )
-                        if new_token != token_json:
-                            await req.app["db"].set_gdrive_token(user_id, new_token)
-                except Exception as e:
-                    log.warning("Google Drive upload failed: %s", e)
-            await req.app["db"].add_file(
-                target_id,
-                user_id,
-                folder,
-                field.filename,
-                str(target_path),
-                target_path.stat().st_size,
-                hashlib.sha256(target_path.read_bytes()).hexdigest(),
-                tags,
-                gdrive_id,
+        # 受信済みのチャンクはまだ集計に入っていないので、この分も上限に含める
+        received = sum(p.stat().st_size for p in tmp_dir.glob("*.part") if p != part_path)
+        try:
+            budget = await open_budget(
+                req.app["db"],
+                DATA_DIR,
+                user_id=user_id,
+                expected=received + (req.content_length or 0),
             )
-            mime, _ = mimetypes.guess_type(field.filename)
-            if mime and mime.startswith("video"):
-                asyncio.create_task(_generate_hls(target_path, target_id))
-            await broadcast_ws({"action": "reload"})
-            return web.json_response({"status": "completed", "file_id": target_id})
+        except QuotaExceeded as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return _quota_response(e)
+        with budget:
+            try:
+                budget.consume(received)
+                await _receive_part(field, part_path, budget)
+            except QuotaExceeded as e:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return _quota_response(e)
+            if is_last:
+                return await _finish_chunked(req, user_id, tmp_dir, field.filename)
         return web.json_response({"status": "ok", "chunk": idx})
 
+    async def _finish_chunked(
+        req: web.Request, user_id: int, tmp_dir: Path, filename: str
+    ):
+        target_id = str(uuid.uuid4())
+        target_path = DATA_DIR / target_id
+        with target_path.open("wb") as out:
+            for part_file in sorted(tmp_dir.iterdir()):
+                with part_file.open("rb") as src:
+                    shutil.copyfileobj(src, out, UPLOAD_READ_SIZE)
+        for part_file in tmp_dir.iterdir():
+            part_file.unlink()
+        tmp_dir.rmdir()
+
+        folder = req.headers.get("X-Upload-Folder") or req.headers.get(
+            "X-Upload-FolderId", ""
+        )
+        from bot.auto_tag import generate_tags
+
+        tags = await asyncio.to_thread(generate_tags, target_path, filename)
+        await req.app["db"].add_file(
+            target_id,
+            user_id,
+            folder,
+            filename,
+            str(target_path),
+            target_path.stat().st_size,
+            await asyncio.to_thread(_sha256_file, target_path),
+            tags,
+        )
+        await _index_text(req.app, "file", target_id, target_path, filename)
+        await _queue_gdrive_mirror(
+            req.app, target_id, user_id, target_path, filename
+        )
+        mime, _ = mimetypes.guess_type(filename)
+        if mime and mime.startswith("video"):
+            asyncio.create_task(_generate_hls(target_path, target_id, req.app["db"]))
+        await broadcast_ws({"action": "reload"})
+        return web.json_response({"status": "completed", "file_id": target_id})
+
     async def delete_file(req: web.Request):
         discord_id = req.get("user_id")
         if not discord_id:
@@ -2122,15 +3076,9 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         user_id = await req.app["db"].get_user_pk(discord_id)
         if not user_id:
             raise web.HTTPForbidden()
-        rows = await req.app["db"].fetchall(
-            "SELECT path FROM files WHERE user_id=?", user_id
-        )
-        for r in rows:
-            try:
-                Path(r["path"]).unlink(missing_ok=True)
-            except Exception as e:
-                log.warning("Failed to delete file: %s", e)
+        # 実体の削除は回収タスクに任せ、一覧からはすぐに消す
         await req.app["db"].delete_all_files(user_id)
+        req.app["blob_reaper"].wake()
         referer = req.headers.get("Referer", "/")
         await broadcast_ws({"action": "reload"})
         raise web.HTTPFound(referer)
@@ -2242,43 +3190,80 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         if not discord_id:
             raise web.HTTPFound("/login")
 
-        data = await req.post()
-        filefield = data.get("file")
-        folder_id = data.get("folder_id")
-        if not filefield or not folder_id:
-            raise web.HTTPBadRequest()
-
         db = req.app["db"]
-        rows = await db.fetchall(
-            "SELECT * FROM shared_folder_members WHERE folder_id = ? AND discord_user_id = ?",
-            folder_id,
-            discord_id,
-        )
-        if not rows:
-            raise web.HTTPForbidden(text="Not a member")
-
+        reader = await req.multipart()
         fid = os.urandom(8).hex()
         path = DATA_DIR / fid
-        with path.open("wb") as f:
-            while True:
-                chunk = filefield.file.read(8192)
-                if not chunk:
-                    break
-                f.write(chunk)
-
-        from bot.auto_tag import generate_tags
+        folder_id = filename = None
+        # 通常は folder_id を読んで参加と容量を確かめてから、ファイル本体を受信しながら保存する。
+        # ファイルが先に届いた場合は folder_id が分かるまで一時ファイルに受けておく
+        spool: Optional[Path] = None
+        spooled = 0
+        try:
+            while (part := await reader.next()) is not None:
+                if part.name == "folder_id":
+                    folder_id = (await part.text()).strip()
+                    if spool is not None:
+                        break
+                elif part.name == "file" and part.filename and filename is None:
+                    filename = part.filename
+                    if folder_id is not None:
+                        break
+                    spool = CHUNK_DIR / f"{fid}.part"
+                    try:
+                        with await open_budget(
+                            db, DATA_DIR, expected=req.content_length or 0
+                        ) as disk:
+                            spooled, _ = await _receive_part(part, spool, disk)
+                    except QuotaExceeded as e:
+                        return _quota_response(e)
+            if filename is None or not folder_id or not folder_id.isdigit():
+                raise web.HTTPBadRequest(text="folder_id and file are required")
+
+            rows = await db.fetchall(
+                "SELECT * FROM shared_folder_members WHERE folder_id = ? AND discord_user_id = ?",
+                folder_id,
+                discord_id,
+            )
+            if not rows:
+                raise web.HTTPForbidden(text="Not a member")
 
-        tags = await asyncio.to_thread(generate_tags, path, filefield.filename)
-        await db.add_shared_file(fid, folder_id, filefield.filename, str(path), tags)
+            try:
+                budget = await open_budget(
+                    db,
+                    DATA_DIR,
+                    shared_folder_id=int(folder_id),
+                    expected=spooled if spool is not None else req.content_length or 0,
+                )
+            except QuotaExceeded as e:
+                return _quota_response(e)
+            with budget:
+                try:
+                    if spool is not None:
+                        budget.consume(spooled)
+                        spool.replace(path)
+                    else:
+                        await _receive_part(part, path, budget)
+                except QuotaExceeded as e:
+                    return _quota_response(e)
+
+                from bot.auto_tag import generate_tags
+
+                tags = await asyncio.to_thread(generate_tags, path, filename)
+                await db.add_shared_file(fid, folder_id, filename, str(path), tags)
+        finally:
+            if spool is not None:
+                spool.unlink(missing_ok=True)
+        await _index_text(req.app, "shared", fid, path, filename)
         # アップロード時は自動的に共有しないようフラグをクリア
         await db.execute(
             "UPDATE shared_files SET is_shared=0, token=NULL WHERE id = ?", fid
         )
         await db.commit()
-        mime, _ = mimetypes.guess_type(filefield.filename)
+        mime, _ = mimetypes.guess_type(filename)
         if mime and mime.startswith("video"):
-            asyncio.create_task(_generate_hls(path, fid))
-        await notify_shared_upload(db, int(folder_id), discord_id, filefield.filename)
+            asyncio.create_task(_generate_hls(path, fid, db))
+        await notify_shared_upload(db, int(folder_id), discord_id, filename)
         await broadcast_ws({"action": "reload"})
         raise web.HTTPFound(f"/shared/{folder_id}")
 
@@ -2444,7 +3429,8 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
                         pass
             return zip_path, tmp_dir
 
-        zip_path, tmp_dir = await asyncio.to_thread(_create_zip, rows, folder_id)
+        with tracer.span("zip.create", {"zip.files": len(rows)}):
+            zip_path, tmp_dir = await asyncio.to_thread(_create_zip, rows, folder_id)
 
         async def _cleanup():
             await asyncio.sleep(60)
@@ -2680,6 +3666,30 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
         if not user_id or not row or row["user_id"] != user_id:
             raise web.HTTPForbidden()
         await db.delete_user_folder(folder_id)
+        request.app["blob_reaper"].wake()
+        await broadcast_ws({"action": "reload"})
+        raise web.HTTPFound(request.headers.get("Referer", "/"))
+
+    async def move_folder(request: web.Request):
+        discord_id = request.get("user_id")
+        if not discord_id:
+            raise web.HTTPForbidden()
+        folder_id = int(request.match_info.get("folder_id", 0))
+        data = await request.post()
+        parent = data.get("parent_id")
+        db = request.app["db"]
+        user_id = await db.get_user_pk(discord_id)
+        if not user_id:
+            raise web.HTTPForbidden()
+        tree = await db.folder_tree(user_id)
+        parent_id = int(parent) if parent else None
+        # 移動元・移動先とも自分のフォルダに限る
+        if folder_id not in tree or (parent_id is not None and parent_id not in tree):
+            raise web.HTTPForbidden()
+        try:
+            await db.move_user_folder(folder_id, parent_id)
+        except ValueError:
+            raise web.HTTPBadRequest(text="cannot move a folder into itself")
         await broadcast_ws({"action": "reload"})
         raise web.HTTPFound(request.headers.get("Referer", "/"))
 
@@ -2695,6 +3705,7 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
             raise web.HTTPForbidden()
         parent_id = int(parent) if parent else None
         await db.delete_all_subfolders(user_id, parent_id)
+        request.app["blob_reaper"].wake()
         await broadcast_ws({"action": "reload"})
         raise web.HTTPFound(request.headers.get("Referer", "/"))
 
@@ -2770,6 +3781,11 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
 
     # routes
     app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_get("/api/admin/system", admin_system)
+    app.router.add_get("/api/admin/queries", admin_queries)
+    app.router.add_get("/api/admin/traces", admin_traces)
+    app.router.add_get("/api/admin/loop", admin_loop)
     app.router.add_get("/csrf_token", csrf_token)
     app.router.add_get("/login", login_get)
     app.router.add_post("/login", login_post)
@@ -2801,6 +3817,12 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
     app.router.add_post("/tags/{id}", update_tags)
     app.router.add_post("/sendfile", send_file_dm)
     app.router.add_get("/search", search_files_api)
+    app.router.add_get("/api/tags", tag_facets_api)
+    app.router.add_get("/api/files", file_list_json)
+    app.router.add_get("/api/usage", usage_api)
+    app.router.add_get("/api/changes", changes_api)
+    app.router.add_get("/api/changes/stream", changes_stream)
+    app.router.add_get("/api/tags/suggest", tag_suggest_api)
     app.router.add_get("/static/api/files", file_list_api)
     app.router.add_get("/partial/files", file_list_api)
     app.router.add_get("/shared", shared_index)
@@ -2812,6 +3834,7 @@ def create_app(bot: Optional[discord.Client] = None) -> web.Application:
     app.router.add_post("/create_folder", create_folder)
     app.router.add_post("/delete_folder/{folder_id}", delete_folder)
     app.router.add_post("/delete_subfolders", delete_subfolders)
+    app.router.add_post("/move_folder/{folder_id}", move_folder)
     app.router.add_get("/zip/{folder_id}", download_zip)
     app.router.add_post("/shared/tags/{id}", shared_update_tags)
     app.router.add_post("/shared/toggle_shared/{id}", shared_toggle)
@@ -0,0 +1,165 @@
+"""Static asset pipeline: content-hashed copies with precompressed variants.
+
+``STATIC_DIR`` のファイルを内容ハッシュ付きの名前で出力先へコピーし、テキスト系は
+``.gz`` / ``.br`` を事前に作っておく。ハッシュ名の URL は内容が変わらない限り不変なので
+``Cache-Control: immutable`` で配信でき、再訪時の転送量はゼロになる。
+
+起動時に ``build_assets`` が呼ばれるほか、デプロイ時に ``python -m web.assets`` で
+事前にビルドしておくこともできる (既に出力済みのファイルは書き直さない)。
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import os
+import re
+import tempfile
+import time
+from pathlib import Path, PurePosixPath
+from typing import Dict, Optional
+
+try:  # brotli は任意。無ければ .gz のみ作る
+    import brotli  # type: ignore
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+ASSET_PREFIX = "/assets/"
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+# 事前圧縮する拡張子 (画像などは既に圧縮済みなので対象外)
+COMPRESSIBLE = {".css", ".js", ".json", ".svg", ".html", ".txt", ".map", ".webmanifest"}
+# 固定の URL で配信する必要があるため、ハッシュ名を付けずに参照だけ書き換えるファイル
+UNHASHED = ("service-worker.js", "manifest.json")
+# 参照されなくなった古いハッシュ名ファイルを消すまでの猶予 (秒)
+STALE_AFTER = 7 * 86400
+
+_STATIC_REF = re.compile(r"""(['"])/static/([^'"?#]+)\1""")
+_SW_VERSION = re.compile(r"(const CACHE_VERSION = ')([^']*)(')")
+
+
+class AssetManifest:
+    """論理パス (``css/style.css``) からハッシュ名 URL を引く対応表。"""
+
+    def __init__(
+        self, files: Dict[str, str], version: str, fallback: str = "/static/"
+    ) -> None:
+        self.files = files
+        self.version = version
+        self.fallback = fallback
+
+    def url(self, path: str) -> str:
+        path = path.lstrip("/")
+        hashed = self.files.get(path)
+        if hashed is None:
+            # ビルド後に追加されたファイルなどは従来の /static/ で返す
+            return f"{self.fallback}{path}?v={self.version}"
+        return ASSET_PREFIX + hashed
+
+    def rewrite(self, text: str) -> str:
+        """文字列リテラル中の ``'/static/...'`` をハッシュ名 URL に置き換える。"""
+
+        def repl(m: re.Match) -> str:
+            if m.group(2) not in self.files:
+                return m.group(0)
+            return f"{m.group(1)}{self.url(m.group(2))}{m.group(1)}"
+
+        return _STATIC_REF.sub(repl, text)
+
+
+def _hashed_name(rel: str, digest: str) -> str:
+    p = PurePosixPath(rel)
+    return str(p.with_name(f"{p.stem}.{digest[:10]}{p.suffix}"))
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    # 複数ワーカーが同時に起動しても中途半端なファイルを配信しないよう rename で置く
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def _precompress(path: Path, data: bytes) -> None:
+    """``path`` の横に .gz / .br を置く。元より小さくならない場合は作らない。"""
+    if path.suffix not in COMPRESSIBLE:
+        return
+    variants = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(data, quality=11)
+    for ext, packed in variants.items():
+        target = path.with_name(path.name + ext)
+        if len(packed) < len(data):
+            _write_atomic(target, packed)
+        else:
+            # 上書き前の古い圧縮版が残っていると中身の違うものを配信してしまう
+            target.unlink(missing_ok=True)
+
+
+def _prune(out_dir: Path, keep: set[str], now: float) -> None:
+    for f in out_dir.rglob("*"):
+        if not f.is_file():
+            continue
+        rel = f.relative_to(out_dir).as_posix()
+        base = rel[:-3] if rel.endswith((".gz", ".br")) else rel
+        if base in keep:
+            continue
+        try:
+            if now - f.stat().st_mtime > STALE_AFTER:
+                f.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def build_assets(
+    static_dir: Path, out_dir: Path, now: Optional[float] = None
+) -> AssetManifest:
+    """``static_dir`` をハッシュ名で ``out_dir`` に出力し、対応表を返す。"""
+    files: Dict[str, str] = {}
+    if static_dir.exists():
+        for src in sorted(static_dir.rglob("*")):
+            rel = src.relative_to(static_dir).as_posix()
+            if not src.is_file() or src.name.startswith(".") or rel in UNHASHED:
+                continue
+            data = src.read_bytes()
+            name = _hashed_name(rel, hashlib.sha256(data).hexdigest())
+            dest = out_dir / name
+            if not dest.exists():
+                _write_atomic(dest, data)
+                _precompress(dest, data)
+            files[rel] = name
+
+    listing = "\n".join(f"{k}={v}" for k, v in sorted(files.items()))
+    version = hashlib.sha256(listing.encode()).hexdigest()[:10]
+    manifest = AssetManifest(files, version)
+
+    for rel in UNHASHED:
+        src = static_dir / rel
+        if not src.exists():
+            continue
+        text = manifest.rewrite(src.read_text(encoding="utf-8"))
+        if rel == "service-worker.js":
+            # アセットが変われば SW のキャッシュ名も変わり、古いキャッシュが破棄される
+            text = _SW_VERSION.sub(rf"\g<1>\g<2>-{version}\g<3>", text, count=1)
+        data = text.encode("utf-8")
+        dest = out_dir / rel
+        if not dest.exists() or dest.read_bytes() != data:
+            _write_atomic(dest, data)
+            _precompress(dest, data)
+
+    _prune(out_dir, set(files.values()) | set(UNHASHED), now or time.time())
+    return manifest
+
+
+if __name__ == "__main__":
+    import sys
+
+    static = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("web/static")
+    out = Path(sys.argv[2]) if len(sys.argv) > 2 else Path("data/cache/assets")
+    m = build_assets(static, out)
+    print(f"built {len(m.files)} assets (version {m.version}) into {out}")
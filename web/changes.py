@@ -0,0 +1,103 @@
+"""Wake-up hub for clients following the ``changes`` log.
+
+``/api/changes`` のロングポーリングと ``/api/changes/stream`` (Server-Sent Events) は、
+新しい変更が記録されるまで待機する。変更はトリガーで書かれるため Bot プロセスなど
+別経路の書き込みもあり、アプリ内の通知だけでは拾えない。待機中のクライアントが
+いる間だけ全体の最新 seq を一定間隔で調べ、増えていれば全員を一度に起こす。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import math
+from typing import Awaitable, Callable, Optional
+
+log = logging.getLogger("web")
+
+
+def format_sse(data: object, event_id: Optional[int] = None, event: str = "changes") -> bytes:
+    """Server-Sent Events の 1 イベント分のバイト列を作る。"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    for line in json.dumps(data, ensure_ascii=False).splitlines() or [""]:
+        lines.append(f"data: {line}")
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+def parse_wait(value: Optional[str], limit: float) -> float:
+    """ロングポーリングの ``wait`` (秒)。未指定は 0、``limit`` で頭打ちにする。
+
+    数値でないもの・負の値・``nan`` や ``inf`` は ``ValueError``。
+    """
+    if value is None or value == "":
+        return 0.0
+    wait = float(value)
+    if not math.isfinite(wait) or wait < 0:
+        raise ValueError(f"invalid wait: {value!r}")
+    return min(wait, limit)
+
+
+class ChangeFeed:
+    """変更履歴の新着を待つコルーチンをまとめて起こす。
+
+    ``latest`` は全ユーザーを通した最新 seq を返すコルーチン関数。
+    """
+
+    def __init__(
+        self, latest: Callable[[], Awaitable[int]], interval: float = 1.0
+    ) -> None:
+        self._latest = latest
+        self.interval = interval
+        self.seq = 0
+        self._event = asyncio.Event()
+        self._waiters = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def waiters(self) -> int:
+        return self._waiters
+
+    def notify(self) -> None:
+        """待機中の全員を起こす (起きた側が自分宛ての変更を確認する)。"""
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """新しい変更が記録されるか ``timeout`` 秒経つまで待つ。起こされたら真。"""
+        event = self._event
+        self._waiters += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._poll())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters -= 1
+
+    async def _poll(self) -> None:
+        # 待機者がいなくなったら止まり、次の wait() で再び起動する
+        while self._waiters:
+            try:
+                seq = await self._latest()
+            except Exception as e:  # DB が一時的に使えなくても待機者は時間切れで戻る
+                log.warning("change feed poll failed: %s", e)
+            else:
+                if seq > self.seq:
+                    self.seq = seq
+                    self.notify()
+            await asyncio.sleep(self.interval)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.notify()
@@ -0,0 +1,143 @@
+"""Response compression limited to text bodies.
+
+``aiohttp_compress`` はすべてのレスポンスに ``enable_compression`` を掛けるため、
+``FileResponse`` のダウンロードや HLS セグメントまで gzip され sendfile が使えなくなる。
+ここではメモリ上に本文を持つ ``web.Response`` のうち、テキスト系で一定サイズ以上の
+ものだけを圧縮する。ファイル配信は一切触らないので常にゼロコピーで送られる。
+
+ETag 付きのレスポンスは圧縮結果を URL・ETag・エンコーディングをキーに LRU で保持し、
+同じ部分 HTML や JSON を何度も圧縮しない。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import gzip
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from aiohttp import hdrs, web
+
+try:  # brotli は任意
+    import brotli  # type: ignore
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+# 圧縮対象の Content-Type (text/* はすべて対象)
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/manifest+json",
+    "image/svg+xml",
+}
+# これを超える本文はイベントループを止めないようスレッドで圧縮する
+THREAD_MIN_SIZE = 256 * 1024
+
+
+def _is_compressible(content_type: str) -> bool:
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+def _choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def _weak(etag: str) -> str:
+    # 圧縮前後で同じ ETag を使うため弱い ETag にする (RFC 9110 8.8.3)
+    return etag if etag.startswith("W/") else f"W/{etag}"
+
+
+class Compressor:
+    """テキスト系レスポンスだけを圧縮するミドルウェアを作る。
+
+    ``skip_prefixes`` に一致するパスは内容に関わらず圧縮しない。
+    """
+
+    def __init__(
+        self,
+        skip_prefixes: Iterable[str] = (),
+        min_size: int = 1024,
+        cache_entries: int = 256,
+    ) -> None:
+        self.skip_prefixes = tuple(skip_prefixes)
+        self.min_size = min_size
+        self.cache_entries = cache_entries
+        # (パス+クエリ, ETag, エンコーディング) -> 圧縮済み本文
+        self._cache: OrderedDict[tuple[str, str, str], bytes] = OrderedDict()
+        self.hits = 0
+
+    def wants(self, request: web.Request, response: web.StreamResponse) -> bool:
+        if request.path.startswith(self.skip_prefixes):
+            return False
+        # FileResponse や独自のストリーミングは sendfile / 逐次送信のまま
+        if type(response) is not web.Response or response.prepared:
+            return False
+        if response.status < 200 or response.status in (204, 304):
+            return False
+        if hdrs.CONTENT_ENCODING in response.headers:
+            return False
+        body = response.body
+        if not isinstance(body, (bytes, bytearray)) or len(body) < self.min_size:
+            return False
+        return _is_compressible(response.content_type)
+
+    async def compress(
+        self, body: bytes, encoding: str, etag: Optional[str] = None, url: str = ""
+    ) -> bytes:
+        key = (url, etag, encoding) if etag else None
+        if key is not None and key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return self._cache[key]
+        if len(body) >= THREAD_MIN_SIZE:
+            packed = await asyncio.to_thread(_compress, body, encoding)
+        else:
+            packed = _compress(body, encoding)
+        if key is not None:
+            self._cache[key] = packed
+            while len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+        return packed
+
+    def middleware(self):
+        @web.middleware
+        async def compress_middleware(request: web.Request, handler):
+            response = await handler(request)
+            if not self.wants(request, response):
+                return response
+            response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+            encoding = _choose_encoding(request.headers.get(hdrs.ACCEPT_ENCODING, ""))
+            if encoding is None:
+                return response
+            etag = response.headers.get(hdrs.ETAG)
+            response.body = await self.compress(
+                bytes(response.body), encoding, etag, request.path_qs
+            )
+            response.headers[hdrs.CONTENT_ENCODING] = encoding
+            if etag:
+                response.headers[hdrs.ETAG] = _weak(etag)
+            return response
+
+        return compress_middleware
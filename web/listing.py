@@ -0,0 +1,86 @@
+"""Compact JSON representation of folder listings.
+
+``/partial/files`` や ``/mobile`` は 1 行変わっただけでも 90 行分の HTML を返す。
+``/api/files`` はファイル一覧を必要な項目だけの JSON で返し、クライアント側
+(``main.js``) が描画と IndexedDB へのキャッシュを行う。
+
+ページングは ``(uploaded_at, id)`` のキーセットカーソルで行うため、OFFSET と違い
+深いページでも読み飛ばしが発生せず、途中でファイルが増減しても重複・欠落しない。
+"""
+
+from __future__ import annotations
+
+import base64
+import json
+from typing import Iterable, Optional
+
+# 返せる項目 (この順で出力する)。``id`` は常に含める
+FILE_FIELDS = (
+    "id",
+    "folder",
+    "name",
+    "size",
+    "uploaded_at",
+    "mime",
+    "icon",
+    "tags",
+    "is_shared",
+    "share_url",
+    "expires_at",
+    "preview_url",
+    "hls_url",
+    "download_path",
+    "url",
+)
+# 署名付き URL を含むため ETag に時間の区切りを入れる必要がある項目
+SIGNED_FIELDS = {"download_path", "url", "preview_url"}
+# Service Worker のカタログ (IndexedDB) に同期する項目
+CATALOG_FIELDS = FILE_FIELDS
+DEFAULT_LIMIT = 90
+MAX_LIMIT = 500
+
+
+def parse_fields(spec: Optional[str]) -> tuple[str, ...]:
+    """``fields=name,size`` を検証して出力順の項目名タプルにする。
+
+    未指定なら全項目。知らない項目名は ``ValueError``。
+    """
+    if not spec:
+        return FILE_FIELDS
+    wanted = {f.strip() for f in spec.split(",") if f.strip()}
+    unknown = wanted.difference(FILE_FIELDS)
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}")
+    wanted.add("id")
+    return tuple(f for f in FILE_FIELDS if f in wanted)
+
+
+def parse_limit(value: Optional[str], default: int = DEFAULT_LIMIT) -> int:
+    if not value:
+        return default
+    return max(1, min(int(value), MAX_LIMIT))
+
+
+def encode_cursor(uploaded_at: str, file_id: str) -> str:
+    """最後に返した行の位置を URL に載せられる不透明な文字列にする。"""
+    raw = json.dumps([uploaded_at, file_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[tuple[str, str]]:
+    """``encode_cursor`` の逆。壊れたカーソルは ``ValueError``。"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        uploaded_at, file_id = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(uploaded_at, str) or not isinstance(file_id, str):
+        raise ValueError("invalid cursor")
+    return uploaded_at, file_id
+
+
+def project(entry: dict, fields: Iterable[str]) -> dict:
+    """``entry`` から ``fields`` の項目だけを取り出す。"""
+    return {f: entry.get(f) for f in fields}
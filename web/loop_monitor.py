@@ -0,0 +1,215 @@
+"""Event-loop lag monitor and blocking-call detector.
+
+Web サーバーと Discord Bot は同じイベントループで動くので、ループ上で同期処理が
+長く走ると HTTP の応答だけでなく Discord のハートビートも遅れる。
+
+``LoopMonitor.run`` はループ上で ``interval`` 秒ごとに眠り、予定より起きるのが
+遅れた分 (スケジューリングの遅延) を測る。別スレッドの見張り役はループが最後に
+起きた時刻を見ていて、``threshold`` を超えても起きなければループのスレッドの
+スタックを ``sys._current_frames()`` で読み取る。ループが戻ってきたら、止まっていた
+時間をスタック中のこのリポジトリの一番内側のフレーム (``web/app.py:123``) に
+付けて集計するので、どこの呼び出しがループを止めているかが分かる。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as _Tally
+from collections import deque
+from pathlib import Path
+from typing import Optional
+
+from bot.query_log import percentile
+
+log = logging.getLogger("web")
+
+ROOT = Path(__file__).resolve().parents[1]
+# リポジトリ内でも呼び出し元として数えないもの
+_SKIP = (str(Path(__file__).resolve()), str(ROOT / "venv"), str(ROOT / ".venv"))
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _is_repo_file(filename: str) -> bool:
+    return (
+        filename.startswith(str(ROOT))
+        and not filename.startswith(_SKIP)
+        and "site-packages" not in filename
+    )
+
+
+def call_site(stack: traceback.StackSummary) -> str:
+    """スタックのうちリポジトリ内の一番内側のフレーム (無ければ一番内側)。"""
+    for frame in reversed(stack):
+        if _is_repo_file(frame.filename):
+            rel = Path(frame.filename).relative_to(ROOT)
+            return f"{rel.as_posix()}:{frame.lineno} ({frame.name})"
+    if not stack:
+        return "unknown"
+    frame = stack[-1]
+    return f"{frame.filename}:{frame.lineno} ({frame.name})"
+
+
+class _Offender:
+    __slots__ = ("count", "total", "max", "last_seen", "stack")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last_seen = 0.0
+        self.stack: list[str] = []
+
+
+class LoopMonitor:
+    """ループの遅延を測り、止めた呼び出し元を集計する。
+
+    ``registry`` (``web.metrics.Registry``) を渡すと遅延のヒストグラムと、呼び出し元
+    ごとの回数・合計時間のカウンタを登録する。``threshold`` が 0 以下なら遅延を
+    測るだけでスタックは取らない。
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.1,
+        threshold: float = 0.1,
+        registry=None,
+        keep: int = 600,
+    ) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        self.recent: deque = deque(maxlen=max(1, keep))
+        self.max_lag = 0.0
+        self.offenders: dict[str, _Offender] = {}
+        self.stalls = 0
+        self._lock = threading.Lock()
+        self._beat = time.monotonic()
+        self._samples: list[traceback.StackSummary] = []
+        self._loop_thread: Optional[int] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+        self.lag_hist = self.blocked = self.blocked_seconds = None
+        if registry is not None:
+            self.lag_hist = registry.histogram(
+                "wds_event_loop_lag_seconds",
+                "Delay between when the loop monitor should wake and when it did.",
+                buckets=LAG_BUCKETS,
+            )
+            self.blocked = registry.counter(
+                "wds_event_loop_blocked_total",
+                "Event loop stalls longer than the threshold, by blocking call site.",
+                ("site",),
+            )
+            self.blocked_seconds = registry.counter(
+                "wds_event_loop_blocked_seconds_total",
+                "Time the event loop was stalled, by blocking call site.",
+                ("site",),
+            )
+
+    # ── ループ側 ──
+    async def run(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        if self.threshold > 0:
+            self._stop.clear()
+            self._watchdog = threading.Thread(
+                target=self._watch, name="loop-watchdog", daemon=True
+            )
+            self._watchdog.start()
+        try:
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self._beat = now
+                self._observe(max(0.0, now - start - self.interval))
+        finally:
+            self._stop.set()
+            if self._watchdog is not None:
+                self._watchdog.join(timeout=1)
+                self._watchdog = None
+
+    def _observe(self, lag: float) -> None:
+        self.recent.append(lag)
+        if lag > self.max_lag:
+            self.max_lag = lag
+        if self.lag_hist is not None:
+            self.lag_hist.observe(lag)
+        with self._lock:
+            samples, self._samples = self._samples, []
+        if samples:
+            self._attribute(lag, samples)
+
+    def _attribute(self, lag: float, samples: list[traceback.StackSummary]) -> None:
+        # 止まっている間に何度か読んだスタックのうち、一番多く見えた呼び出し元
+        sites = [call_site(s) for s in samples]
+        site, _ = _Tally(sites).most_common(1)[0]
+        stack = samples[sites.index(site)]
+        off = self.offenders.get(site)
+        if off is None:
+            off = self.offenders[site] = _Offender()
+        off.count += 1
+        off.total += lag
+        off.max = max(off.max, lag)
+        off.last_seen = time.time()
+        off.stack = stack.format()
+        self.stalls += 1
+        if self.blocked is not None:
+            self.blocked.inc(labels=(site,))
+            self.blocked_seconds.inc(lag, (site,))
+        log.warning(
+            "event loop blocked for %.0f ms at %s\n%s",
+            lag * 1000,
+            site,
+            "".join(off.stack[-8:]).rstrip(),
+        )
+
+    # ── 見張りスレッド側 ──
+    def _watch(self) -> None:
+        period = min(self.threshold, self.interval) / 2
+        while not self._stop.wait(period):
+            stalled = time.monotonic() - self._beat - self.interval
+            if stalled < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            with self._lock:
+                self._samples.append(stack)
+
+    # ── 集計 ──
+    def snapshot(self, limit: int = 20) -> dict:
+        """遅延の分布と、止めていた時間の合計が長い呼び出し元から ``limit`` 件。"""
+        recent = sorted(self.recent)
+        offenders = sorted(
+            self.offenders.items(), key=lambda kv: kv[1].total, reverse=True
+        )
+        return {
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "lag": {
+                "current_ms": round(self.recent[-1] * 1000, 3) if self.recent else 0.0,
+                "p50_ms": round(percentile(recent, 0.50) * 1000, 3),
+                "p99_ms": round(percentile(recent, 0.99) * 1000, 3),
+                "max_ms": round(self.max_lag * 1000, 3),
+                "samples": len(recent),
+            },
+            "stalls": self.stalls,
+            "offenders": [
+                {
+                    "site": site,
+                    "count": off.count,
+                    "total_ms": round(off.total * 1000, 3),
+                    "max_ms": round(off.max * 1000, 3),
+                    "last_seen": off.last_seen,
+                    "stack": off.stack,
+                }
+                for site, off in offenders[:limit]
+            ],
+        }
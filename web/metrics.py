@@ -0,0 +1,256 @@
+"""Minimal Prometheus text-format metrics.
+
+``/metrics`` で Prometheus のテキスト形式 (exposition format 0.0.4) を返すための
+カウンタ・ゲージ・ヒストグラム。外部パッケージは使わない。値の更新はイベントループ上の
+足し算だけなので計測自体が処理を止めることはない。
+
+ラベルは宣言した順の値のタプルで渡す。経路ラベルにはルートの定義 (``/file/{id}`` など)
+を使い、URL ごとに系列が増えないようにする。
+"""
+
+from __future__ import annotations
+
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+from aiohttp import web
+
+# 秒単位の既定バケット (5ms〜30s)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        return [
+            f"{self.name}{_labels(self.labelnames, k)} {_num(v)}"
+            for k, v in sorted(self.values.items())
+        ]
+
+
+class Gauge(_Metric):
+    """値を ``set`` するか、描画時に ``func`` を呼んで読む。"""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        func: Optional[Callable[[], float]] = None,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.values: dict[tuple, float] = {}
+        self.func = func
+
+    def set(self, value: float, labels: tuple = ()) -> None:
+        self.values[labels] = value
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: tuple = ()) -> None:
+        self.inc(-amount, labels)
+
+    def render(self) -> list[str]:
+        if self.func is not None:
+            self.values[()] = self.func()
+        return [
+            f"{self.name}{_labels(self.labelnames, k)} {_num(v)}"
+            for k, v in sorted(self.values.items())
+        ]
+
+
+class ExternalCounter(Gauge):
+    """OS など外部で数えている累積値を、読んだまま ``counter`` として出す。"""
+
+    kind = "counter"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベル -> [バケットごとの件数 (+Inf を含む), 合計, 件数]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> list[str]:
+        lines = []
+        for k, (counts, total, n) in sorted(self.values.items()):
+            acc = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                le = 'le="' + _num(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, k, le)} {acc}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, k)} {_num(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, k)} {n}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))  # type: ignore[return-value]
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        func: Optional[Callable[[], float]] = None,
+    ) -> Gauge:
+        return self.register(Gauge(name, help, labelnames, func))  # type: ignore[return-value]
+
+    def external_counter(self, name: str, help: str) -> ExternalCounter:
+        return self.register(ExternalCounter(name, help))  # type: ignore[return-value]
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))  # type: ignore[return-value]
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for m in self.metrics:
+            body = m.render()
+            if body:
+                lines += m.header() + body
+        return "\n".join(lines) + "\n"
+
+
+def route_label(request: web.Request) -> str:
+    """ルート定義 (``/file/{id}`` など)。どのルートにも一致しなければ ``unmatched``。"""
+    info = request.match_info
+    route = getattr(info, "route", None)
+    resource = getattr(route, "resource", None)
+    if resource is None or getattr(info, "http_exception", None) is not None:
+        return "unmatched"
+    return resource.canonical
+
+
+class HttpMetrics:
+    """リクエストごとの所要時間・送受信バイト数を記録するミドルウェアを作る。"""
+
+    def __init__(self, registry: Registry) -> None:
+        self.latency = registry.histogram(
+            "wds_http_request_duration_seconds",
+            "Time spent handling HTTP requests.",
+            ("method", "route", "status"),
+        )
+        self.in_flight = registry.gauge(
+            "wds_http_requests_in_flight", "HTTP requests currently being handled."
+        )
+        self.request_bytes = registry.counter(
+            "wds_http_request_bytes_total",
+            "Request body bytes declared by clients (uploads).",
+            ("route",),
+        )
+        self.response_bytes = registry.counter(
+            "wds_http_response_bytes_total",
+            "Response body bytes with a known length (downloads, pages).",
+            ("route",),
+        )
+        self._active = 0
+        self.in_flight.func = lambda: self._active
+
+    def middleware(self):
+        @web.middleware
+        async def metrics_middleware(request: web.Request, handler):
+            start = time.perf_counter()
+            self._active += 1
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status
+                return response
+            except web.HTTPException as e:
+                status = e.status
+                raise
+            finally:
+                self._active -= 1
+                route = route_label(request)
+                self.latency.observe(
+                    time.perf_counter() - start, (request.method, route, str(status))
+                )
+                if request.content_length:
+                    self.request_bytes.inc(request.content_length, (route,))
+
+        return metrics_middleware
+
+    async def on_response_prepare(
+        self, request: web.Request, response: web.StreamResponse
+    ) -> None:
+        # FileResponse は送信直前に Content-Length (Range なら部分の長さ) が決まる
+        length = response.content_length
+        if length:
+            self.response_bytes.inc(length, (route_label(request),))
@@ -0,0 +1,301 @@
+"""Route-aware rate limiting for the aiohttp app.
+
+ルートごとにコスト区分 (リクエスト数・アップロードバイト数・ダウンロード帯域など) を
+分け、クライアントごとのトークンバケットで制限する。バケットはメモリ上の LRU か、
+複数ワーカープロセスで共有できる SQLite に保存する。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import ipaddress
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional, Sequence
+
+from aiohttp import web
+
+log = logging.getLogger("web")
+
+
+@dataclass(frozen=True)
+class Policy:
+    """``amount`` 単位を ``per`` 秒で使い切れるトークンバケットの設定。
+
+    ``amount`` がそのままバースト上限になり、``amount / per`` 単位/秒で回復する。
+    ``unit`` が ``"bytes"`` の区分はリクエスト数ではなく転送量を数える。
+    """
+
+    name: str
+    amount: float
+    per: float
+    unit: str = "requests"
+
+    @property
+    def rate(self) -> float:
+        return self.amount / self.per
+
+
+def parse_policy(name: str, spec: str, unit: str = "requests") -> Policy:
+    """``"1000/60"`` 形式の文字列から ``Policy`` を作る。"""
+    amount, _, per = spec.partition("/")
+    policy = Policy(name, float(amount), float(per or 60), unit)
+    if policy.amount <= 0 or policy.per <= 0:
+        raise ValueError(f"invalid rate limit for {name}: {spec!r}")
+    return policy
+
+
+def _apply(
+    state: Optional[tuple[float, float]],
+    policy: Policy,
+    cost: float,
+    now: float,
+    force: bool,
+) -> tuple[tuple[float, float], float]:
+    """バケット状態 ``(tokens, updated)`` に ``cost`` を適用し、新しい状態と待ち秒数を返す。
+
+    ``force`` のときは残量が足りなくても差し引き、残量をマイナス (借り越し) にする。
+    バースト上限を超えるコストは上限まで貯まれば通す。
+    """
+    tokens, updated = state if state else (policy.amount, now)
+    tokens = min(policy.amount, tokens + max(0.0, now - updated) * policy.rate)
+    if not force:
+        need = min(cost, policy.amount)
+        if tokens < need or tokens <= 0:
+            wait = (max(need, 0.0) - tokens) / policy.rate
+            return (tokens, now), max(wait, 1.0 / policy.rate)
+    return (tokens - cost, now), 0.0
+
+
+class MemoryStore:
+    """プロセス内のバケット置き場。最終利用順の LRU で、満杯に戻ったものから捨てる。"""
+
+    def __init__(self, max_entries: int = 100_000) -> None:
+        self.max_entries = max_entries
+        # key -> (tokens, updated, full_at)
+        self._buckets: OrderedDict[str, tuple[float, float, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    async def take(
+        self, key: str, policy: Policy, cost: float, now: float, force: bool = False
+    ) -> float:
+        entry = self._buckets.pop(key, None)
+        state, wait = _apply(entry[:2] if entry else None, policy, cost, now, force)
+        tokens, updated = state
+        full_at = updated + max(0.0, policy.amount - tokens) / policy.rate
+        self._buckets[key] = (tokens, updated, full_at)
+        self._prune(now)
+        return wait
+
+    def _prune(self, now: float) -> None:
+        # 満杯に戻ったバケットは未登録と同じなので消してよい
+        while self._buckets:
+            key, (_t, _u, full_at) = next(iter(self._buckets.items()))
+            if full_at > now and len(self._buckets) <= self.max_entries:
+                break
+            del self._buckets[key]
+
+
+class SqliteStore:
+    """複数プロセスで共有するバケット置き場。
+
+    1 回の判定は ``BEGIN IMMEDIATE`` の短いトランザクションで行い、スレッドへ逃がす。
+    ロック待ちやディスクエラー時は制限しない (フェイルオープン)。
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: Path, timeout: float = 0.2) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(path), timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+            "updated REAL NOT NULL, full_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        self._ops = 0
+
+    def _take(
+        self, key: str, policy: Policy, cost: float, now: float, force: bool
+    ) -> float:
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT tokens, updated FROM rate_buckets WHERE key=?", (key,)
+                ).fetchone()
+                (tokens, updated), wait = _apply(row, policy, cost, now, force)
+                full_at = updated + max(0.0, policy.amount - tokens) / policy.rate
+                conn.execute(
+                    "INSERT INTO rate_buckets (key, tokens, updated, full_at) "
+                    "VALUES (?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                    "tokens=excluded.tokens, updated=excluded.updated, "
+                    "full_at=excluded.full_at",
+                    (key, tokens, updated, full_at),
+                )
+                self._ops += 1
+                if self._ops % self.PRUNE_EVERY == 0:
+                    conn.execute("DELETE FROM rate_buckets WHERE full_at <= ?", (now,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    async def take(
+        self, key: str, policy: Policy, cost: float, now: float, force: bool = False
+    ) -> float:
+        try:
+            return await asyncio.to_thread(self._take, key, policy, cost, now, force)
+        except sqlite3.Error as e:
+            log.warning("rate limit store unavailable: %s", e)
+            return 0.0
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def parse_networks(spec: str) -> list:
+    """カンマ区切りの IP / CIDR 表記をネットワークのリストにする。"""
+    nets = []
+    for part in spec.split(","):
+        part = part.strip()
+        if part:
+            nets.append(ipaddress.ip_network(part, strict=False))
+    return nets
+
+
+def _in_networks(addr: str, networks: Sequence) -> bool:
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return False
+    return any(ip in net for net in networks)
+
+
+def client_key(request: web.Request, trusted_proxies: Sequence = ()) -> str:
+    """制限の単位となるクライアントのアドレスを返す。
+
+    接続元が信頼済みプロキシのときだけ ``X-Forwarded-For`` を右から辿り、
+    信頼済みでない最初のアドレスを採用する。偽装されたヘッダーは無視される。
+    """
+    peer = request.remote or ""
+    if not trusted_proxies or not _in_networks(peer, trusted_proxies):
+        return peer
+    hops = [
+        h.strip()
+        for value in request.headers.getall("X-Forwarded-For", [])
+        for h in value.split(",")
+        if h.strip()
+    ]
+    for hop in reversed(hops):
+        if not _in_networks(hop, trusted_proxies):
+            return hop
+    return hops[0] if hops else peer
+
+
+# 後から差し引く転送量の (バケットの鍵, Policy)。レスポンス送信時と本文の受信後
+CHARGE_ON_RESPONSE = web.RequestKey("rate_limit", tuple)
+CHARGE_ON_RECEIVE = web.RequestKey("rate_limit_received", tuple)
+
+
+class RateLimiter:
+    """パスの前方一致でコスト区分を選び、クライアントごとに制限する。
+
+    ``routes`` は ``(prefix, policy 名)`` の並びで、先に一致したものが使われる。
+    policy 名が ``None`` のパスは制限しない。``bytes`` 単位の区分のうち、
+    ダウンロード系はレスポンスの Content-Length を送信時に借り越しで差し引く。
+    アップロードは Content-Length を先に差し引き、無い (chunked) 場合はハンドラーが
+    実際に受信したバイト数を後から借り越しで差し引く。
+    """
+
+    def __init__(
+        self,
+        policies: Iterable[Policy],
+        routes: Sequence[tuple[str, Optional[str]]],
+        *,
+        default: str = "default",
+        store=None,
+        trusted_proxies: Sequence = (),
+        post_charge: Iterable[str] = ("download",),
+    ) -> None:
+        self.policies = {p.name: p for p in policies}
+        self.routes = list(routes)
+        self.default = default
+        self.store = store if store is not None else MemoryStore()
+        self.trusted_proxies = list(trusted_proxies)
+        self.post_charge = set(post_charge)
+
+    def classify(self, path: str) -> Optional[Policy]:
+        for prefix, name in self.routes:
+            if path == prefix or path.startswith(prefix.rstrip("/") + "/"):
+                return self.policies.get(name) if name else None
+        return self.policies.get(self.default)
+
+    async def check(self, request: web.Request) -> float:
+        """制限内なら 0、超えていれば再試行までの秒数を返す。"""
+        policy = self.classify(request.path)
+        if policy is None:
+            return 0.0
+        key = f"{policy.name}:{client_key(request, self.trusted_proxies)}"
+        if policy.name in self.post_charge:
+            # 転送量は送信時まで分からないので、借り越しがないかだけ確認する
+            cost = 0.0
+            request[CHARGE_ON_RESPONSE] = (key, policy)
+        elif policy.unit == "bytes":
+            cost = float(request.content_length or 0)
+            if request.content_length is None:
+                request[CHARGE_ON_RECEIVE] = (key, policy)
+        else:
+            cost = 1.0
+        return await self.store.take(key, policy, cost, time.time())
+
+    async def on_response_prepare(
+        self, request: web.Request, response: web.StreamResponse
+    ) -> None:
+        """ダウンロード系区分の転送量をレスポンス送信時に差し引く。"""
+        entry = request.get(CHARGE_ON_RESPONSE)
+        if entry is None or not response.content_length:
+            return
+        key, policy = entry
+        await self.store.take(
+            key, policy, float(response.content_length), time.time(), force=True
+        )
+
+    async def charge_received(self, request: web.Request) -> None:
+        """Content-Length の無いアップロードで実際に受信したバイト数を差し引く。"""
+        entry = request.get(CHARGE_ON_RECEIVE)
+        if entry is None or not request.content.total_bytes:
+            return
+        key, policy = entry
+        await self.store.take(
+            key, policy, float(request.content.total_bytes), time.time(), force=True
+        )
+
+    def middleware(self):
+        @web.middleware
+        async def rate_limit_mw(request: web.Request, handler):
+            wait = await self.check(request)
+            if wait > 0:
+                raise web.HTTPTooManyRequests(
+                    headers={"Retry-After": str(math.ceil(wait))}
+                )
+            try:
+                return await handler(request)
+            finally:
+                await self.charge_received(request)
+
+        return rate_limit_mw
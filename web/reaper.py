@@ -0,0 +1,116 @@
+"""Background removal of blobs whose rows were already deleted.
+
+フォルダや全ファイルの削除は行を消して ``pending_unlinks`` に実体のパスを積むだけで
+すぐ応答する。実体の削除はこの回収タスクが一定件数ずつ専用スレッドプールで行い、
+進み具合を WebSocket で知らせる。Bot プロセスが積んだ分も定期的に見に行く。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+log = logging.getLogger("web")
+
+
+def unlink_paths(paths: list[str]) -> int:
+    """``paths`` を削除し、実際に消えたファイル数を返す (スレッド内で実行)。"""
+    removed = 0
+    for p in paths:
+        try:
+            Path(p).unlink()
+            removed += 1
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning("Failed to delete file: %s", e)
+    return removed
+
+
+class BlobReaper:
+    """``pending_unlinks`` を少しずつ空にする。
+
+    ``db`` は ``pending_unlinks`` / ``finish_unlinks`` / ``count_pending_unlinks`` を持つ
+    ``Database``。``notify`` には進捗を流すコルーチン関数 (``broadcast_ws``) を渡す。
+    """
+
+    def __init__(
+        self,
+        db,
+        notify: Optional[Callable[[dict], Awaitable[None]]] = None,
+        batch_size: int = 500,
+        workers: int = 4,
+        interval: float = 60.0,
+    ) -> None:
+        self.db = db
+        self.notify = notify
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+        self.interval = interval
+        self._wake = asyncio.Event()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def wake(self) -> None:
+        """削除待ちを積んだ直後に呼び、次の巡回を待たずに回収させる。"""
+        self._wake.set()
+
+    async def drain_batch(self) -> int:
+        """1 バッチ分を削除し、処理した件数を返す (削除待ちが無ければ 0)。"""
+        rows = await self.db.pending_unlinks(self.batch_size)
+        if not rows:
+            return 0
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="reaper"
+            )
+        loop = asyncio.get_running_loop()
+        paths = [r["path"] for r in rows]
+        step = -(-len(paths) // self.workers)
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(self._executor, unlink_paths, paths[i:i + step])
+                for i in range(0, len(paths), step)
+            )
+        )
+        await self.db.finish_unlinks([r["id"] for r in rows])
+        return len(rows)
+
+    async def drain(self) -> int:
+        """削除待ちが無くなるまで回収し、合計件数を返す。"""
+        total = 0
+        while True:
+            done = await self.drain_batch()
+            if not done:
+                return total
+            total += done
+            if self.notify is not None:
+                remaining = await self.db.count_pending_unlinks()
+                try:
+                    await self.notify(
+                        {"action": "delete_progress", "done": total, "remaining": remaining}
+                    )
+                except Exception as e:
+                    log.debug("delete progress notify failed: %s", e)
+
+    async def run(self) -> None:
+        while True:
+            # 回収中に積まれた分は wake() で次の周回に拾う
+            self._wake.clear()
+            try:
+                removed = await self.drain()
+                if removed:
+                    log.info("removed %d deleted blobs", removed)
+            except Exception as e:
+                log.warning("blob reaper failed: %s", e)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
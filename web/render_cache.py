@@ -0,0 +1,62 @@
+"""LRU cache of rendered partial HTML validated by ETag.
+
+WebSocket の "reload" が届くと全クライアントが同時に ``/partial/files`` を取りに来る。
+描画結果を (ユーザー, フォルダ, ページ…) ごとに保持し、フォルダの更新カウンタから
+作った ETag が変わっていなければ再描画せずに返す。
+"""
+
+from __future__ import annotations
+
+import hashlib
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+
+def make_etag(version: int, *parts: object) -> str:
+    """更新カウンタと描画に影響する値から弱い ETag を作る。"""
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()[:12]
+    return f'W/"{version}-{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """``If-None-Match`` に ``etag`` が含まれるか (弱い比較)。"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for cand in if_none_match.split(","):
+        cand = cand.strip()
+        if cand.startswith("W/"):
+            cand = cand[2:]
+        if cand == bare:
+            return True
+    return False
+
+
+class RenderCache:
+    """描画済み HTML の LRU。各エントリは描画時の ETag と一致する間だけ有効。"""
+
+    def __init__(self, max_entries: int = 512) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[Hashable, tuple[str, str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, etag: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != etag:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, etag: str, html: str) -> None:
+        self._entries[key] = (etag, html)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -134,6 +134,267 @@ let progWrap = null;
 let progBar  = null;
 let userList = [];
 
+// ―― JSON 一覧 (/api/files) と IndexedDB キャッシュ ――
+// スマホ版はフォルダ一覧を JSON で受け取り、ここで描画する。
+// 取得結果は ETag ごと IndexedDB に保存し、次回はまず手元のデータで即座に描画してから
+// If-None-Match で再検証する。変わった行だけ DOM を差し替える。
+const LISTING_DB    = "wds-listing";
+const LISTING_STORE = "folders";
+let listingDbPromise = null;
+
+function openListingDb() {
+  if (!("indexedDB" in window)) return Promise.resolve(null);
+  if (!listingDbPromise) {
+    listingDbPromise = new Promise(resolve => {
+      const req = indexedDB.open(LISTING_DB, 1);
+      req.onupgradeneeded = () => req.result.createObjectStore(LISTING_STORE);
+      req.onsuccess = () => resolve(req.result);
+      req.onerror   = () => resolve(null);
+    });
+  }
+  return listingDbPromise;
+}
+
+async function listingCacheGet(key) {
+  const db = await openListingDb();
+  if (!db) return null;
+  return new Promise(resolve => {
+    const req = db.transaction(LISTING_STORE).objectStore(LISTING_STORE).get(key);
+    req.onsuccess = () => resolve(req.result || null);
+    req.onerror   = () => resolve(null);
+  });
+}
+
+async function listingCachePut(key, record) {
+  const db = await openListingDb();
+  if (!db) return;
+  db.transaction(LISTING_STORE, "readwrite").objectStore(LISTING_STORE).put(record, key);
+}
+
+function escapeHtml(s) {
+  return String(s ?? "").replace(/[&<>"']/g, c => ({
+    "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"
+  })[c]);
+}
+
+function humanSize(size) {
+  const units = ["B", "KB", "MB", "GB", "TB", "PB"];
+  let n = Number(size) || 0;
+  for (const unit of units) {
+    if (n < 1024 || unit === units[units.length - 1]) {
+      return unit === "B" ? `${Math.trunc(n)} B` : `${n.toFixed(1)} ${unit}`;
+    }
+    n /= 1024;
+  }
+}
+
+// mobile/partials/file_cards.html と同じマークアップ
+function fileCardHtml(f) {
+  const id   = escapeHtml(f.id);
+  const name = escapeHtml(f.name);
+  const now  = Math.floor(Date.now() / 1000);
+  const remaining = f.expires_at ? Math.max(0, f.expires_at - now) : 0;
+  const shared = !!f.share_url;
+  let media;
+  if (f.mime.startsWith("image/")) {
+    media = `<img src="${escapeHtml(f.preview_url)}" class="rounded lazy-preview" onerror="previewError(this)">`;
+  } else if (f.mime.startsWith("video/")) {
+    media = `<video src="${escapeHtml(f.preview_url)}" preload="metadata" class="rounded lazy-preview" muted autoplay loop playsinline></video>`;
+  } else {
+    media = `<i class="bi ${escapeHtml(f.icon)} fs-3 text-secondary"></i>`;
+  }
+  const option = (v, label) =>
+    `<option value="${v}" ${remaining === v ? "selected" : ""}>${label}</option>`;
+  return `<div class="card file-card" data-row-id="${id}"><div class="card-body">
+    ${media}
+    <div class="file-name small" data-file-id="${id}" title="${name}">${name}</div>
+    <div class="text-muted small">${humanSize(f.size)}</div>
+    <div class="file-actions">
+      <a href="${escapeHtml(f.url)}" class="btn btn-sm btn-outline-primary" target="_blank" rel="noopener"><i class="bi bi-download"></i> ダウンロード</a>
+      <button class="btn btn-sm btn-outline-secondary send-btn" data-file-id="${id}"><i class="bi bi-send"></i> 送信</button>
+      <button class="btn btn-sm btn-outline-secondary rename-btn" data-file-id="${id}" data-current="${name}"><i class="bi bi-pencil-square"></i> 名前変更</button>
+      <form method="post" action="/delete/${id}" class="d-inline-block delete-form">
+        <input type="hidden" name="csrf_token" value="${escapeHtml(getCsrfToken())}">
+        <button type="submit" class="btn btn-sm btn-outline-danger"><i class="bi bi-trash"></i> 削除</button>
+      </form>
+    </div>
+    <select class="form-select form-select-sm expiration-select" data-file-id="${id}">
+      ${option(86400, "1日")}${option(604800, "1週間")}${option(2592000, "1か月")}${option(0, "無期限")}
+    </select>
+    <span class="badge shared-toggle ${shared ? "bg-success" : "bg-secondary"}" data-file-id="${id}" data-url="/toggle_shared/${id}" data-shared="${shared ? "1" : "0"}">
+      <i class="bi bi-link-45deg me-1"></i>${shared ? "共有中" : "非共有"}
+    </span>
+    <div id="sharebox-${id}">
+      ${shared
+        ? `<div class="input-group input-group-sm"><input id="link-${id}" type="text" class="form-control" readonly value="${escapeHtml(f.share_url)}"><button class="btn btn-outline-secondary btn-sm" onclick="copyLink('${id}')"><i class="bi bi-clipboard"></i> コピー</button></div>`
+        : `<span class="text-muted">非共有</span>`}
+    </div>
+    <input type="text" class="form-control form-control-sm tag-input" data-file-id="${id}" value="${escapeHtml(f.tags)}">
+    <div class="expiration-cell text-center" data-file-id="${id}" data-expiration="${shared ? remaining : 0}">
+      <small class="text-muted">${shared ? formatExpiration(remaining) : "-"}</small>
+    </div>
+  </div></div>`;
+}
+
+function folderListHtml(folders, folderId) {
+  if (!folders || !folders.length) return "";
+  const csrf = escapeHtml(getCsrfToken());
+  const items = folders.map(f => `
+    <div class="list-group-item d-flex justify-content-between align-items-center">
+      <a href="/mobile?folder=${f.id}" class="flex-grow-1 text-decoration-none">
+        <i class="bi bi-folder-fill me-2"></i>${escapeHtml(f.name)}
+      </a>
+      <form method="post" action="/delete_folder/${f.id}" class="delete-form" onsubmit="return confirm('削除しますか？');">
+        <input type="hidden" name="csrf_token" value="${csrf}">
+        <button type="submit" class="btn btn-sm btn-outline-danger">削除</button>
+      </form>
+    </div>`).join("");
+  return `<div class="list-group mb-3">${items}</div>
+    <form method="post" action="/delete_subfolders" class="mb-3 delete-form" onsubmit="return confirm('本当に全て削除しますか？');">
+      <input type="hidden" name="csrf_token" value="${csrf}">
+      <input type="hidden" name="parent_id" value="${escapeHtml(folderId)}">
+      <button class="btn btn-danger btn-sm w-100">サブフォルダ全削除</button>
+    </form>`;
+}
+
+// 行 id ごとに内容が同じカードは DOM をそのまま残し、変わった行だけ作り直す
+function renderListing(container, folderBlock, data) {
+  if (!data.files.length) {
+    container.innerHTML = '<p class="text-center text-muted">ファイルはありません。</p>';
+  } else {
+    let grid = container.querySelector(":scope > .d-grid");
+    if (!grid) {
+      container.innerHTML = '<div class="d-grid gap-2"></div>';
+      grid = container.firstElementChild;
+    }
+    const existing = new Map();
+    grid.querySelectorAll(":scope > .file-card").forEach(card => {
+      existing.set(card.dataset.rowId || card.querySelector(".file-name")?.dataset.fileId, card);
+    });
+    const tpl = document.createElement("template");
+    data.files.forEach(f => {
+      const sig = JSON.stringify([f.name, f.size, f.tags, f.share_url, f.expires_at, f.preview_url]);
+      let card = existing.get(f.id);
+      existing.delete(f.id);
+      if (!card || card.dataset.sig !== sig) {
+        tpl.innerHTML = fileCardHtml(f).trim();
+        card = tpl.content.firstElementChild;
+        card.dataset.sig = sig;
+      }
+      grid.appendChild(card);
+    });
+    existing.forEach(card => card.remove());
+    // 2 ページ目以降は JSON のカーソルで追加読み込みする
+    container.querySelector(":scope > nav, :scope > .load-more")?.remove();
+    renderListingTail(container, data);
+  }
+  if (folderBlock && data.folders) {
+    folderBlock.innerHTML = folderListHtml(data.folders, data.folder);
+  }
+}
+
+async function loadMoreListing(container, data, button) {
+  button.disabled = true;
+  const params = new URLSearchParams({ folder: data.folder, cursor: data.next_cursor });
+  try {
+    const res = await fetch(`/api/files?${params}`, { credentials: "same-origin" });
+    if (!res.ok) throw new Error("HTTP " + res.status);
+    const page = await res.json();
+    const grid = container.querySelector(":scope > .d-grid");
+    const tpl  = document.createElement("template");
+    tpl.innerHTML = page.files.map(fileCardHtml).join("");
+    grid.append(tpl.content);
+    button.remove();
+    renderListingTail(container, { ...data, next_cursor: page.next_cursor });
+    startExpirationCountdowns();
+    initLazyPreview(container);
+  } catch (err) {
+    console.error("追加読み込み失敗", err);
+    button.disabled = false;
+  }
+}
+
+function renderListingTail(container, data) {
+  if (!data.next_cursor) return;
+  const more = document.createElement("button");
+  more.className = "btn btn-outline-secondary btn-sm w-100 mt-3 load-more";
+  more.textContent = "さらに表示";
+  more.addEventListener("click", () => loadMoreListing(container, data, more));
+  container.appendChild(more);
+}
+
+async function reloadListingJson(container, folderBlock, folderId) {
+  const key    = folderId || "";
+  const cached = await listingCacheGet(key);
+  // 別フォルダから移ってきたときは、まず手元のデータで即座に描画する
+  if (cached && container.dataset.listingFolder !== key) {
+    renderListing(container, folderBlock, cached.data);
+  }
+  container.dataset.listingFolder = key;
+  const headers = cached ? { "If-None-Match": cached.etag } : {};
+  let res;
+  try {
+    res = await fetch(`/api/files?folder=${encodeURIComponent(key)}`,
+                      { credentials: "same-origin", headers });
+  } catch (err) {
+    if (cached) return;  // オフライン時はキャッシュの表示のまま
+    throw err;
+  }
+  if (res.status === 304 && cached) return;
+  if (!res.ok) throw new Error("一覧取得失敗: HTTP " + res.status);
+  const data = await res.json();
+  renderListing(container, folderBlock, data);
+  const etag = res.headers.get("ETag");
+  if (etag) await listingCachePut(key, { etag, data });
+}
+
+function usesJsonListing() {
+  const fldInput = document.querySelector('input[name="folder_id"]');
+  return window.IS_MOBILE === true && fldInput?.dataset.shared !== "1" &&
+         !!document.getElementById("subfolderList");
+}
+
+// スマホ版の検索はフォルダをまたいでファイル名で引く (オフライン時は SW のカタログから)
+let listingSearchTimer = null;
+function searchListingJson(term) {
+  const container = document.getElementById("fileListContainer");
+  if (!container || !usesJsonListing()) return;
+  clearTimeout(listingSearchTimer);
+  listingSearchTimer = setTimeout(async () => {
+    if (term.length < 2) {
+      if (container.dataset.listingSearch) {
+        delete container.dataset.listingSearch;
+        reloadFileList();
+      }
+      return;
+    }
+    try {
+      const res = await fetch(`/api/files?q=${encodeURIComponent(term)}`,
+                              { credentials: "same-origin" });
+      if (!res.ok) return;
+      container.dataset.listingSearch = term;
+      // 検索をやめたときにフォルダの一覧を描き直させる
+      delete container.dataset.listingFolder;
+      renderListing(container, null, await res.json());
+      startExpirationCountdowns();
+      initLazyPreview(container);
+    } catch (err) {
+      console.error("検索失敗", err);
+    }
+  }, 300);
+}
+
+// オフライン時に SW が別フォルダのページを返した場合は、URL のフォルダを描き直す
+window.addEventListener("DOMContentLoaded", () => {
+  if (!usesJsonListing()) return;
+  const folder = new URLSearchParams(location.search).get("folder") || "";
+  const inputs = document.querySelectorAll('input[name="folder_id"], input[name="parent_id"]');
+  if (inputs.length && inputs[0].value !== folder) {
+    inputs.forEach(el => { el.value = folder; });
+    reloadFileList();
+  }
+});
+
 // ―― ファイル一覧を再描画 ――
 async function reloadFileList() {
   const container   = document.getElementById("fileListContainer");
@@ -152,20 +413,26 @@ async function reloadFileList() {
                        : `/partial/files${folderId ? '?folder=' + folderId : ''}`;
 
   try {
-    const res  = await fetch(url, { credentials: "same-origin" });
-    if (!res.ok) throw new Error("一覧取得失敗: HTTP " + res.status);
-
-    const html = await res.text();
-    if (url.startsWith('/partial/files')) {
-      container.innerHTML = html;
+    // SW のカタログにも差分を取り込ませる
+    navigator.serviceWorker?.controller?.postMessage({ action: "syncCatalog" });
+    if (usesJsonListing()) {
+      await reloadListingJson(container, folderBlock, folderId);
     } else {
-      const parser  = new DOMParser();
-      const doc     = parser.parseFromString(html, "text/html");
-      const newCont = doc.getElementById("fileListContainer");
-      container.innerHTML = newCont ? newCont.innerHTML : html;
-      if (folderBlock) {
-        const newFolders = doc.getElementById("subfolderList");
-        folderBlock.innerHTML = newFolders ? newFolders.innerHTML : "";
+      const res  = await fetch(url, { credentials: "same-origin" });
+      if (!res.ok) throw new Error("一覧取得失敗: HTTP " + res.status);
+
+      const html = await res.text();
+      if (url.startsWith('/partial/files')) {
+        container.innerHTML = html;
+      } else {
+        const parser  = new DOMParser();
+        const doc     = parser.parseFromString(html, "text/html");
+        const newCont = doc.getElementById("fileListContainer");
+        container.innerHTML = newCont ? newCont.innerHTML : html;
+        if (folderBlock) {
+          const newFolders = doc.getElementById("subfolderList");
+          folderBlock.innerHTML = newFolders ? newFolders.innerHTML : "";
+        }
       }
     }
 
@@ -254,10 +521,11 @@ function bindUploadArea() {
       const reqUrl   = isShared ? "/shared/upload" : "/upload";
 
       // FormData を一回だけ作る
+      // サーバーは受信しながら保存先の容量を確かめるので、folder_id を先に送る
       const formData = new FormData();
-      files.forEach(f => formData.append("file", f));
       if (folderId) formData.append("folder_id", folderId);
       formData.append("csrf_token", getCsrfToken());
+      files.forEach(f => formData.append("file", f));
 
       try {
         await uploadWithProgress(reqUrl, formData);    // ★ 置き換え
@@ -522,6 +790,10 @@ function uploadWithProgress(url, formData) {
       }
       if (xhr.status >= 200 && xhr.status < 300) {
         resolve();
+      } else if (xhr.status === 413 || xhr.status === 507) {
+        reject(new Error(xhr.status === 507
+          ? "サーバーの空き容量が不足しています"
+          : "保存容量の上限を超えています"));
       } else {
         reject(new Error(xhr.responseText || xhr.status));
       }
@@ -666,6 +938,7 @@ document.addEventListener("click", async (e) => {
 document.addEventListener("input", e => {
     if (e.target.id === "fileSearch") {
       filterTable(e.target.value.toLowerCase());
+      searchListingJson(e.target.value.trim());
     }
   });
 
@@ -779,6 +1052,26 @@ if (sendExecBtn) {
 
 let ws;
 let wsSkipReload = false;
+
+// 削除したファイルの実体は裏で順に消えるので、残り件数を画面の隅に出す
+function showDeleteProgress(data) {
+  let el = document.getElementById('deleteProgress');
+  if (!el) {
+    el = document.createElement('div');
+    el.id = 'deleteProgress';
+    el.className = 'alert alert-secondary position-fixed bottom-0 start-0 m-3 py-2 small';
+    el.setAttribute('role', 'status');
+    document.body.appendChild(el);
+  }
+  if (data.remaining > 0) {
+    el.textContent = `ファイルを削除中… ${data.done} 件完了 / 残り ${data.remaining} 件`;
+    el.hidden = false;
+  } else {
+    el.textContent = `${data.done} 件のファイルを削除しました`;
+    setTimeout(() => { el.hidden = true; }, 3000);
+  }
+}
+
 function connectWs() {
   if (ws) return;
   const proto = location.protocol === 'https:' ? 'wss' : 'ws';
@@ -791,6 +1084,8 @@ function connectWs() {
           reloadFileList();
         }
         wsSkipReload = false;
+      } else if (data.action === 'delete_progress') {
+        showDeleteProgress(data);
       } else if (
         data.action === 'qr_login' &&
         typeof qTok !== 'undefined' &&
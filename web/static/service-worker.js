@@ -1,4 +1,4 @@
-const CACHE_VERSION = 'v4';
+const CACHE_VERSION = 'v5';
 const CACHE_NAME = `wds-cache-${CACHE_VERSION}`;
 const OFFLINE_PAGE = '/offline';
 const OFFLINE_URLS = [
@@ -35,7 +35,7 @@ self.addEventListener('activate', (event) => {
   event.waitUntil(
     caches.keys().then(keys => Promise.all(
       keys.filter(k => k !== CACHE_NAME).map(k => caches.delete(k))
-    ))
+    )).then(() => syncCatalog())
   );
   self.clients.claim();
 });
@@ -62,6 +62,12 @@ self.addEventListener('fetch', (event) => {
     return;
   }
 
+  // ハッシュ名のアセットは内容が変わらないので、キャッシュがあれば通信しない
+  if (url.pathname.startsWith('/assets/')) {
+    event.respondWith(cacheFirst(request));
+    return;
+  }
+
   if (url.pathname.startsWith('/static/')) {
     event.respondWith(staleWhileRevalidate(request));
     return;
@@ -75,6 +81,13 @@ self.addEventListener('fetch', (event) => {
     return;
   }
 
+  // ファイル一覧 JSON は通信が遅い・切れているときカタログから返す
+  if (url.pathname === '/api/files' && request.method === 'GET') {
+    event.respondWith(catalogFallback(request, url));
+    event.waitUntil(syncCatalog());
+    return;
+  }
+
   // それ以外の API や部分 HTML などは新しい内容を優先
   event.respondWith(networkFirst(request));
 });
@@ -112,6 +125,11 @@ async function handleNavigate(request) {
     }
     return res;
   } catch (_) {
+    // 未訪問のフォルダでも、スマホ版の画面があればカタログから一覧を描ける
+    if (new URL(request.url).pathname === '/mobile') {
+      const shell = await cache.match('/mobile', { ignoreSearch: true });
+      if (shell) return shell;
+    }
     return caches.match(OFFLINE_PAGE);
   }
 }
@@ -128,6 +146,19 @@ async function staleWhileRevalidate(request) {
   return cached || fetchPromise;
 }
 
+async function cacheFirst(request) {
+  const cache = await caches.open(CACHE_NAME);
+  const cached = await cache.match(request);
+  if (cached) {
+    return cached;
+  }
+  const res = await fetch(request);
+  if (res.ok) {
+    cache.put(request, res.clone());
+  }
+  return res;
+}
+
 async function networkFirst(request) {
   if (request.method !== 'GET') {
     // POST などはキャッシュできないためそのままフェッチする
@@ -195,6 +226,180 @@ self.addEventListener('message', event => {
   if (event.data && event.data.action === 'clearCache') {
     event.waitUntil(
       caches.keys().then(keys => Promise.all(keys.map(k => caches.delete(k))))
+        .then(() => clearCatalog())
     );
   }
+  if (event.data && event.data.action === 'syncCatalog') {
+    event.waitUntil(syncCatalog(true));
+  }
 });
+
+/*──────────────────────
+  ファイルカタログ (IndexedDB)
+  /api/changes?since=<seq> で差分だけを取り込み、ファイルとフォルダの
+  メタデータを手元に複製しておく。オフラインや応答が遅いときは
+  /api/files をここから組み立てて返す。
+──────────────────────*/
+const CATALOG_DB = 'wds-catalog';
+const CATALOG_TIMEOUT_MS = 3000;
+const CATALOG_MIN_INTERVAL_MS = 15000;
+const PREVIEW_PREFETCH = 30;
+let catalogDbPromise = null;
+let catalogSyncing = null;
+let catalogSyncedAt = 0;
+
+function openCatalog() {
+  if (!catalogDbPromise) {
+    catalogDbPromise = new Promise((resolve, reject) => {
+      const req = indexedDB.open(CATALOG_DB, 1);
+      req.onupgradeneeded = () => {
+        const db = req.result;
+        db.createObjectStore('files', { keyPath: 'id' }).createIndex('folder', 'folder');
+        db.createObjectStore('folders', { keyPath: 'id' });
+        db.createObjectStore('meta');
+      };
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => { catalogDbPromise = null; reject(req.error); };
+    });
+  }
+  return catalogDbPromise;
+}
+
+function idbRequest(req) {
+  return new Promise((resolve, reject) => {
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+function idbDone(tx) {
+  return new Promise((resolve, reject) => {
+    tx.oncomplete = () => resolve();
+    tx.onerror = tx.onabort = () => reject(tx.error);
+  });
+}
+
+async function clearCatalog() {
+  const db = await openCatalog();
+  const tx = db.transaction(['files', 'folders', 'meta'], 'readwrite');
+  ['files', 'folders', 'meta'].forEach(name => tx.objectStore(name).clear());
+  await idbDone(tx);
+}
+
+async function applyChanges(db, data) {
+  const tx = db.transaction(['files', 'folders', 'meta'], 'readwrite');
+  const files = tx.objectStore('files');
+  const folders = tx.objectStore('folders');
+  const meta = tx.objectStore('meta');
+  if (data.reset) {
+    files.clear();
+    folders.clear();
+  }
+  data.files.forEach(f => files.put(f));
+  data.deleted_files.forEach(id => files.delete(id));
+  data.folders.forEach(f => folders.put(f));
+  data.deleted_folders.forEach(id => folders.delete(id));
+  meta.put(data.seq, 'since');
+  meta.put(data.user, 'user');
+  await idbDone(tx);
+}
+
+// 新しく届いたサムネイルを先読みしておき、オフラインでもプレビューを出せるようにする
+async function prefetchPreviews(files) {
+  const cache = await caches.open(CACHE_NAME);
+  const urls = files
+    .map(f => f.preview_url)
+    .filter(u => u && u.startsWith('/previews/'))
+    .slice(0, PREVIEW_PREFETCH);
+  await Promise.all(urls.map(async u => {
+    if (await cache.match(u)) return;
+    try {
+      const res = await fetch(u, { credentials: 'same-origin' });
+      if (res.ok) await cache.put(u, res);
+    } catch (_) {}
+  }));
+}
+
+async function runSync() {
+  const db = await openCatalog();
+  const meta = db.transaction('meta').objectStore('meta');
+  // since が無ければ全件を取り込む
+  let since = await idbRequest(meta.get('since'));
+  const user = await idbRequest(meta.get('user'));
+  for (;;) {
+    const url = since === undefined ? '/api/changes' : `/api/changes?since=${since}`;
+    const res = await fetch(url, { credentials: 'same-origin' });
+    if (!res.ok) return;  // 未ログインなど
+    const data = await res.json();
+    if (user !== undefined && data.user !== user && !data.reset) {
+      // 別のユーザーでログインし直した。手元の複製を捨てて取り直す
+      await clearCatalog();
+      since = undefined;
+      continue;
+    }
+    await applyChanges(db, data);
+    prefetchPreviews(data.files);
+    since = data.seq;
+    if (!data.more) return;
+  }
+}
+
+function syncCatalog(force = false) {
+  if (catalogSyncing) return catalogSyncing;
+  if (!force && Date.now() - catalogSyncedAt < CATALOG_MIN_INTERVAL_MS) {
+    return Promise.resolve();
+  }
+  catalogSyncedAt = Date.now();
+  catalogSyncing = runSync()
+    .catch(() => {})
+    .finally(() => { catalogSyncing = null; });
+  return catalogSyncing;
+}
+
+async function catalogListing(url) {
+  const db = await openCatalog();
+  const meta = db.transaction('meta').objectStore('meta');
+  if ((await idbRequest(meta.get('since'))) === undefined) return null;  // まだ一度も同期していない
+  const params = url.searchParams;
+  const folder = params.get('folder') || '';
+  const q = (params.get('q') || '').trim().toLowerCase();
+  const tx = db.transaction(['files', 'folders']);
+  let files = q
+    ? (await idbRequest(tx.objectStore('files').getAll()))
+        .filter(f => f.name.toLowerCase().includes(q))
+    : await idbRequest(tx.objectStore('files').index('folder').getAll(folder));
+  files.sort((a, b) =>
+    a.uploaded_at === b.uploaded_at
+      ? (a.id < b.id ? 1 : -1)
+      : (a.uploaded_at < b.uploaded_at ? 1 : -1));
+  const fields = params.get('fields');
+  if (fields) {
+    const keep = new Set(['id', ...fields.split(',').map(f => f.trim())]);
+    files = files.map(f => Object.fromEntries(Object.entries(f).filter(([k]) => keep.has(k))));
+  }
+  const body = { folder, version: null, files, next_cursor: null };
+  if (!q) {
+    const parent = folder ? Number(folder) : null;
+    body.folders = (await idbRequest(tx.objectStore('folders').getAll()))
+      .filter(f => f.parent_id === parent)
+      .sort((a, b) => a.name.localeCompare(b.name))
+      .map(({ id, name }) => ({ id, name }));
+  }
+  return new Response(JSON.stringify(body), {
+    headers: { 'Content-Type': 'application/json', 'X-Catalog': 'offline' }
+  });
+}
+
+async function catalogFallback(request, url) {
+  const network = fetch(request);
+  const timeout = new Promise(resolve => setTimeout(resolve, CATALOG_TIMEOUT_MS, null));
+  try {
+    const res = await Promise.race([network, timeout]);
+    if (res) return res;
+  } catch (_) {}
+  try {
+    const local = await catalogListing(url);
+    if (local) return local;
+  } catch (_) {}
+  return network;
+}
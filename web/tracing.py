@@ -0,0 +1,330 @@
+"""Lightweight request tracing.
+
+リクエストごとにルートスパンを開き、その中で行われた DB 呼び出し・ファイル I/O・
+外部コマンド・外部 HTTP をスパンとして記録する。現在のスパンは ``contextvars`` で
+持つので、``asyncio.to_thread`` で動く処理や ``await`` をまたいでも親子関係が保たれる。
+
+トレースは開始時に ``sample_rate`` の割合で選び、選ばれなかったリクエストでは
+スパンの API は何もしない。終わったトレースは直近の分をメモリに残し (管理画面の
+「遅いリクエスト」用)、設定されていれば JSON Lines ファイルか OTLP/HTTP の
+コレクタへまとめて書き出す。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import aiohttp
+from aiohttp import web
+
+from web.metrics import route_label
+
+log = logging.getLogger("web")
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "root", "done", "dropped")
+
+    def __init__(self) -> None:
+        self.trace_id = os.urandom(16).hex()
+        self.spans: list[Span] = []
+        self.root: Optional[Span] = None
+        self.done = False
+        self.dropped = 0
+
+    @property
+    def duration_ms(self) -> float:
+        return self.root.duration_ms if self.root else 0.0
+
+    def to_dict(self) -> dict:
+        root = self.root
+        return {
+            "trace_id": self.trace_id,
+            "name": root.name,
+            "start": root.start_ns / 1e9,
+            "duration_ms": round(root.duration_ms, 3),
+            "attributes": root.attributes,
+            "dropped_spans": self.dropped,
+            "spans": [
+                {
+                    "name": s.name,
+                    "span_id": s.span_id,
+                    "parent_id": s.parent_id,
+                    "offset_ms": round((s.start_ns - root.start_ns) / 1e6, 3),
+                    "duration_ms": round(s.duration_ms, 3),
+                    "attributes": s.attributes,
+                    "error": s.error,
+                }
+                for s in sorted(self.spans, key=lambda s: s.start_ns)
+                if s is not root
+            ],
+        }
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: Optional[dict]) -> None:
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = "internal"
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = dict(attributes) if attributes else {}
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        return max(0, (self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("wds_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+class Tracer:
+    """スパンを作り、終わったトレースを保持・書き出す。
+
+    ``exporter`` は ``async export(traces)`` を持つもの (``JsonFileExporter`` /
+    ``OtlpExporter``)。書き出しは :meth:`run` が ``interval`` 秒ごとにまとめて行う。
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 0.0,
+        exporter=None,
+        keep: int = 200,
+        max_spans: int = 500,
+        interval: float = 5.0,
+    ) -> None:
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.recent: deque = deque(maxlen=max(1, keep))
+        self.max_spans = max_spans
+        self.interval = interval
+        self.pending: list[Trace] = []
+
+    def _open(self, trace: Trace, parent_id: Optional[str], name: str, attributes: Optional[dict]) -> Optional[Span]:
+        if len(trace.spans) >= self.max_spans:
+            trace.dropped += 1
+            return None
+        span = Span(trace, name, parent_id, attributes)
+        trace.spans.append(span)  # スレッドからでも list.append は一度に行われる
+        return span
+
+    @contextmanager
+    def start_trace(self, name: str, attributes: Optional[dict] = None, kind: str = "internal") -> Iterator[Optional[Span]]:
+        """新しいトレースのルートスパン。選ばれなければ ``None`` (中のスパンも記録しない)。"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            token = _current.set(None)
+            try:
+                yield None
+            finally:
+                _current.reset(token)
+            return
+        trace = Trace()
+        span = trace.root = self._open(trace, None, name, attributes)
+        span.kind = kind
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            _current.reset(token)
+            span.end_ns = time.time_ns()
+            trace.done = True
+            self.recent.append(trace)
+            if self.exporter is not None:
+                self.pending.append(trace)
+
+    @contextmanager
+    def span(self, name: str, attributes: Optional[dict] = None) -> Iterator[Optional[Span]]:
+        """現在のスパンの子を開く。トレースの外や、終わったトレースの中では何もしない。"""
+        parent = _current.get()
+        if parent is None or parent.trace.done:
+            yield None
+            return
+        span = self._open(parent.trace, parent.span_id, name, attributes)
+        if span is None:
+            yield None
+            return
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            _current.reset(token)
+            span.end_ns = time.time_ns()
+
+    def record(self, name: str, elapsed: float, attributes: Optional[dict] = None) -> None:
+        """今終わった処理を ``elapsed`` 秒のスパンとして追加する (DB のフックなど)。"""
+        parent = _current.get()
+        if parent is None or parent.trace.done:
+            return
+        span = self._open(parent.trace, parent.span_id, name, attributes)
+        if span is not None:
+            span.end_ns = time.time_ns()
+            span.start_ns = span.end_ns - int(elapsed * 1e9)
+
+    def slowest(self, limit: int = 20) -> list[dict]:
+        """直近のトレースのうち時間のかかったものから ``limit`` 件。"""
+        traces = sorted(self.recent, key=lambda t: t.duration_ms, reverse=True)
+        return [t.to_dict() for t in traces[:limit]]
+
+    def middleware(self):
+        @web.middleware
+        async def tracing_middleware(request: web.Request, handler):
+            route = route_label(request)
+            attrs = {"http.method": request.method, "http.route": route, "http.target": request.path}
+            with self.start_trace(f"{request.method} {route}", attrs, kind="server") as span:
+                try:
+                    response = await handler(request)
+                except web.HTTPException as e:
+                    if span is not None:
+                        span.set("http.status_code", e.status)
+                    raise
+                if span is not None:
+                    span.set("http.status_code", response.status)
+                return response
+
+        return tracing_middleware
+
+    def client_trace_config(self) -> aiohttp.TraceConfig:
+        """``aiohttp.ClientSession(trace_configs=[...])`` に渡すと外部 HTTP をスパンにする。"""
+        config = aiohttp.TraceConfig()
+
+        async def on_start(session, ctx, params):
+            ctx.start = time.perf_counter()
+
+        async def on_end(session, ctx, params):
+            self.record(
+                "http.client",
+                time.perf_counter() - ctx.start,
+                {
+                    "http.method": params.method,
+                    "http.host": params.url.host or "",
+                    "http.status_code": params.response.status,
+                },
+            )
+
+        async def on_exception(session, ctx, params):
+            self.record(
+                "http.client",
+                time.perf_counter() - ctx.start,
+                {"http.method": params.method, "http.host": params.url.host or "", "error": type(params.exception).__name__},
+            )
+
+        config.on_request_start.append(on_start)
+        config.on_request_end.append(on_end)
+        config.on_request_exception.append(on_exception)
+        return config
+
+    async def flush(self) -> None:
+        batch, self.pending = self.pending, []
+        if batch and self.exporter is not None:
+            try:
+                await self.exporter.export(batch)
+            except Exception as e:
+                log.warning("trace export failed (%d traces): %s", len(batch), e)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+
+class JsonFileExporter:
+    """1 トレース 1 行の JSON Lines で追記する。"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+
+    def _write(self, lines: list[str]) -> None:
+        with self.path.open("a", encoding="utf-8") as f:
+            f.write("".join(lines))
+
+    async def export(self, traces: list[Trace]) -> None:
+        lines = [json.dumps(t.to_dict(), ensure_ascii=False, default=str) + "\n" for t in traces]
+        await asyncio.to_thread(self._write, lines)
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+_OTLP_KIND = {"internal": 1, "server": 2, "client": 3}
+
+
+def otlp_payload(traces: list[Trace], service: str = "web_discord_server") -> dict:
+    """OTLP/HTTP JSON (``/v1/traces``) の ``ExportTraceServiceRequest``。"""
+    spans = []
+    for t in traces:
+        for s in t.spans:
+            attrs = [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items()]
+            span = {
+                "traceId": t.trace_id,
+                "spanId": s.span_id,
+                "name": s.name,
+                "kind": _OTLP_KIND.get(s.kind, 1),
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.end_ns or s.start_ns),
+                "attributes": attrs,
+            }
+            if s.parent_id:
+                span["parentSpanId"] = s.parent_id
+            if s.error:
+                span["status"] = {"code": 2, "message": s.error}
+            spans.append(span)
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service}}]},
+                "scopeSpans": [{"scope": {"name": "web.tracing"}, "spans": spans}],
+            }
+        ]
+    }
+
+
+class OtlpExporter:
+    """OTLP/HTTP (JSON) を受け付けるコレクタへ送る。"""
+
+    def __init__(self, endpoint: str, timeout: float = 10.0) -> None:
+        self.endpoint = endpoint
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async def export(self, traces: list[Trace]) -> None:
+        async with aiohttp.ClientSession(timeout=self.timeout) as session:
+            async with session.post(self.endpoint, json=otlp_payload(traces)) as resp:
+                if resp.status >= 300:
+                    raise RuntimeError(f"collector returned {resp.status}")